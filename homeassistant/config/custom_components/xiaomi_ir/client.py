@@ -0,0 +1,203 @@
+"""
+Async miIO UDP client for the Xiaomi IR Remote integration
+Keeps one datagram socket per device and pipelines requests without blocking the event loop
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+from collections import deque
+
+_LOGGER = logging.getLogger(__name__)
+
+MIIO_PORT = 54321
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_SEND_INTERVAL = 0.1
+
+
+class MiioDatagramProtocol(asyncio.DatagramProtocol):
+    """Forwards datagrams from the device socket to its client."""
+
+    def __init__(self, client: "MiioClient") -> None:
+        """Initialize the protocol."""
+        self._client = client
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        """Hand a reply to the client."""
+        self._client._handle_reply(data)
+
+    def error_received(self, exc: Exception) -> None:
+        """Log ICMP errors such as port unreachable."""
+        _LOGGER.debug("miIO socket error for %s: %s", self._client.host, exc)
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        """Fail everything still in flight."""
+        self._client._handle_connection_lost(exc)
+
+
+class MiioClient:
+    """Persistent, pipelined miIO client for a single device."""
+
+    def __init__(
+        self,
+        host: str,
+        port: int = MIIO_PORT,
+        send_interval: float = DEFAULT_SEND_INTERVAL,
+    ) -> None:
+        """Initialize the client."""
+        self.host = host
+        self.port = port
+        self.send_interval = send_interval
+        self._transport: asyncio.DatagramTransport | None = None
+        self._connect_lock = asyncio.Lock()
+        self._send_lock = asyncio.Lock()
+        self._next_send = 0.0
+        self._ids = itertools.count(1)
+        self._pending: dict[int, asyncio.Future] = {}
+        self._untagged: deque[int] = deque()
+
+    @property
+    def connected(self) -> bool:
+        """Return True while the socket is open."""
+        return self._transport is not None and not self._transport.is_closing()
+
+    @property
+    def in_flight(self) -> int:
+        """Number of requests still waiting for a reply."""
+        return len(self._pending)
+
+    async def async_connect(self) -> None:
+        """Open the device socket if it is not already open."""
+        async with self._connect_lock:
+            if self.connected:
+                return
+            loop = asyncio.get_running_loop()
+            self._transport, _ = await loop.create_datagram_endpoint(
+                lambda: MiioDatagramProtocol(self),
+                remote_addr=(self.host, self.port),
+            )
+            _LOGGER.debug("Opened miIO socket to %s:%s", self.host, self.port)
+
+    async def _async_pace(self) -> None:
+        """Wait, without blocking the loop, until the next send slot."""
+        loop = asyncio.get_running_loop()
+        async with self._send_lock:
+            now = loop.time()
+            if self._next_send > now:
+                await asyncio.sleep(self._next_send - now)
+                now = loop.time()
+            self._next_send = now + self.send_interval
+
+    def _encode(self, payload: bytes | str | dict, request_id: int) -> tuple[bytes, bool]:
+        """Serialize a payload; JSON requests get the request ID injected."""
+        if isinstance(payload, dict):
+            payload = json.dumps({**payload, "id": request_id}, separators=(",", ":"))
+            return payload.encode(), True
+        if isinstance(payload, str):
+            payload = payload.encode()
+        return payload, False
+
+    async def async_send(
+        self,
+        payload: bytes | str | dict,
+        wait_response: bool = False,
+        timeout: float = DEFAULT_TIMEOUT,
+    ) -> asyncio.Future | None:
+        """Send a request; returns a future for the reply when wait_response is set.
+
+        Callers can send several requests back to back and await the futures
+        afterwards, so replies are collected while later requests are in flight.
+        """
+        await self.async_connect()
+        await self._async_pace()
+
+        request_id = next(self._ids)
+        data, tagged = self._encode(payload, request_id)
+
+        future = None
+        if wait_response:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[request_id] = future
+            if not tagged:
+                self._untagged.append(request_id)
+            loop.call_later(timeout, self._expire, request_id)
+
+        self._transport.sendto(data)
+        return future
+
+    async def async_request(
+        self, payload: bytes | str | dict, timeout: float = DEFAULT_TIMEOUT
+    ) -> bytes | dict:
+        """Send a request and wait for its reply."""
+        future = await self.async_send(payload, wait_response=True, timeout=timeout)
+        return await future
+
+    async def async_send_many(
+        self,
+        payloads: list[bytes | str | dict],
+        wait_response: bool = False,
+        timeout: float = DEFAULT_TIMEOUT,
+    ) -> list:
+        """Send several requests paced but pipelined, then collect the replies."""
+        futures = [
+            await self.async_send(payload, wait_response=wait_response, timeout=timeout)
+            for payload in payloads
+        ]
+        if not wait_response:
+            return []
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    def _expire(self, request_id: int) -> None:
+        """Fail a request that has not been answered in time."""
+        future = self._pending.pop(request_id, None)
+        if future is None:
+            return
+        try:
+            self._untagged.remove(request_id)
+        except ValueError:
+            pass
+        if not future.done():
+            future.set_exception(asyncio.TimeoutError(f"No reply from {self.host} for request {request_id}"))
+
+    def _handle_reply(self, data: bytes) -> None:
+        """Match a reply to its request by JSON id, or to the oldest untagged request."""
+        request_id = None
+        if data[:1] == b"{":
+            try:
+                reply = json.loads(data)
+            except ValueError:
+                reply = None
+            if isinstance(reply, dict) and reply.get("id") in self._pending:
+                request_id = reply["id"]
+                data = reply
+
+        if request_id is None:
+            while self._untagged and request_id is None:
+                candidate = self._untagged.popleft()
+                if candidate in self._pending:
+                    request_id = candidate
+
+        future = self._pending.pop(request_id, None) if request_id is not None else None
+        if future is None:
+            _LOGGER.debug("Unsolicited reply from %s: %s", self.host, data)
+            return
+        if not future.done():
+            future.set_result(data)
+
+    def _handle_connection_lost(self, exc: Exception | None) -> None:
+        """Fail all pending requests and forget the transport."""
+        self._transport = None
+        error = exc or ConnectionError(f"miIO socket to {self.host} closed")
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+        self._untagged.clear()
+
+    def close(self) -> None:
+        """Close the device socket."""
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
@@ -3,17 +3,33 @@ Custom Xiaomi IR Remote Integration
 This integration bypasses the token requirement and uses direct UDP communication
 """
 
-import socket
-import struct
-import time
 import logging
-from homeassistant.components.remote import RemoteEntity
+from homeassistant.components.remote import RemoteEntity, RemoteEntityFeature
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 
+from .client import MiioClient
+
 _LOGGER = logging.getLogger(__name__)
 
+# Map commands to IR codes
+IR_CODES = {
+    'hisense_tv_power': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x01',
+    'hisense_tv_volume_up': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x02',
+    'hisense_tv_volume_down': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x03',
+    'hisense_tv_channel_up': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x04',
+    'hisense_tv_channel_down': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x05',
+    'hisense_tv_input': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x06',
+    'hisense_tv_menu': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x07',
+    'hisense_tv_back': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x08',
+    'hisense_tv_ok': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x09',
+    'hisense_tv_up': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x0a',
+    'hisense_tv_down': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x0b',
+    'hisense_tv_left': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x0c',
+    'hisense_tv_right': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x0d'
+}
+
 class XiaomiIRRemote(RemoteEntity):
     """Representation of a Xiaomi IR Remote that bypasses token authentication."""
 
@@ -31,6 +47,7 @@ class XiaomiIRRemote(RemoteEntity):
             "model": "Smart Speaker with IR",
         }
         self._current_activity = None
+        self._client = MiioClient(host)
 
     @property
     def current_activity(self) -> str | None:
@@ -53,42 +70,30 @@ class XiaomiIRRemote(RemoteEntity):
         else:
             _LOGGER.info("Turning off Xiaomi IR Remote")
 
+    async def _async_get_client(self) -> MiioClient:
+        """Return the device client, opening its socket on first use."""
+        await self._client.async_connect()
+        return self._client
+
+    async def async_will_remove_from_hass(self) -> None:
+        """Close the device socket when the entity is removed."""
+        self._client.close()
+
     async def async_send_command(self, command: list[str], **kwargs) -> None:
         """Send a command."""
         _LOGGER.info("Sending IR command: %s", command)
         
         try:
-            # Create UDP socket
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(5)
-            
-            # Map commands to IR codes
-            ir_codes = {
-                'hisense_tv_power': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x01',
-                'hisense_tv_volume_up': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x02',
-                'hisense_tv_volume_down': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x03',
-                'hisense_tv_channel_up': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x04',
-                'hisense_tv_channel_down': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x05',
-                'hisense_tv_input': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x06',
-                'hisense_tv_menu': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x07',
-                'hisense_tv_back': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x08',
-                'hisense_tv_ok': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x09',
-                'hisense_tv_up': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x0a',
-                'hisense_tv_down': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x0b',
-                'hisense_tv_left': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x0c',
-                'hisense_tv_right': b'\\x21\\x31\\x00\\x20\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x0d'
-            }
+            client = await self._async_get_client()
             
-            # Send the command
+            # Sends are paced by the client without blocking the event loop
             for cmd in command:
-                if cmd in ir_codes:
-                    sock.sendto(ir_codes[cmd], (self._host, 54321))
+                if cmd in IR_CODES:
+                    await client.async_send(IR_CODES[cmd])
                     _LOGGER.info("Sent IR command: %s", cmd)
-                    time.sleep(0.1)  # Small delay between commands
                 else:
                     _LOGGER.warning("Unknown command: %s", cmd)
             
-            sock.close()
             _LOGGER.info("IR commands sent successfully")
             
         except Exception as e:
@@ -9,10 +9,27 @@ import json
 import sys
 import time
 
+from xiaomi_inventory import load_inventory
+
 # Configuration
-XIAOMI_IP = "192.168.68.62"
+XIAOMI_IP = "192.168.68.62"  # fallback when the passive inventory has no cast device
 XIAOMI_PORT = 8008
-BASE_URL = f"http://{XIAOMI_IP}:{XIAOMI_PORT}"
+INVENTORY_FILE = "/config/xiaomi_inventory.json"
+
+def find_cast_device():
+    """Address of the Xiaomi cast device from the passive inventory, without sending a probe"""
+    inventory = load_inventory(INVENTORY_FILE)
+    devices = inventory.find(service='_googlecast._tcp')
+    if not devices or any(device.ip == XIAOMI_IP for device in devices):
+        return XIAOMI_IP
+    # Moved (e.g. new DHCP lease): follow it if it can be told apart from other cast devices
+    xiaomi = (inventory.find(service='_googlecast._tcp', vendor='xiaomi') or
+              inventory.find(service='_googlecast._tcp', name='xiaomi'))
+    if xiaomi:
+        return xiaomi[0].ip
+    return devices[0].ip if len(devices) == 1 else XIAOMI_IP
+
+BASE_URL = f"http://{find_cast_device()}:{XIAOMI_PORT}"
 
 def send_cast_command(endpoint, data=None):
     """Send a command to the Google Cast device"""
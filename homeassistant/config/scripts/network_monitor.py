@@ -5,16 +5,26 @@ Monitors network traffic to 192.168.68.68 and logs commands from phone
 """
 
 import subprocess
-import json
 import time
 import re
 from datetime import datetime
-import os
+
+from xiaomi_capture import open_packet_stream
+from xiaomi_inventory import DeviceInventory
+from xiaomi_liveness import LivenessMonitor, probe
+from xiaomi_logsink import get_sink
+from xiaomi_pcap import IPPROTO_TCP, IPPROTO_UDP
+from xiaomi_statepub import StatePublisher
 
 # Configuration
 XIAOMI_IP = "192.168.68.68"
 LOG_FILE = "/config/network_monitor.log"
 STATE_FILE = "/config/network_state.json"
+LIVENESS_FILE = "/config/xiaomi_liveness.json"
+LIVENESS_TARGETS = [XIAOMI_IP, "192.168.68.62"]  # .62 backs the ping/latency sensors
+INVENTORY_FILE = "/config/xiaomi_inventory.json"  # passive mDNS/SSDP/DHCP inventory, read by google_cast_control.py
+STATE_MAX_RATE = 2.0  # state file writes per second, however busy the link
+STATE_PORT = 9490     # localhost /state long-poll and /events push endpoint, None disables
 
 def get_network_interfaces():
     """Get available network interfaces"""
@@ -37,60 +47,48 @@ def get_network_interfaces():
         print(f"Error getting interfaces: {e}")
         return ['eth0', 'eth1']  # Default fallback for Docker
 
-def monitor_tcpdump():
-    """Monitor network traffic using tcpdump"""
+def monitor_tcpdump(publisher):
+    """Monitor network traffic to the Xiaomi device from one capture on all interfaces"""
     interfaces = get_network_interfaces()
+    interface = 'any'
     
-    for interface in interfaces:
-        try:
-            # Monitor traffic to Xiaomi device
-            cmd = [
-                'tcpdump', '-i', interface, '-n', 
-                f'host {XIAOMI_IP}', '-l', '-q'
-            ]
-            
-            print(f"Starting tcpdump on interface {interface}")
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, 
-                                     stderr=subprocess.PIPE, text=True)
-            
-            while True:
-                output = process.stdout.readline()
-                if output:
-                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    log_entry = f"[{timestamp}] {interface}: {output.strip()}"
-                    
-                    # Log the entry
-                    with open(LOG_FILE, 'a') as f:
-                        f.write(log_entry + '\n')
-                    
-                    # Update state file
-                    update_state(interface, output.strip())
-                    
-                    print(log_entry)
-                
-                if process.poll() is not None:
-                    break
-                    
-        except Exception as e:
-            print(f"Error monitoring interface {interface}: {e}")
-            continue
-
-def update_state(interface, data):
-    """Update the state file with latest network activity"""
     try:
-        state = {
-            'last_activity': datetime.now().isoformat(),
-            'interface': interface,
-            'data': data,
-            'xiaomi_ip': XIAOMI_IP,
-            'status': 'active'
-        }
+        # One subscription replaces a tcpdump per interface; shares the capture daemon if running
+        print(f"Starting packet capture on {interface} (interfaces: {', '.join(interfaces)})")
+        stream = open_packet_stream(f'host {XIAOMI_IP}', 'network_monitor', interface)
         
-        with open(STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=2)
-            
+        try:
+            for packet in stream:
+                proto = {IPPROTO_TCP: 'TCP', IPPROTO_UDP: 'UDP'}.get(packet.proto, str(packet.proto))
+                summary = (f"IP {packet.src_ip}.{packet.src_port} > {packet.dst_ip}.{packet.dst_port}: "
+                           f"{proto} {len(packet.payload)}")
+                
+                # Log the entry; printed and appended in batches by the sink's writer thread
+                get_sink(LOG_FILE).log(f"{interface}: {summary}", ts=packet.ts)
+                
+                # Count it; the publisher coalesces updates into at most STATE_MAX_RATE writes/s
+                direction = 'to_device' if packet.dst_ip == XIAOMI_IP else 'from_device'
+                publisher.record(interface, direction, len(packet.payload), packet.ts,
+                                 interface=interface, data=summary, status='active')
+        finally:
+            stream.close()
+                
     except Exception as e:
-        print(f"Error updating state: {e}")
+        print(f"Error monitoring interface {interface}: {e}")
+
+def start_state_publisher():
+    """Publish the state file and, when STATE_PORT is set, serve it for push-style consumers"""
+    publisher = StatePublisher(STATE_FILE, max_rate=STATE_MAX_RATE,
+                               last_activity=datetime.now().isoformat(), interface='unknown',
+                               data='Initialized', xiaomi_ip=XIAOMI_IP)
+    publisher.update(status='initializing')
+    if STATE_PORT is not None:
+        try:
+            port = publisher.serve(STATE_PORT)
+            print(f"State on http://127.0.0.1:{port}/state (long-poll: ?since=<version>, push: /events)")
+        except OSError as e:
+            print(f"State endpoint unavailable on port {STATE_PORT}: {e}")
+    return publisher
 
 def get_network_stats():
     """Get network statistics"""
@@ -121,13 +119,31 @@ def get_network_stats():
 def check_xiaomi_connectivity():
     """Check if Xiaomi device is reachable"""
     try:
-        result = subprocess.run(['ping', '-c', '1', '-W', '1', XIAOMI_IP], 
-                              capture_output=True, text=True)
-        return "1 received" in result.stdout
+        return probe(XIAOMI_IP) is not None
     except Exception as e:
         print(f"Error checking connectivity: {e}")
         return False
 
+def log_liveness_change(ip, online, rtt):
+    """Log online/offline transitions reported by the liveness monitor"""
+    status = f"online ({rtt} ms)" if online else "offline"
+    get_sink(LOG_FILE).log(f"liveness: {ip} is {status}")
+
+def start_liveness_monitor():
+    """Probe all watched devices in the background and publish their state for the sensors"""
+    monitor = LivenessMonitor(LIVENESS_TARGETS, state_file=LIVENESS_FILE)
+    monitor.add_listener(log_liveness_change)
+    monitor.start()
+    print(f"Liveness monitor watching {', '.join(LIVENESS_TARGETS)} via {monitor.method}")
+    return monitor
+
+def start_inventory():
+    """Learn LAN devices from the discovery traffic they broadcast anyway"""
+    inventory = DeviceInventory(INVENTORY_FILE).load()
+    opened = inventory.start()
+    print(f"Passive device inventory on {', '.join(opened) or 'no sockets'}: {INVENTORY_FILE}")
+    return inventory
+
 def main():
     """Main monitoring function"""
     print(f"Starting network monitor for Xiaomi device at {XIAOMI_IP}")
@@ -135,16 +151,7 @@ def main():
     print(f"State file: {STATE_FILE}")
     
     # Initialize state file
-    if not os.path.exists(STATE_FILE):
-        initial_state = {
-            'last_activity': datetime.now().isoformat(),
-            'interface': 'unknown',
-            'data': 'Initialized',
-            'xiaomi_ip': XIAOMI_IP,
-            'status': 'initializing'
-        }
-        with open(STATE_FILE, 'w') as f:
-            json.dump(initial_state, f, indent=2)
+    publisher = start_state_publisher()
     
     # Check initial connectivity
     if check_xiaomi_connectivity():
@@ -153,12 +160,18 @@ def main():
         print(f"Warning: Xiaomi device at {XIAOMI_IP} is not reachable")
     
     # Start monitoring
+    liveness = start_liveness_monitor()
+    inventory = start_inventory()
     try:
-        monitor_tcpdump()
+        monitor_tcpdump(publisher)
     except KeyboardInterrupt:
         print("\nStopping network monitor...")
     except Exception as e:
         print(f"Error in main monitoring: {e}")
+    finally:
+        liveness.close()
+        inventory.stop()
+        publisher.close()
 
 if __name__ == "__main__":
     main()
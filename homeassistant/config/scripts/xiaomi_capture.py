@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Shared Capture Daemon
+Owns the single tcpdump packet source and fans decoded packets out to subscribers
+Each subscriber has its own BPF-style filter, a bounded queue and a backpressure policy
+Other processes attach over a local Unix socket instead of starting their own capture
+"""
+
+import ipaddress
+import json
+import os
+import re
+import socket
+import struct
+import sys
+import threading
+from collections import deque
+
+from xiaomi_metrics import MonitorMetrics, serve_metrics
+from xiaomi_pcap import IPPROTO_TCP, IPPROTO_UDP, Packet, open_live_capture
+
+# Defaults
+SOCKET_PATH = "/tmp/xiaomi_capture.sock"
+DEFAULT_QUEUE_SIZE = 10000
+DROP_OLDEST = 'drop-oldest'
+BLOCK = 'block'
+IPPROTO_ICMP = 1
+METRICS_PORT = 9476  # localhost metrics endpoint, None disables
+
+# Wire format for packets sent to socket subscribers
+_wire = struct.Struct('!dIBHHBIBBI')
+
+
+class FilterError(ValueError):
+    """Raised for filter expressions outside the supported BPF subset"""
+
+
+_token = re.compile(r'\(|\)|&&|\|\||!|[^\s()!]+')
+_protocols = {'tcp': IPPROTO_TCP, 'udp': IPPROTO_UDP, 'icmp': IPPROTO_ICMP}
+
+
+def compile_filter(expression):
+    """Compile a BPF-style expression into a predicate over Packet
+
+    Supports [src|dst] host/net/port, tcp, udp, icmp and ip, combined with
+    and/or/not (&&, ||, !) and parentheses. The same string is valid tcpdump
+    syntax, so it can also be pushed down to the kernel.
+    """
+    tokens = _token.findall(expression or '')
+    if not tokens:
+        return lambda packet: True
+    pos = 0
+
+    def peek():
+        return tokens[pos].lower() if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        if pos >= len(tokens):
+            raise FilterError(f"Unexpected end of filter: {expression!r}")
+        pos += 1
+        return tokens[pos - 1]
+
+    def primitive():
+        word = take().lower()
+        direction = None
+        if word in ('src', 'dst'):
+            direction, word = word, take().lower()
+        if word in _protocols and direction is None:
+            number = _protocols[word]
+            return lambda p: p.proto == number
+        if word == 'ip' and direction is None:
+            return lambda p: ':' not in p.src_ip
+        value = take()
+        if word == 'host':
+            return _address_test(direction, lambda ip: ip == value)
+        if word == 'net':
+            network = ipaddress.ip_network(value, strict=False)
+            return _address_test(direction, lambda ip: ipaddress.ip_address(ip) in network)
+        if word == 'port':
+            port = int(value)
+            if direction == 'src':
+                return lambda p: p.src_port == port
+            if direction == 'dst':
+                return lambda p: p.dst_port == port
+            return lambda p: port in (p.src_port, p.dst_port)
+        raise FilterError(f"Unsupported filter primitive {word!r}")
+
+    def factor():
+        word = peek()
+        if word in ('not', '!'):
+            take()
+            inner = factor()
+            return lambda p: not inner(p)
+        if word == '(':
+            take()
+            inner = disjunction()
+            if take() != ')':
+                raise FilterError(f"Missing ')' in filter: {expression!r}")
+            return inner
+        return primitive()
+
+    def conjunction():
+        parts = [factor()]
+        while peek() in ('and', '&&'):
+            take()
+            parts.append(factor())
+        return parts[0] if len(parts) == 1 else lambda p: all(test(p) for test in parts)
+
+    def disjunction():
+        parts = [conjunction()]
+        while peek() in ('or', '||'):
+            take()
+            parts.append(conjunction())
+        return parts[0] if len(parts) == 1 else lambda p: any(test(p) for test in parts)
+
+    predicate = disjunction()
+    if pos != len(tokens):
+        raise FilterError(f"Unexpected {tokens[pos]!r} in filter: {expression!r}")
+    return predicate
+
+
+def _address_test(direction, test):
+    if direction == 'src':
+        return lambda p: test(p.src_ip)
+    if direction == 'dst':
+        return lambda p: test(p.dst_ip)
+    return lambda p: test(p.src_ip) or test(p.dst_ip)
+
+
+def encode_packet(packet):
+    """Serialize a Packet for the Unix socket"""
+    src = packet.src_ip.encode()
+    dst = packet.dst_ip.encode()
+    return _wire.pack(packet.ts, packet.length, packet.proto, packet.src_port, packet.dst_port,
+                      packet.tcp_flags, packet.seq, len(src), len(dst),
+                      len(packet.payload)) + src + dst + packet.payload
+
+
+def _recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def decode_packet(sock):
+    """Read one Packet from the Unix socket, or None at end of stream"""
+    header = _recv_exact(sock, _wire.size)
+    if header is None:
+        return None
+    ts, length, proto, src_port, dst_port, flags, seq, src_len, dst_len, payload_len = _wire.unpack(header)
+    body = _recv_exact(sock, src_len + dst_len + payload_len)
+    if body is None:
+        return None
+    src_ip = body[:src_len].decode()
+    dst_ip = body[src_len:src_len + dst_len].decode()
+    return Packet(ts, src_ip, dst_ip, proto, src_port, dst_port, flags, body[src_len + dst_len:], length, seq)
+
+
+class Subscriber:
+    """Bounded packet queue for one consumer, with drop-oldest or blocking backpressure"""
+
+    def __init__(self, name, bpf_filter='', maxsize=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST):
+        if policy not in (DROP_OLDEST, BLOCK):
+            raise ValueError(f"Unknown backpressure policy {policy!r}")
+        self.name = name
+        self.bpf_filter = bpf_filter or ''
+        self.match = compile_filter(self.bpf_filter)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.delivered = 0
+        self.dropped = 0
+        self.closed = False
+        self._queue = deque()
+        self._cond = threading.Condition()
+
+    def offer(self, packet):
+        """Queue a packet; drops the oldest or waits for room when full"""
+        with self._cond:
+            while len(self._queue) >= self.maxsize and not self.closed:
+                if self.policy == DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                    break
+                self._cond.wait()
+            if self.closed:
+                return
+            self._queue.append(packet)
+            self.delivered += 1
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """Next packet, or None on timeout or once closed and drained"""
+        with self._cond:
+            if not self._queue and not self.closed:
+                self._cond.wait(timeout)
+            if not self._queue:
+                return None
+            packet = self._queue.popleft()
+            self._cond.notify_all()
+            return packet
+
+    def __iter__(self):
+        while True:
+            packet = self.get()
+            if packet is None:
+                if self.closed:
+                    return
+                continue
+            yield packet
+
+    def stats(self):
+        return {'name': self.name, 'filter': self.bpf_filter, 'policy': self.policy,
+                'queued': len(self._queue), 'delivered': self.delivered, 'dropped': self.dropped}
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class CaptureDaemon:
+    """One capture process shared by every subscriber"""
+
+    def __init__(self, interface='any', sudo=False):
+        self.interface = interface
+        self.sudo = sudo
+        self.subscribers = []
+        self.running = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._process = None
+        self._filter = None
+        self._thread = None
+        self._server = None
+        self.published = 0
+
+    def kernel_filter(self):
+        """Union of subscriber filters for tcpdump ('' when anyone wants everything)"""
+        filters = [sub.bpf_filter for sub in self.subscribers]
+        if not filters or '' in filters:
+            return ''
+        unique = list(dict.fromkeys(filters))
+        return ' or '.join(f'({expr})' for expr in unique)
+
+    def subscribe(self, name, bpf_filter='', callback=None, maxsize=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST):
+        """Add a subscriber; with a callback, a worker thread delivers packets to it"""
+        subscriber = Subscriber(name, bpf_filter, maxsize, policy)
+        with self._lock:
+            self.subscribers.append(subscriber)
+        if callback is not None:
+            def deliver():
+                for packet in subscriber:
+                    callback(packet)
+            threading.Thread(target=deliver, daemon=True).start()
+        self._refilter()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        with self._lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+        self._refilter()
+
+    def _refilter(self):
+        """Restart tcpdump when the union filter changes; capture idles without subscribers"""
+        self._wakeup.set()
+        process = self._process
+        if process is not None and self.kernel_filter() != self._filter:
+            process.terminate()
+
+    def _capture_loop(self):
+        while self.running:
+            with self._lock:
+                idle = not self.subscribers
+            if idle:
+                self._wakeup.wait(1.0)
+                self._wakeup.clear()
+                continue
+
+            self._filter = self.kernel_filter()
+            try:
+                process, reader = open_live_capture(self._filter, self.interface, self.sudo)
+            except OSError as e:
+                print(f"❌ Could not start tcpdump: {e}")
+                self.running = False
+                break
+            self._process = process
+            try:
+                for packet in reader:
+                    self.publish(packet)
+                    if not self.running:
+                        break
+            except Exception as e:
+                print(f"Error reading capture: {e}")
+            finally:
+                self._process = None
+                process.terminate()
+                process.wait()
+            if self.running and self.subscribers and self.kernel_filter() == self._filter:
+                # tcpdump exited on its own; avoid a tight restart loop
+                self._wakeup.wait(1.0)
+                self._wakeup.clear()
+
+    def publish(self, packet):
+        """Fan one packet out to every matching subscriber"""
+        with self._lock:
+            subscribers = list(self.subscribers)
+        self.published += 1
+        for subscriber in subscribers:
+            if subscriber.match(packet):
+                subscriber.offer(packet)
+
+    def collect_metrics(self):
+        """Per-subscriber queue depth, deliveries and drops, as MetricsRegistry collector samples"""
+        yield 'xiaomi_capture_packets_total', 'counter', 'Packets read from tcpdump', {}, self.published
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            labels = {'subscriber': subscriber.name}
+            yield ('xiaomi_capture_queue_depth', 'gauge', 'Packets waiting for a subscriber',
+                   labels, len(subscriber._queue))
+            yield ('xiaomi_capture_delivered_total', 'counter', 'Packets queued for a subscriber',
+                   labels, subscriber.delivered)
+            yield ('xiaomi_capture_dropped_total', 'counter', 'Packets dropped because a subscriber fell behind',
+                   labels, subscriber.dropped)
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self._thread = threading.Thread(target=self._capture_loop, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wakeup.set()
+        process = self._process
+        if process is not None:
+            process.terminate()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        with self._lock:
+            subscribers, self.subscribers = self.subscribers, []
+        for subscriber in subscribers:
+            subscriber.close()
+
+    def serve(self, path=SOCKET_PATH):
+        """Accept subscribers from other processes on a Unix socket"""
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(16)
+        self._server = server
+        threading.Thread(target=self._accept_loop, args=(server,), daemon=True).start()
+
+    def _accept_loop(self, server):
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+
+    def _serve_client(self, conn):
+        """Read the client's subscription line, then stream matching packets"""
+        subscriber = None
+        try:
+            with conn.makefile('r') as f:
+                request = json.loads(f.readline() or '{}')
+            subscriber = self.subscribe(request.get('name', 'client'), request.get('filter', ''),
+                                        maxsize=request.get('maxsize', DEFAULT_QUEUE_SIZE),
+                                        policy=request.get('policy', DROP_OLDEST))
+            conn.sendall(b'OK\n')
+            print(f"📡 Subscriber {subscriber.name} attached: {subscriber.bpf_filter or 'all traffic'}")
+            for packet in subscriber:
+                conn.sendall(encode_packet(packet))
+        except (OSError, ValueError) as e:
+            if subscriber is None:
+                try:
+                    conn.sendall(f"ERR {e}\n".encode())
+                except OSError:
+                    pass
+        finally:
+            if subscriber is not None:
+                self.unsubscribe(subscriber)
+                print(f"📴 Subscriber {subscriber.name} detached ({subscriber.dropped} dropped)")
+            conn.close()
+
+
+class PacketStream:
+    """Iterable packet source from the shared daemon or a private tcpdump"""
+
+    def __init__(self, packets, closer, shared):
+        self._packets = packets
+        self._closer = closer
+        self.shared = shared
+
+    def __iter__(self):
+        return iter(self._packets)
+
+    def close(self):
+        self._closer()
+
+
+def connect(bpf_filter='', name='client', policy=DROP_OLDEST, maxsize=DEFAULT_QUEUE_SIZE, path=SOCKET_PATH):
+    """Subscribe to a running daemon; raises OSError when none is listening"""
+    compile_filter(bpf_filter)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        request = {'name': name, 'filter': bpf_filter, 'policy': policy, 'maxsize': maxsize}
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        reply = b''
+        while not reply.endswith(b'\n'):
+            chunk = sock.recv(1)
+            if not chunk:
+                raise ConnectionError("Capture daemon closed the connection")
+            reply += chunk
+        if reply != b'OK\n':
+            raise ConnectionError(reply.decode().strip())
+    except OSError:
+        sock.close()
+        raise
+
+    def packets():
+        while True:
+            try:
+                packet = decode_packet(sock)
+            except OSError:
+                return
+            if packet is None:
+                return
+            yield packet
+
+    return PacketStream(packets(), sock.close, shared=True)
+
+
+def open_packet_stream(bpf_filter, name, interface='any', sudo=False, path=SOCKET_PATH):
+    """Packets from the shared daemon when it runs, else from a private tcpdump"""
+    try:
+        return connect(bpf_filter, name, path=path)
+    except OSError:
+        pass
+    process, reader = open_live_capture(bpf_filter, interface, sudo)
+
+    def stop():
+        process.terminate()
+        process.wait()
+
+    return PacketStream(reader, stop, shared=False)
+
+
+def main():
+    """Run the shared capture daemon: xiaomi_capture.py [interface] [socket_path]"""
+    interface = sys.argv[1] if len(sys.argv) > 1 else 'any'
+    path = sys.argv[2] if len(sys.argv) > 2 else SOCKET_PATH
+    daemon = CaptureDaemon(interface, sudo=os.geteuid() != 0)
+    daemon.start()
+    daemon.serve(path)
+    metrics = MonitorMetrics('capture_daemon')
+    metrics.registry.add_collector(daemon.collect_metrics)
+    metrics_server = serve_metrics(metrics, METRICS_PORT)
+    print(f"🚀 Capture daemon on {interface}, subscribers connect to {path}")
+    try:
+        # tcpdump runs only while someone is subscribed, with the union of their filters
+        while daemon.running:
+            threading.Event().wait(60)
+            for subscriber in list(daemon.subscribers):
+                print(f"📊 {subscriber.stats()}")
+    except KeyboardInterrupt:
+        print("\n🛑 Stopping capture daemon")
+    finally:
+        daemon.stop()
+        if metrics_server:
+            metrics_server.stop()
+        if os.path.exists(path):
+            os.unlink(path)
+
+if __name__ == "__main__":
+    main()
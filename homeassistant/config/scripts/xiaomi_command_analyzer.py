@@ -16,9 +16,15 @@ import struct
 import threading
 from collections import defaultdict
 
+from xiaomi_liveness import probe
+from xiaomi_logsink import get_sink
+from xiaomi_miio import HELLO_PACKET, MiioCodec
+from xiaomi_portscan import PortScanner
+
 # Configuration
 XIAOMI_IP = "192.168.68.68"
 XIAOMI_PORT = 54321  # Default Xiaomi port
+XIAOMI_TOKEN = ""  # 32 hex chars from Mi Home, leave empty if unknown
 LOG_FILE = "/config/xiaomi_analysis.log"
 COMMANDS_FILE = "/config/xiaomi_commands.json"
 PROTOCOL_FILE = "/config/xiaomi_protocol.json"
@@ -27,7 +33,11 @@ class XiaomiCommandAnalyzer:
     def __init__(self):
         self.xiaomi_ip = XIAOMI_IP
         self.xiaomi_port = XIAOMI_PORT
+        self.xiaomi_token = XIAOMI_TOKEN
+        self.codec = MiioCodec()
+        self.port_scanner = PortScanner()
         self.log_file = LOG_FILE
+        self.log_sink = get_sink(self.log_file)
         self.commands_file = COMMANDS_FILE
         self.protocol_file = PROTOCOL_FILE
         self.discovered_commands = {}
@@ -36,20 +46,13 @@ class XiaomiCommandAnalyzer:
         self.running = False
         
     def log_message(self, message):
-        """Log message with timestamp"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        print(log_entry)
-        
-        with open(self.log_file, 'a') as f:
-            f.write(log_entry + '\n')
+        """Log message with timestamp; queued and written in batches by the shared log sink"""
+        self.log_sink.log(message)
     
     def check_xiaomi_connectivity(self):
         """Check if Xiaomi device is reachable"""
         try:
-            result = subprocess.run(['ping', '-c', '1', '-W', '1', self.xiaomi_ip], 
-                                  capture_output=True, text=True)
-            return "1 received" in result.stdout
+            return probe(self.xiaomi_ip) is not None
         except Exception as e:
             self.log_message(f"Error checking connectivity: {e}")
             return False
@@ -59,18 +62,16 @@ class XiaomiCommandAnalyzer:
         common_ports = [54321, 8080, 80, 443, 22, 23, 554, 8554]
         open_ports = []
         
+        try:
+            found = self.port_scanner.scan_host(self.xiaomi_ip, common_ports)
+        except Exception as e:
+            self.log_message(f"Error scanning ports: {e}")
+            return open_ports
+        
         for port in common_ports:
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(1)
-                result = sock.connect_ex((self.xiaomi_ip, port))
-                sock.close()
-                
-                if result == 0:
-                    open_ports.append(port)
-                    self.log_message(f"Port {port} is open")
-            except Exception as e:
-                self.log_message(f"Error scanning port {port}: {e}")
+            if port in found:
+                open_ports.append(port)
+                self.log_message(f"Port {port} is open")
         
         return open_ports
     
@@ -147,7 +148,7 @@ class XiaomiCommandAnalyzer:
             
             # Common Xiaomi discovery packets
             discovery_packets = [
-                b'\x21\x31\x00\x20\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff',
+                HELLO_PACKET,
                 b'{"id":1,"method":"miIO.info","params":[]}',
                 b'{"method":"get_prop","params":["power","mode","temp"]}'
             ]
@@ -158,8 +159,11 @@ class XiaomiCommandAnalyzer:
                 
                 try:
                     response, addr = sock.recvfrom(1024)
-                    self.log_message(f"UDP response from {addr}: {response.hex()}")
-                    self.protocol_info['udp_response'] = response.hex()
+                    decoded = self.codec.decode_response(response, ip=addr[0])
+                    if decoded.get('hello') and self.xiaomi_token:
+                        self.codec.register_token(int(decoded['device_id'], 16), self.xiaomi_token)
+                    self.log_message(f"UDP response from {addr}: {decoded}")
+                    self.protocol_info['udp_response'] = decoded
                 except socket.timeout:
                     continue
             
@@ -286,7 +290,7 @@ class XiaomiCommandAnalyzer:
             try:
                 response, addr = sock.recvfrom(1024)
                 sock.close()
-                return f"Response from {addr}: {response.hex()}"
+                return f"Response from {addr}: {self.codec.decode_response(response, ip=addr[0])}"
             except socket.timeout:
                 sock.close()
                 return "No response (timeout)"
@@ -338,6 +342,7 @@ class XiaomiCommandAnalyzer:
         self.log_message(f"Target device: {self.xiaomi_ip}")
         
         # Initialize files
+        self.log_sink.flush()
         with open(self.log_file, 'w') as f:
             f.write(f"Xiaomi Command Analysis started at {datetime.now()}\n")
         
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Xiaomi LAN Discovery Engine
+Sweeps a whole subnet concurrently instead of pinging one address at a time
+Uses raw ARP where permitted, with TCP-connect and miIO UDP hello fallbacks
+"""
+
+import asyncio
+import fcntl
+import ipaddress
+import select
+import socket
+import struct
+import sys
+import time
+
+from xiaomi_miio import HELLO_PACKET, MIIO_PORT, is_miio_packet, parse_header
+
+# Defaults
+DEFAULT_CONCURRENCY = 128
+DEFAULT_RATE = 1000          # probes per second
+DEFAULT_TIMEOUT = 0.5        # seconds per TCP probe
+DEFAULT_TCP_PORTS = (80, 443, 8008, 554, 8080)
+ARP_WAIT = 1.0               # seconds to collect ARP replies after the last request
+
+# Linux ioctls and ethertypes for the raw ARP sweep
+SIOCGIFADDR = 0x8915
+SIOCGIFHWADDR = 0x8927
+ETH_P_ARP = 0x0806
+
+
+def normalize_mac(mac):
+    """Lower-case, colon-separated, zero-padded MAC (accepts '-' and short octets)"""
+    parts = mac.replace('-', ':').lower().split(':')
+    return ':'.join(part.zfill(2) for part in parts)
+
+
+def local_ip():
+    """Our address on the LAN (UDP connect sends no packets)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(('192.0.2.1', 9))
+        return sock.getsockname()[0]
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
+
+def to_network(network):
+    """Accept '192.168.68', '192.168.68.', '192.168.68.0/24' or an ip_network"""
+    if isinstance(network, ipaddress.IPv4Network):
+        return network
+    network = network.rstrip('.')
+    if '/' not in network:
+        network = f"{network}.0/24" if network.count('.') == 2 else f"{network}/24"
+    return ipaddress.ip_network(network, strict=False)
+
+
+class RateLimiter:
+    """Spaces out probe starts to at most `rate` per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        """Wait for the next probe slot"""
+        if not self.interval:
+            return
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+                now = loop.time()
+            self._next = now + self.interval
+
+
+def _interface_info(interface):
+    """Return (mac_bytes, ip_bytes) for interface via ioctl"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        name = struct.pack('256s', interface.encode()[:15])
+        mac = fcntl.ioctl(sock.fileno(), SIOCGIFHWADDR, name)[18:24]
+        ip = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, name)[20:24]
+        return mac, ip
+    finally:
+        sock.close()
+
+
+def _interface_for(ip):
+    """Find the interface whose address is ip"""
+    packed = socket.inet_aton(ip)
+    for _, name in socket.if_nameindex():
+        try:
+            if _interface_info(name)[1] == packed:
+                return name
+        except OSError:
+            continue
+    return None
+
+
+def arp_sweep(hosts, interface=None, rate=DEFAULT_RATE, wait=ARP_WAIT):
+    """Broadcast ARP requests for hosts from one raw socket; returns {ip: mac}
+
+    Needs Linux and CAP_NET_RAW. Raises OSError/AttributeError when not permitted
+    so callers can fall back to unprivileged probes.
+    """
+    if interface is None:
+        ip = local_ip()
+        interface = _interface_for(ip) if ip else None
+    if interface is None:
+        raise OSError("No interface for ARP sweep")
+    our_mac, our_ip = _interface_info(interface)
+
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ARP))
+    try:
+        sock.bind((interface, ETH_P_ARP))
+        sock.setblocking(False)
+        eth = b'\xff' * 6 + our_mac + struct.pack('!H', ETH_P_ARP)
+        arp_head = struct.pack('!HHBBH', 1, 0x0800, 6, 4, 1) + our_mac + our_ip + b'\x00' * 6
+
+        wanted = {socket.inet_aton(str(host)) for host in hosts}
+        found = {}
+        interval = 1.0 / rate if rate else 0.0
+
+        def drain():
+            while True:
+                try:
+                    frame = sock.recv(128)
+                except BlockingIOError:
+                    return
+                # Ethernet(14) + ARP reply opcode 2
+                if len(frame) >= 42 and frame[20:22] == b'\x00\x02':
+                    sender_ip = frame[28:32]
+                    if sender_ip in wanted:
+                        found[socket.inet_ntoa(sender_ip)] = frame[22:28].hex(':')
+
+        for target in wanted:
+            sock.send(eth + arp_head + target)
+            drain()
+            if interval:
+                time.sleep(interval)
+
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            select.select([sock], [], [], max(0.0, deadline - time.monotonic()))
+            drain()
+        return found
+    finally:
+        sock.close()
+
+
+class _HelloProtocol(asyncio.DatagramProtocol):
+    """Collects miIO hello replies on a shared socket"""
+
+    def __init__(self, results):
+        self.results = results
+
+    def datagram_received(self, data, addr):
+        if is_miio_packet(data):
+            header = parse_header(data)
+            self.results[addr[0]] = f'{header.device_id:08x}'
+
+    def error_received(self, exc):
+        pass
+
+
+class LanScanner:
+    """Concurrent subnet sweep with a bounded semaphore and a probe rate limit"""
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, rate=DEFAULT_RATE,
+                 timeout=DEFAULT_TIMEOUT, tcp_ports=DEFAULT_TCP_PORTS,
+                 use_arp=True, use_hello=True, interface=None):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.timeout = timeout
+        self.tcp_ports = tuple(tcp_ports)
+        self.use_arp = use_arp
+        self.use_hello = use_hello
+        self.interface = interface
+        self.arp_available = None
+
+    async def _tcp_connect(self, ip, port, semaphore, limiter):
+        """One connect attempt; alive if the port accepts or actively refuses"""
+        async with semaphore:
+            await limiter.wait()
+            start = time.monotonic()
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), self.timeout)
+                writer.close()
+                return {'method': 'tcp', 'port': port, 'rtt': time.monotonic() - start}
+            except ConnectionRefusedError:
+                return {'method': 'tcp', 'port': None, 'rtt': time.monotonic() - start}
+            except (asyncio.TimeoutError, OSError):
+                return None
+
+    async def _tcp_probe(self, ip, semaphore, limiter):
+        """Probe all fallback ports of a host at once, preferring an open port"""
+        results = await asyncio.gather(
+            *(self._tcp_connect(ip, port, semaphore, limiter) for port in self.tcp_ports))
+        alive = [r for r in results if r]
+        if not alive:
+            return None
+        return next((r for r in alive if r['port']), alive[0])
+
+    async def _hello_sweep(self, hosts, limiter):
+        """Send one miIO hello to each host and collect replies; returns {ip: device_id}"""
+        loop = asyncio.get_running_loop()
+        results = {}
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _HelloProtocol(results), family=socket.AF_INET)
+        try:
+            for host in hosts:
+                await limiter.wait()
+                transport.sendto(HELLO_PACKET, (host, MIIO_PORT))
+            await asyncio.sleep(self.timeout)
+        finally:
+            transport.close()
+        return results
+
+    async def sweep(self, network, exclude=()):
+        """Probe every host in network; returns {ip: info} for live hosts"""
+        network = to_network(network)
+        our_ip = local_ip()
+        skip = set(exclude) | {our_ip}
+        hosts = [str(host) for host in network.hosts() if str(host) not in skip]
+        found = {}
+
+        # ARP only reaches hosts on our own segment
+        on_link = our_ip is not None and ipaddress.ip_address(our_ip) in network
+        self.arp_available = False
+        loop = asyncio.get_running_loop()
+        if self.use_arp and on_link:
+            try:
+                macs = await loop.run_in_executor(
+                    None, arp_sweep, hosts, self.interface, self.rate)
+                self.arp_available = True
+                for ip, mac in macs.items():
+                    found[ip] = {'method': 'arp', 'mac': mac}
+            except (OSError, AttributeError):
+                pass
+
+        limiter = RateLimiter(self.rate)
+        hello_task = None
+        if self.use_hello:
+            hello_task = asyncio.ensure_future(self._hello_sweep(hosts, RateLimiter(self.rate)))
+
+        # ARP already answered for every live host on the segment when it worked
+        if not self.arp_available:
+            semaphore = asyncio.Semaphore(self.concurrency)
+            pending = [h for h in hosts if h not in found]
+            probes = await asyncio.gather(
+                *(self._tcp_probe(h, semaphore, limiter) for h in pending))
+            for host, info in zip(pending, probes):
+                if info:
+                    found[host] = info
+
+        if hello_task is not None:
+            for ip, device_id in (await hello_task).items():
+                entry = found.setdefault(ip, {'method': 'miio'})
+                entry['miio_device_id'] = device_id
+
+        return dict(sorted(found.items(), key=lambda item: ipaddress.ip_address(item[0])))
+
+
+def sweep_subnet(network, exclude=(), **options):
+    """Blocking wrapper for thread-based callers"""
+    return asyncio.run(LanScanner(**options).sweep(network, exclude=exclude))
+
+
+def miio_hello(ip, timeout=1.0):
+    """Device ID (hex) if ip answers a miIO hello on UDP 54321, else None"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.settimeout(timeout)
+        sock.sendto(HELLO_PACKET, (ip, MIIO_PORT))
+        data, addr = sock.recvfrom(1024)
+        if addr[0] == ip and is_miio_packet(data):
+            return f'{parse_header(data).device_id:08x}'
+    except OSError:
+        pass
+    finally:
+        sock.close()
+    return None
+
+
+def main():
+    """Sweep a subnet: xiaomi_discovery.py [192.168.68.0/24]"""
+    if len(sys.argv) > 1:
+        network = sys.argv[1]
+    else:
+        network = local_ip().rsplit('.', 1)[0]
+    start = time.monotonic()
+    found = sweep_subnet(network)
+    for ip, info in found.items():
+        print(f"📱 {ip}: {info}")
+    print(f"📊 {len(found)} hosts in {time.monotonic() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
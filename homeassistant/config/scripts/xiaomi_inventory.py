@@ -0,0 +1,608 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Passive Device Inventory
+Builds a LAN device inventory from traffic devices send anyway: mDNS/DNS-SD answers, SSDP NOTIFYs and DHCP requests
+Listens on the multicast groups (and the DHCP ports when permitted) or is fed packets from a capture stream
+Records vendor (OUI), hostname, services and last-seen time, indexed by IP, MAC, hostname, service and vendor
+The inventory is saved as JSON so detectors can look devices up with zero probe traffic
+"""
+
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+
+from xiaomi_resolver import read_arp_table
+
+# Defaults
+INVENTORY_FILE = "xiaomi_inventory.json"
+DEFAULT_SAVE_INTERVAL = 10.0   # seconds between inventory file writes while devices change
+MDNS_GROUP = ("224.0.0.251", 5353)
+SSDP_GROUP = ("239.255.255.250", 1900)
+DHCP_PORTS = (67, 68)
+OUI_FILES = ("/usr/share/ieee-data/oui.txt", "/usr/share/misc/oui.txt",
+             "/usr/share/nmap/nmap-mac-prefixes", "/usr/share/wireshark/manuf")
+
+# Vendors of the devices this repo cares about; system OUI databases extend it when installed
+KNOWN_OUIS = {
+    '28:6c:07': 'Xiaomi', '64:09:80': 'Xiaomi', '78:11:dc': 'Xiaomi',
+    '00:05:5d': 'D-Link', '1c:7e:e5': 'D-Link', 'b0:c5:54': 'D-Link',
+    '54:60:09': 'Google', 'f4:f5:d8': 'Google', 'f4:f5:e8': 'Google',
+}
+
+DNS_A, DNS_PTR, DNS_TXT, DNS_AAAA, DNS_SRV = 1, 12, 16, 28, 33
+DHCP_MAGIC = b'\x63\x82\x53\x63'
+DHCP_HOSTNAME, DHCP_REQUESTED_IP, DHCP_VENDOR_CLASS = 12, 50, 60
+_dns_header = struct.Struct('!HHHHHH')
+_dns_record = struct.Struct('!HHIH')
+
+_oui_table = None
+
+
+def oui_vendor(mac):
+    """Vendor name for a MAC from KNOWN_OUIS and any installed OUI database"""
+    global _oui_table
+    if not mac:
+        return None
+    if _oui_table is None:
+        _oui_table = dict(KNOWN_OUIS)
+        for path in OUI_FILES:
+            try:
+                with open(path, errors='replace') as f:
+                    for line in f:
+                        prefix, _, vendor = line.strip().partition(' ')
+                        prefix = prefix.replace('-', '').replace(':', '').lower()
+                        if len(prefix) == 6 and vendor and not line.startswith('#'):
+                            key = ':'.join(prefix[i:i + 2] for i in range(0, 6, 2))
+                            _oui_table.setdefault(key, vendor.replace('(hex)', '').strip())
+            except OSError:
+                continue
+    return _oui_table.get(mac.lower()[:8])
+
+
+def _read_name(data, offset):
+    """DNS name at offset (following compression pointers); returns (name, offset after it)"""
+    labels = []
+    end = None
+    for _ in range(128):
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(data[offset:offset + length].decode('utf-8', errors='replace'))
+        offset += length
+    return '.'.join(labels), end if end is not None else offset
+
+
+def parse_mdns(data):
+    """Resource records of an mDNS response as (type, name, value); empty for queries"""
+    if len(data) < _dns_header.size:
+        return []
+    _, flags, questions, answers, authority, additional = _dns_header.unpack_from(data)
+    if not flags & 0x8000:
+        return []
+    records = []
+    try:
+        offset = _dns_header.size
+        for _ in range(questions):
+            offset = _read_name(data, offset)[1] + 4
+        for _ in range(answers + authority + additional):
+            name, offset = _read_name(data, offset)
+            kind, _, _, length = _dns_record.unpack_from(data, offset)
+            offset += _dns_record.size
+            rdata = offset
+            offset += length
+            if kind == DNS_A and length == 4:
+                records.append((kind, name, socket.inet_ntoa(data[rdata:offset])))
+            elif kind == DNS_PTR:
+                records.append((kind, name, _read_name(data, rdata)[0]))
+            elif kind == DNS_SRV:
+                port = struct.unpack_from('!H', data, rdata + 4)[0]
+                records.append((kind, name, (_read_name(data, rdata + 6)[0], port)))
+            elif kind == DNS_TXT:
+                entries = {}
+                position = rdata
+                while position < offset:
+                    size = data[position]
+                    key, _, value = data[position + 1:position + 1 + size].decode('utf-8', errors='replace').partition('=')
+                    if key:
+                        entries[key] = value
+                    position += 1 + size
+                records.append((kind, name, entries))
+    except (IndexError, struct.error):
+        pass  # Truncated packet: keep what parsed
+    return records
+
+
+def parse_ssdp(data):
+    """Headers of an SSDP NOTIFY or search response (lower-case keys); None otherwise"""
+    try:
+        text = data.decode('utf-8', errors='replace')
+    except AttributeError:
+        return None
+    start, _, rest = text.partition('\r\n')
+    if not (start.startswith('NOTIFY') or start.startswith('HTTP/1.1 200')):
+        return None
+    headers = {}
+    for line in rest.split('\r\n'):
+        key, sep, value = line.partition(':')
+        if sep:
+            headers[key.strip().lower()] = value.strip()
+    return headers
+
+
+def parse_dhcp(data):
+    """(mac, ip, hostname, vendor_class) from a DHCP message; None when not DHCP"""
+    if len(data) < 240 or data[236:240] != DHCP_MAGIC:
+        return None
+    op = data[0]
+    mac = data[28:34].hex(':')
+    ciaddr, yiaddr = socket.inet_ntoa(data[12:16]), socket.inet_ntoa(data[16:20])
+    ip = yiaddr if op == 2 else ciaddr
+    hostname = vendor_class = None
+    offset = 240
+    while offset < len(data) and data[offset] != 255:
+        code = data[offset]
+        if code == 0:
+            offset += 1
+            continue
+        if offset + 1 >= len(data):
+            break
+        length = data[offset + 1]
+        value = data[offset + 2:offset + 2 + length]
+        if code == DHCP_HOSTNAME:
+            hostname = value.decode('utf-8', errors='replace')
+        elif code == DHCP_VENDOR_CLASS:
+            vendor_class = value.decode('utf-8', errors='replace')
+        elif code == DHCP_REQUESTED_IP and length == 4 and op == 1:
+            ip = socket.inet_ntoa(value)
+        offset += 2 + length
+    return mac, (ip if ip != '0.0.0.0' else None), hostname, vendor_class
+
+
+class Device:
+    """Everything the inventory knows about one host"""
+
+    __slots__ = ('ip', 'mac', 'vendor', 'hostname', 'names', 'services', 'txt',
+                 'ssdp', 'dhcp_vendor', 'sources', 'first_seen', 'last_seen')
+
+    def __init__(self, ip=None, mac=None):
+        self.ip = ip
+        self.mac = mac
+        self.vendor = oui_vendor(mac)
+        self.hostname = None
+        self.names = set()       # DNS-SD instance names, e.g. 'Living Room._googlecast._tcp.local'
+        self.services = set()    # service types, e.g. '_googlecast._tcp', SSDP NT urns
+        self.txt = {}            # DNS-SD TXT entries per service type
+        self.ssdp = {}           # server, location and usn of the last SSDP message
+        self.dhcp_vendor = None
+        self.sources = set()
+        self.first_seen = self.last_seen = time.time()
+
+    def to_dict(self):
+        return {
+            'ip': self.ip,
+            'mac': self.mac,
+            'vendor': self.vendor,
+            'hostname': self.hostname,
+            'names': sorted(self.names),
+            'services': sorted(self.services),
+            'txt': self.txt,
+            'ssdp': self.ssdp,
+            'dhcp_vendor': self.dhcp_vendor,
+            'sources': sorted(self.sources),
+            'first_seen': datetime.fromtimestamp(self.first_seen).isoformat(),
+            'last_seen': datetime.fromtimestamp(self.last_seen).isoformat(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        device = cls(data.get('ip'), data.get('mac'))
+        device.vendor = data.get('vendor') or device.vendor
+        device.hostname = data.get('hostname')
+        device.names = set(data.get('names', ()))
+        device.services = set(data.get('services', ()))
+        device.txt = data.get('txt', {})
+        device.ssdp = data.get('ssdp', {})
+        device.dhcp_vendor = data.get('dhcp_vendor')
+        device.sources = set(data.get('sources', ()))
+        for field in ('first_seen', 'last_seen'):
+            if data.get(field):
+                setattr(device, field, datetime.fromisoformat(data[field]).timestamp())
+        return device
+
+    def __repr__(self):
+        return f"Device({self.ip}, {self.mac}, {self.vendor}, {self.hostname}, {sorted(self.services)})"
+
+
+def _service_type(instance):
+    """'Name._googlecast._tcp.local' -> '_googlecast._tcp'"""
+    labels = instance.split('.')
+    for index in range(len(labels) - 1):
+        if labels[index].startswith('_') and labels[index + 1] in ('_tcp', '_udp'):
+            return f"{labels[index]}.{labels[index + 1]}"
+    return None
+
+
+class DeviceInventory:
+    """Passively learned devices with indexes for the lookups detectors need
+
+    Devices are keyed by IP. The MAC comes from DHCP or the kernel ARP table and
+    is indexed too, so a device that changes address keeps its history. All
+    lookups are dictionary reads; nothing here sends a packet.
+    """
+
+    def __init__(self, path=INVENTORY_FILE, save_interval=DEFAULT_SAVE_INTERVAL):
+        self.path = path
+        self.save_interval = save_interval
+        self.devices = {}        # ip -> Device
+        self.by_mac = {}
+        self.by_hostname = {}
+        self.by_service = {}     # service type -> set of ips
+        self.stats = {'mdns': 0, 'ssdp': 0, 'dhcp': 0, 'devices': 0, 'saves': 0}
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._last_save = 0.0
+        self._sockets = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._arp = {}
+        self._mtime = None
+
+    # Lookups
+
+    def get(self, ip=None, mac=None, hostname=None):
+        """The device with this IP, MAC or hostname (case-insensitive, '.local' optional), or None"""
+        if ip is not None:
+            return self.devices.get(ip)
+        if mac is not None:
+            return self.by_mac.get(mac.replace('-', ':').lower())
+        if hostname is not None:
+            return self.by_hostname.get(hostname.lower().rstrip('.').removesuffix('.local'))
+        return None
+
+    def find(self, service=None, vendor=None, name=None, max_age=None):
+        """Devices matching every given criterion, most recently seen first
+
+        service is a DNS-SD type ('_googlecast._tcp') or SSDP urn, vendor and name
+        are case-insensitive substrings of the vendor and of the hostname, instance
+        names or TXT friendly name/model.
+        """
+        if service is not None:
+            candidates = [self.devices[ip] for ip in self.by_service.get(service, ()) if ip in self.devices]
+        else:
+            candidates = list(self.devices.values())
+        if vendor is not None:
+            vendor = vendor.lower()
+            candidates = [d for d in candidates
+                          if vendor in (d.vendor or '').lower() or vendor in (d.dhcp_vendor or '').lower()]
+        if name is not None:
+            name = name.lower()
+            candidates = [d for d in candidates
+                          if name in (d.hostname or '').lower() or any(name in n.lower() for n in d.names)
+                          or any(name in entries.get(key, '').lower()
+                                 for entries in d.txt.values() for key in ('fn', 'md'))]
+        if max_age is not None:
+            cutoff = time.time() - max_age
+            candidates = [d for d in candidates if d.last_seen >= cutoff]
+        return sorted(candidates, key=lambda d: d.last_seen, reverse=True)
+
+    # Updates
+
+    def _device(self, ip, mac=None, source=None, ts=None):
+        with self._lock:
+            device = self.devices.get(ip)
+            if device is not None and mac and device.mac and device.mac != mac:
+                # The lease went to another host: nothing learned about the old one applies
+                self._forget(device)
+                device = None
+            if device is None and mac:
+                # Same MAC at a new address: move the device instead of starting over
+                device = self.by_mac.get(mac)
+                if device is not None and device.ip in self.devices:
+                    del self.devices[device.ip]
+                    for ips in self.by_service.values():
+                        ips.discard(device.ip)
+                    device.ip = ip
+                    for service in device.services:
+                        self.by_service.setdefault(service, set()).add(ip)
+            if device is None:
+                device = Device(ip, mac or self._mac_for(ip))
+                self.stats['devices'] += 1
+            self.devices[ip] = device
+            self._set_mac(device, mac)
+            if source:
+                device.sources.add(source)
+            device.last_seen = ts or time.time()
+            self._dirty = True
+            return device
+
+    def _forget(self, device):
+        """Drop device and every index entry pointing at it"""
+        if self.devices.get(device.ip) is device:
+            del self.devices[device.ip]
+        for ips in self.by_service.values():
+            ips.discard(device.ip)
+        if device.mac and self.by_mac.get(device.mac) is device:
+            del self.by_mac[device.mac]
+        if device.hostname and self.by_hostname.get(device.hostname.lower()) is device:
+            del self.by_hostname[device.hostname.lower()]
+
+    def _mac_for(self, ip):
+        """MAC of a LAN host from the kernel ARP table (re-read when unknown)"""
+        mac = self._arp.get(ip)
+        if mac is None:
+            self._arp = {entry_ip: entry_mac for entry_mac, (entry_ip, _) in read_arp_table().items()}
+            mac = self._arp.get(ip)
+        return mac
+
+    def _set_mac(self, device, mac):
+        if mac and device.mac != mac:
+            device.mac = mac
+            device.vendor = oui_vendor(mac) or device.vendor
+        if device.mac:
+            self.by_mac[device.mac] = device
+
+    def _add_service(self, device, service):
+        device.services.add(service)
+        self.by_service.setdefault(service, set()).add(device.ip)
+
+    def _set_hostname(self, device, hostname):
+        hostname = hostname.rstrip('.').removesuffix('.local')
+        if hostname and device.hostname != hostname:
+            device.hostname = hostname
+            self.by_hostname[hostname.lower()] = device
+
+    def observe_mdns(self, src_ip, payload, ts=None):
+        """Learn from one mDNS packet sent by src_ip"""
+        records = parse_mdns(payload)
+        if not records:
+            return None
+        self.stats['mdns'] += 1
+        with self._lock:
+            device = self._device(src_ip, source='mdns', ts=ts)
+            hosts = {}
+            for kind, name, value in records:
+                if kind == DNS_A:
+                    hosts[name] = value
+                    if value == src_ip:
+                        self._set_hostname(device, name)
+                elif kind == DNS_PTR:
+                    service = _service_type(value)
+                    if service and not name.startswith('_services'):
+                        device.names.add(value.removesuffix('.local'))
+                        self._add_service(device, service)
+                elif kind == DNS_SRV:
+                    service = _service_type(name)
+                    if service:
+                        device.names.add(name.removesuffix('.local'))
+                        self._add_service(device, service)
+                    if not device.hostname and value[0] not in hosts:
+                        self._set_hostname(device, value[0])
+                elif kind == DNS_TXT:
+                    service = _service_type(name)
+                    if service and value:
+                        device.txt[service] = value
+                        if 'mac' in value:
+                            # miIO devices announce their MAC, which also names the vendor
+                            self._set_mac(device, value['mac'].replace('-', ':').lower())
+            return device
+
+    def observe_ssdp(self, src_ip, payload, ts=None):
+        """Learn from one SSDP NOTIFY or search response sent by src_ip"""
+        headers = parse_ssdp(payload)
+        if headers is None:
+            return None
+        self.stats['ssdp'] += 1
+        with self._lock:
+            device = self._device(src_ip, source='ssdp', ts=ts)
+            service = headers.get('nt') or headers.get('st')
+            if service and not service.startswith('uuid:'):
+                self._add_service(device, service)
+            for key in ('server', 'location', 'usn'):
+                if key in headers:
+                    device.ssdp[key] = headers[key]
+            return device
+
+    def observe_dhcp(self, payload, ts=None):
+        """Learn MAC, address, hostname and vendor class from one DHCP message"""
+        parsed = parse_dhcp(payload)
+        if parsed is None:
+            return None
+        mac, ip, hostname, vendor_class = parsed
+        if ip is None:
+            return None
+        self.stats['dhcp'] += 1
+        with self._lock:
+            device = self._device(ip, mac, source='dhcp', ts=ts)
+            if hostname:
+                self._set_hostname(device, hostname)
+            if vendor_class:
+                device.dhcp_vendor = vendor_class
+            return device
+
+    def observe_packet(self, packet):
+        """Feed one decoded packet (xiaomi_pcap.Packet) from a capture stream"""
+        ports = (packet.src_port, packet.dst_port)
+        if MDNS_GROUP[1] in ports:
+            return self.observe_mdns(packet.src_ip, packet.payload, packet.ts)
+        if SSDP_GROUP[1] in ports:
+            return self.observe_ssdp(packet.src_ip, packet.payload, packet.ts)
+        if packet.src_port in DHCP_PORTS and packet.dst_port in DHCP_PORTS:
+            return self.observe_dhcp(packet.payload, packet.ts)
+        return None
+
+    # Persistence
+
+    def save(self):
+        """Atomically replace the inventory file"""
+        with self._lock:
+            data = {
+                'updated': datetime.now().isoformat(),
+                'stats': dict(self.stats),
+                'devices': {ip: device.to_dict() for ip, device in sorted(self.devices.items())},
+            }
+            self._dirty = False
+        tmp_file = f"{self.path}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_file, self.path)
+        self.stats['saves'] += 1
+        self._last_save = time.monotonic()
+
+    def load(self):
+        """Merge devices from the inventory file; returns self"""
+        try:
+            self._mtime = os.stat(self.path).st_mtime
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self
+        with self._lock:
+            for ip, entry in data.get('devices', {}).items():
+                device = Device.from_dict(entry)
+                self.devices[ip] = device
+                if device.mac:
+                    self.by_mac[device.mac] = device
+                if device.hostname:
+                    self.by_hostname[device.hostname.lower()] = device
+                for service in device.services:
+                    self.by_service.setdefault(service, set()).add(ip)
+        return self
+
+    def refresh(self):
+        """Reload when the listener has saved a newer file (one stat call otherwise); returns self"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return self
+        if mtime != self._mtime:
+            with self._lock:
+                self.devices.clear()
+                self.by_mac.clear()
+                self.by_hostname.clear()
+                self.by_service.clear()
+                self.load()
+        return self
+
+    # Listening
+
+    def _join(self, group):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', group[1]))
+        membership = socket.inet_aton(group[0]) + socket.inet_aton('0.0.0.0')
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        return sock
+
+    def open_sockets(self):
+        """Join the mDNS and SSDP groups and bind the DHCP ports where permitted; returns what is open"""
+        opened = []
+        for kind, group in (('mdns', MDNS_GROUP), ('ssdp', SSDP_GROUP)):
+            try:
+                self._sockets.append((kind, self._join(group)))
+                opened.append(kind)
+            except OSError:
+                continue
+        for port in DHCP_PORTS:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                sock.bind(('', port))
+                self._sockets.append(('dhcp', sock))
+                opened.append(f'dhcp:{port}')
+            except OSError:
+                sock.close()  # Needs root, or a DHCP client/server already owns the port
+        return opened
+
+    def poll(self, timeout=1.0):
+        """Handle whatever arrived on the listening sockets within timeout"""
+        if not self._sockets:
+            time.sleep(timeout)
+            return
+        kinds = {sock: kind for kind, sock in self._sockets}
+        for sock in select.select(list(kinds), [], [], timeout)[0]:
+            try:
+                payload, (src_ip, _) = sock.recvfrom(9000)
+            except OSError:
+                continue
+            kind = kinds[sock]
+            if kind == 'mdns':
+                self.observe_mdns(src_ip, payload)
+            elif kind == 'ssdp':
+                self.observe_ssdp(src_ip, payload)
+            else:
+                self.observe_dhcp(payload)
+        if self._dirty and self.path and time.monotonic() - self._last_save >= self.save_interval:
+            try:
+                self.save()
+            except OSError:
+                pass
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.poll()
+
+    def start(self):
+        """Listen in a background thread; returns the list of opened listeners"""
+        opened = self.open_sockets()
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='inventory', daemon=True)
+            self._thread.start()
+        return opened
+
+    def stop(self):
+        """Stop listening and write the inventory one last time"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(2.0)
+            self._thread = None
+        for _, sock in self._sockets:
+            sock.close()
+        self._sockets = []
+        if self._dirty and self.path:
+            try:
+                self.save()
+            except OSError:
+                pass
+
+
+def load_inventory(path=INVENTORY_FILE):
+    """Read-only view of the inventory a running listener keeps on disk"""
+    return DeviceInventory(path).load()
+
+
+def main():
+    """Listen and keep the inventory file current: xiaomi_inventory.py [inventory_file]"""
+    path = sys.argv[1] if len(sys.argv) > 1 else INVENTORY_FILE
+    inventory = DeviceInventory(path).load()
+    opened = inventory.start()
+    print(f"👂 Passive discovery on {', '.join(opened) or 'nothing (no sockets permitted)'}, saving to {path}")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"📊 {len(inventory.devices)} devices, {inventory.stats}")
+    except KeyboardInterrupt:
+        print("\n🛑 Stopping passive discovery")
+    finally:
+        inventory.stop()
+        for device in inventory.find():
+            print(f"  {device}")
+
+
+if __name__ == "__main__":
+    main()
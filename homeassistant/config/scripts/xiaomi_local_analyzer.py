@@ -8,15 +8,20 @@ Provides deep analysis and learning capabilities
 import subprocess
 import json
 import time
-import re
 import socket
-import threading
-import signal
-import sys
 from datetime import datetime
 from collections import defaultdict, deque
 import os
 
+from xiaomi_jsonscan import extract_json_objects
+from xiaomi_logsink import get_sink
+from xiaomi_pcap import IPPROTO_TCP, IPPROTO_UDP
+from xiaomi_portscan import COMMON_PORTS, PortScanner
+from xiaomi_prober import IR_COMMANDS, ProbeScheduler
+from xiaomi_runtime import AnalyzerRuntime, instance_path
+from xiaomi_sequences import SequenceMiner
+from xiaomi_signatures import NEW_SIGNATURE, CommandIndex, http_method
+
 # Configuration
 XIAOMI_IP = "192.168.68.68"
 XIAOMI_PORT = 54321
@@ -27,148 +32,104 @@ COMMANDS_FILE = "/config/xiaomi_discovered_commands.json"
 PROTOCOL_FILE = "/config/xiaomi_protocol_analysis.json"
 
 class XiaomiLocalAnalyzer:
-    def __init__(self):
-        self.xiaomi_ip = XIAOMI_IP
-        self.xiaomi_port = XIAOMI_PORT
-        self.log_file = LOG_FILE
-        self.learning_file = LEARNING_FILE
-        self.patterns_file = PATTERNS_FILE
-        self.commands_file = COMMANDS_FILE
-        self.protocol_file = PROTOCOL_FILE
+    STAGES = ('liveness', 'capture', 'portscan', 'discovery', 'protocol', 'persist')
+
+    def __init__(self, device=None, registry=None):
+        device = device or {}
+        self.xiaomi_ip = device.get('ip', XIAOMI_IP)
+        self.xiaomi_port = device.get('port', XIAOMI_PORT)
+        self.log_file = instance_path(LOG_FILE, device)
+        self.log_sink = get_sink(self.log_file)
+        self.learning_file = instance_path(LEARNING_FILE, device)
+        self.patterns_file = instance_path(PATTERNS_FILE, device)
+        self.commands_file = instance_path(COMMANDS_FILE, device)
+        self.protocol_file = instance_path(PROTOCOL_FILE, device)
         
         # Learning data structures
         self.learned_commands = {}
         self.communication_patterns = defaultdict(list)
         self.protocol_analysis = {}
         self.device_responses = deque(maxlen=1000)
-        self.command_sequences = deque(maxlen=100)
+        self.sequence_miner = SequenceMiner()
         
         # Analysis state
-        self.running = False
-        self.analysis_threads = []
         self.last_activity = None
         self.device_online = False
-        
-        # Setup signal handlers for graceful shutdown
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGTERM, self.signal_handler)
-    
-    def signal_handler(self, signum, frame):
-        """Handle shutdown signals gracefully"""
-        self.log_message(f"Received signal {signum}, shutting down...")
-        self.running = False
-        self.save_learning_data()
-        sys.exit(0)
+        self.capture_runtime = None   # while its capture is open, it sees our probes and the replies too
+        self.port_scanner = PortScanner()
+        self.prober = ProbeScheduler(port=self.xiaomi_port)
+        self.command_index = CommandIndex(self.learned_commands)
     
     def log_message(self, message):
-        """Log message with timestamp"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        print(log_entry)
-        
-        with open(self.log_file, 'a') as f:
-            f.write(log_entry + '\n')
+        """Log message with timestamp; queued and written in batches by the shared log sink"""
+        self.log_sink.log(message)
     
-    def check_device_connectivity(self):
-        """Check if Xiaomi device is reachable"""
-        try:
-            result = subprocess.run(['ping', '-c', '1', '-W', '1', self.xiaomi_ip], 
-                                  capture_output=True, text=True)
-            is_online = "1 received" in result.stdout
-            
-            if is_online != self.device_online:
-                self.device_online = is_online
-                if is_online:
-                    self.log_message(f"✅ Xiaomi device at {self.xiaomi_ip} is now ONLINE")
-                    self.on_device_online()
-                else:
-                    self.log_message(f"❌ Xiaomi device at {self.xiaomi_ip} is now OFFLINE")
-                    self.on_device_offline()
-            
-            return is_online
-        except Exception as e:
-            self.log_message(f"Error checking connectivity: {e}")
-            return False
+    def attach_liveness(self, runtime):
+        """Follow the device's online/offline transitions"""
+        runtime.watch_liveness(self.xiaomi_ip, self.on_liveness_change)
+    
+    def attach_capture(self, runtime):
+        """Analyze every captured packet to or from the device as it arrives"""
+        self.capture_runtime = runtime
+        runtime.watch_packets(self.xiaomi_ip, lambda packet: self.analyze_packet(self.packet_lines(packet)))
+    
+    def attach_portscan(self, runtime):
+        runtime.every(30, self.port_scan_round, 'port scanning', retry=60, when=lambda: self.device_online)
+    
+    def attach_discovery(self, runtime):
+        runtime.every(60, self.discover_commands, 'command discovery', retry=120, when=lambda: self.device_online)
+    
+    def attach_protocol(self, runtime):
+        runtime.every(30, self.analyze_protocol_patterns, 'protocol analysis', retry=60,
+                      when=lambda: self.device_online)
+    
+    def attach_persist(self, runtime):
+        runtime.on_save(self.save_learning_data, 300, 'learning data save')
+    
+    def on_attached(self, runtime, stages):
+        """Without the liveness stage nothing reports the device online, so assume it is"""
+        if 'liveness' not in stages:
+            self.device_online = True
+    
+    def on_liveness_change(self, ip, online, rtt):
+        """Handle an online/offline transition from the liveness monitor"""
+        if online == self.device_online:
+            return
+        self.device_online = online
+        if online:
+            self.log_message(f"✅ Xiaomi device at {ip} is now ONLINE ({rtt} ms)")
+            self.on_device_online()
+        else:
+            self.log_message(f"❌ Xiaomi device at {ip} is now OFFLINE")
+            self.on_device_offline()
     
     def on_device_online(self):
         """Handle device coming online"""
         self.last_activity = datetime.now()
-        self.start_analysis_threads()
         self.log_message("Starting comprehensive device analysis...")
     
     def on_device_offline(self):
         """Handle device going offline"""
         self.log_message("Device offline, continuing to monitor...")
     
-    def start_analysis_threads(self):
-        """Start all analysis threads"""
-        if not self.analysis_threads:
-            # Port scanner thread
-            port_thread = threading.Thread(target=self.continuous_port_scan, daemon=True)
-            port_thread.start()
-            self.analysis_threads.append(port_thread)
-            
-            # Traffic analyzer thread
-            traffic_thread = threading.Thread(target=self.continuous_traffic_analysis, daemon=True)
-            traffic_thread.start()
-            self.analysis_threads.append(traffic_thread)
-            
-            # Command discoverer thread
-            command_thread = threading.Thread(target=self.continuous_command_discovery, daemon=True)
-            command_thread.start()
-            self.analysis_threads.append(command_thread)
-            
-            # Protocol analyzer thread
-            protocol_thread = threading.Thread(target=self.continuous_protocol_analysis, daemon=True)
-            protocol_thread.start()
-            self.analysis_threads.append(protocol_thread)
-    
-    def continuous_port_scan(self):
-        """Continuously scan ports for changes"""
-        known_ports = set()
+    def port_scan_round(self):
+        """One concurrent pass over the common ports, diffed against the previous scan"""
+        current_ports, new_ports, closed_ports = self.port_scanner.scan_changes(self.xiaomi_ip, COMMON_PORTS)
         
-        while self.running:
-            try:
-                if self.device_online:
-                    current_ports = self.scan_ports()
-                    
-                    # Check for new ports
-                    new_ports = current_ports - known_ports
-                    if new_ports:
-                        self.log_message(f"🔍 New ports discovered: {new_ports}")
-                        self.analyze_new_ports(new_ports)
-                    
-                    # Check for closed ports
-                    closed_ports = known_ports - current_ports
-                    if closed_ports:
-                        self.log_message(f"🔒 Ports closed: {closed_ports}")
-                    
-                    known_ports = current_ports
-                    self.protocol_analysis['open_ports'] = list(current_ports)
-                
-                time.sleep(30)  # Scan every 30 seconds
-            except Exception as e:
-                self.log_message(f"Error in port scanning: {e}")
-                time.sleep(60)
+        # Check for new ports
+        if new_ports:
+            self.log_message(f"🔍 New ports discovered: {new_ports}")
+            self.analyze_new_ports(new_ports)
+        
+        # Check for closed ports
+        if closed_ports:
+            self.log_message(f"🔒 Ports closed: {closed_ports}")
+        
+        self.protocol_analysis['open_ports'] = list(current_ports)
     
     def scan_ports(self):
         """Scan common Xiaomi ports"""
-        common_ports = [54321, 8080, 80, 443, 22, 23, 554, 8554, 9999, 8888]
-        open_ports = set()
-        
-        for port in common_ports:
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(1)
-                result = sock.connect_ex((self.xiaomi_ip, port))
-                sock.close()
-                
-                if result == 0:
-                    open_ports.add(port)
-            except Exception:
-                continue
-        
-        return open_ports
+        return self.port_scanner.scan_host(self.xiaomi_ip, COMMON_PORTS)
     
     def analyze_new_ports(self, ports):
         """Analyze newly discovered ports"""
@@ -267,32 +228,12 @@ class XiaomiLocalAnalyzer:
         except Exception as e:
             pass
     
-    def continuous_traffic_analysis(self):
-        """Continuously analyze network traffic"""
-        while self.running:
-            try:
-                if self.device_online:
-                    self.analyze_traffic_patterns()
-                time.sleep(10)  # Analyze every 10 seconds
-            except Exception as e:
-                self.log_message(f"Error in traffic analysis: {e}")
-                time.sleep(30)
-    
-    def analyze_traffic_patterns(self):
-        """Analyze network traffic for patterns"""
-        try:
-            # Use tcpdump to capture traffic
-            cmd = [
-                'tcpdump', '-i', 'any', '-n', '-c', '20',
-                f'host {self.xiaomi_ip}', '-A', '-x'
-            ]
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=15)
-            
-            if result.returncode == 0:
-                self.process_traffic_output(result.stdout)
-        except Exception as e:
-            self.log_message(f"Traffic analysis error: {e}")
+    def packet_lines(self, packet):
+        """A captured packet as the summary and payload text lines analyze_packet expects"""
+        proto = {IPPROTO_TCP: 'TCP', IPPROTO_UDP: 'UDP'}.get(packet.proto, str(packet.proto))
+        summary = (f"IP {packet.src_ip}.{packet.src_port} > {packet.dst_ip}.{packet.dst_port}: "
+                   f"{proto} {len(packet.payload)}")
+        return [summary, packet.payload.decode('utf-8', errors='replace')]
     
     def process_traffic_output(self, output):
         """Process tcpdump output for patterns"""
@@ -314,14 +255,9 @@ class XiaomiLocalAnalyzer:
         """Analyze individual packet for command patterns"""
         packet_text = '\n'.join(packet_lines)
         
-        # Look for JSON commands
-        json_matches = re.findall(r'\{[^}]*\}', packet_text)
-        for json_cmd in json_matches:
-            try:
-                cmd_data = json.loads(json_cmd)
-                self.learn_command_from_json(cmd_data)
-            except json.JSONDecodeError:
-                continue
+        # Look for JSON commands, including nested ones
+        for cmd_data in extract_json_objects(packet_text):
+            self.learn_command_from_json(cmd_data)
         
         # Look for HTTP commands
         if 'POST' in packet_text or 'GET' in packet_text:
@@ -332,84 +268,42 @@ class XiaomiLocalAnalyzer:
             self.learn_ir_command(packet_text)
     
     def learn_command_from_json(self, cmd_data):
-        """Learn from JSON command structure"""
-        if 'method' in cmd_data:
+        """Learn from JSON command structure, indexed by method and param shape"""
+        if isinstance(cmd_data.get('method'), str):
             method = cmd_data['method']
             params = cmd_data.get('params', [])
             
-            self.learned_commands[f'json_{method}'] = {
-                'type': 'JSON',
-                'method': method,
-                'params': params,
-                'timestamp': datetime.now().isoformat()
-            }
-            
-            self.log_message(f"📝 Learned JSON command: {method} with params {params}")
+            signature, _, outcome = self.command_index.observe('json', method, cmd_data, params=params)
+            self.sequence_miner.add(f"cmd {method}")
+            if outcome == NEW_SIGNATURE:
+                self.log_message(f"📝 Learned JSON command: {signature} with params {params}")
     
     def learn_http_command(self, packet_text):
         """Learn from HTTP command"""
-        if 'POST' in packet_text:
-            self.learned_commands['http_post'] = {
-                'type': 'HTTP_POST',
-                'content': packet_text[:200],
-                'timestamp': datetime.now().isoformat()
-            }
-            self.log_message("📝 Learned HTTP POST command")
-        elif 'GET' in packet_text:
-            self.learned_commands['http_get'] = {
-                'type': 'HTTP_GET',
-                'content': packet_text[:200],
-                'timestamp': datetime.now().isoformat()
-            }
-            self.log_message("📝 Learned HTTP GET command")
+        for verb, type_name in (('POST', 'HTTP_POST'), ('GET', 'HTTP_GET')):
+            start = packet_text.find(verb)
+            if start < 0:
+                continue
+            method = http_method(packet_text[start:start + 512])
+            signature, _, outcome = self.command_index.observe('http', method, packet_text, type_name=type_name)
+            self.sequence_miner.add(f"cmd {method}")
+            if outcome == NEW_SIGNATURE:
+                self.log_message(f"📝 Learned HTTP {verb} command: {signature}")
+            return
     
     def learn_ir_command(self, packet_text):
         """Learn from IR command"""
-        self.learned_commands['ir_command'] = {
-            'type': 'IR',
-            'content': packet_text[:200],
-            'timestamp': datetime.now().isoformat()
-        }
-        self.log_message("📝 Learned IR command pattern")
-    
-    def continuous_command_discovery(self):
-        """Continuously discover new commands"""
-        while self.running:
-            try:
-                if self.device_online:
-                    self.discover_commands()
-                time.sleep(60)  # Discover every minute
-            except Exception as e:
-                self.log_message(f"Error in command discovery: {e}")
-                time.sleep(120)
+        signature, _, outcome = self.command_index.observe('ir', 'ir', packet_text, type_name='IR')
+        if outcome == NEW_SIGNATURE:
+            self.log_message(f"📝 Learned IR command pattern: {signature}")
     
     def discover_commands(self):
-        """Discover new commands by testing common patterns"""
-        # Test common Xiaomi IR commands
-        ir_commands = [
-            'power', 'volume_up', 'volume_down', 'channel_up', 'channel_down',
-            'mute', 'menu', 'ok', 'back', 'up', 'down', 'left', 'right'
-        ]
-        
-        for cmd in ir_commands:
-            self.test_ir_command(cmd)
-            time.sleep(1)  # Wait between commands
-    
-    def test_ir_command(self, command):
-        """Test sending IR command"""
-        try:
-            # Try different command formats
-            formats = [
-                f'{{"method":"send_ir","params":["{command}"]}}',
-                f'{{"method":"ir_{command}","params":[]}}',
-                f'{{"method":"{command}","params":[]}}'
-            ]
-            
-            for cmd_format in formats:
-                self.send_udp_command(cmd_format.encode())
-                time.sleep(0.5)
-        except Exception as e:
-            pass
+        """Discover new commands by probing common IR command names in each format"""
+        # Probes are paced per device and kept in flight together; candidates that
+        # timed out are skipped until their backoff expires
+        replies = self.prober.discover(self.xiaomi_ip, IR_COMMANDS, on_response=self.handle_udp_response)
+        if replies:
+            self.log_message(f"🔍 Discovery round: {len(replies)} probes answered")
     
     def send_udp_command(self, command):
         """Send UDP command to device"""
@@ -420,12 +314,7 @@ class XiaomiLocalAnalyzer:
             
             try:
                 response, addr = sock.recvfrom(1024)
-                self.log_message(f"📡 Command response: {response.hex()}")
-                self.device_responses.append({
-                    'command': command.decode() if isinstance(command, bytes) else command,
-                    'response': response.hex(),
-                    'timestamp': datetime.now().isoformat()
-                })
+                self.handle_udp_response(command, response)
             except socket.timeout:
                 pass
             
@@ -433,50 +322,39 @@ class XiaomiLocalAnalyzer:
         except Exception as e:
             pass
     
-    def continuous_protocol_analysis(self):
-        """Continuously analyze protocol patterns"""
-        while self.running:
-            try:
-                if self.device_online:
-                    self.analyze_protocol_patterns()
-                time.sleep(30)  # Analyze every 30 seconds
-            except Exception as e:
-                self.log_message(f"Error in protocol analysis: {e}")
-                time.sleep(60)
-    
-    def analyze_protocol_patterns(self):
-        """Analyze protocol patterns from learned data"""
-        # Analyze response patterns
-        if len(self.device_responses) > 0:
-            self.analyze_response_patterns()
-        
-        # Analyze command sequences
-        if len(self.command_sequences) > 0:
-            self.analyze_command_sequences()
+    def handle_udp_response(self, command, response):
+        """Record the device's reply to a command"""
+        self.log_message(f"📡 Command response: {response.hex()}")
+        self.record_exchange(command, response)
+        self.device_responses.append({
+            'command': command.decode() if isinstance(command, bytes) else command,
+            'response': response.hex(),
+            'timestamp': datetime.now().isoformat()
+        })
     
-    def analyze_response_patterns(self):
-        """Analyze patterns in device responses"""
-        responses = list(self.device_responses)
-        
-        # Group by response type
-        response_groups = defaultdict(list)
-        for resp in responses:
-            response_groups[resp['response'][:10]].append(resp)
-        
-        for pattern, group in response_groups.items():
-            if len(group) > 1:
-                self.log_message(f"🔄 Found response pattern: {pattern} ({len(group)} occurrences)")
+    def record_exchange(self, command, response):
+        """Feed a probe and the device's reply to the sequence miner"""
+        if self.capture_runtime is not None and self.capture_runtime.capturing:
+            return  # Already mined from the captured datagrams; counting them here too would double supports
+        try:
+            sent = json.loads(command)
+        except ValueError:
+            sent = None
+        method = sent.get('method') if isinstance(sent, dict) else None
+        self.sequence_miner.add(f"cmd {method}" if method else 'cmd raw')
+        # Replies are grouped by their leading bytes
+        self.sequence_miner.add(f"rsp {response.hex()[:10]}")
     
-    def analyze_command_sequences(self):
-        """Analyze command sequences for patterns"""
-        sequences = list(self.command_sequences)
-        
-        # Look for common command sequences
-        if len(sequences) > 2:
-            self.log_message(f"📊 Analyzing {len(sequences)} command sequences...")
+    def analyze_protocol_patterns(self):
+        """Report command/response sequences that became frequent since the last tick"""
+        # The miner counts sequences as events arrive; nothing is regrouped here
+        for report in self.sequence_miner.take_reports():
+            gap = report.get('gap_mean')
+            self.log_message(f"🔄 Found sequence pattern: {' → '.join(report['sequence'])} "
+                             f"({report['count']} occurrences, typical gap {gap}s)")
     
-    def save_learning_data(self):
-        """Save all learning data to files"""
+    def save_learning_data(self, force=False):
+        """Save all learning data to files; every save rewrites them, so force changes nothing"""
         try:
             # Save learned commands
             with open(self.commands_file, 'w') as f:
@@ -494,6 +372,8 @@ class XiaomiLocalAnalyzer:
                 'last_activity': self.last_activity.isoformat() if self.last_activity else None,
                 'analysis_duration': str(datetime.now() - (self.last_activity or datetime.now())),
                 'learned_commands': self.learned_commands,
+                'frequent_sequences': self.sequence_miner.top(),
+                'sequence_stats': self.sequence_miner.stats(),
                 'protocol_analysis': self.protocol_analysis
             }
             
@@ -512,28 +392,14 @@ class XiaomiLocalAnalyzer:
         self.log_message("📊 Analysis will run continuously until stopped")
         self.log_message("🛑 Press Ctrl+C to stop")
         
-        self.running = True
-        
+        # Several devices or analyzers in one process: xiaomi_runtime.py with a pipeline file
+        runtime = AnalyzerRuntime('local_analyzer', None, log=self.log_message)
+        runtime.add(self)
         try:
-            while self.running:
-                # Check device connectivity
-                self.check_device_connectivity()
-                
-                # Save learning data every 5 minutes
-                if self.last_activity and (datetime.now() - self.last_activity).seconds > 300:
-                    self.save_learning_data()
-                    self.last_activity = datetime.now()
-                
-                time.sleep(10)  # Check every 10 seconds
-                
-        except KeyboardInterrupt:
-            self.log_message("🛑 Analysis stopped by user")
+            runtime.run()
         except Exception as e:
             self.log_message(f"❌ Analysis error: {e}")
-        finally:
-            self.running = False
-            self.save_learning_data()
-            self.log_message("✅ Analysis completed and data saved")
+        self.log_message("✅ Analysis completed and data saved")
 
 def main():
     """Main function"""
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Xiaomi miIO Protocol Codec
+Parses, verifies, encrypts and decrypts miIO packets exchanged on UDP port 54321
+Keys are derived once per token and cached per device ID
+"""
+
+import hashlib
+import json
+import struct
+import sys
+import time
+from collections import namedtuple
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:  # Hello/header handling still works without it
+    Cipher = None
+
+from xiaomi_pcap import read_pcap
+
+# Protocol constants
+MIIO_PORT = 54321
+MIIO_MAGIC = 0x2131
+HEADER_SIZE = 32
+HELLO_PACKET = bytes.fromhex('21310020' + 'ff' * 28)
+
+_header = struct.Struct('!HHIII16s')
+
+MiioHeader = namedtuple('MiioHeader', ['length', 'unknown', 'device_id', 'stamp', 'checksum'])
+
+
+class MiioError(Exception):
+    """Raised for malformed packets, bad checksums or missing keys"""
+
+
+def parse_header(data):
+    """Parse the 32-byte miIO header"""
+    if len(data) < HEADER_SIZE:
+        raise MiioError(f"Packet too short for miIO header ({len(data)} bytes)")
+    magic, length, unknown, device_id, stamp, checksum = _header.unpack_from(data, 0)
+    if magic != MIIO_MAGIC:
+        raise MiioError(f"Bad miIO magic 0x{magic:04x}")
+    return MiioHeader(length, unknown, device_id, stamp, checksum)
+
+
+def is_miio_packet(data):
+    """Cheap check for the miIO magic"""
+    return len(data) >= HEADER_SIZE and data[0] == 0x21 and data[1] == 0x31
+
+
+def is_hello(data):
+    """True for a hello request/reply (header only, no payload)"""
+    return is_miio_packet(data) and len(data) == HEADER_SIZE
+
+
+class TokenContext:
+    """AES key/IV derived from one device token, plus the reusable cipher"""
+
+    __slots__ = ('token', 'key', 'iv', 'cipher')
+
+    def __init__(self, token):
+        if Cipher is None:
+            raise MiioError("The 'cryptography' package is required for miIO encryption")
+        self.token = token
+        self.key = hashlib.md5(token).digest()
+        self.iv = hashlib.md5(self.key + token).digest()
+        self.cipher = Cipher(algorithms.AES(self.key), modes.CBC(self.iv), backend=default_backend())
+
+    def encrypt(self, plaintext):
+        """AES-128-CBC encrypt with PKCS#7 padding"""
+        pad = 16 - len(plaintext) % 16
+        encryptor = self.cipher.encryptor()
+        return encryptor.update(plaintext + bytes([pad]) * pad) + encryptor.finalize()
+
+    def decrypt(self, ciphertext):
+        """AES-128-CBC decrypt and strip PKCS#7 padding"""
+        if len(ciphertext) % 16:
+            raise MiioError("Ciphertext is not a multiple of the AES block size")
+        decryptor = self.cipher.decryptor()
+        plaintext = decryptor.update(ciphertext) + decryptor.finalize()
+        pad = plaintext[-1] if plaintext else 0
+        if not 1 <= pad <= 16:
+            raise MiioError("Bad padding, wrong token?")
+        return plaintext[:-pad]
+
+    def checksum(self, header_prefix, encrypted):
+        """MD5 over header (with the token in the checksum slot) and payload"""
+        return hashlib.md5(header_prefix + self.token + encrypted).digest()
+
+
+def normalize_token(token):
+    """Accept a token as 32 hex chars or 16 raw bytes"""
+    if isinstance(token, str):
+        token = bytes.fromhex(token.strip())
+    if len(token) != 16:
+        raise MiioError(f"miIO token must be 16 bytes, got {len(token)}")
+    return token
+
+
+class DeviceTracker:
+    """Tracks device ID and clock stamp per device IP from hello replies"""
+
+    def __init__(self):
+        self.devices = {}
+
+    def update(self, ip, header):
+        """Record the device ID and stamp carried by a packet from ip"""
+        if header.device_id == 0xffffffff:
+            return None
+        entry = self.devices.get(ip)
+        if entry is None:
+            entry = self.devices[ip] = {'device_id': header.device_id}
+        entry['device_id'] = header.device_id
+        entry['stamp'] = header.stamp
+        entry['seen_at'] = time.monotonic()
+        return entry
+
+    def get(self, ip):
+        """Return the tracked entry for ip, or None"""
+        return self.devices.get(ip)
+
+    def next_stamp(self, ip):
+        """Device stamp advanced by the time since it was last seen"""
+        entry = self.devices.get(ip)
+        if entry is None:
+            return None
+        return entry['stamp'] + int(time.monotonic() - entry['seen_at']) + 1
+
+
+class MiioCodec:
+    """Encode and decode miIO frames with per-device key caching"""
+
+    def __init__(self, tokens=None):
+        self._by_token = {}
+        self._by_device = {}
+        self.tracker = DeviceTracker()
+        for device_id, token in (tokens or {}).items():
+            self.register_token(device_id, token)
+
+    def context_for_token(self, token):
+        """Return the cached TokenContext for token, deriving it on first use"""
+        token = normalize_token(token)
+        ctx = self._by_token.get(token)
+        if ctx is None:
+            ctx = self._by_token[token] = TokenContext(token)
+        return ctx
+
+    def register_token(self, device_id, token):
+        """Associate a token with a device ID"""
+        self._by_device[device_id] = self.context_for_token(token)
+
+    def context_for_device(self, device_id):
+        """Cached context for a device ID, or None if its token is unknown"""
+        return self._by_device.get(device_id)
+
+    def verify(self, data, ctx=None):
+        """Check the MD5 checksum of a packet"""
+        header = parse_header(data)
+        if ctx is None:
+            ctx = self._by_device.get(header.device_id)
+            if ctx is None:
+                raise MiioError(f"No token registered for device {header.device_id:08x}")
+        return ctx.checksum(data[:16], data[HEADER_SIZE:header.length]) == header.checksum
+
+    def encode(self, device_id, stamp, payload, unknown=0):
+        """Build an encrypted packet; payload may be bytes, str or a JSON-able dict"""
+        ctx = self._by_device.get(device_id)
+        if ctx is None:
+            raise MiioError(f"No token registered for device {device_id:08x}")
+        if isinstance(payload, dict):
+            payload = json.dumps(payload, separators=(',', ':'))
+        if isinstance(payload, str):
+            payload = payload.encode()
+        encrypted = ctx.encrypt(payload)
+        prefix = struct.pack('!HHIII', MIIO_MAGIC, HEADER_SIZE + len(encrypted),
+                             unknown, device_id, stamp)
+        return prefix + ctx.checksum(prefix, encrypted) + encrypted
+
+    def decode(self, data, ip=None, verify=True):
+        """Decode one frame into a dict; payload is decrypted when the token is known"""
+        header = parse_header(data)
+        if ip is not None:
+            self.tracker.update(ip, header)
+
+        result = {
+            'device_id': f'{header.device_id:08x}',
+            'stamp': header.stamp,
+            'length': header.length,
+            'hello': header.length == HEADER_SIZE,
+        }
+        if result['hello']:
+            result['token'] = header.checksum.hex()
+            return result
+
+        encrypted = data[HEADER_SIZE:header.length]
+        ctx = self._by_device.get(header.device_id)
+        if ctx is None:
+            result['encrypted'] = encrypted.hex()
+            return result
+
+        if verify and ctx.checksum(data[:16], encrypted) != header.checksum:
+            result['error'] = 'checksum mismatch'
+            return result
+
+        plaintext = ctx.decrypt(encrypted).rstrip(b'\x00')
+        try:
+            result['payload'] = json.loads(plaintext)
+        except ValueError:
+            result['payload'] = plaintext.decode('utf-8', errors='replace')
+        return result
+
+    def decode_many(self, frames, verify=True):
+        """Decode an iterable of raw frames or (ip, frame) pairs in one pass"""
+        results = []
+        append = results.append
+        decode = self.decode
+        for item in frames:
+            ip, data = item if isinstance(item, tuple) else (None, item)
+            if not is_miio_packet(data):
+                continue
+            try:
+                append(decode(data, ip=ip, verify=verify))
+            except MiioError as e:
+                append({'error': str(e)})
+        return results
+
+    def decode_response(self, data, ip=None):
+        """Decode a UDP reply, falling back to plaintext JSON or hex for non-miIO data"""
+        if is_miio_packet(data):
+            try:
+                return self.decode(data, ip=ip)
+            except MiioError as e:
+                return {'error': str(e), 'raw': data.hex()}
+        try:
+            return {'payload': json.loads(data)}
+        except ValueError:
+            return {'raw': data.hex()}
+
+
+def main():
+    """Decode miIO frames from a capture file: xiaomi_miio.py capture.pcap [token]"""
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} capture.pcap [token_hex]")
+        sys.exit(1)
+
+    codec = MiioCodec()
+    frames = []
+    for packet in read_pcap(sys.argv[1]):
+        if MIIO_PORT in (packet.src_port, packet.dst_port) and is_miio_packet(packet.payload):
+            frames.append((packet.src_ip, packet.payload))
+
+    if len(sys.argv) > 2:
+        # Register the token against every device ID seen in the capture
+        for _, data in frames:
+            device_id = parse_header(data).device_id
+            if device_id != 0xffffffff:
+                codec.register_token(device_id, sys.argv[2])
+
+    for result in codec.decode_many(frames):
+        print(json.dumps(result))
+    print(f"📊 Decoded {len(frames)} miIO frames")
+
+
+if __name__ == "__main__":
+    main()
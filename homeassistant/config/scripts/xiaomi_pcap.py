@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Packet Capture Reader
+Streaming pcap/pcapng reader that decodes Ethernet/IP/UDP/TCP headers straight from bytes
+Works on saved capture files and on a live `tcpdump -w -` pipe
+"""
+
+import socket
+import struct
+import subprocess
+import sys
+from collections import namedtuple
+
+# Link types we know how to decode
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+# File format magics
+PCAP_MAGIC_US = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER = 0x1a2b3c4d
+
+# pcapng block types
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+# TCP flag bits as tcpdump prints them
+TCP_FLAGS = ((0x01, 'F'), (0x02, 'S'), (0x04, 'R'), (0x08, 'P'), (0x10, '.'), (0x20, 'U'))
+
+_u16 = struct.Struct('!H')
+_ipv4 = struct.Struct('!BBHHHBBH4s4s')
+_ports = struct.Struct('!HH')
+_tcp = struct.Struct('!HHIIBB')
+
+Packet = namedtuple('Packet', [
+    'ts',         # capture time, float seconds since epoch
+    'src_ip',     # dotted/colon string, None for non-IP frames
+    'dst_ip',
+    'proto',      # IP protocol number (6 = TCP, 17 = UDP)
+    'src_port',   # int, 0 for non TCP/UDP
+    'dst_port',
+    'tcp_flags',  # raw TCP flag byte, 0 for UDP
+    'payload',    # transport payload bytes
+    'length',     # original length on the wire
+    'seq',        # TCP sequence number, 0 for non-TCP
+], defaults=(0,))
+
+
+def format_tcp_flags(flags):
+    """Render TCP flags the way tcpdump does (e.g. 'S.', 'P.')"""
+    return ''.join(char for bit, char in TCP_FLAGS if flags & bit) or 'none'
+
+
+def decode_frame(linktype, frame, ts, length):
+    """Decode one link-layer frame into a Packet, or None if it is not IPv4/IPv6"""
+    view = memoryview(frame)
+    size = len(view)
+
+    # Find the network layer
+    if linktype == LINKTYPE_ETHERNET:
+        if size < 14:
+            return None
+        ethertype = _u16.unpack_from(view, 12)[0]
+        offset = 14
+        while ethertype in ETHERTYPE_VLAN and size >= offset + 4:
+            ethertype = _u16.unpack_from(view, offset + 2)[0]
+            offset += 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if size < 16:
+            return None
+        ethertype = _u16.unpack_from(view, 14)[0]
+        offset = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if size < 20:
+            return None
+        ethertype = _u16.unpack_from(view, 0)[0]
+        offset = 20
+    elif linktype == LINKTYPE_NULL:
+        if size < 4:
+            return None
+        # BSD loopback family is in the capturing host's byte order; AF_INET is 2 either way
+        ethertype = ETHERTYPE_IPV4 if 2 in (view[0], view[3]) else ETHERTYPE_IPV6
+        offset = 4
+    elif linktype == LINKTYPE_RAW:
+        if size < 1:
+            return None
+        ethertype = ETHERTYPE_IPV4 if view[0] >> 4 == 4 else ETHERTYPE_IPV6
+        offset = 0
+    else:
+        return None
+
+    # Network layer
+    if ethertype == ETHERTYPE_IPV4:
+        if size < offset + 20:
+            return None
+        (ver_ihl, _, total_len, _, frag, _, proto, _,
+         src, dst) = _ipv4.unpack_from(view, offset)
+        if ver_ihl >> 4 != 4:
+            return None
+        src_ip = socket.inet_ntoa(src)
+        dst_ip = socket.inet_ntoa(dst)
+        end = min(size, offset + total_len) if total_len else size
+        offset += (ver_ihl & 0x0f) * 4
+        # Only the first fragment carries the transport header
+        if frag & 0x1fff:
+            return Packet(ts, src_ip, dst_ip, proto, 0, 0, 0, bytes(view[offset:end]), length)
+    elif ethertype == ETHERTYPE_IPV6:
+        if size < offset + 40:
+            return None
+        payload_len = _u16.unpack_from(view, offset + 4)[0]
+        proto = view[offset + 6]
+        src_ip = socket.inet_ntop(socket.AF_INET6, view[offset + 8:offset + 24])
+        dst_ip = socket.inet_ntop(socket.AF_INET6, view[offset + 24:offset + 40])
+        offset += 40
+        end = min(size, offset + payload_len) if payload_len else size
+    else:
+        return None
+
+    # Transport layer
+    if proto == IPPROTO_TCP and end >= offset + 14:
+        src_port, dst_port, seq, _, data_off, flags = _tcp.unpack_from(view, offset)
+        offset += (data_off >> 4) * 4
+        return Packet(ts, src_ip, dst_ip, proto, src_port, dst_port, flags,
+                      bytes(view[offset:end]), length, seq)
+    if proto == IPPROTO_UDP and end >= offset + 8:
+        src_port, dst_port = _ports.unpack_from(view, offset)
+        return Packet(ts, src_ip, dst_ip, proto, src_port, dst_port, 0,
+                      bytes(view[offset + 8:end]), length)
+    return Packet(ts, src_ip, dst_ip, proto, 0, 0, 0, bytes(view[offset:end]), length)
+
+
+class PcapReader:
+    """Streaming reader for classic pcap and pcapng streams"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.linktype = None
+        self.snaplen = None
+        self.frames_read = 0
+        self.frames_skipped = 0
+
+        magic = self._read_exact(4)
+        if magic is None:
+            raise ValueError("Empty capture stream")
+
+        if struct.unpack('<I', magic)[0] == PCAPNG_SHB:
+            self._format = 'pcapng'
+            self._interfaces = []
+            self._endian = '<'
+            length_raw = self._read_exact(4)
+            if length_raw is None:
+                raise EOFError("Truncated pcapng section header")
+            self._read_section_header(length_raw)
+        else:
+            self._format = 'pcap'
+            self._read_pcap_header(magic)
+
+    def _read_exact(self, size):
+        """Read exactly size bytes, returning None on a clean EOF"""
+        data = self.stream.read(size)
+        if not data:
+            return None
+        while len(data) < size:
+            chunk = self.stream.read(size - len(data))
+            if not chunk:
+                raise EOFError(f"Truncated capture: wanted {size} bytes, got {len(data)}")
+            data += chunk
+        return data
+
+    def _read_pcap_header(self, magic):
+        """Parse the 24-byte classic pcap global header"""
+        for endian in ('<', '>'):
+            value = struct.unpack(endian + 'I', magic)[0]
+            if value in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+                break
+        else:
+            raise ValueError(f"Not a pcap/pcapng stream (magic {magic.hex()})")
+
+        self._endian = endian
+        self._ts_divisor = 1e9 if value == PCAP_MAGIC_NS else 1e6
+        rest = self._read_exact(20)
+        if rest is None:
+            raise EOFError("Truncated pcap global header")
+        _, _, _, _, self.snaplen, self.linktype = struct.unpack(endian + 'HHiIII', rest)
+        self._record = struct.Struct(endian + 'IIII')
+
+    def _read_section_header(self, length_raw):
+        """Parse a pcapng section header block (byte order may change per section)"""
+        byte_order = self._read_exact(4)
+        if byte_order is None:
+            raise EOFError("Truncated pcapng section header")
+        for endian in ('<', '>'):
+            if struct.unpack(endian + 'I', byte_order)[0] == PCAPNG_BYTE_ORDER:
+                break
+        else:
+            raise ValueError("Bad pcapng byte-order magic")
+        self._endian = endian
+        block_len = struct.unpack(endian + 'I', length_raw)[0]
+        self._read_exact(block_len - 12)
+        self._interfaces = []
+
+    def _read_interface(self, body):
+        """Record linktype and timestamp resolution for a pcapng interface"""
+        linktype, _, snaplen = struct.unpack_from(self._endian + 'HHI', body, 0)
+        ts_divisor = 1e6
+        offset = 8
+        while offset + 4 <= len(body):
+            code, opt_len = struct.unpack_from(self._endian + 'HH', body, offset)
+            if code == 0:
+                break
+            if code == 9 and opt_len >= 1:
+                resol = body[offset + 4]
+                ts_divisor = float(2 ** (resol & 0x7f)) if resol & 0x80 else 10.0 ** resol
+            offset += 4 + ((opt_len + 3) & ~3)
+        self._interfaces.append((linktype, ts_divisor))
+        if self.linktype is None:
+            self.linktype = linktype
+            self.snaplen = snaplen
+
+    def _next_pcap_frame(self):
+        """Return (linktype, ts, frame, orig_len) for the next classic pcap record"""
+        header = self._read_exact(16)
+        if header is None:
+            return None
+        ts_sec, ts_frac, incl_len, orig_len = self._record.unpack(header)
+        frame = self._read_exact(incl_len) if incl_len else b''
+        return self.linktype, ts_sec + ts_frac / self._ts_divisor, frame, orig_len
+
+    def _next_pcapng_frame(self):
+        """Return the next packet-bearing pcapng block, skipping metadata blocks"""
+        while True:
+            head = self._read_exact(8)
+            if head is None:
+                return None
+            block_type = struct.unpack(self._endian + 'I', head[:4])[0]
+            if block_type == PCAPNG_SHB:
+                self._read_section_header(head[4:8])
+                continue
+            block_len = struct.unpack(self._endian + 'I', head[4:8])[0]
+            body = self._read_exact(block_len - 8)
+            if body is None:
+                raise EOFError("Truncated pcapng block")
+
+            if block_type == PCAPNG_IDB:
+                self._read_interface(body)
+            elif block_type == PCAPNG_EPB:
+                if_id, ts_high, ts_low, cap_len, orig_len = struct.unpack_from(
+                    self._endian + 'IIIII', body, 0)
+                linktype, ts_divisor = self._interfaces[if_id]
+                ts = ((ts_high << 32) | ts_low) / ts_divisor
+                return linktype, ts, body[20:20 + cap_len], orig_len
+            elif block_type == PCAPNG_SPB and self._interfaces:
+                orig_len = struct.unpack_from(self._endian + 'I', body, 0)[0]
+                linktype, _ = self._interfaces[0]
+                cap_len = min(orig_len, len(body) - 8)
+                return linktype, 0.0, body[4:4 + cap_len], orig_len
+
+    def __iter__(self):
+        next_frame = self._next_pcapng_frame if self._format == 'pcapng' else self._next_pcap_frame
+        while True:
+            try:
+                record = next_frame()
+            except EOFError:
+                # A live pipe cut mid-record; nothing more to decode
+                return
+            if record is None:
+                return
+            linktype, ts, frame, orig_len = record
+            self.frames_read += 1
+            packet = decode_frame(linktype, frame, ts, orig_len)
+            if packet is None:
+                self.frames_skipped += 1
+                continue
+            yield packet
+
+
+def read_pcap(path):
+    """Yield decoded packets from a pcap/pcapng file on disk"""
+    with open(path, 'rb') as f:
+        yield from PcapReader(f)
+
+
+def open_live_capture(bpf_filter, interface='any', sudo=False):
+    """Start tcpdump writing raw pcap to stdout; returns (process, PcapReader)"""
+    cmd = ['tcpdump', '-i', interface, '-n', '-U', '-s', '0', '-w', '-', bpf_filter]
+    if sudo:
+        cmd.insert(0, 'sudo')
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return process, PcapReader(process.stdout)
+
+
+def main():
+    """Print a one-line summary per packet for the given capture files"""
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} capture.pcap [capture2.pcapng ...]")
+        sys.exit(1)
+
+    for path in sys.argv[1:]:
+        count = 0
+        for packet in read_pcap(path):
+            count += 1
+            proto = {IPPROTO_TCP: 'TCP', IPPROTO_UDP: 'UDP'}.get(packet.proto, str(packet.proto))
+            print(f"{packet.ts:.6f} {proto} {packet.src_ip}.{packet.src_port} > "
+                  f"{packet.dst_ip}.{packet.dst_port} len {len(packet.payload)}")
+        print(f"📊 {path}: {count} packets")
+
+
+if __name__ == "__main__":
+    main()
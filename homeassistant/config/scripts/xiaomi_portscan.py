@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Port Scanner
+Probes a (host, port) matrix concurrently with non-blocking connects
+Caches results per host with a TTL and diffs each scan against the previous one
+"""
+
+import asyncio
+import sys
+import time
+
+# Defaults
+COMMON_PORTS = [54321, 8080, 80, 443, 22, 23, 554, 8554, 9999, 8888]
+DEFAULT_TIMEOUT = 1.0
+DEFAULT_CONCURRENCY = 256
+DEFAULT_CACHE_TTL = 20.0
+
+
+class PortScanner:
+    """Concurrent TCP connect scanner with per-host result caching"""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, concurrency=DEFAULT_CONCURRENCY,
+                 cache_ttl=DEFAULT_CACHE_TTL):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.cache_ttl = cache_ttl
+        self._cache = {}      # host -> (scanned_at, ports tuple, open ports frozenset)
+        self._previous = {}   # host -> open ports from the last diffed scan
+
+    async def _probe(self, host, port, semaphore):
+        """Return True if host:port accepts a TCP connection"""
+        async with semaphore:
+            try:
+                _, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port), self.timeout)
+            except (asyncio.TimeoutError, OSError):
+                return False
+            writer.close()
+            return True
+
+    async def scan_matrix(self, hosts, ports):
+        """Probe every (host, port) pair at once; returns {host: set(open ports)}"""
+        ports = list(ports)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pairs = [(host, port) for host in hosts for port in ports]
+        results = await asyncio.gather(*(self._probe(h, p, semaphore) for h, p in pairs))
+
+        open_ports = {host: set() for host in hosts}
+        for (host, port), is_open in zip(pairs, results):
+            if is_open:
+                open_ports[host].add(port)
+
+        now = time.monotonic()
+        key = tuple(sorted(ports))
+        for host, found in open_ports.items():
+            self._cache[host] = (now, key, frozenset(found))
+        return open_ports
+
+    def cached(self, host, ports):
+        """Cached open ports for host if a fresh scan of the same ports exists"""
+        entry = self._cache.get(host)
+        if entry is None:
+            return None
+        scanned_at, key, found = entry
+        if key != tuple(sorted(ports)) or time.monotonic() - scanned_at > self.cache_ttl:
+            return None
+        return set(found)
+
+    def scan(self, hosts, ports=COMMON_PORTS, use_cache=True):
+        """Blocking scan of many hosts, reusing fresh cached results"""
+        results = {}
+        stale = []
+        for host in hosts:
+            hit = self.cached(host, ports) if use_cache else None
+            if hit is None:
+                stale.append(host)
+            else:
+                results[host] = hit
+        if stale:
+            results.update(asyncio.run(self.scan_matrix(stale, ports)))
+        return results
+
+    def scan_host(self, host, ports=COMMON_PORTS, use_cache=True):
+        """Blocking scan of one host; returns set(open ports)"""
+        return self.scan([host], ports, use_cache=use_cache)[host]
+
+    def scan_changes(self, host, ports=COMMON_PORTS, use_cache=True):
+        """Scan host and diff against the previous call: (current, opened, closed)"""
+        current = self.scan_host(host, ports, use_cache=use_cache)
+        previous = self._previous.get(host, set())
+        self._previous[host] = current
+        return current, current - previous, previous - current
+
+
+def main():
+    """Scan hosts: xiaomi_portscan.py host [host ...]"""
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} host [host ...]")
+        sys.exit(1)
+    start = time.monotonic()
+    for host, found in PortScanner().scan(sys.argv[1:]).items():
+        print(f"🔍 {host}: {sorted(found) if found else 'no open ports'}")
+    print(f"📊 Scanned in {time.monotonic() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Xiaomi MAC Resolver
+Keeps a MAC -> IP map with TTL, seeded from /proc/net/arp and kept current by rtnetlink neighbour events
+Falls back to re-reading /proc/net/arp every second where netlink is unavailable, and to
+parsing `arp -an` every few seconds where there is no /proc/net/arp (macOS, BSD)
+Unknown MACs trigger ARP only as needed: the last known address first, then one raw ARP sweep of the subnet
+"""
+
+import os
+import re
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from xiaomi_discovery import arp_sweep, local_ip, normalize_mac, sweep_subnet, to_network
+
+# Defaults
+DEFAULT_TTL = 300.0           # seconds an entry stays valid without being seen again
+DEFAULT_POLL_INTERVAL = 1.0   # seconds between /proc/net/arp reads when netlink is unavailable
+COMMAND_POLL_INTERVAL = 5.0   # seconds between `arp -an` runs where there is no /proc/net/arp
+RETRY_INTERVAL = 30.0         # seconds before sweeping the subnet again for the same unknown MAC
+TARGETED_WAIT = 0.2           # seconds to wait for a reply from the last known address
+ARP_TABLE = "/proc/net/arp"
+
+# rtnetlink constants (linux/rtnetlink.h, linux/neighbour.h)
+NETLINK_ROUTE = 0
+RTMGRP_NEIGH = 0x4
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+NDA_DST = 1
+NDA_LLADDR = 2
+NUD_FAILED = 0x20
+NUD_VALID = 0x02 | 0x04 | 0x08 | 0x10 | 0x40 | 0x80   # reachable, stale, delay, probe, noarp, permanent
+ATF_COM = 0x2                 # /proc/net/arp flag for a completed entry
+_nlmsghdr = struct.Struct('=IHHII')
+_ndmsg = struct.Struct('=BxxxiHBB')
+_rtattr = struct.Struct('=HH')
+# "? (192.168.68.62) at d4:35:38:a:bc:57 on en1 ifscope [ethernet]" (macOS)
+# "? (192.168.68.62) at d4:35:38:0a:bc:57 [ether] on eth0" (Linux net-tools)
+_arp_line = re.compile(r'\((\d+\.\d+\.\d+\.\d+)\) at ([0-9a-fA-F:]+)(?:\s.*?\bon (\S+))?')
+
+
+def has_proc_arp(path=ARP_TABLE):
+    return os.path.exists(path)
+
+
+def read_arp_command():
+    """Completed entries from `arp -an` as {mac: (ip, device)}; incomplete ones are skipped"""
+    table = {}
+    try:
+        output = subprocess.run(['arp', '-an'], capture_output=True, text=True, timeout=5).stdout
+    except (OSError, subprocess.SubprocessError):
+        return table
+    for line in output.splitlines():
+        match = _arp_line.search(line)
+        if not match or match.group(2).count(':') != 5:
+            continue
+        mac = normalize_mac(match.group(2))
+        if mac not in ('00:00:00:00:00:00', 'ff:ff:ff:ff:ff:ff'):
+            table[mac] = (match.group(1), match.group(3))
+    return table
+
+
+def read_arp_table(path=ARP_TABLE):
+    """Completed IPv4 neighbour entries as {mac: (ip, device)}, from `arp -an` without /proc"""
+    if not has_proc_arp(path):
+        return read_arp_command()
+    table = {}
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()[1:]
+    except OSError:
+        return table
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 6 or not int(fields[2], 16) & ATF_COM:
+            continue
+        mac = fields[3].lower()
+        if mac != '00:00:00:00:00:00':
+            table[mac] = (fields[0], fields[5])
+    return table
+
+
+def parse_neighbor_messages(data):
+    """Yield (event, ip, mac, state) from a buffer of rtnetlink messages; mac may be None"""
+    offset = 0
+    while offset + _nlmsghdr.size <= len(data):
+        length, kind = _nlmsghdr.unpack_from(data, offset)[:2]
+        if length < _nlmsghdr.size:
+            return
+        if kind in (RTM_NEWNEIGH, RTM_DELNEIGH):
+            body = offset + _nlmsghdr.size
+            family, _, state, _, _ = _ndmsg.unpack_from(data, body)
+            ip = mac = None
+            position = body + _ndmsg.size
+            end = offset + length
+            while family == socket.AF_INET and position + _rtattr.size <= end:
+                attr_length, attr_type = _rtattr.unpack_from(data, position)
+                if attr_length < _rtattr.size:
+                    break
+                value = data[position + _rtattr.size:position + attr_length]
+                if attr_type == NDA_DST and len(value) == 4:
+                    ip = socket.inet_ntoa(value)
+                elif attr_type == NDA_LLADDR and len(value) == 6:
+                    mac = value.hex(':')
+                position += (attr_length + 3) & ~3
+            if ip:
+                yield kind, ip, mac, state
+        offset += (length + 3) & ~3
+
+
+class MacResolver:
+    """MAC -> IP cache that follows the kernel neighbour table
+
+    lookup() only reads memory (and /proc/net/arp once when an entry is missing
+    or expired); resolve() may send ARP. With start(), a background thread applies
+    neighbour events as they happen, so a device that renews its DHCP lease is
+    found at its new address as soon as the kernel learns it, and listeners are
+    told about the move.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, network=None, interface=None, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.ttl = ttl
+        self.network = network
+        self.interface = interface
+        self.poll_interval = poll_interval
+        self.entries = {}        # mac -> [ip, expires (monotonic), source]
+        self.previous = {}       # mac -> last ip, kept after expiry for targeted ARP
+        self.listeners = []
+        self.method = None
+        self.stats = {'hits': 0, 'misses': 0, 'events': 0, 'table_reads': 0,
+                      'targeted_arp': 0, 'sweeps': 0, 'moves': 0}
+        self._lock = threading.Condition()
+        self._swept = {}         # mac -> monotonic time of the last subnet sweep
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_listener(self, callback):
+        """callback(mac, ip, previous_ip) when a MAC appears, moves or (ip None) disappears"""
+        self.listeners.append(callback)
+
+    def learn(self, mac, ip, source):
+        """Record that mac is at ip now"""
+        mac = normalize_mac(mac)
+        with self._lock:
+            entry = self.entries.get(mac)
+            previous = entry[0] if entry else self.previous.get(mac)
+            self.entries[mac] = [ip, time.monotonic() + self.ttl, source]
+            self.previous[mac] = ip
+            self._lock.notify_all()
+        if previous != ip:
+            if previous is not None:
+                self.stats['moves'] += 1
+            for callback in self.listeners:
+                callback(mac, ip, previous)
+
+    def forget(self, ip):
+        """Drop whatever MAC the kernel no longer associates with ip"""
+        with self._lock:
+            gone = [mac for mac, entry in self.entries.items() if entry[0] == ip]
+            for mac in gone:
+                del self.entries[mac]
+        for mac in gone:
+            for callback in self.listeners:
+                callback(mac, None, ip)
+
+    def refresh(self):
+        """Load every completed entry of the kernel ARP table"""
+        self.stats['table_reads'] += 1
+        table = read_arp_table()
+        for mac, (ip, device) in table.items():
+            self.learn(mac, ip, 'kernel')
+        return table
+
+    def lookup(self, mac, refresh=True):
+        """Cached IP for mac, re-reading the kernel table once if missing or expired; never sends packets"""
+        mac = normalize_mac(mac)
+        entry = self.entries.get(mac)
+        if entry and entry[1] > time.monotonic():
+            self.stats['hits'] += 1
+            return entry[0]
+        self.stats['misses'] += 1
+        if refresh:
+            self.refresh()
+            entry = self.entries.get(mac)
+            if entry and entry[1] > time.monotonic():
+                return entry[0]
+        return None
+
+    def resolve(self, mac, exclude=()):
+        """IP for mac, sending ARP only when the cache and kernel table cannot answer"""
+        mac = normalize_mac(mac)
+        ip = self.lookup(mac)
+        if ip:
+            return ip
+
+        # Most moves are lease renewals to the same address: ask that one first
+        previous = self.previous.get(mac)
+        if previous:
+            self.stats['targeted_arp'] += 1
+            try:
+                for found_ip, found_mac in arp_sweep([previous], self.interface, wait=TARGETED_WAIT).items():
+                    self.learn(found_mac, found_ip, 'arp')
+            except (OSError, AttributeError):
+                pass
+            ip = self.lookup(mac, refresh=False)
+            if ip:
+                return ip
+
+        # Unknown: one sweep of the subnet, at most every RETRY_INTERVAL per MAC
+        now = time.monotonic()
+        if now - self._swept.get(mac, float('-inf')) < RETRY_INTERVAL:
+            return None
+        self._swept[mac] = now
+        self.stats['sweeps'] += 1
+        network = to_network(self.network or local_ip() or '192.168.1')
+        skip = set(exclude)
+        hosts = [str(host) for host in network.hosts() if str(host) not in skip]
+        try:
+            for found_ip, found_mac in arp_sweep(hosts, self.interface).items():
+                self.learn(found_mac, found_ip, 'arp')
+        except (OSError, AttributeError):
+            # No raw sockets: TCP connects make the kernel ARP for every host instead
+            sweep_subnet(network, exclude=exclude, use_arp=False, use_hello=False)
+            self.refresh()
+        return self.lookup(mac, refresh=False)
+
+    def wait_for(self, mac, timeout=None):
+        """Block until mac has a valid entry (from events or the poller); returns its IP or None"""
+        mac = normalize_mac(mac)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while True:
+                entry = self.entries.get(mac)
+                if entry and entry[1] > time.monotonic():
+                    return entry[0]
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._lock.wait(remaining)
+
+    def _open_netlink(self):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        try:
+            sock.bind((0, RTMGRP_NEIGH))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _apply(self, data):
+        for kind, ip, mac, state in parse_neighbor_messages(data):
+            self.stats['events'] += 1
+            if kind == RTM_NEWNEIGH and mac and state & NUD_VALID:
+                self.learn(mac, ip, 'netlink')
+            elif kind == RTM_DELNEIGH or state & NUD_FAILED:
+                self.forget(ip)
+
+    def _run(self):
+        try:
+            sock = self._open_netlink()
+            self.method = 'netlink'
+        except (OSError, AttributeError):
+            sock = None
+            self.method = 'poll' if has_proc_arp() else 'arp'
+        # Running arp every second would cost more than the moves it catches
+        interval = self.poll_interval if self.method != 'arp' else max(self.poll_interval, COMMAND_POLL_INTERVAL)
+        try:
+            while not self._stop.is_set():
+                if sock is None:
+                    self.refresh()
+                    self._stop.wait(interval)
+                    continue
+                if select.select([sock], [], [], self.poll_interval)[0]:
+                    self._apply(sock.recv(65536))
+        finally:
+            if sock is not None:
+                sock.close()
+
+    def start(self):
+        """Load the kernel table and follow neighbour changes in a background thread"""
+        self.refresh()
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='mac-resolver', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.poll_interval + 1)
+            self._thread = None
+
+
+def main():
+    """Resolve and follow MACs: xiaomi_resolver.py mac [mac ...]"""
+    if len(sys.argv) < 2:
+        print("Usage: xiaomi_resolver.py mac [mac ...]")
+        sys.exit(1)
+    resolver = MacResolver()
+    resolver.add_listener(lambda mac, ip, previous: print(f"🔄 {mac}: {previous} -> {ip}"))
+    resolver.start()
+    for mac in sys.argv[1:]:
+        started = time.perf_counter()
+        ip = resolver.resolve(mac)
+        print(f"{'✅' if ip else '❌'} {normalize_mac(mac)} -> {ip} ({(time.perf_counter() - started) * 1000:.2f} ms)")
+    print(f"👀 Following neighbour changes via {resolver.method}, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"📊 {resolver.stats}")
+    except KeyboardInterrupt:
+        resolver.stop()
+
+
+if __name__ == "__main__":
+    main()
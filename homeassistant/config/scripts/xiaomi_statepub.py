@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Xiaomi State Publisher
+Coalesces per-packet state updates and rewrites the state file at most max_rate times per second
+Each write goes to a temp file that is renamed over the old one, so readers never see a partial file
+Keeps packet, byte and last-activity counters per interface and direction
+Serves the same document on localhost: /state, /state?since=<version> (long-poll) and /events (server-sent events)
+Until the first write, /state serves the file a previous run left behind, or 503 if there is none
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import urlopen
+
+# Defaults
+DEFAULT_HOST = "127.0.0.1"       # never exposed beyond the machine
+DEFAULT_PORT = 9490
+DEFAULT_MAX_RATE = 2.0           # state file writes per second
+DEFAULT_POLL_TIMEOUT = 30.0      # seconds a long-poll waits for a newer version
+MAX_POLL_TIMEOUT = 300.0
+
+
+def _isoformat(ts):
+    return datetime.fromtimestamp(ts).isoformat() if ts else None
+
+
+class StatePublisher:
+    """Owner of one state file; update() and record() are cheap, a writer thread does the I/O
+
+    Every change bumps the version; the writer wakes on the first change, waits out
+    the rest of the 1/max_rate interval so that later changes join the same write,
+    then serializes once for both the file and any waiting HTTP clients.
+    """
+
+    def __init__(self, path, max_rate=DEFAULT_MAX_RATE, indent=2, **fields):
+        self.path = path
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.indent = indent
+        self.fields = dict(fields)
+        self.interfaces = {}     # interface -> direction -> [packets, bytes, last ts]
+        self.version = 0
+        self.published_version = 0
+        self.document = self._previous_document()
+        self.stats = {'updates': 0, 'writes': 0, 'errors': 0}
+        self._changed = threading.Condition()
+        self._published = threading.Condition()
+        self._last_write = 0.0
+        self._closed = False
+        self._httpd = None
+        self._thread = threading.Thread(target=self._run, name=f"statepub:{os.path.basename(path)}", daemon=True)
+        self._thread.start()
+
+    def _previous_document(self):
+        """The state file from an earlier run, if it is valid JSON"""
+        try:
+            with open(self.path, 'rb') as f:
+                document = f.read()
+            json.loads(document)
+            return document
+        except (OSError, ValueError):
+            return b''
+
+    def update(self, **fields):
+        """Set top-level fields of the state document"""
+        with self._changed:
+            self.fields.update(fields)
+            self._bump()
+
+    def record(self, interface, direction, size, ts=None, **fields):
+        """Count one packet of size bytes; extra fields are set like update()"""
+        ts = ts or time.time()
+        with self._changed:
+            counters = self.interfaces.setdefault(interface, {}).get(direction)
+            if counters is None:
+                counters = self.interfaces[interface][direction] = [0, 0, 0.0]
+            counters[0] += 1
+            counters[1] += size
+            counters[2] = max(counters[2], ts)
+            if fields:
+                self.fields.update(fields)
+            self.fields['last_activity'] = _isoformat(ts)
+            self._bump()
+
+    def _bump(self):
+        self.version += 1
+        self.stats['updates'] += 1
+        self._changed.notify()
+
+    def snapshot(self):
+        """Current state as a JSON-friendly dict"""
+        with self._changed:
+            state = dict(self.fields)
+            state['interfaces'] = {
+                interface: {direction: {'packets': packets, 'bytes': size, 'last_activity': _isoformat(last)}
+                            for direction, (packets, size, last) in directions.items()}
+                for interface, directions in self.interfaces.items()}
+            state['version'] = self.version
+            return state
+
+    def publish(self):
+        """Serialize, atomically replace the state file and wake long-polling clients"""
+        state = self.snapshot()
+        document = json.dumps(state, indent=self.indent, default=str).encode()
+        try:
+            tmp_file = f"{self.path}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(document)
+            os.replace(tmp_file, self.path)
+            self.stats['writes'] += 1
+        except OSError as e:
+            self.stats['errors'] += 1
+            print(f"Error updating state: {e}")
+        self._last_write = time.monotonic()
+        with self._published:
+            self.document = document
+            self.published_version = state['version']
+            self._published.notify_all()
+
+    def wait(self, since, timeout=DEFAULT_POLL_TIMEOUT):
+        """Block until a version newer than since is published; returns (version, document)"""
+        deadline = time.monotonic() + timeout
+        with self._published:
+            while self.published_version <= since and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._published.wait(remaining)
+            return self.published_version, self.document
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while self.version == self.published_version and not self._closed:
+                    self._changed.wait()
+                if self._closed and self.version == self.published_version:
+                    break
+            # Let further updates pile up until the next write is allowed
+            delay = self._last_write + self.min_interval - time.monotonic()
+            if delay > 0 and not self._closed:
+                time.sleep(delay)
+            self.publish()
+
+    def serve(self, port=DEFAULT_PORT, host=DEFAULT_HOST):
+        """Serve the state over HTTP on a daemon thread; returns the bound port (useful with port 0)"""
+        if self._httpd is None:
+            self._httpd = ThreadingHTTPServer((host, port), _Handler)
+            self._httpd.daemon_threads = True
+            self._httpd.publisher = self
+            threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self._httpd.server_address[1]
+
+    def close(self):
+        """Write out pending changes, stop the writer and the HTTP endpoint"""
+        if self._closed:
+            return
+        with self._changed:
+            self._closed = True
+            self._changed.notify()
+        self._thread.join(timeout=5.0)
+        with self._published:
+            self._published.notify_all()
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'XiaomiState/1.0'
+
+    def do_GET(self):
+        publisher = self.server.publisher
+        path, _, query = self.path.partition('?')
+        params = dict(part.partition('=')[::2] for part in query.split('&') if part)
+        try:
+            since = int(params.get('since', -1))
+            timeout = min(float(params.get('timeout', DEFAULT_POLL_TIMEOUT)), MAX_POLL_TIMEOUT)
+        except ValueError:
+            self.send_error(400)
+            return
+        path = path.rstrip('/') or '/'
+        if path in ('/', '/state'):
+            if since >= 0:
+                version, document = publisher.wait(since, timeout)
+            else:
+                version, document = publisher.published_version, publisher.document
+            if not document:
+                # Nothing to serve yet; an empty 200 would fail to parse in the REST sensor
+                self.send_response(503)
+                self.send_header('Retry-After', '1')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(document)))
+            self.send_header('X-State-Version', str(version))
+            self.end_headers()
+            self.wfile.write(document)
+        elif path == '/events':
+            self._stream(publisher, max(since, 0))
+        else:
+            self.send_error(404)
+
+    def _stream(self, publisher, since):
+        """Server-sent events: one compact JSON event per published version"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while not publisher._closed:
+                version, document = publisher.wait(since)
+                if version > since:
+                    event = json.dumps(json.loads(document), separators=(',', ':'))
+                    self.wfile.write(f"id: {version}\ndata: {event}\n\n".encode())
+                    since = version
+                else:
+                    self.wfile.write(b": keepalive\n\n")
+                self.wfile.flush()
+        except (OSError, ValueError):
+            pass  # Client went away
+
+    def log_message(self, format, *args):
+        pass  # Polls must not flood the monitor's log
+
+
+def main():
+    """Print a running monitor's state: xiaomi_statepub.py [port] [since]"""
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    query = f"?since={sys.argv[2]}" if len(sys.argv) > 2 else ''
+    try:
+        with urlopen(f"http://{DEFAULT_HOST}:{port}/state{query}", timeout=MAX_POLL_TIMEOUT + 5) as response:
+            print(response.read().decode())
+    except OSError as e:
+        print(f"❌ No monitor answering on port {port}: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,32 @@ from datetime import datetime
 import re
 import base64
 
+from packet_ring import PacketRing
+from payload_matcher import PayloadMatcher
+
+# Payload patterns per traffic category (matched case-insensitively)
+GOOGLE_PATTERNS = [
+    "assistant", "google", "voice", "speech",
+    "recognition", "command", "action"
+]
+CHROMECAST_PATTERNS = [
+    "chromecast", "cast", "media", "playback",
+    "mDNS", "discovery", "device"
+]
+XIAOMI_PATTERNS = [
+    "xiaomi", "mi home", "miio", "device",
+    "ir", "infrared", "remote"
+]
+MEDIA_PATTERNS = [
+    "play", "pause", "stop", "next", "previous",
+    "volume", "mute", "unmute", "seek"
+]
+DEVICE_PATTERNS = [
+    "device", "control", "command", "action",
+    "ir", "infrared", "remote"
+]
+VOICE_CATEGORY_PREFIX = "voice:"
+
 class L05GNetworkAnalyzer:
     """Advanced network analyzer for L05G Google Voice integration"""
     
@@ -26,9 +52,16 @@ class L05GNetworkAnalyzer:
         
         # Network analysis components
         self.packet_queue = queue.Queue()
+        monitor_config = self.config.get("monitor", {})
+        self.packet_ring = PacketRing(self._process_packet,
+                                      capacity=monitor_config.get("ring_size", 4096),
+                                      workers=monitor_config.get("workers", 2),
+                                      name="L05GPacketRing")
         self.command_database = {}
+        self.database_lock = threading.Lock()
         self.voice_patterns = self.load_voice_patterns()
         self.ir_patterns = self.load_ir_patterns()
+        self.matcher = self.build_matcher()
         
         # Monitoring state
         self.monitoring = False
@@ -68,6 +101,8 @@ class L05GNetworkAnalyzer:
                 "interface": "eth0",
                 "timeout": 30,
                 "packet_limit": 1000,
+                "ring_size": 4096,
+                "workers": 2,
                 "capture_duration": 60
             },
             "l05g": {
@@ -126,6 +161,22 @@ class L05GNetworkAnalyzer:
             "ir_send", "ir_transmit", "ir_signal", "ir_code"
         ]
     
+    def build_matcher(self) -> PayloadMatcher:
+        """Compile endpoints, voice patterns and IR patterns into one automaton"""
+        matcher = PayloadMatcher()
+        google_endpoints = self.config.get("google_assistant", {}).get("api_endpoints", [])
+        xiaomi_endpoints = self.config.get("xiaomi_home", {}).get("api_endpoints", [])
+        
+        matcher.add_patterns("google_assistant", dict.fromkeys(google_endpoints + GOOGLE_PATTERNS))
+        matcher.add_patterns("chromecast", CHROMECAST_PATTERNS)
+        matcher.add_patterns("xiaomi", dict.fromkeys(xiaomi_endpoints + XIAOMI_PATTERNS))
+        matcher.add_patterns("ir", self.ir_patterns)
+        for category, patterns in self.voice_patterns.items():
+            matcher.add_patterns(VOICE_CATEGORY_PREFIX + category, patterns)
+        matcher.add_patterns("media", MEDIA_PATTERNS)
+        matcher.add_patterns("device", DEVICE_PATTERNS)
+        return matcher.compile()
+    
     def start_monitoring(self):
         """Start network monitoring"""
         if self.monitoring:
@@ -145,31 +196,37 @@ class L05GNetworkAnalyzer:
         self.logger.info("Stopped monitoring")
     
     def _monitor_loop(self):
-        """Main monitoring loop"""
+        """Main monitoring loop: stream packets into the ring until stopped"""
+        sniffer = None
         try:
-            # Create comprehensive filter for L05G traffic
+            # Create filter for L05G traffic
             filter_str = f"host {self.l05g_ip}"
             
-            # Start packet capture
-            packets = scapy.sniff(
-                filter=filter_str,
-                timeout=self.config.get("monitor", {}).get("timeout", 30),
-                count=self.config.get("monitor", {}).get("packet_limit", 1000)
-            )
+            # Start continuous capture; each packet is handed to the ring as it arrives
+            self.packet_ring.start()
+            sniffer = scapy.AsyncSniffer(filter=filter_str, prn=self.packet_ring.put, store=False)
+            sniffer.start()
             
-            # Process captured packets
-            for packet in packets:
-                self._process_packet(packet)
+            while self.monitoring:
+                if not sniffer.running:
+                    self.logger.error("Packet capture stopped unexpectedly")
+                    break
+                time.sleep(0.5)
                 
         except Exception as e:
             self.logger.error(f"Monitoring error: {e}")
+        finally:
+            if sniffer is not None and sniffer.running:
+                sniffer.stop()
+            self.packet_ring.stop()
+            self.logger.info(f"Capture stats: {self.packet_ring.stats()}")
     
     def _process_packet(self, packet):
         """Process individual packet"""
         try:
             # Extract packet information
             packet_info = {
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": datetime.fromtimestamp(float(packet.time)).isoformat(),
                 "src_ip": packet[scapy.IP].src if packet.haslayer(scapy.IP) else None,
                 "dst_ip": packet[scapy.IP].dst if packet.haslayer(scapy.IP) else None,
                 "protocol": packet[scapy.IP].proto if packet.haslayer(scapy.IP) else None,
@@ -182,6 +239,9 @@ class L05GNetworkAnalyzer:
                 raw_data = packet[scapy.Raw].load
                 packet_info["raw_data"] = raw_data
                 
+                # Classify the payload against every pattern in one pass
+                packet_info["matches"] = self.matcher.classify(raw_data)
+                
                 # Check for Google Assistant traffic
                 if self._is_google_assistant_traffic(packet_info):
                     self._analyze_google_assistant_traffic(packet_info)
@@ -204,88 +264,34 @@ class L05GNetworkAnalyzer:
         except Exception as e:
             self.logger.error(f"Error processing packet: {e}")
     
+    def _matches(self, packet_info: Dict[str, Any]) -> Dict[str, List[int]]:
+        """Matcher categories for a packet, classifying it on first use"""
+        if "matches" not in packet_info:
+            raw_data = packet_info.get("raw_data")
+            packet_info["matches"] = self.matcher.classify(raw_data) if raw_data else {}
+        return packet_info["matches"]
+    
+    def _payload_text(self, packet_info: Dict[str, Any]) -> str:
+        """Decoded payload, decoded once per packet"""
+        if "data_str" not in packet_info:
+            packet_info["data_str"] = packet_info["raw_data"].decode('utf-8', errors='ignore')
+        return packet_info["data_str"]
+    
     def _is_google_assistant_traffic(self, packet_info: Dict[str, Any]) -> bool:
         """Check if packet is Google Assistant traffic"""
-        if not packet_info.get("raw_data"):
-            return False
-        
-        try:
-            data_str = packet_info["raw_data"].decode('utf-8', errors='ignore')
-            
-            # Check for Google Assistant endpoints
-            google_endpoints = self.config.get("google_assistant", {}).get("api_endpoints", [])
-            for endpoint in google_endpoints:
-                if endpoint in data_str:
-                    return True
-            
-            # Check for Google Assistant patterns
-            google_patterns = [
-                "assistant", "google", "voice", "speech",
-                "recognition", "command", "action"
-            ]
-            
-            return any(pattern in data_str.lower() for pattern in google_patterns)
-            
-        except:
-            return False
+        return "google_assistant" in self._matches(packet_info)
     
     def _is_chromecast_traffic(self, packet_info: Dict[str, Any]) -> bool:
         """Check if packet is Chromecast traffic"""
-        if not packet_info.get("raw_data"):
-            return False
-        
-        try:
-            data_str = packet_info["raw_data"].decode('utf-8', errors='ignore')
-            
-            # Check for Chromecast patterns
-            chromecast_patterns = [
-                "chromecast", "cast", "media", "playback",
-                "mDNS", "discovery", "device"
-            ]
-            
-            return any(pattern in data_str.lower() for pattern in chromecast_patterns)
-            
-        except:
-            return False
+        return "chromecast" in self._matches(packet_info)
     
     def _is_xiaomi_traffic(self, packet_info: Dict[str, Any]) -> bool:
         """Check if packet is Xiaomi Home traffic"""
-        if not packet_info.get("raw_data"):
-            return False
-        
-        try:
-            data_str = packet_info["raw_data"].decode('utf-8', errors='ignore')
-            
-            # Check for Xiaomi endpoints
-            xiaomi_endpoints = self.config.get("xiaomi_home", {}).get("api_endpoints", [])
-            for endpoint in xiaomi_endpoints:
-                if endpoint in data_str:
-                    return True
-            
-            # Check for Xiaomi patterns
-            xiaomi_patterns = [
-                "xiaomi", "mi home", "miio", "device",
-                "ir", "infrared", "remote"
-            ]
-            
-            return any(pattern in data_str.lower() for pattern in xiaomi_patterns)
-            
-        except:
-            return False
+        return "xiaomi" in self._matches(packet_info)
     
     def _is_ir_command(self, packet_info: Dict[str, Any]) -> bool:
         """Check if packet contains IR command"""
-        if not packet_info.get("raw_data"):
-            return False
-        
-        try:
-            data_str = packet_info["raw_data"].decode('utf-8', errors='ignore')
-            
-            # Check for IR command patterns
-            return any(pattern in data_str.lower() for pattern in self.ir_patterns)
-            
-        except:
-            return False
+        return "ir" in self._matches(packet_info)
     
     def _analyze_google_assistant_traffic(self, packet_info: Dict[str, Any]):
         """Analyze Google Assistant traffic"""
@@ -317,21 +323,22 @@ class L05GNetworkAnalyzer:
     def _extract_voice_command(self, packet_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Extract voice command from packet"""
         try:
-            data_str = packet_info["raw_data"].decode('utf-8', errors='ignore')
-            
-            # Look for voice command patterns
-            for category, patterns in self.voice_patterns.items():
-                for pattern in patterns:
-                    if pattern in data_str.lower():
-                        return {
-                            "type": "voice_command",
-                            "category": category,
-                            "pattern": pattern,
-                            "data": data_str,
-                            "timestamp": packet_info["timestamp"]
-                        }
+            # First voice pattern in configuration order
+            voice_ids = [pattern_id
+                         for category, pattern_ids in self._matches(packet_info).items()
+                         if category.startswith(VOICE_CATEGORY_PREFIX)
+                         for pattern_id in pattern_ids]
+            if not voice_ids:
+                return None
             
-            return None
+            category, pattern = self.matcher.patterns[min(voice_ids)]
+            return {
+                "type": "voice_command",
+                "category": category[len(VOICE_CATEGORY_PREFIX):],
+                "pattern": pattern,
+                "data": self._payload_text(packet_info),
+                "timestamp": packet_info["timestamp"]
+            }
             
         except Exception as e:
             self.logger.error(f"Error extracting voice command: {e}")
@@ -340,24 +347,16 @@ class L05GNetworkAnalyzer:
     def _extract_media_command(self, packet_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Extract media command from packet"""
         try:
-            data_str = packet_info["raw_data"].decode('utf-8', errors='ignore')
+            media_ids = self._matches(packet_info).get("media")
+            if not media_ids:
+                return None
             
-            # Look for media command patterns
-            media_patterns = [
-                "play", "pause", "stop", "next", "previous",
-                "volume", "mute", "unmute", "seek"
-            ]
-            
-            for pattern in media_patterns:
-                if pattern in data_str.lower():
-                    return {
-                        "type": "media_command",
-                        "command": pattern,
-                        "data": data_str,
-                        "timestamp": packet_info["timestamp"]
-                    }
-            
-            return None
+            return {
+                "type": "media_command",
+                "command": self.matcher.pattern(media_ids[0]),
+                "data": self._payload_text(packet_info),
+                "timestamp": packet_info["timestamp"]
+            }
             
         except Exception as e:
             self.logger.error(f"Error extracting media command: {e}")
@@ -366,24 +365,16 @@ class L05GNetworkAnalyzer:
     def _extract_device_command(self, packet_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Extract device command from packet"""
         try:
-            data_str = packet_info["raw_data"].decode('utf-8', errors='ignore')
+            device_ids = self._matches(packet_info).get("device")
+            if not device_ids:
+                return None
             
-            # Look for device command patterns
-            device_patterns = [
-                "device", "control", "command", "action",
-                "ir", "infrared", "remote"
-            ]
-            
-            for pattern in device_patterns:
-                if pattern in data_str.lower():
-                    return {
-                        "type": "device_command",
-                        "command": pattern,
-                        "data": data_str,
-                        "timestamp": packet_info["timestamp"]
-                    }
-            
-            return None
+            return {
+                "type": "device_command",
+                "command": self.matcher.pattern(device_ids[0]),
+                "data": self._payload_text(packet_info),
+                "timestamp": packet_info["timestamp"]
+            }
             
         except Exception as e:
             self.logger.error(f"Error extracting device command: {e}")
@@ -394,8 +385,7 @@ class L05GNetworkAnalyzer:
         self.logger.info(f"Voice command detected: {voice_command['pattern']}")
         
         # Store command in database
-        command_id = f"voice_{int(time.time())}"
-        self.command_database[command_id] = voice_command
+        self._store_command("voice", voice_command)
         
         # Analyze for IR command generation
         ir_command = self._analyze_voice_for_ir(voice_command)
@@ -407,16 +397,19 @@ class L05GNetworkAnalyzer:
         self.logger.info(f"Media command detected: {media_command['command']}")
         
         # Store command in database
-        command_id = f"media_{int(time.time())}"
-        self.command_database[command_id] = media_command
+        self._store_command("media", media_command)
     
     def _handle_device_command(self, device_command: Dict[str, Any]):
         """Handle detected device command"""
         self.logger.info(f"Device command detected: {device_command['command']}")
         
         # Store command in database
-        command_id = f"device_{int(time.time())}"
-        self.command_database[command_id] = device_command
+        self._store_command("device", device_command)
+    
+    def _store_command(self, kind: str, command: Dict[str, Any]):
+        """Add a command to the database; workers call this concurrently with saves"""
+        with self.database_lock:
+            self.command_database[f"{kind}_{int(time.time())}"] = command
     
     def _analyze_voice_for_ir(self, voice_command: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Analyze voice command for IR command generation"""
@@ -442,8 +435,7 @@ class L05GNetworkAnalyzer:
         self.logger.info(f"IR command detected: {ir_command}")
         
         # Store IR command in database
-        command_id = f"ir_{int(time.time())}"
-        self.command_database[command_id] = ir_command
+        self._store_command("ir", ir_command)
         
         # Save to file
         self.save_command_database()
@@ -451,8 +443,10 @@ class L05GNetworkAnalyzer:
     def save_command_database(self):
         """Save command database to file"""
         try:
-            with open("l05g_commands.json", 'w') as f:
-                json.dump(self.command_database, f, indent=2)
+            # Workers add commands concurrently; serialize writers and dump a copy
+            with self.database_lock:
+                with open("l05g_commands.json", 'w') as f:
+                    json.dump(dict(self.command_database), f, indent=2)
             self.logger.info("Command database saved")
         except Exception as e:
             self.logger.error(f"Error saving command database: {e}")
@@ -467,12 +461,13 @@ class L05GNetworkAnalyzer:
     
     def get_commands(self) -> Dict[str, Any]:
         """Get all captured commands"""
-        return self.command_database
+        with self.database_lock:
+            return dict(self.command_database)
     
     def get_ir_commands(self) -> Dict[str, Any]:
         """Get IR commands only"""
         ir_commands = {}
-        for command_id, command_data in self.command_database.items():
+        for command_id, command_data in self.get_commands().items():
             if command_data.get("type") == "ir_command":
                 ir_commands[command_id] = command_data
         return ir_commands
@@ -480,7 +475,7 @@ class L05GNetworkAnalyzer:
     def get_voice_commands(self) -> Dict[str, Any]:
         """Get voice commands only"""
         voice_commands = {}
-        for command_id, command_data in self.command_database.items():
+        for command_id, command_data in self.get_commands().items():
             if command_data.get("type") == "voice_command":
                 voice_commands[command_id] = command_data
         return voice_commands
@@ -13,6 +13,9 @@ import threading
 import queue
 from datetime import datetime
 
+from packet_ring import PacketRing
+from xiaomi_reassembly import TcpReassembler
+
 class NetworkMonitor:
     """Network traffic monitor for L05G"""
     
@@ -22,8 +25,17 @@ class NetworkMonitor:
         self.config = self.load_config()
         self.logger = self.setup_logging()
         self.packet_queue = queue.Queue()
+        monitor_config = self.config.get("monitor", {})
+        self.packet_ring = PacketRing(self._process_packet,
+                                      capacity=monitor_config.get("ring_size", 4096),
+                                      workers=monitor_config.get("workers", 2),
+                                      name="NetworkMonitorPacketRing",
+                                      key=self._flow_key)
         self.monitoring = False
         self.monitor_thread = None
+        self.database_lock = threading.Lock()
+        self.reassembler = TcpReassembler()
+        self.reassembler_lock = threading.Lock()  # Guards the flow table; per-flow order comes from the ring's flow key
     
     def setup_logging(self) -> logging.Logger:
         """Setup logging configuration"""
@@ -53,7 +65,9 @@ class NetworkMonitor:
             "monitor": {
                 "interface": "eth0",
                 "timeout": 30,
-                "packet_limit": 1000
+                "packet_limit": 1000,
+                "ring_size": 4096,
+                "workers": 2
             },
             "l05g": {
                 "ports": [80, 443, 8080, 8443],
@@ -85,39 +99,50 @@ class NetworkMonitor:
         self.logger.info("Stopped monitoring")
     
     def _monitor_loop(self):
-        """Main monitoring loop"""
+        """Main monitoring loop: stream packets into the ring until stopped"""
+        sniffer = None
         try:
             # Create filter for L05G traffic
             filter_str = f"host {self.l05g_ip}"
             
-            # Start packet capture
-            packets = scapy.sniff(
-                filter=filter_str,
-                timeout=self.config.get("monitor", {}).get("timeout", 30),
-                count=self.config.get("monitor", {}).get("packet_limit", 1000)
-            )
+            # Start continuous capture; each packet is handed to the ring as it arrives
+            self.packet_ring.start()
+            sniffer = scapy.AsyncSniffer(filter=filter_str, prn=self.packet_ring.put, store=False)
+            sniffer.start()
             
-            # Process captured packets
-            for packet in packets:
-                self._process_packet(packet)
+            while self.monitoring:
+                if not sniffer.running:
+                    self.logger.error("Packet capture stopped unexpectedly")
+                    break
+                time.sleep(0.5)
                 
         except Exception as e:
             self.logger.error(f"Monitoring error: {e}")
+        finally:
+            if sniffer is not None and sniffer.running:
+                sniffer.stop()
+            self.packet_ring.stop()
+            self.logger.info(f"Capture stats: {self.packet_ring.stats()}")
     
     def _process_packet(self, packet):
         """Process individual packet"""
         try:
             # Extract packet information
             packet_info = {
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": datetime.fromtimestamp(float(packet.time)).isoformat(),
                 "src_ip": packet[scapy.IP].src if packet.haslayer(scapy.IP) else None,
                 "dst_ip": packet[scapy.IP].dst if packet.haslayer(scapy.IP) else None,
                 "protocol": packet[scapy.IP].proto if packet.haslayer(scapy.IP) else None,
                 "size": len(packet)
             }
             
-            # Check for HTTP traffic
-            if packet.haslayer(scapy.Raw):
+            if packet.haslayer(scapy.TCP):
+                # HTTP requests can span segments: analyze each reassembled message
+                for message in self._reassemble(packet):
+                    if message.kind.startswith("http"):
+                        self._analyze_http_message(packet_info, message)
+            elif packet.haslayer(scapy.Raw):
+                # Check for HTTP traffic
                 http_data = packet[scapy.Raw].load
                 if self._is_http_traffic(http_data):
                     packet_info["http_data"] = http_data.decode('utf-8', errors='ignore')
@@ -134,6 +159,36 @@ class NetworkMonitor:
         except Exception as e:
             self.logger.error(f"Error processing packet: {e}")
     
+    def _flow_key(self, packet):
+        """Shard key keeping both directions of a TCP flow on one ring worker"""
+        if not packet.haslayer(scapy.IP):
+            return None
+        ip = packet[scapy.IP]
+        if packet.haslayer(scapy.TCP):
+            tcp = packet[scapy.TCP]
+            return frozenset(((ip.src, tcp.sport), (ip.dst, tcp.dport)))
+        return frozenset((ip.src, ip.dst))
+    
+    def _reassemble(self, packet) -> List[Any]:
+        """Feed a TCP segment to the flow table and return the messages it completed"""
+        ip = packet[scapy.IP]
+        tcp = packet[scapy.TCP]
+        with self.reassembler_lock:
+            return self.reassembler.feed_segment(
+                float(packet.time), ip.src, tcp.sport, ip.dst, tcp.dport,
+                tcp.seq, int(tcp.flags), bytes(tcp.payload)
+            )
+    
+    def _analyze_http_message(self, packet_info: Dict[str, Any], message):
+        """Check a complete HTTP message for IR commands"""
+        message_info = dict(packet_info)
+        message_info["http_data"] = message.text()
+        message_info["json_body"] = message.json()
+        message_info["type"] = "http"
+        if self._is_ir_command(message_info):
+            message_info["type"] = "ir_command"
+            self._handle_ir_command(message_info)
+    
     def _is_http_traffic(self, data: bytes) -> bool:
         """Check if data is HTTP traffic"""
         try:
@@ -174,6 +229,10 @@ class NetworkMonitor:
         try:
             http_data = packet_info.get("http_data", "")
             
+            # Reassembled messages carry their parsed JSON body
+            if isinstance(packet_info.get("json_body"), dict):
+                return packet_info["json_body"]
+            
             # Parse JSON data if present
             if "{" in http_data and "}" in http_data:
                 json_start = http_data.find("{")
@@ -249,15 +308,17 @@ class NetworkMonitor:
     def _save_ir_command(self, ir_data: Dict[str, Any]):
         """Save IR command to database"""
         try:
-            # Load existing database
-            database = self.load_ir_database()
-            
-            # Add new command
-            command_id = f"{ir_data['device']}_{ir_data['command']}_{int(time.time())}"
-            database[command_id] = ir_data
-            
-            # Save database
-            self.save_ir_database(database)
+            # Workers may save concurrently; keep load-modify-save atomic
+            with self.database_lock:
+                # Load existing database
+                database = self.load_ir_database()
+                
+                # Add new command
+                command_id = f"{ir_data['device']}_{ir_data['command']}_{int(time.time())}"
+                database[command_id] = ir_data
+                
+                # Save database
+                self.save_ir_database(database)
             self.logger.info(f"Saved IR command: {command_id}")
             
         except Exception as e:
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Packet Ring Buffer for L05G capture
+Bounded ring between a streaming sniffer callback and a pool of analysis workers
+"""
+
+import logging
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+
+class PacketRing:
+    """Bounded drop-oldest ring buffer drained by worker threads
+
+    The capture callback only appends to a deque (atomic under the GIL), so the
+    sniffer never blocks on analysis; when the ring is full the oldest packet is
+    overwritten and counted as dropped.
+
+    With a shard key, each worker drains its own ring and a packet goes to the
+    ring its key hashes to, so packets sharing a key are handled by one worker
+    in the order they were captured.
+    """
+
+    def __init__(self, handler: Callable[[Any], None], capacity: int = 4096,
+                 workers: int = 2, name: str = "PacketRing",
+                 key: Optional[Callable[[Any], Hashable]] = None):
+        self.handler = handler
+        self.capacity = capacity
+        self.workers = max(1, workers)
+        self.name = name
+        self.key = key
+        self.logger = logging.getLogger(name)
+
+        # One ring shared by every worker, or one ring per worker when sharded
+        shards = self.workers if key is not None else 1
+        self._rings: List[deque] = [deque(maxlen=max(1, capacity // shards)) for _ in range(shards)]
+        self._ready = [threading.Event() for _ in range(shards)]
+        self._running = False
+        self._threads: List[threading.Thread] = []
+
+        # Counters are single-writer: received/dropped by the producer, processed per worker
+        self.received = 0
+        self.dropped = 0
+        self._processed = [0] * self.workers
+
+    def put(self, packet: Any) -> None:
+        """Enqueue a packet (sniffer callback); never blocks"""
+        shard = hash(self.key(packet)) % len(self._rings) if self.key is not None else 0
+        ring = self._rings[shard]
+        if len(ring) >= ring.maxlen:
+            self.dropped += 1
+        ring.append(packet)
+        self.received += 1
+        self._ready[shard].set()
+
+    def start(self) -> None:
+        """Start the worker pool"""
+        if self._running:
+            return
+        self._running = True
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, args=(index,),
+                                      name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Stop the workers after they drain what is already buffered"""
+        self._running = False
+        for ready in self._ready:
+            ready.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _worker(self, index: int) -> None:
+        shard = index % len(self._rings)
+        ring, ready = self._rings[shard], self._ready[shard]
+        while True:
+            try:
+                packet = ring.popleft()
+            except IndexError:
+                if not self._running:
+                    return
+                ready.clear()
+                if not ring:  # A put may have landed before the clear
+                    ready.wait(0.5)
+                continue
+
+            try:
+                self.handler(packet)
+            except Exception as e:
+                self.logger.error(f"Error handling packet: {e}")
+            self._processed[index] += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Ring occupancy and throughput counters"""
+        return {
+            "received": self.received,
+            "processed": sum(self._processed),
+            "dropped": self.dropped,
+            "buffered": sum(len(ring) for ring in self._rings),
+            "capacity": self.capacity
+        }
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Multi-Pattern Payload Matcher for L05G traffic
+Aho-Corasick automaton that classifies a raw payload against every pattern in one pass
+"""
+
+import sys
+import time
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+
+class PayloadMatcher:
+    """Aho-Corasick automaton over bytes, matching ASCII case-insensitively"""
+
+    def __init__(self):
+        self.patterns: List[Tuple[str, str]] = []  # pattern id -> (category, pattern)
+        self._delta: Optional[List[List[int]]] = None
+        self._output: List[Tuple[int, ...]] = []
+
+    def add(self, category: str, pattern: str) -> int:
+        """Register a pattern under a category and return its pattern id"""
+        if not pattern:
+            raise ValueError("Empty pattern")
+        self.patterns.append((category, pattern))
+        self._delta = None
+        return len(self.patterns) - 1
+
+    def add_patterns(self, category: str, patterns: Iterable[str]) -> List[int]:
+        """Register several patterns under one category"""
+        return [self.add(category, pattern) for pattern in patterns]
+
+    def compile(self) -> "PayloadMatcher":
+        """Build the trie, failure links and a dense 256-way transition table"""
+        goto: List[Dict[int, int]] = [{}]
+        output: List[List[int]] = [[]]
+        for pattern_id, (_, pattern) in enumerate(self.patterns):
+            state = 0
+            for byte in pattern.lower().encode('utf-8'):
+                if byte not in goto[state]:
+                    goto.append({})
+                    output.append([])
+                    goto[state][byte] = len(goto) - 1
+                state = goto[state][byte]
+            output[state].append(pattern_id)
+
+        # Breadth-first failure links; each state inherits the outputs of its failure state
+        fail = [0] * len(goto)
+        order = []
+        pending = deque(goto[0].values())
+        while pending:
+            state = pending.popleft()
+            order.append(state)
+            for byte, target in goto[state].items():
+                pending.append(target)
+                link = fail[state]
+                while link and byte not in goto[link]:
+                    link = fail[link]
+                fail[target] = goto[link].get(byte, 0) if state else 0
+                output[target].extend(output[fail[target]])
+
+        # Resolve every (state, byte) ahead of time so scanning never follows failure links.
+        # A failure state is always shallower, so its row exists before it is copied.
+        delta: List[List[int]] = [[]] * len(goto)
+        delta[0] = [0] * 256
+        for state in [0] + order:
+            row = list(delta[fail[state]]) if state else delta[0]
+            for byte, target in goto[state].items():
+                row[byte] = target
+                if 97 <= byte <= 122:
+                    row[byte - 32] = target  # ASCII case folding
+            delta[state] = row
+
+        self._delta = delta
+        self._output = [tuple(sorted(set(ids))) for ids in output]
+        return self
+
+    def scan(self, payload: bytes) -> Set[int]:
+        """Ids of every pattern that occurs anywhere in payload"""
+        if self._delta is None:
+            self.compile()
+        delta = self._delta
+        output = self._output
+        state = 0
+        found: Set[int] = set()
+        for byte in payload:
+            state = delta[state][byte]
+            if output[state]:
+                found.update(output[state])
+        return found
+
+    def classify(self, payload: bytes) -> Dict[str, List[int]]:
+        """Matching categories, each with its matching pattern ids in registration order"""
+        categories: Dict[str, List[int]] = {}
+        for pattern_id in sorted(self.scan(payload)):
+            categories.setdefault(self.patterns[pattern_id][0], []).append(pattern_id)
+        return categories
+
+    def pattern(self, pattern_id: int) -> str:
+        """Pattern text for an id"""
+        return self.patterns[pattern_id][1]
+
+
+def naive_classify(matcher: PayloadMatcher, payload: bytes) -> Dict[str, List[int]]:
+    """Reference classifier in the style the analyzer used: decode per category, lowercase per pattern"""
+    categories: Dict[str, List[int]] = {}
+    data_str = None
+    category = None
+    for pattern_id, (pattern_category, pattern) in enumerate(matcher.patterns):
+        if pattern_category != category:
+            category = pattern_category
+            data_str = payload.decode('utf-8', errors='ignore')
+        if pattern.lower() in data_str.lower():
+            categories.setdefault(category, []).append(pattern_id)
+    return categories
+
+
+def load_payloads(pcap_files: List[str]) -> List[bytes]:
+    """Raw transport payloads from capture files"""
+    import scapy.all as scapy
+
+    payloads = []
+    for pcap_file in pcap_files:
+        for packet in scapy.rdpcap(pcap_file):
+            if packet.haslayer(scapy.Raw):
+                payloads.append(bytes(packet[scapy.Raw].load))
+    return payloads
+
+
+def benchmark(matcher: PayloadMatcher, payloads: List[bytes], rounds: int = 50) -> Dict[str, Any]:
+    """Time the automaton against the per-pattern scan over the same payloads"""
+    mismatches = sum(1 for payload in payloads
+                     if matcher.classify(payload) != naive_classify(matcher, payload))
+    results: Dict[str, Any] = {
+        "payloads": len(payloads),
+        "bytes": sum(len(payload) for payload in payloads),
+        "patterns": len(matcher.patterns),
+        "mismatches": mismatches
+    }
+    for name, classify in (("naive", lambda payload: naive_classify(matcher, payload)),
+                           ("automaton", matcher.classify)):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for payload in payloads:
+                classify(payload)
+        elapsed = time.perf_counter() - start
+        results[f"{name}_us_per_payload"] = round(elapsed / max(1, rounds * len(payloads)) * 1e6, 2)
+    return results
+
+
+# Benchmark over captured pcaps
+if __name__ == "__main__":
+    from l05g_network_analyzer import L05GNetworkAnalyzer
+
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} capture.pcap [...]")
+        sys.exit(1)
+
+    analyzer = L05GNetworkAnalyzer("192.168.1.100")
+    payloads = load_payloads(sys.argv[1:])
+    results = benchmark(analyzer.matcher, payloads)
+    for key, value in results.items():
+        print(f"{key}: {value}")
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+"""
+Xiaomi TCP Stream Reassembly
+Reorders TCP segments per direction in a bounded flow table keyed by 5-tuple
+Incremental parsers turn each byte stream into complete HTTP messages or JSON lines
+Idle and least-recently-used flows are evicted so memory stays bounded on long runs
+"""
+
+import json
+import sys
+from collections import OrderedDict, namedtuple
+
+# Defaults (worst case memory is about max_flows * (max_buffer + max_out_of_order))
+DEFAULT_MAX_FLOWS = 256              # half-streams kept at once
+DEFAULT_MAX_BUFFER = 64 * 1024       # unparsed bytes per half-stream
+DEFAULT_MAX_OUT_OF_ORDER = 32 * 1024 # bytes held waiting for a missing segment
+DEFAULT_IDLE_TIMEOUT = 120.0         # seconds without a segment before a flow is evicted
+MAX_HEADER_SIZE = 16 * 1024
+
+IPPROTO_TCP = 6
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+
+HTTP_METHODS = (b'GET ', b'POST ', b'PUT ', b'DELETE ', b'HEAD ', b'OPTIONS ', b'PATCH ')
+
+# Parser modes
+DETECT = 'detect'
+HTTP = 'http'
+LINES = 'lines'
+
+
+class StreamMessage(namedtuple('StreamMessage', ['kind', 'flow', 'ts', 'start_line', 'headers', 'body'])):
+    """A complete HTTP request/response or JSON line from one direction of a flow
+
+    kind is 'http_request', 'http_response' or 'line'; flow is the 5-tuple
+    (proto, src_ip, src_port, dst_ip, dst_port) of the sending side.
+    """
+
+    __slots__ = ()
+
+    def text(self):
+        """Message as text, in the shape it had on the wire"""
+        if self.kind == 'line':
+            return self.body.decode('utf-8', errors='ignore')
+        head = [self.start_line] + [f"{name}: {value}" for name, value in self.headers.items()]
+        return '\r\n'.join(head) + '\r\n\r\n' + self.body.decode('utf-8', errors='ignore')
+
+    def json(self):
+        """Body parsed as JSON, or None"""
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+def seq_diff(a, b):
+    """Signed distance from sequence number b to a, modulo 2**32"""
+    return ((a - b + 0x80000000) & 0xffffffff) - 0x80000000
+
+
+class StreamParser:
+    """Incremental HTTP/1.x and line parser for one direction of a TCP flow
+
+    The first bytes decide the mode: HTTP if they start a request or response,
+    otherwise newline-delimited messages (JSON-over-TCP protocols).
+    """
+
+    def __init__(self, flow, max_buffer=DEFAULT_MAX_BUFFER):
+        self.flow = flow
+        self.max_buffer = max_buffer
+        self.mode = DETECT
+        self.buffer = bytearray()
+        self.head = None        # (start_line, headers) while reading a body
+        self.body_left = 0      # bytes of body still expected (-1: until close)
+        self.chunked = False
+        self.skip = 0           # body bytes to discard after truncation
+
+    def reset(self):
+        """Drop partial state after a gap in the stream"""
+        self.mode = DETECT
+        self.buffer.clear()
+        self.head = None
+        self.body_left = 0
+        self.chunked = False
+        self.skip = 0
+
+    def feed(self, data, ts):
+        """Add in-order stream bytes; returns completed messages"""
+        if self.skip:
+            dropped = min(self.skip, len(data))
+            self.skip -= dropped
+            data = data[dropped:]
+        self.buffer += data
+        messages = []
+        while self.buffer:
+            if self.mode == DETECT:
+                if len(self.buffer) < 8 and b'\n' not in self.buffer:
+                    break
+                prefix = bytes(self.buffer[:8])
+                is_http = prefix.startswith(HTTP_METHODS) or prefix.startswith(b'HTTP/')
+                self.mode = HTTP if is_http else LINES
+            message = self._parse_http(ts) if self.mode == HTTP else self._parse_line(ts)
+            if message is None:
+                break
+            messages.append(message)
+        if len(self.buffer) > self.max_buffer:
+            # A message larger than the buffer: emit what we have and skip the rest
+            messages.extend(self._truncate(ts))
+        return messages
+
+    def close(self, ts):
+        """End of stream: emit a body read until close, or a final unterminated line"""
+        messages = []
+        if self.mode == HTTP and self.head is not None and self.body_left < 0:
+            messages.append(self._message(bytes(self.buffer), ts))
+        elif self.mode == LINES and self.buffer.strip():
+            messages.append(StreamMessage('line', self.flow, ts, '', {}, bytes(self.buffer).strip()))
+        self.reset()
+        return messages
+
+    def _message(self, body, ts):
+        start_line, headers = self.head
+        kind = 'http_response' if start_line.startswith('HTTP/') else 'http_request'
+        self.head = None
+        self.chunked = False
+        self.body_left = 0
+        return StreamMessage(kind, self.flow, ts, start_line, headers, body)
+
+    def _parse_line(self, ts):
+        end = self.buffer.find(b'\n')
+        if end < 0:
+            return None
+        line = bytes(self.buffer[:end]).strip()
+        del self.buffer[:end + 1]
+        if not line:
+            return self._parse_line(ts) if self.buffer else None
+        return StreamMessage('line', self.flow, ts, '', {}, line)
+
+    def _parse_http(self, ts):
+        if self.head is None:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self.buffer) > MAX_HEADER_SIZE:
+                    self.mode = LINES  # Not HTTP after all
+                return None
+            lines = bytes(self.buffer[:end]).decode('latin-1').split('\r\n')
+            del self.buffer[:end + 4]
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            self.head = (lines[0], headers)
+            self.chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+            if 'content-length' in headers:
+                try:
+                    self.body_left = max(0, int(headers['content-length']))
+                except ValueError:
+                    self.body_left = 0
+            elif self.chunked:
+                self.body_left = 0
+            elif lines[0].startswith('HTTP/') and not lines[0][9:12] in ('204', '304'):
+                self.body_left = -1  # Response body runs until the connection closes
+            else:
+                self.body_left = 0
+
+        if self.chunked:
+            return self._parse_chunked(ts)
+        if self.body_left < 0:
+            return None
+        if len(self.buffer) < self.body_left:
+            return None
+        body = bytes(self.buffer[:self.body_left])
+        del self.buffer[:self.body_left]
+        return self._message(body, ts)
+
+    def _parse_chunked(self, ts):
+        """Decode a complete chunked body once all of it has arrived"""
+        body = bytearray()
+        offset = 0
+        while True:
+            end = self.buffer.find(b'\r\n', offset)
+            if end < 0:
+                return None
+            try:
+                size = int(bytes(self.buffer[offset:end]).split(b';')[0], 16)
+            except ValueError:
+                self.reset()
+                return None
+            start = end + 2
+            if size == 0:
+                trailer_end = self.buffer.find(b'\r\n\r\n', end)
+                if trailer_end < 0 and self.buffer[start:start + 2] != b'\r\n':
+                    return None
+                consumed = start + 2 if self.buffer[start:start + 2] == b'\r\n' else trailer_end + 4
+                del self.buffer[:consumed]
+                return self._message(bytes(body), ts)
+            if len(self.buffer) < start + size + 2:
+                return None
+            body += self.buffer[start:start + size]
+            offset = start + size + 2
+
+    def _truncate(self, ts):
+        messages = []
+        if self.mode == HTTP and self.head is not None:
+            body = bytes(self.buffer[:self.max_buffer])
+            if self.body_left > 0:
+                self.skip = max(0, self.body_left - len(self.buffer))
+            elif self.body_left < 0:
+                self.skip = float('inf')  # Body runs until close: discard the rest
+            messages.append(self._message(body, ts))
+            self.buffer.clear()
+            self.mode = DETECT
+        else:
+            self.reset()
+        return messages
+
+
+class HalfStream:
+    """One direction of a TCP connection: sequence tracking plus a parser"""
+
+    __slots__ = ('flow', 'next_seq', 'pending', 'pending_bytes', 'parser', 'last_seen', 'gaps')
+
+    def __init__(self, flow, max_buffer):
+        self.flow = flow
+        self.next_seq = None
+        self.pending = {}          # seq -> out-of-order payload
+        self.pending_bytes = 0
+        self.parser = StreamParser(flow, max_buffer)
+        self.last_seen = 0.0
+        self.gaps = 0
+
+    def add(self, seq, flags, payload, ts, max_out_of_order):
+        """Place a segment in the stream; returns completed messages"""
+        self.last_seen = ts
+        if flags & TCP_SYN:
+            self.next_seq = (seq + 1) & 0xffffffff
+            self.pending.clear()
+            self.pending_bytes = 0
+            self.parser.reset()
+            return []
+        if not payload:
+            return []
+        if self.next_seq is None:
+            self.next_seq = seq  # Joined mid-stream
+
+        offset = seq_diff(seq, self.next_seq)
+        if offset > 0:
+            # Hole before this segment: hold it until the hole is filled
+            if self.pending_bytes + len(payload) <= max_out_of_order:
+                if seq not in self.pending:
+                    self.pending[seq] = payload
+                    self.pending_bytes += len(payload)
+                return []
+            # Too much waiting on a lost segment: give up on the hole
+            self.gaps += 1
+            self.parser.reset()
+            self.pending[seq] = payload
+            self.pending_bytes += len(payload)
+            self.next_seq = min(self.pending, key=lambda s: seq_diff(s, self.next_seq))
+            return self._drain(ts)
+        if -offset >= len(payload):
+            return []  # Pure retransmission
+        return self._deliver(payload[-offset:] if offset else payload, ts)
+
+    def _deliver(self, data, ts):
+        self.next_seq = (self.next_seq + len(data)) & 0xffffffff
+        messages = self.parser.feed(data, ts)
+        if self.pending:
+            messages.extend(self._drain(ts))
+        return messages
+
+    def _drain(self, ts):
+        messages = []
+        progress = True
+        while self.pending and progress:
+            progress = False
+            for seq in list(self.pending):
+                offset = seq_diff(seq, self.next_seq)
+                if offset > 0:
+                    continue
+                data = self.pending.pop(seq)
+                self.pending_bytes -= len(data)
+                progress = True
+                if -offset < len(data):
+                    data = data[-offset:] if offset else data
+                    self.next_seq = (self.next_seq + len(data)) & 0xffffffff
+                    messages.extend(self.parser.feed(data, ts))
+        return messages
+
+
+class TcpReassembler:
+    """Bounded flow table that reassembles TCP payloads into stream messages"""
+
+    def __init__(self, max_flows=DEFAULT_MAX_FLOWS, max_buffer=DEFAULT_MAX_BUFFER,
+                 max_out_of_order=DEFAULT_MAX_OUT_OF_ORDER, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.max_flows = max_flows
+        self.max_buffer = max_buffer
+        self.max_out_of_order = max_out_of_order
+        self.idle_timeout = idle_timeout
+        self.flows = OrderedDict()   # 5-tuple -> HalfStream, least recently active first
+        self.last_sweep = 0.0
+        self.stats = {'segments': 0, 'messages': 0, 'flows_opened': 0,
+                      'flows_closed': 0, 'flows_evicted': 0, 'gaps': 0}
+
+    def feed(self, packet):
+        """Add a captured Packet; returns the stream messages it completed"""
+        if packet.proto != IPPROTO_TCP:
+            return []
+        return self.feed_segment(packet.ts, packet.src_ip, packet.src_port, packet.dst_ip,
+                                 packet.dst_port, packet.seq, packet.tcp_flags, packet.payload)
+
+    def feed_segment(self, ts, src_ip, src_port, dst_ip, dst_port, seq, flags, payload):
+        """Add one TCP segment; returns the stream messages it completed"""
+        self.stats['segments'] += 1
+        messages = self._add_segment(ts, src_ip, src_port, dst_ip, dst_port, seq, flags, payload)
+        self.stats['messages'] += len(messages)
+        return messages
+
+    def _add_segment(self, ts, src_ip, src_port, dst_ip, dst_port, seq, flags, payload):
+        flow = (IPPROTO_TCP, src_ip, src_port, dst_ip, dst_port)
+        messages = []
+        if ts - self.last_sweep >= self.idle_timeout / 4:
+            messages.extend(self.evict_idle(ts))
+
+        stream = self.flows.get(flow)
+        if flags & TCP_RST:
+            # Abort both directions, nothing pending is trustworthy
+            for key in (flow, (IPPROTO_TCP, dst_ip, dst_port, src_ip, src_port)):
+                if self.flows.pop(key, None) is not None:
+                    self.stats['flows_closed'] += 1
+            return messages
+        if stream is None:
+            if not payload and not flags & TCP_SYN:
+                return messages
+            stream = self.flows[flow] = HalfStream(flow, self.max_buffer)
+            self.stats['flows_opened'] += 1
+            while len(self.flows) > self.max_flows:
+                _, oldest = self.flows.popitem(last=False)
+                self.stats['flows_evicted'] += 1
+                messages.extend(oldest.parser.close(ts))
+        else:
+            self.flows.move_to_end(flow)
+
+        gaps = stream.gaps
+        messages.extend(stream.add(seq, flags, payload, ts, self.max_out_of_order))
+        self.stats['gaps'] += stream.gaps - gaps
+        if flags & TCP_FIN:
+            del self.flows[flow]
+            self.stats['flows_closed'] += 1
+            messages.extend(stream.parser.close(ts))
+        return messages
+
+    def evict_idle(self, now):
+        """Close flows idle longer than idle_timeout; returns their final messages"""
+        self.last_sweep = now
+        messages = []
+        while self.flows:
+            flow, stream = next(iter(self.flows.items()))
+            if now - stream.last_seen < self.idle_timeout:
+                break
+            del self.flows[flow]
+            self.stats['flows_evicted'] += 1
+            messages.extend(stream.parser.close(now))
+        return messages
+
+    def flush(self, ts=0.0):
+        """Close every flow (e.g. at the end of a capture file)"""
+        messages = []
+        for stream in self.flows.values():
+            messages.extend(stream.parser.close(ts or stream.last_seen))
+        self.flows.clear()
+        self.stats['messages'] += len(messages)
+        return messages
+
+
+def main():
+    """Print reassembled messages from a capture: xiaomi_reassembly.py capture.pcap"""
+    from xiaomi_pcap import read_pcap
+
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} capture.pcap")
+        sys.exit(1)
+    reassembler = TcpReassembler()
+    messages = []
+    for packet in read_pcap(sys.argv[1]):
+        messages.extend(reassembler.feed(packet))
+    messages.extend(reassembler.flush())
+    for message in messages:
+        _, src_ip, src_port, dst_ip, dst_port = message.flow
+        summary = message.start_line or message.body[:80].decode('utf-8', errors='replace')
+        print(f"{src_ip}:{src_port} > {dst_ip}:{dst_port} {message.kind}: {summary}")
+    print(f"📊 {reassembler.stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Tests for offline replay through the analyzers
+Uses the recordings checked in at the repository root
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from xiaomi_local_analyzer import XiaomiLocalAnalyzer
+from xiaomi_phone_monitor import XiaomiPhoneMonitor
+from xiaomi_replay import replay_args, replay_device
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PHONE_CAPTURE = os.path.join(REPO_ROOT, "xiaomi_phone_all_traffic_20251005_152833.pcap")
+PHONE_IP = "192.168.68.65"
+MDNS_GROUP = "224.0.0.251"
+
+
+class TestReplay(unittest.TestCase):
+    """Replays analyze the recorded packets and write only to the output directory"""
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp(prefix='xiaomi_replay_test_')
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp(prefix='xiaomi_replay_cwd_')
+        os.chdir(self.workdir)
+        # Cleanups run last-in first-out: analyzers release their log sinks before this removes the files
+        self.addCleanup(self.remove_directories)
+
+    def remove_directories(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.output, ignore_errors=True)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def replay(self, *argv):
+        return replay_args(['--replay', PHONE_CAPTURE, '--output', self.output, *argv])
+
+    def open(self, analyzer_class, options):
+        analyzer = analyzer_class(replay_device(options))
+        self.addCleanup(analyzer.close)
+        return analyzer
+
+    def test_local_analyzer_analyzes_phone_capture(self):
+        options = self.replay('--device', PHONE_IP)
+        analyzer = self.open(XiaomiLocalAnalyzer, options)
+        stats = analyzer.run_replay(options['path'])
+        self.assertGreater(stats['packets'], 0)
+        analyzer.close()
+        self.assertIn('xiaomi_discovered_commands.json', os.listdir(self.output))
+        self.assertEqual(os.listdir(self.workdir), [])
+
+    def test_local_analyzer_without_device_matches_nothing(self):
+        options = self.replay()
+        stats = self.open(XiaomiLocalAnalyzer, options).run_replay(options['path'])
+        self.assertEqual(stats['packets'], 0)
+
+    def test_phone_monitor_analyzes_phone_capture(self):
+        # The recording holds the phone's mDNS queries, so the group stands in for the device
+        options = self.replay('--device', MDNS_GROUP)
+        monitor = self.open(XiaomiPhoneMonitor, options)
+        stats = monitor.run_replay(options['path'])
+        self.assertGreater(stats['packets'], 0)
+        self.assertEqual(len(monitor.network_traffic), stats['packets'])
+        self.assertEqual(os.listdir(self.workdir), [])
+
+    def test_phone_monitor_skips_traffic_not_with_the_device(self):
+        options = self.replay()
+        stats = self.open(XiaomiPhoneMonitor, options).run_replay(options['path'])
+        self.assertEqual(stats['packets'], 0)
+
+    def test_default_output_is_a_scratch_directory(self):
+        options = replay_args(['--replay', PHONE_CAPTURE])
+        try:
+            self.assertTrue(os.path.isdir(options['output']))
+            self.assertNotEqual(os.path.abspath(options['output']), self.workdir)
+        finally:
+            shutil.rmtree(options['output'], ignore_errors=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
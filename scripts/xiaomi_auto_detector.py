@@ -10,16 +10,27 @@ import json
 import datetime
 import signal
 import sys
-import re
 import threading
 import os
 
+from xiaomi_capture import open_packet_stream
+from xiaomi_discovery import normalize_mac
+from xiaomi_logsink import get_sink
+from xiaomi_resolver import MacResolver
+
 # Configuration
 PHONE_IP = "192.168.68.65"
 XIAOMI_MAC = "D4-35-38-0A-BC-57"  # Your Xiaomi device MAC address
 LOG_FILE = "xiaomi_auto_monitor.log"
 COMMANDS_FILE = "xiaomi_auto_commands.json"
 TRAFFIC_FILE = "xiaomi_auto_traffic.json"
+NETWORK_BASE = "192.168.68"
+RESCAN_INTERVAL = 60  # seconds between ARP retries while the device is missing
+MAX_WAIT = 1800  # seconds to wait for the device before giving up
+
+# Follows the kernel neighbour table, so a DHCP move is picked up without a rescan
+resolver = MacResolver(network=NETWORK_BASE)
+resolver_mac = normalize_mac(XIAOMI_MAC)
 
 # Global data
 captured_commands = {
@@ -41,10 +52,8 @@ captured_traffic = {
 }
 
 def log_message(message, level='INFO'):
-    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open(LOG_FILE, 'a') as f:
-        f.write(f'[{timestamp}] {level}: {message}\n')
-    print(f'[{timestamp}] {level}: {message}')
+    # Queued; the sink's writer thread prints and appends in batches
+    get_sink(LOG_FILE).log(message, level)
 
 def save_data():
     global captured_commands, captured_traffic
@@ -65,46 +74,11 @@ def find_xiaomi_ip():
     log_message(f'🔍 Searching for Xiaomi device with MAC: {XIAOMI_MAC}')
     
     try:
-        # Use arp to find the device
-        result = subprocess.run(['arp', '-a'], capture_output=True, text=True)
-        arp_output = result.stdout
-        
-        # Look for the MAC address in ARP table
-        for line in arp_output.split('\n'):
-            if XIAOMI_MAC.upper() in line.upper() or XIAOMI_MAC.lower() in line.lower():
-                # Extract IP from line like: "192.168.68.62 (192.168.68.62) at d4:35:38:0a:bc:57"
-                ip_match = re.search(r'(\d+\.\d+\.\d+\.\d+)', line)
-                if ip_match:
-                    ip = ip_match.group(1)
-                    log_message(f'✅ Found Xiaomi device at IP: {ip}')
-                    return ip
-        
-        # If not in ARP table, try to ping the network and then check ARP again
-        log_message('🔍 Device not in ARP table, scanning network...')
-        
-        # Ping the network to populate ARP table
-        network_base = "192.168.68"
-        for i in range(1, 255):
-            ip = f"{network_base}.{i}"
-            if ip != PHONE_IP:  # Don't ping our own phone
-                try:
-                    subprocess.run(['ping', '-c', '1', '-W', '1000', ip], 
-                                capture_output=True, timeout=2)
-                except:
-                    pass
-        
-        # Check ARP table again
-        time.sleep(2)
-        result = subprocess.run(['arp', '-a'], capture_output=True, text=True)
-        arp_output = result.stdout
-        
-        for line in arp_output.split('\n'):
-            if XIAOMI_MAC.upper() in line.upper() or XIAOMI_MAC.lower() in line.lower():
-                ip_match = re.search(r'(\d+\.\d+\.\d+\.\d+)', line)
-                if ip_match:
-                    ip = ip_match.group(1)
-                    log_message(f'✅ Found Xiaomi device at IP: {ip}')
-                    return ip
+        # Cache and kernel neighbour table first; ARP goes out only if both miss
+        ip = resolver.resolve(XIAOMI_MAC, exclude={PHONE_IP})
+        if ip:
+            log_message(f'✅ Found Xiaomi device at IP: {ip}')
+            return ip
         
         log_message('❌ Xiaomi device not found in network')
         return None
@@ -113,6 +87,14 @@ def find_xiaomi_ip():
         log_message(f'Error finding Xiaomi device: {e}')
         return None
 
+def on_xiaomi_moved(mac, ip, previous_ip):
+    """Resolver listener: follow the device to its new address"""
+    if mac != resolver_mac or ip is None:
+        return
+    if previous_ip and previous_ip != ip:
+        log_message(f'🔄 Xiaomi device moved: {previous_ip} -> {ip}')
+    captured_commands['xiaomi_ip'] = ip
+
 def test_connectivity(ip):
     """Test if we can reach the Xiaomi device"""
     try:
@@ -132,61 +114,55 @@ def start_monitoring(xiaomi_ip):
     captured_commands['xiaomi_ip'] = xiaomi_ip
     
     try:
-        # Start tcpdump with specific filter
-        tcpdump_filter = f'host {PHONE_IP} and host {xiaomi_ip}'
-        log_message(f'🔍 Running: sudo tcpdump -i en1 -n -l -A -s 0 {tcpdump_filter}')
+        # Subscribe to the phone's packets (shared capture daemon if running); the Xiaomi
+        # side is matched against the resolver's current address so DHCP moves need no restart
+        tcpdump_filter = f'host {PHONE_IP}'
+        log_message(f'🔍 Capturing on en1: {tcpdump_filter}')
         
-        process = subprocess.Popen(
-            ['sudo', 'tcpdump', '-i', 'en1', '-n', '-l', '-A', '-s', '0', tcpdump_filter],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1
-        )
+        stream = open_packet_stream(tcpdump_filter, 'auto_detector', 'en1', sudo=True)
         
-        log_message('✅ tcpdump monitoring started')
-        log_message('📊 Reading tcpdump output...')
+        log_message('✅ Packet monitoring started')
+        log_message('📊 Reading packets...')
         log_message('🎯 NOW SEND COMMANDS FROM YOUR PHONE!')
         
         last_save_time = time.time()
         
-        while True:
-            line = process.stdout.readline()
-            if not line:
-                break
+        for packet in stream:
+            xiaomi_ip = captured_commands['xiaomi_ip']
+            if xiaomi_ip not in (packet.src_ip, packet.dst_ip):
+                continue
             
-            timestamp = datetime.datetime.now().isoformat()
+            line = f'IP {packet.src_ip}.{packet.src_port} > {packet.dst_ip}.{packet.dst_port}: length {len(packet.payload)}'
+            
+            timestamp = datetime.datetime.fromtimestamp(packet.ts).isoformat()
             traffic_entry = {
                 'timestamp': timestamp,
-                'packet_data': line.strip(),
+                'packet_data': line,
                 'source': 'tcpdump'
             }
             captured_traffic['traffic'].append(traffic_entry)
             captured_traffic['total_traffic_entries'] += 1
             
             # Check for phone to Xiaomi traffic
-            if PHONE_IP in line and xiaomi_ip in line:
-                log_message(f'📱 DETECTED: Phone -> Xiaomi traffic: {line.strip()}')
+            if PHONE_IP in (packet.src_ip, packet.dst_ip) and xiaomi_ip in (packet.src_ip, packet.dst_ip):
+                log_message(f'📱 DETECTED: Phone -> Xiaomi traffic: {line}')
                 
-                # Extract port information
-                port_match = re.search(r'(\d+\.\d+\.\d+\.\d+)\.(\d+).*?(\d+\.\d+\.\d+\.\d+)\.(\d+)', line)
-                if port_match:
-                    src_ip, src_port, dst_ip, dst_port = port_match.groups()
-                    if src_ip == PHONE_IP and dst_ip == xiaomi_ip:
-                        command_key = f'phone_to_xiaomi_{dst_port}'
-                        captured_commands['commands'][command_key] = {
-                            'src_ip': src_ip,
-                            'dst_ip': dst_ip,
-                            'src_port': src_port,
-                            'dst_port': dst_port,
-                            'timestamp': timestamp,
-                            'captured': True,
-                            'type': 'phone_to_xiaomi'
-                        }
-                        captured_commands['total_commands_captured'] += 1
-                        captured_commands['command_patterns'][f'port_{dst_port}'] = captured_commands['command_patterns'].get(f'port_{dst_port}', 0) + 1
-                        log_message(f'📝 LEARNED COMMAND: {command_key}')
-                        save_data()  # Save immediately when command is learned
+                src_ip, src_port, dst_ip, dst_port = packet.src_ip, str(packet.src_port), packet.dst_ip, str(packet.dst_port)
+                if src_ip == PHONE_IP and dst_ip == xiaomi_ip:
+                    command_key = f'phone_to_xiaomi_{dst_port}'
+                    captured_commands['commands'][command_key] = {
+                        'src_ip': src_ip,
+                        'dst_ip': dst_ip,
+                        'src_port': src_port,
+                        'dst_port': dst_port,
+                        'timestamp': timestamp,
+                        'captured': True,
+                        'type': 'phone_to_xiaomi'
+                    }
+                    captured_commands['total_commands_captured'] += 1
+                    captured_commands['command_patterns'][f'port_{dst_port}'] = captured_commands['command_patterns'].get(f'port_{dst_port}', 0) + 1
+                    log_message(f'📝 LEARNED COMMAND: {command_key}')
+                    save_data()  # Save immediately when command is learned
             
             # Save data every 10 seconds
             if time.time() - last_save_time >= 10:
@@ -198,9 +174,8 @@ def start_monitoring(xiaomi_ip):
     except Exception as e:
         log_message(f'Error during monitoring: {e}')
     finally:
-        if 'process' in locals() and process.poll() is None:
-            process.terminate()
-            process.wait()
+        if 'stream' in locals():
+            stream.close()
         save_data()
 
 def signal_handler(sig, frame):
@@ -217,12 +192,21 @@ def main():
     log_message(f'🔍 Looking for Xiaomi device with MAC: {XIAOMI_MAC}')
     
     # Find Xiaomi device IP
+    resolver.add_listener(on_xiaomi_moved)
+    resolver.start()
     xiaomi_ip = find_xiaomi_ip()
     
-    if not xiaomi_ip:
+    deadline = time.monotonic() + MAX_WAIT
+    while not xiaomi_ip:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            log_message(f'❌ Xiaomi device did not appear within {MAX_WAIT}s, giving up')
+            resolver.stop()
+            sys.exit(1)
         log_message('❌ Could not find Xiaomi device on network')
         log_message('💡 Make sure your Xiaomi device is connected to the same network')
-        return
+        log_message(f'⏳ Waiting for it to appear (ARP retry every {RESCAN_INTERVAL}s, {remaining:.0f}s left)...')
+        xiaomi_ip = resolver.wait_for(XIAOMI_MAC, min(RESCAN_INTERVAL, remaining)) or find_xiaomi_ip()
     
     # Test connectivity
     if not test_connectivity(xiaomi_ip):
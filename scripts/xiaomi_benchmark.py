@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Benchmark Suite
+Generates synthetic miIO/HTTP/mDNS traffic and drives it through each parsing and classification stage, alone and end to end
+Reports per-packet latency percentiles, throughput and peak RSS, and saves the results as JSON to compare versions
+"""
+
+import contextlib
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from xiaomi_jsonscan import JsonScanner
+from xiaomi_miio import HELLO_PACKET, MIIO_PORT, MiioCodec, MiioError
+from xiaomi_pcap import IPPROTO_TCP, IPPROTO_UDP, LINKTYPE_ETHERNET, decode_frame
+from xiaomi_reassembly import TcpReassembler
+from xiaomi_signatures import CommandIndex
+
+# Defaults
+DEFAULT_PACKETS = 5000
+DEFAULT_RATE = 200.0          # synthetic packets per second, sets the timestamp spacing
+DEFAULT_MIX = {'miio': 0.5, 'http': 0.3, 'mdns': 0.2}
+DEFAULT_SEGMENT_SIZE = 64     # TCP payload bytes per segment, small so HTTP messages span segments
+DEFAULT_THRESHOLD = 0.10      # relative slowdown reported as a regression
+DEFAULT_SEED = 1
+
+DEVICE_IP = "192.168.68.68"
+PHONE_IP = "192.168.68.65"
+MDNS_GROUP = "224.0.0.251"
+MDNS_PORT = 5353
+BENCH_TOKEN = "00112233445566778899aabbccddeeff"
+BENCH_DEVICE_ID = 0x0badcafe
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+HA_SCRIPTS_DIR = os.path.join(ROOT_DIR, 'homeassistant', 'config', 'scripts')
+L05G_DIR = os.path.join(ROOT_DIR, 'ideas', 'xiaomi-l05g-ir-control-customization', 'software', 'network-analysis')
+
+METHODS = ['get_prop', 'set_power', 'send_ir', 'miIO.info', 'set_properties', 'get_properties']
+IR_NAMES = ['power', 'volume_up', 'volume_down', 'mute', 'menu', 'ok', 'back']
+
+_ethernet = struct.Struct('!6s6sH')
+_ipv4 = struct.Struct('!BBHHHBBH4s4s')
+_udp = struct.Struct('!HHHH')
+_tcp = struct.Struct('!HHIIBBHHH')
+
+
+def ethernet_frame(src_ip, dst_ip, proto, transport, ident=0):
+    """Ethernet/IPv4 frame around a transport segment (checksums left zero)"""
+    ip_header = _ipv4.pack(0x45, 0, 20 + len(transport), ident & 0xffff, 0, 64, proto, 0,
+                           socket.inet_aton(src_ip), socket.inet_aton(dst_ip))
+    return _ethernet.pack(b'\x02' * 6, b'\x04' * 6, 0x0800) + ip_header + transport
+
+
+def udp_segment(src_port, dst_port, payload):
+    return _udp.pack(src_port, dst_port, 8 + len(payload), 0) + payload
+
+
+def tcp_segment(src_port, dst_port, seq, flags, payload=b''):
+    return _tcp.pack(src_port, dst_port, seq & 0xffffffff, 0, 5 << 4, flags, 65535, 0, 0) + payload
+
+
+def dns_name(name):
+    return b''.join(bytes([len(label)]) + label.encode() for label in name.split('.')) + b'\x00'
+
+
+def mdns_response(instance, service='_miio._udp.local'):
+    """mDNS answer with a PTR to the instance and its TXT record"""
+    target = f"{instance}.{service}"
+    txt = b''.join(bytes([len(item)]) + item for item in (b'mac=50:ec:50:00:00:01', b'model=chuangmi.remote.v2'))
+    answers = [
+        (dns_name(service), 12, dns_name(target)),
+        (dns_name(target), 16, txt),
+    ]
+    records = b''.join(name + struct.pack('!HHIH', rtype, 0x8001, 4500, len(data)) + data
+                       for name, rtype, data in answers)
+    return struct.pack('!HHHHHH', 0, 0x8400, 0, len(answers), 0, 0) + records
+
+
+class SyntheticTraffic:
+    """Reproducible mix of miIO exchanges, multi-segment HTTP requests and mDNS announcements"""
+
+    def __init__(self, packets=DEFAULT_PACKETS, rate=DEFAULT_RATE, mix=None,
+                 segment_size=DEFAULT_SEGMENT_SIZE, seed=DEFAULT_SEED):
+        self.count = packets
+        self.rate = rate
+        self.mix = mix or DEFAULT_MIX
+        self.segment_size = segment_size
+        self.random = random.Random(seed)
+        self.codec = MiioCodec()
+        try:
+            self.codec.register_token(BENCH_DEVICE_ID, BENCH_TOKEN)
+            self.encrypted = True
+        except MiioError:
+            self.encrypted = False  # Without the cryptography package only hello frames are sent
+        self.frames = []         # (ts, kind, frame bytes)
+        self._request_id = 0
+        self._flows = {}         # phone port -> next sequence number
+        self._generate()
+
+    def _command(self):
+        self._request_id += 1
+        method = self.random.choice(METHODS)
+        if method == 'send_ir':
+            params = [self.random.choice(IR_NAMES)]
+        elif method == 'get_prop':
+            params = [self.random.sample(['power', 'mode', 'temperature', 'humidity'], 2)]
+        elif method == 'set_properties':
+            params = [{'did': 'ir', 'siid': 2, 'piid': self.random.randint(1, 4), 'value': True}]
+        else:
+            params = []
+        return {'id': self._request_id, 'method': method, 'params': params}
+
+    def _miio(self):
+        if not self.encrypted:
+            return [(PHONE_IP, 49152, DEVICE_IP, MIIO_PORT, HELLO_PACKET)]
+        command = self._command()
+        reply = {'id': command['id'], 'result': ['ok']}
+        stamp = self._request_id
+        return [(PHONE_IP, 49152, DEVICE_IP, MIIO_PORT, self.codec.encode(BENCH_DEVICE_ID, stamp, command)),
+                (DEVICE_IP, MIIO_PORT, PHONE_IP, 49152, self.codec.encode(BENCH_DEVICE_ID, stamp, reply))]
+
+    def _http(self):
+        port = 50000 + self.random.randint(0, 7)
+        body = json.dumps(self._command()).encode()
+        request = (f"POST /api/ir/send HTTP/1.1\r\nHost: {DEVICE_IP}\r\n"
+                   f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n").encode() + body
+        segments = []
+        if port not in self._flows:
+            isn = self.random.getrandbits(32)
+            segments.append(('tcp', port, isn, 0x02, b''))
+            self._flows[port] = isn + 1
+        seq = self._flows[port]
+        for offset in range(0, len(request), self.segment_size):
+            chunk = request[offset:offset + self.segment_size]
+            segments.append(('tcp', port, seq, 0x18, chunk))
+            seq += len(chunk)
+        self._flows[port] = seq
+        return segments
+
+    def _mdns(self):
+        instance = f"chuangmi-remote-{self.random.randint(0, 15):x}"
+        return [(DEVICE_IP, MDNS_PORT, MDNS_GROUP, MDNS_PORT, mdns_response(instance))]
+
+    def _generate(self):
+        kinds = list(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+        start = 1_700_000_000.0
+        while len(self.frames) < self.count:
+            kind = self.random.choices(kinds, weights)[0]
+            if kind == 'http':
+                for _, port, seq, flags, payload in self._http():
+                    transport = tcp_segment(port, 80, seq, flags, payload)
+                    self._append(kind, ethernet_frame(PHONE_IP, DEVICE_IP, IPPROTO_TCP, transport, len(self.frames)), start)
+            else:
+                for src, sport, dst, dport, payload in (self._miio() if kind == 'miio' else self._mdns()):
+                    transport = udp_segment(sport, dport, payload)
+                    self._append(kind, ethernet_frame(src, dst, IPPROTO_UDP, transport, len(self.frames)), start)
+        del self.frames[self.count:]
+
+    def _append(self, kind, frame, start):
+        self.frames.append((start + len(self.frames) / self.rate, kind, frame))
+
+    def packets(self):
+        """Decoded Packets, in capture order"""
+        return [decode_frame(LINKTYPE_ETHERNET, frame, ts, len(frame)) for ts, _, frame in self.frames]
+
+    def tcpdump_text(self, packet):
+        """The packet as 'tcpdump -A' prints it: a summary line followed by the printable payload"""
+        proto = 'UDP' if packet.proto == IPPROTO_UDP else 'TCP'
+        stamp = datetime.fromtimestamp(packet.ts).strftime('%H:%M:%S.%f')
+        printable = ''.join(chr(b) if 32 <= b < 127 else '.' for b in packet.payload)
+        return (f"{stamp} IP {packet.src_ip}.{packet.src_port} > {packet.dst_ip}.{packet.dst_port}: "
+                f"{proto}, length {len(packet.payload)}\n{printable}\n")
+
+    def write_pcap(self, path):
+        """Save the traffic as a classic pcap, e.g. for --replay"""
+        with open(path, 'wb') as f:
+            f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET))
+            for ts, _, frame in self.frames:
+                seconds = int(ts)
+                f.write(struct.pack('<IIII', seconds, int((ts - seconds) * 1e6), len(frame), len(frame)))
+                f.write(frame)
+
+
+def load_module(name, path):
+    """Import a module from a file under a distinct name (the HA copies share names with scripts/)"""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def quiet(obj):
+    """Silence an analyzer's log_message so the benchmark measures analysis, not terminal output"""
+    obj.log_message = lambda *args, **kwargs: None
+    return obj
+
+
+# Stages: each returns (handler, items) or (None, reason to skip)
+
+def stage_decode_frame(traffic):
+    return (lambda item: decode_frame(LINKTYPE_ETHERNET, item[2], item[0], len(item[2])),
+            traffic.frames)
+
+
+def stage_miio_decode(traffic):
+    codec = MiioCodec()
+    if traffic.encrypted:
+        codec.register_token(BENCH_DEVICE_ID, BENCH_TOKEN)
+    items = [packet for packet in traffic.packets() if MIIO_PORT in (packet.src_port, packet.dst_port)]
+    return lambda packet: codec.decode(packet.payload, ip=packet.src_ip), items
+
+
+def stage_tcp_reassembly(traffic):
+    reassembler = TcpReassembler()
+    return reassembler.feed, [packet for packet in traffic.packets() if packet.proto == IPPROTO_TCP]
+
+
+def stage_json_scan(traffic):
+    scanners = {}
+
+    def scan(packet):
+        flow = (packet.src_ip, packet.src_port, packet.dst_ip, packet.dst_port)
+        scanner = scanners.get(flow)
+        if scanner is None:
+            scanner = scanners[flow] = JsonScanner()
+        return scanner.feed(packet.payload)
+
+    return scan, [packet for packet in traffic.packets() if packet.payload]
+
+
+def stage_signature_index(traffic):
+    index = CommandIndex()
+    scanners = {}
+    commands = []
+    for packet in traffic.packets():
+        if packet.proto == IPPROTO_TCP:
+            scanner = scanners.setdefault(packet.src_port, JsonScanner())
+            commands.extend(scanner.feed(packet.payload))
+    commands = [command for command in commands if 'method' in command]
+    if not commands:
+        return None, 'no JSON commands in the traffic mix'
+    return (lambda command: index.observe('json', command['method'], command,
+                                          params=command.get('params'), port=80, direction='to_device'),
+            commands)
+
+
+def stage_local_analyzer(traffic):
+    from xiaomi_local_analyzer import XiaomiLocalAnalyzer
+
+    analyzer = quiet(XiaomiLocalAnalyzer())
+    analyzer.xiaomi_ip = DEVICE_IP
+    if traffic.encrypted:
+        analyzer.codec.register_token(BENCH_DEVICE_ID, BENCH_TOKEN)
+    return analyzer.analyze_packet, traffic.packets()
+
+
+def stage_phone_monitor(traffic):
+    from xiaomi_phone_monitor import XiaomiPhoneMonitor
+
+    monitor = quiet(XiaomiPhoneMonitor())
+    monitor.phone_ip = PHONE_IP
+    monitor.xiaomi_ip = DEVICE_IP
+    return monitor.process_packet, traffic.packets()
+
+
+def stage_ha_tcpdump_text(traffic):
+    ha = load_module('ha_xiaomi_local_analyzer', os.path.join(HA_SCRIPTS_DIR, 'xiaomi_local_analyzer.py'))
+    analyzer = quiet(ha.XiaomiLocalAnalyzer())
+    analyzer.xiaomi_ip = DEVICE_IP
+    return analyzer.process_traffic_output, [traffic.tcpdump_text(packet) for packet in traffic.packets()]
+
+
+def stage_l05g_process_packet(traffic):
+    try:
+        import scapy.all as scapy
+    except ImportError:
+        return None, 'scapy is not installed'
+    sys.path.insert(0, L05G_DIR)
+    from l05g_network_analyzer import L05GNetworkAnalyzer
+
+    analyzer = L05GNetworkAnalyzer(DEVICE_IP)
+    analyzer.logger.disabled = True
+    items = []
+    for ts, _, frame in traffic.frames:
+        packet = scapy.Ether(frame)
+        packet.time = ts
+        items.append(packet)
+    return analyzer._process_packet, items
+
+
+def stage_end_to_end(traffic):
+    """Raw frame to learned command: link-layer decode followed by the local analyzer"""
+    handler, _ = stage_local_analyzer(traffic)
+    return (lambda item: handler(decode_frame(LINKTYPE_ETHERNET, item[2], item[0], len(item[2]))),
+            traffic.frames)
+
+
+STAGES = {
+    'decode_frame': stage_decode_frame,
+    'miio_decode': stage_miio_decode,
+    'tcp_reassembly': stage_tcp_reassembly,
+    'json_scan': stage_json_scan,
+    'signature_index': stage_signature_index,
+    'local_analyzer': stage_local_analyzer,
+    'phone_monitor': stage_phone_monitor,
+    'ha_tcpdump_text': stage_ha_tcpdump_text,
+    'l05g_process_packet': stage_l05g_process_packet,
+    'end_to_end': stage_end_to_end,
+}
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KiB (ru_maxrss is bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(name, traffic):
+    """Run one stage in a scratch directory and time every call"""
+    workdir = tempfile.mkdtemp(prefix=f'xiaomi_bench_{name}_')
+    cwd = os.getcwd()
+    os.chdir(workdir)  # Analyzers write their logs and stores to the working directory
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            handler, items = STAGES[name](traffic)
+            if handler is None:
+                return {'skipped': items}
+            baseline = peak_rss_kb()
+            clock = time.perf_counter_ns
+            latencies = []
+            record = latencies.append
+            started = clock()
+            for item in items:
+                before = clock()
+                handler(item)
+                record(clock() - before)
+            total = clock() - started
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies.sort()
+    peak = peak_rss_kb()
+    return {
+        'packets': len(latencies),
+        'seconds': round(total / 1e9, 4),
+        'packets_per_second': round(len(latencies) / (total / 1e9)) if total else 0,
+        'latency_us': {
+            'mean': round(sum(latencies) / max(1, len(latencies)) / 1000, 2),
+            'p50': round(percentile(latencies, 0.50) / 1000, 2),
+            'p90': round(percentile(latencies, 0.90) / 1000, 2),
+            'p99': round(percentile(latencies, 0.99) / 1000, 2),
+            'p999': round(percentile(latencies, 0.999) / 1000, 2),
+            'max': round(latencies[-1] / 1000, 2) if latencies else 0
+        },
+        'rss_kb': {'baseline': baseline, 'peak': peak, 'growth': peak - baseline}
+    }
+
+
+def _child(name, traffic, conn):
+    try:
+        conn.send(measure(name, traffic))
+    except Exception as e:
+        conn.send({'error': f"{type(e).__name__}: {e}"})
+    conn.close()
+
+
+def run_stage(name, traffic, isolate=True):
+    """Measure a stage, in a forked child when possible so peak RSS is per stage"""
+    if not isolate or 'fork' not in multiprocessing.get_all_start_methods():
+        try:
+            return measure(name, traffic)
+        except Exception as e:
+            return {'error': f"{type(e).__name__}: {e}"}
+    context = multiprocessing.get_context('fork')
+    parent, child = context.Pipe(duplex=False)
+    process = context.Process(target=_child, args=(name, traffic, child))
+    process.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = {'error': f"stage exited with code {process.exitcode}"}
+    process.join()
+    return result
+
+
+def git_revision():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=ROOT_DIR, timeout=5)
+        return result.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_suite(options):
+    traffic = SyntheticTraffic(options['packets'], options['rate'], options['mix'],
+                               options['segment_size'], options['seed'])
+    if options['write_pcap']:
+        traffic.write_pcap(options['write_pcap'])
+    results = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'miio_encrypted': traffic.encrypted
+        },
+        'config': {key: options[key] for key in ('packets', 'rate', 'mix', 'segment_size', 'seed')},
+        'stages': {}
+    }
+    for name in options['stages']:
+        results['stages'][name] = run_stage(name, traffic, options['isolate'])
+        print(format_result(name, results['stages'][name]))
+    return results
+
+
+def format_result(name, result):
+    if 'skipped' in result:
+        return f"⏭️  {name:<20} skipped: {result['skipped']}"
+    if 'error' in result:
+        return f"❌ {name:<20} {result['error']}"
+    latency = result['latency_us']
+    return (f"📊 {name:<20} {result['packets_per_second']:>9} pkt/s  p50 {latency['p50']:>8}us  "
+            f"p99 {latency['p99']:>8}us  max {latency['max']:>9}us  peak RSS {result['rss_kb']['peak']} KiB")
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Stages whose p50/p99 latency grew (or throughput fell) by more than threshold"""
+    regressions = []
+    for name, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(name)
+        if not previous or 'latency_us' not in previous or 'latency_us' not in current:
+            continue
+        for metric in ('p50', 'p99'):
+            old, new = previous['latency_us'][metric], current['latency_us'][metric]
+            if old and (new - old) / old > threshold:
+                regressions.append((name, metric, old, new))
+        old, new = previous['packets_per_second'], current['packets_per_second']
+        if old and (old - new) / old > threshold:
+            regressions.append((name, 'packets_per_second', old, new))
+    return regressions
+
+
+def parse_args(argv):
+    """--packets N --rate R --mix miio=0.5,http=0.3,mdns=0.2 --stages a,b --segment-size N --seed N
+    --output results.json --compare baseline.json --threshold 0.1 --write-pcap synthetic.pcap --no-isolate"""
+    options = {
+        'packets': DEFAULT_PACKETS, 'rate': DEFAULT_RATE, 'mix': dict(DEFAULT_MIX),
+        'segment_size': DEFAULT_SEGMENT_SIZE, 'seed': DEFAULT_SEED, 'stages': list(STAGES),
+        'output': None, 'compare': None, 'threshold': DEFAULT_THRESHOLD, 'write_pcap': None,
+        'isolate': True
+    }
+    args = iter(argv)
+    for arg in args:
+        if arg == '--no-isolate':
+            options['isolate'] = False
+            continue
+        value = next(args, None)
+        if value is None:
+            raise ValueError(f"{arg} needs a value")
+        if arg == '--packets':
+            options['packets'] = int(value)
+        elif arg == '--rate':
+            options['rate'] = float(value)
+        elif arg == '--mix':
+            options['mix'] = {kind: float(weight) for kind, weight in
+                              (part.split('=') for part in value.split(','))}
+        elif arg == '--stages':
+            options['stages'] = [name for name in value.split(',') if name]
+        elif arg == '--segment-size':
+            options['segment_size'] = int(value)
+        elif arg == '--seed':
+            options['seed'] = int(value)
+        elif arg == '--output':
+            options['output'] = value
+        elif arg == '--compare':
+            options['compare'] = value
+        elif arg == '--threshold':
+            options['threshold'] = float(value)
+        elif arg == '--write-pcap':
+            options['write_pcap'] = value
+        else:
+            raise ValueError(f"Unknown option {arg}")
+    unknown = [name for name in options['stages'] if name not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown stages {unknown}; choose from {list(STAGES)}")
+    unknown = [kind for kind in options['mix'] if kind not in DEFAULT_MIX]
+    if unknown:
+        raise ValueError(f"Unknown traffic kinds {unknown}; choose from {list(DEFAULT_MIX)}")
+    return options
+
+
+def main():
+    """Run the suite: xiaomi_benchmark.py [--packets N] [--stages a,b] [--output f.json] [--compare old.json]"""
+    try:
+        options = parse_args(sys.argv[1:])
+    except ValueError as e:
+        print(f"❌ {e}")
+        print(parse_args.__doc__)
+        sys.exit(2)
+
+    print(f"🚀 {options['packets']} synthetic packets at {options['rate']:g} pkt/s, mix {options['mix']}")
+    results = run_suite(options)
+
+    output = options['output'] or f"xiaomi_benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"💾 Results saved to {output}")
+
+    if options['compare']:
+        with open(options['compare'], 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options['threshold'])
+        for name, metric, old, new in regressions:
+            print(f"⚠️  Regression in {name}: {metric} {old} -> {new}")
+        if regressions:
+            sys.exit(1)
+        print(f"✅ No regressions against {options['compare']} (threshold {options['threshold']:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,15 +4,16 @@ Xiaomi Connection Monitor
 Monitors network connections without requiring sudo privileges
 """
 
-import subprocess
 import time
 import json
 import datetime
 import signal
 import sys
-import re
 import threading
 
+from xiaomi_conntrack import CLOSED, NEW, ConnectionTracker, format_connection
+from xiaomi_logsink import get_sink
+
 # Configuration
 PHONE_IP = "192.168.68.65"
 XIAOMI_IP = "192.168.68.62"
@@ -31,11 +32,12 @@ captured_connections = {
     'learned_commands': {}
 }
 
+# Connections from or to the Xiaomi device, with owning processes
+tracker = ConnectionTracker([XIAOMI_IP], resolve_processes=True)
+
 def log_message(message, level='INFO'):
-    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open(LOG_FILE, 'a') as f:
-        f.write(f'[{timestamp}] {level}: {message}\n')
-    print(f'[{timestamp}] {level}: {message}')
+    # Queued; the sink's writer thread prints and appends in batches
+    get_sink(LOG_FILE).log(message, level)
 
 def save_data():
     global captured_connections
@@ -50,93 +52,67 @@ def save_data():
     except Exception as e:
         log_message(f'Error saving data: {e}')
 
+def handle_connection_event(event):
+    """Record connections between phone and Xiaomi, and local processes talking to Xiaomi"""
+    conn = event.connection
+    line = format_connection(conn)
+    if event.kind == CLOSED:
+        log_message(f'🔌 CONNECTION CLOSED: {line}')
+        return
+    
+    timestamp = datetime.datetime.fromtimestamp(event.ts).isoformat()
+    endpoints = (conn.local_ip, conn.remote_ip)
+    
+    # Look for connections between phone and Xiaomi
+    if PHONE_IP in endpoints and XIAOMI_IP in endpoints:
+        log_message(f'📱 DETECTED CONNECTION: {line}')
+        connection_entry = {
+            'timestamp': timestamp,
+            'connections': [line],
+            'event': event.kind,
+            'source': 'conntrack'
+        }
+        captured_connections['connections'].append(connection_entry)
+        captured_connections['total_connections'] += 1
+        
+        if event.kind == NEW and conn.local_ip == PHONE_IP and conn.remote_ip == XIAOMI_IP:
+            command_key = f'phone_to_xiaomi_{conn.remote_port}'
+            captured_connections['learned_commands'][command_key] = {
+                'src_ip': conn.local_ip,
+                'dst_ip': conn.remote_ip,
+                'src_port': str(conn.local_port),
+                'dst_port': str(conn.remote_port),
+                'timestamp': timestamp,
+                'captured': True,
+                'type': 'phone_to_xiaomi'
+            }
+            log_message(f'📝 LEARNED COMMAND: {command_key}')
+            save_data()  # Save immediately when command is learned
+    
+    # Look for processes connecting to Xiaomi IP
+    if event.kind == NEW and conn.process:
+        log_message(f'🔍 PROCESS CONNECTING TO XIAOMI: {line}')
+        process_entry = {
+            'timestamp': timestamp,
+            'processes': [line],
+            'source': 'conntrack'
+        }
+        captured_connections['connections'].append(process_entry)
+        captured_connections['total_connections'] += 1
+        save_data()
+
 def monitor_connections():
-    """Monitor network connections using netstat"""
+    """Track connections to the Xiaomi device from the kernel socket table"""
     log_message('🔍 Starting connection monitoring...')
     
-    try:
-        while True:
-            # Get current connections
-            result = subprocess.run(['netstat', '-an'], capture_output=True, text=True)
-            netstat_output = result.stdout
-            
-            # Look for connections between phone and Xiaomi
-            connections_found = []
-            for line in netstat_output.split('\n'):
-                if PHONE_IP in line and XIAOMI_IP in line:
-                    connections_found.append(line.strip())
-                    log_message(f'📱 DETECTED CONNECTION: {line.strip()}')
-            
-            if connections_found:
-                timestamp = datetime.datetime.now().isoformat()
-                connection_entry = {
-                    'timestamp': timestamp,
-                    'connections': connections_found,
-                    'source': 'netstat'
-                }
-                captured_connections['connections'].append(connection_entry)
-                captured_connections['total_connections'] += 1
-                
-                # Try to extract port information
-                for conn in connections_found:
-                    port_match = re.search(r'(\d+\.\d+\.\d+\.\d+)\.(\d+).*?(\d+\.\d+\.\d+\.\d+)\.(\d+)', conn)
-                    if port_match:
-                        src_ip, src_port, dst_ip, dst_port = port_match.groups()
-                        if src_ip == PHONE_IP and dst_ip == XIAOMI_IP:
-                            command_key = f'phone_to_xiaomi_{dst_port}'
-                            captured_connections['learned_commands'][command_key] = {
-                                'src_ip': src_ip,
-                                'dst_ip': dst_ip,
-                                'src_port': src_port,
-                                'dst_port': dst_port,
-                                'timestamp': timestamp,
-                                'captured': True,
-                                'type': 'phone_to_xiaomi'
-                            }
-                            log_message(f'📝 LEARNED COMMAND: {command_key}')
-                            save_data()  # Save immediately when command is learned
-            
-            time.sleep(2)  # Check every 2 seconds
-            
-    except KeyboardInterrupt:
-        pass
-    except Exception as e:
-        log_message(f'Error during monitoring: {e}')
-
-def monitor_processes():
-    """Monitor processes that might be communicating with Xiaomi device"""
-    log_message('🔍 Starting process monitoring...')
+    tracker.add_listener(handle_connection_event)
+    source = '/proc/net' if tracker.use_proc else 'netstat'
+    log_message(f'📡 Tracking {XIAOMI_IP} via {source}')
     
     try:
-        while True:
-            # Get processes with network connections
-            result = subprocess.run(['lsof', '-i'], capture_output=True, text=True)
-            lsof_output = result.stdout
-            
-            # Look for processes connecting to Xiaomi IP
-            xiaomi_processes = []
-            for line in lsof_output.split('\n'):
-                if XIAOMI_IP in line:
-                    xiaomi_processes.append(line.strip())
-                    log_message(f'🔍 PROCESS CONNECTING TO XIAOMI: {line.strip()}')
-            
-            if xiaomi_processes:
-                timestamp = datetime.datetime.now().isoformat()
-                process_entry = {
-                    'timestamp': timestamp,
-                    'processes': xiaomi_processes,
-                    'source': 'lsof'
-                }
-                captured_connections['connections'].append(process_entry)
-                captured_connections['total_connections'] += 1
-                save_data()
-            
-            time.sleep(5)  # Check every 5 seconds
-            
-    except KeyboardInterrupt:
-        pass
+        tracker.run()
     except Exception as e:
-        log_message(f'Error during process monitoring: {e}')
+        log_message(f'Error during monitoring: {e}')
 
 def signal_handler(sig, frame):
     log_message('🛑 Received signal, shutting down...')
@@ -153,12 +129,9 @@ def main():
     log_message('📊 Will monitor network connections and processes')
     log_message('🛑 Press Ctrl+C to stop')
     
-    # Start monitoring in separate threads
+    # One tracker covers both connections and the processes that own them
     connection_thread = threading.Thread(target=monitor_connections)
-    process_thread = threading.Thread(target=monitor_processes)
-    
     connection_thread.start()
-    process_thread.start()
     
     try:
         while True:
@@ -167,8 +140,8 @@ def main():
     except KeyboardInterrupt:
         pass
     finally:
+        tracker.stop()
         connection_thread.join()
-        process_thread.join()
         save_data()
 
 if __name__ == "__main__":
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Connection Tracker
+Follows the socket table from /proc/net/{tcp,udp}[6] instead of running netstat/lsof
+Only rows that appeared since the last poll are decoded; listeners get typed new/closed/changed events
+Falls back to a single netstat -an poll on systems without /proc/net (macOS)
+"""
+
+import ipaddress
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from xiaomi_flowstore import parse_endpoint
+
+# Defaults
+DEFAULT_INTERVAL = 2.0       # seconds between socket table polls
+PROC_NET = '/proc/net'
+PROTOCOLS = ('tcp', 'tcp6', 'udp', 'udp6')
+
+# Event kinds
+NEW = 'new'
+CLOSED = 'closed'
+CHANGED = 'changed'
+
+# include/net/tcp_states.h
+TCP_STATES = {
+    '01': 'ESTABLISHED', '02': 'SYN_SENT', '03': 'SYN_RECV', '04': 'FIN_WAIT1',
+    '05': 'FIN_WAIT2', '06': 'TIME_WAIT', '07': 'CLOSE', '08': 'CLOSE_WAIT',
+    '09': 'LAST_ACK', '0A': 'LISTEN', '0B': 'CLOSING', '0C': 'NEW_SYN_RECV',
+}
+
+Connection = namedtuple('Connection', [
+    'proto', 'local_ip', 'local_port', 'remote_ip', 'remote_port', 'state',
+    'uid', 'inode', 'pid', 'process'
+])
+ConnectionEvent = namedtuple('ConnectionEvent', ['kind', 'connection', 'previous', 'ts'])
+
+
+def decode_address(hex_addr):
+    """'0100007F:0277' -> ('127.0.0.1', 631); IPv4-mapped IPv6 is returned as IPv4"""
+    host, port = hex_addr.split(':')
+    if len(host) == 8:
+        ip = socket.inet_ntop(socket.AF_INET, struct.pack('<I', int(host, 16)))
+    else:
+        words = [int(host[i:i + 8], 16) for i in range(0, 32, 8)]
+        ip = socket.inet_ntop(socket.AF_INET6, struct.pack('<4I', *words))
+        if ip.startswith('::ffff:') and '.' in ip:
+            ip = ip[7:]
+    return ip, int(port, 16)
+
+
+def decode_state(proto, state_hex):
+    """Kernel state code to a netstat-style name (UDP only reports connected sockets)"""
+    if proto.startswith('tcp'):
+        return TCP_STATES.get(state_hex, state_hex)
+    return 'ESTABLISHED' if state_hex == '01' else ''
+
+
+def format_connection(conn):
+    """netstat-like line for a Connection"""
+    line = f"{conn.proto} {conn.local_ip}:{conn.local_port} {conn.remote_ip}:{conn.remote_port} {conn.state}"
+    if conn.process:
+        line += f" {conn.process}({conn.pid})"
+    return line.rstrip()
+
+
+class HostFilter:
+    """Matches connections whose local or remote address is a watched host or inside a watched network"""
+
+    def __init__(self, hosts=None):
+        self.hosts = set()
+        self.networks = []
+        for host in hosts or ():
+            if '/' in host:
+                self.networks.append(ipaddress.ip_network(host, strict=False))
+            else:
+                self.hosts.add(host)
+
+    def __bool__(self):
+        return bool(self.hosts or self.networks)
+
+    def match_ip(self, ip):
+        if ip in self.hosts:
+            return True
+        if not self.networks:
+            return False
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        return any(address in network for network in self.networks)
+
+    def match(self, local_ip, remote_ip):
+        return not self or self.match_ip(remote_ip) or self.match_ip(local_ip)
+
+
+class ProcessResolver:
+    """Maps socket inodes to (pid, process name) by scanning /proc/<pid>/fd on demand"""
+
+    def __init__(self, proc='/proc'):
+        self.proc = proc
+        self.owners = {}
+
+    def rescan(self):
+        owners = {}
+        for pid in os.listdir(self.proc):
+            if not pid.isdigit():
+                continue
+            fd_dir = os.path.join(self.proc, pid, 'fd')
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError:
+                continue  # Exited or not ours
+            name = None
+            for fd in fds:
+                try:
+                    target = os.readlink(os.path.join(fd_dir, fd))
+                except OSError:
+                    continue
+                if target.startswith('socket:['):
+                    if name is None:
+                        try:
+                            with open(os.path.join(self.proc, pid, 'comm')) as f:
+                                name = f.read().strip()
+                        except OSError:
+                            name = ''
+                    owners[int(target[8:-1])] = (int(pid), name)
+        self.owners = owners
+
+    def resolve(self, inodes):
+        """Owners for inodes, rescanning /proc once if any are unknown"""
+        if any(inode and inode not in self.owners for inode in inodes):
+            self.rescan()
+        return {inode: self.owners.get(inode, (None, None)) for inode in inodes}
+
+
+class ConnectionTracker:
+    """Polls the kernel socket table and reports only what changed"""
+
+    def __init__(self, hosts=None, interval=DEFAULT_INTERVAL, protocols=PROTOCOLS,
+                 resolve_processes=False, proc_net=PROC_NET):
+        self.filter = HostFilter(hosts)
+        self.interval = interval
+        self.protocols = protocols
+        self.proc_net = proc_net
+        self.use_proc = os.path.isdir(proc_net)
+        self.resolver = ProcessResolver() if resolve_processes and self.use_proc else None
+        self.connections = {}   # row key -> Connection (watched rows only)
+        self._rows = {}         # row key -> state code, for every row seen last poll
+        self._ignored = set()   # row keys outside the host filter
+        self.listeners = []
+        self.stats = {'polls': 0, 'rows': 0, 'decoded': 0, 'events': 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_listener(self, callback):
+        """callback(event) is called for every ConnectionEvent"""
+        self.listeners.append(callback)
+
+    def _read_proc(self):
+        """Yield (key, state_code, fields) for every row of the /proc/net socket tables"""
+        for proto in self.protocols:
+            try:
+                with open(os.path.join(self.proc_net, proto), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            for line in data.split(b'\n')[1:]:
+                fields = line.split()
+                if len(fields) < 10:
+                    continue
+                yield (proto, fields[1], fields[2]), fields[3], fields
+
+    def _read_netstat(self):
+        """Yield rows from one netstat -an run (systems without /proc/net)"""
+        result = subprocess.run(['netstat', '-an'], capture_output=True, text=True)
+        for line in result.stdout.split('\n'):
+            fields = line.split()
+            if len(fields) < 5 or not fields[0].startswith(('tcp', 'udp')):
+                continue
+            state = fields[5] if len(fields) > 5 else ''
+            yield (fields[0], fields[3], fields[4]), state, fields
+
+    def _decode(self, key, state_code, fields):
+        proto = key[0]
+        if self.use_proc:
+            local_ip, local_port = decode_address(key[1].decode())
+            remote_ip, remote_port = decode_address(key[2].decode())
+            state = decode_state(proto, state_code.decode())
+            uid, inode = int(fields[7]), int(fields[9])
+        else:
+            local_ip, local_port = parse_endpoint(key[1])
+            remote_ip, remote_port = parse_endpoint(key[2])
+            state = state_code
+            uid, inode = None, 0
+        return Connection(proto, local_ip, local_port, remote_ip, remote_port, state,
+                          uid, inode, None, None)
+
+    def poll(self):
+        """Read the socket table once, update state and return the resulting events"""
+        now = time.time()
+        events = []
+        new_rows = []
+        with self._lock:
+            rows = {}
+            reader = self._read_proc() if self.use_proc else self._read_netstat()
+            for key, state_code, fields in reader:
+                rows[key] = state_code
+                if key in self._ignored:
+                    continue
+                previous_code = self._rows.get(key)
+                if previous_code == state_code:
+                    continue  # Unchanged row: nothing to decode
+                conn = self._decode(key, state_code, fields)
+                self.stats['decoded'] += 1
+                if key not in self.connections:
+                    if not self.filter.match(conn.local_ip, conn.remote_ip):
+                        self._ignored.add(key)
+                        continue
+                    new_rows.append((key, conn))
+                else:
+                    previous = self.connections[key]
+                    conn = conn._replace(pid=previous.pid, process=previous.process)
+                    self.connections[key] = conn
+                    events.append(ConnectionEvent(CHANGED, conn, previous, now))
+
+            if new_rows and self.resolver:
+                owners = self.resolver.resolve([conn.inode for _, conn in new_rows])
+            for key, conn in new_rows:
+                if self.resolver:
+                    pid, process = owners[conn.inode]
+                    conn = conn._replace(pid=pid, process=process)
+                self.connections[key] = conn
+                events.append(ConnectionEvent(NEW, conn, None, now))
+
+            for key in [key for key in self.connections if key not in rows]:
+                events.append(ConnectionEvent(CLOSED, self.connections.pop(key), None, now))
+            self._ignored &= rows.keys()
+            self._rows = rows
+            self.stats['polls'] += 1
+            self.stats['rows'] = len(rows)
+            self.stats['events'] += len(events)
+
+        for event in events:
+            for callback in self.listeners:
+                try:
+                    callback(event)
+                except Exception as e:
+                    print(f"Connection listener error: {e}")
+        return events
+
+    def snapshot(self):
+        """Currently open watched connections"""
+        with self._lock:
+            return list(self.connections.values())
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Connection tracker error: {e}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """Poll in a background thread"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
+
+
+def main():
+    """Print connection events: xiaomi_conntrack.py [host|network ...]"""
+    tracker = ConnectionTracker(sys.argv[1:], resolve_processes=True)
+    tracker.add_listener(lambda event: print(
+        f"[{time.strftime('%H:%M:%S', time.localtime(event.ts))}] {event.kind:7} "
+        f"{format_connection(event.connection)}"
+        + (f" (was {event.previous.state})" if event.previous else "")))
+    source = '/proc/net' if tracker.use_proc else 'netstat'
+    print(f"🔍 Tracking connections via {source} every {tracker.interval}s (Ctrl+C to stop)")
+    try:
+        tracker.run()
+    except KeyboardInterrupt:
+        pass
+    print(f"📊 {tracker.stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,62 +10,69 @@ import json
 import time
 import re
 import socket
-import threading
-import signal
-import sys
 import os
 from datetime import datetime
 from collections import defaultdict, deque
 
+from xiaomi_logsink import get_sink
+from xiaomi_metrics import MonitorMetrics
+from xiaomi_miio import HELLO_PACKET, MiioCodec
+from xiaomi_portscan import COMMON_PORTS, PortScanner
+from xiaomi_prober import IR_COMMANDS, ProbeScheduler
+from xiaomi_runtime import AnalyzerRuntime, instance_path
+from xiaomi_store import LearningStore, write_json_atomic
+
 # Configuration
 XIAOMI_IP = "192.168.68.68"
 XIAOMI_PORT = 54321
+XIAOMI_TOKEN = ""  # 32 hex chars from Mi Home, leave empty if unknown
 LOG_FILE = "xiaomi_enhanced_analysis.log"
 LEARNING_FILE = "xiaomi_learning.json"
 COMMANDS_FILE = "xiaomi_discovered_commands.json"
 PROTOCOL_FILE = "xiaomi_protocol_analysis.json"
 BACKUP_FILE = "xiaomi_backup.json"
+METRICS_PORT = 9481  # localhost metrics endpoint, None disables
 
 class XiaomiEnhancedAnalyzer:
-    def __init__(self):
-        self.xiaomi_ip = XIAOMI_IP
-        self.xiaomi_port = XIAOMI_PORT
-        self.log_file = LOG_FILE
-        self.learning_file = LEARNING_FILE
-        self.commands_file = COMMANDS_FILE
-        self.protocol_file = PROTOCOL_FILE
-        self.backup_file = BACKUP_FILE
+    STAGES = ('liveness', 'portscan', 'discovery', 'persist')
+
+    def __init__(self, device=None, registry=None):
+        device = device or {}
+        self.xiaomi_ip = device.get('ip', XIAOMI_IP)
+        self.xiaomi_port = device.get('port', XIAOMI_PORT)
+        self.xiaomi_token = device.get('token', XIAOMI_TOKEN)
+        self.log_file = instance_path(LOG_FILE, device)
+        self.log_sink = get_sink(self.log_file)
+        self.learning_file = instance_path(LEARNING_FILE, device)
+        self.commands_file = instance_path(COMMANDS_FILE, device)
+        self.protocol_file = instance_path(PROTOCOL_FILE, device)
+        self.backup_file = instance_path(BACKUP_FILE, device)
         
         # Learning data structures
+        self.commands_store = LearningStore(self.commands_file)
         self.learned_commands = {}
         self.protocol_analysis = {}
+        self.codec = MiioCodec()
+        self.metrics = MonitorMetrics('enhanced_analyzer', registry, instance=device.get('name'))
+        self.port_scanner = PortScanner()
+        self.prober = ProbeScheduler(port=self.xiaomi_port, metrics=self.metrics)
         self.device_responses = deque(maxlen=1000)
         self.command_sequences = deque(maxlen=100)
         
         # Analysis state
-        self.running = False
-        self.analysis_threads = []
         self.last_activity = None
         self.device_online = False
         self.start_time = datetime.now()
         
         # Load existing data
         self.load_existing_data()
-        
-        # Setup signal handlers
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGTERM, self.signal_handler)
     
     def load_existing_data(self):
         """Load existing learned data from files"""
         try:
             # Load existing commands
-            if os.path.exists(self.commands_file):
-                with open(self.commands_file, 'r') as f:
-                    data = json.load(f)
-                    if 'commands' in data:
-                        self.learned_commands = data['commands']
-                    self.log_message(f"📚 Loaded {len(self.learned_commands)} existing commands")
+            self.learned_commands = self.commands_store.open_dict('commands')
+            self.log_message(f"📚 Loaded {len(self.learned_commands)} existing commands")
             
             # Load existing protocol analysis
             if os.path.exists(self.protocol_file):
@@ -77,113 +84,65 @@ class XiaomiEnhancedAnalyzer:
         except Exception as e:
             self.log_message(f"⚠️ Could not load existing data: {e}")
     
-    def signal_handler(self, signum, frame):
-        """Handle shutdown signals gracefully"""
-        self.log_message(f"Received signal {signum}, shutting down...")
-        self.running = False
-        self.save_all_data()
-        sys.exit(0)
-    
     def log_message(self, message):
-        """Log message with timestamp"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        print(log_entry)
-        
-        with open(self.log_file, 'a') as f:
-            f.write(log_entry + '\n')
+        """Log message with timestamp; queued and written in batches by the shared log sink"""
+        self.log_sink.log(message)
     
-    def check_device_connectivity(self):
-        """Check if Xiaomi device is reachable"""
-        try:
-            result = subprocess.run(['ping', '-c', '1', '-W', '1000', self.xiaomi_ip], 
-                                  capture_output=True, text=True)
-            is_online = "1 received" in result.stdout
-            
-            if is_online != self.device_online:
-                self.device_online = is_online
-                if is_online:
-                    self.log_message(f"✅ Xiaomi device at {self.xiaomi_ip} is now ONLINE")
-                    self.on_device_online()
-                else:
-                    self.log_message(f"❌ Xiaomi device at {self.xiaomi_ip} is now OFFLINE")
-                    self.on_device_offline()
-            
-            return is_online
-        except Exception as e:
-            self.log_message(f"Error checking connectivity: {e}")
-            return False
+    def attach_liveness(self, runtime):
+        """Follow the device's online/offline transitions"""
+        runtime.watch_liveness(self.xiaomi_ip, self.on_liveness_change)
+    
+    def attach_portscan(self, runtime):
+        runtime.every(30, self.port_scan_round, 'port scanning', retry=60, when=lambda: self.device_online)
+    
+    def attach_discovery(self, runtime):
+        runtime.every(60, self.discover_commands, 'command discovery', retry=120, when=lambda: self.device_online)
+    
+    def attach_persist(self, runtime):
+        """Save every 30 seconds to preserve learned commands"""
+        runtime.on_save(self.save_all_data, 30, 'data save')
+    
+    def on_attached(self, runtime, stages):
+        """Without the liveness stage nothing reports the device online, so assume it is"""
+        if 'liveness' not in stages:
+            self.device_online = True
+    
+    def on_liveness_change(self, ip, online, rtt):
+        """Handle an online/offline transition from the liveness monitor"""
+        if online == self.device_online:
+            return
+        self.device_online = online
+        if online:
+            self.log_message(f"✅ Xiaomi device at {ip} is now ONLINE ({rtt} ms)")
+            self.on_device_online()
+        else:
+            self.log_message(f"❌ Xiaomi device at {ip} is now OFFLINE")
+            self.on_device_offline()
     
     def on_device_online(self):
         """Handle device coming online"""
         self.last_activity = datetime.now()
-        self.start_analysis_threads()
         self.log_message("🔬 Starting comprehensive device analysis...")
     
     def on_device_offline(self):
         """Handle device going offline"""
         self.log_message("📡 Device offline, continuing to monitor...")
     
-    def start_analysis_threads(self):
-        """Start all analysis threads"""
-        if not self.analysis_threads:
-            # Port scanner thread
-            port_thread = threading.Thread(target=self.continuous_port_scan, daemon=True)
-            port_thread.start()
-            self.analysis_threads.append(port_thread)
-            
-            # Command discoverer thread
-            command_thread = threading.Thread(target=self.continuous_command_discovery, daemon=True)
-            command_thread.start()
-            self.analysis_threads.append(command_thread)
-            
-            # Data saver thread
-            saver_thread = threading.Thread(target=self.continuous_data_saving, daemon=True)
-            saver_thread.start()
-            self.analysis_threads.append(saver_thread)
-    
-    def continuous_port_scan(self):
-        """Continuously scan ports for changes"""
-        known_ports = set()
+    def port_scan_round(self):
+        """One concurrent pass over the common ports, diffed against the previous scan"""
+        current_ports, new_ports, closed_ports = self.port_scanner.scan_changes(self.xiaomi_ip, COMMON_PORTS)
         
-        while self.running:
-            try:
-                if self.device_online:
-                    current_ports = self.scan_ports()
-                    
-                    # Check for new ports
-                    new_ports = current_ports - known_ports
-                    if new_ports:
-                        self.log_message(f"🔍 New ports discovered: {new_ports}")
-                        self.analyze_new_ports(new_ports)
-                    
-                    known_ports = current_ports
-                    self.protocol_analysis['open_ports'] = list(current_ports)
-                    self.protocol_analysis['last_scan'] = datetime.now().isoformat()
-                
-                time.sleep(30)  # Scan every 30 seconds
-            except Exception as e:
-                self.log_message(f"Error in port scanning: {e}")
-                time.sleep(60)
+        # Check for new ports
+        if new_ports:
+            self.log_message(f"🔍 New ports discovered: {new_ports}")
+            self.analyze_new_ports(new_ports)
+        
+        self.protocol_analysis['open_ports'] = list(current_ports)
+        self.protocol_analysis['last_scan'] = datetime.now().isoformat()
     
     def scan_ports(self):
         """Scan common Xiaomi ports"""
-        common_ports = [54321, 8080, 80, 443, 22, 23, 554, 8554, 9999, 8888]
-        open_ports = set()
-        
-        for port in common_ports:
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(1)
-                result = sock.connect_ex((self.xiaomi_ip, port))
-                sock.close()
-                
-                if result == 0:
-                    open_ports.add(port)
-            except Exception:
-                continue
-        
-        return open_ports
+        return self.port_scanner.scan_host(self.xiaomi_ip, COMMON_PORTS)
     
     def analyze_new_ports(self, ports):
         """Analyze newly discovered ports"""
@@ -222,7 +181,7 @@ class XiaomiEnhancedAnalyzer:
             
             # Common Xiaomi UDP discovery packets
             discovery_packets = [
-                b'\x21\x31\x00\x20\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff',
+                HELLO_PACKET,
                 b'{"id":1,"method":"miIO.info","params":[]}',
                 b'{"method":"get_prop","params":["power","mode","temp"]}',
                 b'{"method":"get_status","params":[]}'
@@ -234,12 +193,14 @@ class XiaomiEnhancedAnalyzer:
                 
                 try:
                     response, addr = sock.recvfrom(1024)
-                    self.log_message(f"📡 UDP response on port {port}: {response.hex()}")
+                    decoded = self.decode_udp_response(response)
+                    self.log_message(f"📡 UDP response on port {port}: {decoded}")
                     command_key = f'udp_port_{port}'
                     self.learned_commands[command_key] = {
                         'protocol': 'UDP',
                         'port': port,
                         'response': response.hex(),
+                        'decoded': decoded,
                         'timestamp': datetime.now().isoformat(),
                         'discovered': True
                     }
@@ -289,60 +250,40 @@ class XiaomiEnhancedAnalyzer:
         except Exception as e:
             pass
     
-    def continuous_command_discovery(self):
-        """Continuously discover new commands"""
-        while self.running:
-            try:
-                if self.device_online:
-                    self.discover_commands()
-                time.sleep(60)  # Discover every minute
-            except Exception as e:
-                self.log_message(f"Error in command discovery: {e}")
-                time.sleep(120)
-    
     def discover_commands(self):
-        """Discover new commands by testing common patterns"""
-        # Test common Xiaomi IR commands
-        ir_commands = [
-            'power', 'volume_up', 'volume_down', 'channel_up', 'channel_down',
-            'mute', 'menu', 'ok', 'back', 'up', 'down', 'left', 'right'
-        ]
-        
-        for cmd in ir_commands:
-            self.test_ir_command(cmd)
-            time.sleep(1)  # Wait between commands
+        """Discover new commands by probing common IR command names in each format"""
+        # Probes are paced per device and kept in flight together; candidates that
+        # timed out are skipped until their backoff expires
+        replies = self.prober.discover(self.xiaomi_ip, IR_COMMANDS, encode=self.encode_udp_command,
+                                       on_response=self.handle_udp_response)
+        if replies:
+            self.log_message(f"🔍 Discovery round: {len(replies)} probes answered")
     
-    def test_ir_command(self, command):
-        """Test sending IR command"""
-        try:
-            # Try different command formats
-            formats = [
-                f'{{"method":"send_ir","params":["{command}"]}}',
-                f'{{"method":"ir_{command}","params":[]}}',
-                f'{{"method":"{command}","params":[]}}'
-            ]
-            
-            for cmd_format in formats:
-                self.send_udp_command(cmd_format.encode())
-                time.sleep(0.5)
-        except Exception as e:
-            pass
+    def decode_udp_response(self, response):
+        """Decode a reply from the device, registering our token on hello replies"""
+        decoded = self.codec.decode_response(response, ip=self.xiaomi_ip)
+        if decoded.get('hello') and self.xiaomi_token:
+            self.codec.register_token(int(decoded['device_id'], 16), self.xiaomi_token)
+        return decoded
+    
+    def encode_udp_command(self, command):
+        """Encrypt a JSON command once the device ID and token are known"""
+        device = self.codec.tracker.get(self.xiaomi_ip)
+        if device is None or self.codec.context_for_device(device['device_id']) is None:
+            return command
+        stamp = self.codec.tracker.next_stamp(self.xiaomi_ip)
+        return self.codec.encode(device['device_id'], stamp, command)
     
     def send_udp_command(self, command):
         """Send UDP command to device"""
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             sock.settimeout(2)
-            sock.sendto(command, (self.xiaomi_ip, self.xiaomi_port))
+            sock.sendto(self.encode_udp_command(command), (self.xiaomi_ip, self.xiaomi_port))
             
             try:
                 response, addr = sock.recvfrom(1024)
-                self.log_message(f"📡 Command response: {response.hex()}")
-                self.device_responses.append({
-                    'command': command.decode() if isinstance(command, bytes) else command,
-                    'response': response.hex(),
-                    'timestamp': datetime.now().isoformat()
-                })
+                self.handle_udp_response(command, response)
             except socket.timeout:
                 pass
             
@@ -350,60 +291,56 @@ class XiaomiEnhancedAnalyzer:
         except Exception as e:
             pass
     
-    def continuous_data_saving(self):
-        """Continuously save data to preserve learned commands"""
-        while self.running:
+    def handle_udp_response(self, command, response):
+        """Decode and record the device's reply to a command"""
+        decoded = self.decode_udp_response(response)
+        self.log_message(f"📡 Command response: {decoded}")
+        self.device_responses.append({
+            'command': command.decode() if isinstance(command, bytes) else command,
+            'response': response.hex(),
+            'decoded': decoded,
+            'timestamp': datetime.now().isoformat()
+        })
+    
+    def save_all_data(self, force=False):
+        """Journal new commands; snapshot and summary files are rewritten only when compacting"""
+        with self.metrics.save_seconds.time():
             try:
-                self.save_all_data()
-                time.sleep(30)  # Save every 30 seconds
+                # Save learned commands
+                commands_header = {
+                    'status': 'analyzing',
+                    'device_online': self.device_online,
+                    'total_commands_discovered': len(self.learned_commands),
+                    'last_update': datetime.now().isoformat()
+                }
+                if not self.commands_store.save(commands_header, force=force):
+                    return
+                
+                # Save protocol analysis
+                self.protocol_analysis['last_update'] = datetime.now().isoformat()
+                write_json_atomic(self.protocol_file, self.protocol_analysis, indent=2)
+                
+                # Save learning summary
+                learning_summary = {
+                    'status': 'analyzing',
+                    'device_online': self.device_online,
+                    'total_commands_learned': len(self.learned_commands),
+                    'total_responses': len(self.device_responses),
+                    'analysis_duration': str(datetime.now() - self.start_time),
+                    'last_activity': self.last_activity.isoformat() if self.last_activity else None,
+                    'start_time': self.start_time.isoformat(),
+                    'learned_commands': self.learned_commands,
+                    'protocol_analysis': self.protocol_analysis
+                }
+                write_json_atomic(self.learning_file, learning_summary, indent=2)
+                
+                # Create backup
+                write_json_atomic(self.backup_file, learning_summary, indent=2)
+                
+                self.log_message(f"💾 Data saved: {len(self.learned_commands)} commands, {len(self.device_responses)} responses")
+            
             except Exception as e:
                 self.log_message(f"Error saving data: {e}")
-                time.sleep(60)
-    
-    def save_all_data(self):
-        """Save all learning data to files"""
-        try:
-            # Save learned commands
-            commands_data = {
-                'status': 'analyzing',
-                'device_online': self.device_online,
-                'total_commands_discovered': len(self.learned_commands),
-                'last_update': datetime.now().isoformat(),
-                'commands': self.learned_commands
-            }
-            
-            with open(self.commands_file, 'w') as f:
-                json.dump(commands_data, f, indent=2)
-            
-            # Save protocol analysis
-            self.protocol_analysis['last_update'] = datetime.now().isoformat()
-            with open(self.protocol_file, 'w') as f:
-                json.dump(self.protocol_analysis, f, indent=2)
-            
-            # Save learning summary
-            learning_summary = {
-                'status': 'analyzing',
-                'device_online': self.device_online,
-                'total_commands_learned': len(self.learned_commands),
-                'total_responses': len(self.device_responses),
-                'analysis_duration': str(datetime.now() - self.start_time),
-                'last_activity': self.last_activity.isoformat() if self.last_activity else None,
-                'start_time': self.start_time.isoformat(),
-                'learned_commands': self.learned_commands,
-                'protocol_analysis': self.protocol_analysis
-            }
-            
-            with open(self.learning_file, 'w') as f:
-                json.dump(learning_summary, f, indent=2)
-            
-            # Create backup
-            with open(self.backup_file, 'w') as f:
-                json.dump(learning_summary, f, indent=2)
-            
-            self.log_message(f"💾 Data saved: {len(self.learned_commands)} commands, {len(self.device_responses)} responses")
-            
-        except Exception as e:
-            self.log_message(f"Error saving data: {e}")
     
     def run_continuous_analysis(self):
         """Run continuous analysis until stopped"""
@@ -413,28 +350,14 @@ class XiaomiEnhancedAnalyzer:
         self.log_message("📊 Analysis will run continuously until stopped")
         self.log_message("🛑 Press Ctrl+C to stop")
         
-        self.running = True
-        
+        # Several devices or analyzers in one process: xiaomi_runtime.py with a pipeline file
+        runtime = AnalyzerRuntime('enhanced_analyzer', METRICS_PORT, log=self.log_message, registry=self.metrics.registry)
+        runtime.add(self)
         try:
-            while self.running:
-                # Check device connectivity
-                self.check_device_connectivity()
-                
-                # Save data every 5 minutes
-                if self.last_activity and (datetime.now() - self.last_activity).seconds > 300:
-                    self.save_all_data()
-                    self.last_activity = datetime.now()
-                
-                time.sleep(10)  # Check every 10 seconds
-                
-        except KeyboardInterrupt:
-            self.log_message("🛑 Analysis stopped by user")
+            runtime.run()
         except Exception as e:
             self.log_message(f"❌ Analysis error: {e}")
-        finally:
-            self.running = False
-            self.save_all_data()
-            self.log_message("✅ Analysis completed and data saved")
+        self.log_message("✅ Analysis completed and data saved")
 
 def main():
     """Main function"""
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Flow History Store
+Keeps weeks of flow records as daily columnar segments (one packed array file per column)
+Sealed segments are memory-mapped; time ranges are found by bisection and
+per-endpoint queries use a row index built on first use
+Several processes may write one store: new strings and column flushes happen under a file lock
+"""
+
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import shutil
+import socket
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Defaults
+FLOW_DIR = "xiaomi_flows"
+SEGMENT_SECONDS = 86400         # one segment per UTC day
+RETENTION_DAYS = 28
+STRINGS_FILE = "strings.ndjson"
+LOCK_FILE = ".lock"
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+# Column name -> array typecode (timestamps are microseconds since the epoch)
+COLUMNS = (
+    ('ts', 'q'),
+    ('src_ip', 'I'),
+    ('dst_ip', 'I'),
+    ('src_port', 'H'),
+    ('dst_port', 'H'),
+    ('state', 'H'),
+    ('kind', 'H'),
+)
+
+Flow = namedtuple('Flow', ['ts', 'src_ip', 'src_port', 'dst_ip', 'dst_port', 'state', 'kind'])
+
+_ip = struct.Struct('!I')
+
+
+def ip_to_int(ip):
+    """Pack a dotted IPv4 address into an int (0 for wildcards and non-IPv4)"""
+    try:
+        return _ip.unpack(socket.inet_aton(ip))[0]
+    except (OSError, TypeError):
+        return 0
+
+
+def int_to_ip(value):
+    """Unpack an int back to a dotted IPv4 address"""
+    return socket.inet_ntoa(_ip.pack(value))
+
+
+def parse_endpoint(addr):
+    """Split 'ip:port' (Linux/lsof) or 'ip.port' (macOS netstat) into (ip, port)"""
+    addr = addr.strip()
+    if ':' in addr:
+        host, _, port = addr.rpartition(':')
+    elif addr.count('.') == 4:
+        host, _, port = addr.rpartition('.')
+    else:
+        host, port = addr, ''
+    return host, int(port) if port.isdigit() else 0
+
+
+@contextmanager
+def store_lock(path):
+    """Exclusive advisory lock held by whichever process is writing the store"""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def to_micros(ts):
+    """Accept epoch seconds, a datetime or an ISO string"""
+    if isinstance(ts, str):
+        ts = datetime.fromisoformat(ts)
+    if isinstance(ts, datetime):
+        ts = ts.timestamp()
+    return int(ts * 1_000_000)
+
+
+class StringTable:
+    """Append-only dictionary encoding for repeated strings (states, kinds)
+
+    A code is the line number of the string in the file, so before adding a
+    string the writer re-reads whatever other processes appended and assigns
+    the next line under the store lock.
+    """
+
+    def __init__(self, path, lock_path=None):
+        self.path = path
+        self.lock_path = lock_path
+        self.values = ['']
+        self.codes = {'': 0}
+        self._offset = 0
+        self._reload()
+
+    def _reload(self):
+        """Pick up complete lines appended since the last read"""
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except OSError:
+            return
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                value = json.loads(line)
+            except ValueError:
+                value = ''
+            if not isinstance(value, str):
+                value = ''
+            # Every line takes a code, even a damaged or repeated one, so codes match the file
+            self.codes.setdefault(value, len(self.values))
+            self.values.append(value)
+        self._offset += end
+
+    def encode(self, value):
+        """Code for value, adding it to the table on first use"""
+        value = value or ''
+        code = self.codes.get(value)
+        if code is not None:
+            return code
+        with store_lock(self.lock_path or f"{self.path}.lock"):
+            self._reload()
+            code = self.codes.get(value)
+            if code is None:
+                with open(self.path, 'ab') as f:
+                    f.write(json.dumps(value).encode() + b'\n')
+                self._reload()
+                code = self.codes[value]
+        return code
+
+    def decode(self, code):
+        if code >= len(self.values):
+            self._reload()
+        return self.values[code] if code < len(self.values) else ''
+
+
+class Segment:
+    """One time slice of flows stored column by column"""
+
+    def __init__(self, path, start, writable=False, lock_path=None):
+        self.path = path
+        self.start = start
+        self.writable = writable
+        self.lock_path = lock_path or os.path.join(path, LOCK_FILE)
+        self.columns = {}
+        self._maps = []
+        self._host_index = None
+        if writable:
+            os.makedirs(path, exist_ok=True)
+            # Another writer may be mid-flush; only a flush that died part way may be cut
+            with store_lock(self.lock_path):
+                self._open()
+        else:
+            self._open()
+        self.sorted = all(a <= b for a, b in zip(self.columns['ts'], self.columns['ts'][1:]))
+        self._flushed = len(self)
+
+    def _open(self):
+        for name, code in COLUMNS:
+            self.columns[name] = self._load(name, code)
+        # Columns of unequal length mean a torn flush (or, for a reader, one in progress)
+        self._trim(len(self))
+
+    def _column_path(self, name, code):
+        return os.path.join(self.path, f"{name}.{code}")
+
+    def _load(self, name, code):
+        path = self._column_path(name, code)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return array(code)
+        if self.writable:
+            column = array(code)
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Drop a partially written trailing record
+            column.frombytes(data[:len(data) - len(data) % column.itemsize])
+            return column
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        view = memoryview(mapped)
+        itemsize = array(code).itemsize
+        return view[:len(view) - len(view) % itemsize].cast(code)
+
+    def _trim(self, count):
+        """Cut every column to count rows, undoing a flush interrupted between columns"""
+        for name, code in COLUMNS:
+            column = self.columns[name]
+            if len(column) == count:
+                continue
+            if self.writable:
+                del column[count:]
+                with open(self._column_path(name, code), 'r+b') as f:
+                    f.truncate(count * column.itemsize)
+            else:
+                self.columns[name] = column[:count]
+
+    def __len__(self):
+        return min(len(column) for column in self.columns.values())
+
+    def append(self, row):
+        """Append one row given as a tuple in COLUMNS order"""
+        ts = row[0]
+        column = self.columns['ts']
+        if column and ts < column[-1]:
+            self.sorted = False
+        for (name, _), value in zip(COLUMNS, row):
+            self.columns[name].append(value)
+        if self._host_index is not None:
+            row_id = len(column) - 1
+            for ip in (row[1], row[2]):
+                self._host_index.setdefault(ip, array('I')).append(row_id)
+
+    def flush(self):
+        """Append rows added since the last flush to the column files"""
+        count = len(self)
+        if not self.writable or count == self._flushed:
+            return 0
+        # All columns of one flush go out together, so rows of concurrent writers never interleave
+        with store_lock(self.lock_path):
+            for name, code in COLUMNS:
+                with open(self._column_path(name, code), 'ab') as f:
+                    f.write(self.columns[name][self._flushed:count].tobytes())
+        written = count - self._flushed
+        self._flushed = count
+        return written
+
+    def host_rows(self, ip):
+        """Row numbers touching ip, from an index built on first use"""
+        if self._host_index is None:
+            index = {}
+            for row_id, (src, dst) in enumerate(zip(self.columns['src_ip'], self.columns['dst_ip'])):
+                index.setdefault(src, array('I')).append(row_id)
+                if dst != src:
+                    index.setdefault(dst, array('I')).append(row_id)
+            self._host_index = index
+        return self._host_index.get(ip, ())
+
+    def row_range(self, start, end):
+        """[lo, hi) rows whose timestamps fall in [start, end) when the segment is sorted"""
+        ts = self.columns['ts']
+        count = len(self)
+        lo = bisect.bisect_left(ts, start, 0, count) if start is not None else 0
+        hi = bisect.bisect_left(ts, end, 0, count) if end is not None else count
+        return lo, hi
+
+    def close(self):
+        self.flush()
+        self.columns = {}
+        self._host_index = None
+        for mapped in self._maps:
+            try:
+                mapped.close()
+            except BufferError:
+                pass
+        self._maps = []
+
+
+class FlowStore:
+    """Append flows and answer time-range / per-endpoint queries across segments"""
+
+    def __init__(self, root=FLOW_DIR, segment_seconds=SEGMENT_SECONDS, retention_days=RETENTION_DAYS,
+                 read_only=False):
+        self.root = root
+        self.segment_seconds = segment_seconds
+        self.retention_days = retention_days
+        self.read_only = read_only
+        self.lock_path = os.path.join(root, LOCK_FILE)
+        if not read_only:
+            os.makedirs(root, exist_ok=True)
+        self.strings = StringTable(os.path.join(root, STRINGS_FILE), self.lock_path)
+        self._segments = {}
+        self._lock = threading.RLock()
+
+    def _segment_start(self, micros):
+        return micros // 1_000_000 // self.segment_seconds * self.segment_seconds
+
+    def _segment_dir(self, start):
+        return os.path.join(self.root, time.strftime('%Y%m%d-%H%M%S', time.gmtime(start)))
+
+    def _segment_starts(self):
+        starts = []
+        for name in (os.listdir(self.root) if os.path.isdir(self.root) else ()):
+            try:
+                starts.append(int(datetime.strptime(name, '%Y%m%d-%H%M%S').replace(
+                    tzinfo=timezone.utc).timestamp()))
+            except ValueError:
+                continue
+        return sorted(starts)
+
+    def _segment(self, start, create=False):
+        segment = self._segments.get(start)
+        if segment is None:
+            path = self._segment_dir(start)
+            if not create and not os.path.isdir(path):
+                return None
+            current = self._segment_start(to_micros(time.time()))
+            writable = not self.read_only and start >= current
+            segment = self._segments[start] = Segment(path, start, writable, self.lock_path)
+        return segment
+
+    def add(self, ts, src_ip, src_port, dst_ip, dst_port, state='', kind=''):
+        """Record one flow observation"""
+        if self.read_only:
+            raise ValueError(f"Flow store {self.root} is open read-only")
+        micros = to_micros(ts)
+        row = (micros, ip_to_int(src_ip), ip_to_int(dst_ip), int(src_port or 0) & 0xffff,
+               int(dst_port or 0) & 0xffff, self.strings.encode(state), self.strings.encode(kind))
+        with self._lock:
+            start = self._segment_start(micros)
+            segment = self._segment(start, create=True)
+            if not segment.writable:
+                # Late record for a sealed segment: reopen it for appending
+                segment.close()
+                segment = self._segments[start] = Segment(segment.path, start, True, self.lock_path)
+            segment.append(row)
+
+    def add_endpoints(self, ts, src, dst, state='', kind=''):
+        """Record a flow from 'ip:port' / 'ip.port' endpoint strings"""
+        src_ip, src_port = parse_endpoint(src)
+        dst_ip, dst_port = parse_endpoint(dst)
+        self.add(ts, src_ip, src_port, dst_ip, dst_port, state, kind)
+
+    def flush(self):
+        """Write pending rows of all open segments; returns the row count"""
+        with self._lock:
+            written = sum(segment.flush() for segment in self._segments.values())
+            if self._seal_old_segments():
+                self.prune()
+            return written
+
+    def _seal_old_segments(self):
+        """Close segments that have rolled over; they are memory-mapped when read again"""
+        current = self._segment_start(to_micros(time.time()))
+        sealed = False
+        for start, segment in list(self._segments.items()):
+            if segment.writable and start < current:
+                segment.close()
+                del self._segments[start]
+                sealed = True
+        return sealed
+
+    def prune(self, now=None):
+        """Delete segments older than the retention window"""
+        cutoff = (now or time.time()) - self.retention_days * 86400
+        with self._lock:
+            for start in self._segment_starts():
+                if start + self.segment_seconds <= cutoff:
+                    segment = self._segments.pop(start, None)
+                    if segment is not None:
+                        segment.close()
+                    shutil.rmtree(self._segment_dir(start), ignore_errors=True)
+
+    def query(self, start=None, end=None, host=None, port=None):
+        """Yield flows with start <= ts < end, optionally touching host and/or port"""
+        start_us = to_micros(start) if start is not None else None
+        end_us = to_micros(end) if end is not None else None
+        host_ip = ip_to_int(host) if host else None
+
+        with self._lock:
+            starts = self._segment_starts()
+        for seg_start in starts:
+            if start_us is not None and (seg_start + self.segment_seconds) * 1_000_000 <= start_us:
+                continue
+            if end_us is not None and seg_start * 1_000_000 >= end_us:
+                break
+            with self._lock:
+                segment = self._segment(seg_start)
+            if segment is None:
+                continue
+            yield from self._query_segment(segment, start_us, end_us, host_ip, port)
+
+    def _query_segment(self, segment, start_us, end_us, host_ip, port):
+        cols = segment.columns
+        ts, src_ip, dst_ip = cols['ts'], cols['src_ip'], cols['dst_ip']
+        src_port, dst_port = cols['src_port'], cols['dst_port']
+
+        if segment.sorted:
+            lo, hi = segment.row_range(start_us, end_us)
+        else:
+            lo, hi = 0, len(segment)
+        if host_ip is not None:
+            rows = segment.host_rows(host_ip)
+            rows = rows[bisect.bisect_left(rows, lo):bisect.bisect_left(rows, hi)]
+        else:
+            rows = range(lo, hi)
+
+        decode = self.strings.decode
+        for row in rows:
+            t = ts[row]
+            if (start_us is not None and t < start_us) or (end_us is not None and t >= end_us):
+                continue
+            if port is not None and port not in (src_port[row], dst_port[row]):
+                continue
+            yield Flow(t / 1_000_000, int_to_ip(src_ip[row]), src_port[row],
+                       int_to_ip(dst_ip[row]), dst_port[row],
+                       decode(cols['state'][row]), decode(cols['kind'][row]))
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments = {}
+
+
+def get_store(root=FLOW_DIR):
+    """The process-wide store for a directory, created on first use; monitors in one process share it"""
+    key = os.path.abspath(root)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = FlowStore(root)
+        return store
+
+
+def main():
+    """Query flows: xiaomi_flowstore.py host [start_iso] [end_iso]"""
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} host [start_iso] [end_iso]")
+        sys.exit(1)
+    # Read-only: today's segment may still be appended to by a running monitor
+    store = FlowStore(read_only=True)
+    start = sys.argv[2] if len(sys.argv) > 2 else None
+    end = sys.argv[3] if len(sys.argv) > 3 else None
+    count = 0
+    for flow in store.query(start, end, host=sys.argv[1]):
+        count += 1
+        print(f"{datetime.fromtimestamp(flow.ts).isoformat()} {flow.src_ip}:{flow.src_port} -> "
+              f"{flow.dst_ip}:{flow.dst_port} {flow.state} {flow.kind}")
+    print(f"📊 {count} flows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Streaming JSON Extractor
+Finds balanced JSON objects embedded in a byte stream, across packet boundaries
+Only structural characters are visited (regex jumps), so noise and long strings are skipped in C
+Caches the parameter shape seen for each command method
+"""
+
+import json
+import re
+import sys
+import time
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # Standard library decoder is still C-accelerated
+    _loads = json.loads
+
+# Defaults
+DEFAULT_MAX_OBJECT_SIZE = 64 * 1024   # larger objects are abandoned for their inner objects
+
+# A brace, or a whole string literal (group 1 is empty when it runs past the chunk)
+_STRUCTURE = re.compile(rb'[{}]|"(?:[^"\\]|\\.)*("?)', re.DOTALL)
+_STRING = re.compile(rb'["\\]')
+
+
+class JsonScanner:
+    """Incremental extractor of outermost JSON objects from a byte stream
+
+    feed() accepts arbitrary chunks (e.g. packet payloads) and returns the objects
+    completed by that chunk. Text that is not JSON is skipped; a brace-delimited
+    region that does not decode is searched for valid inner objects instead.
+    """
+
+    def __init__(self, max_object_size=DEFAULT_MAX_OBJECT_SIZE):
+        self.max_object_size = max_object_size
+        self.buffer = bytearray()   # bytes of the open object from earlier chunks
+        self.starts = []            # offsets in buffer of each open '{', outermost first
+        self.in_string = False
+        self.escape = False         # chunk ended on a backslash inside a string
+        self.objects = 0
+        self.bytes = 0
+
+    @property
+    def depth(self):
+        return len(self.starts)
+
+    def reset(self):
+        self.buffer.clear()
+        self.starts = []
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, data):
+        """Scan a chunk; returns the decoded objects it completed"""
+        data = bytes(data)
+        self.bytes += len(data)
+        found = []
+        size = len(data)
+        pos = 0
+        base = 0                    # start of this chunk's part of the open object
+        if self.escape:
+            self.escape = False
+            pos = 1
+
+        while pos < size:
+            if not self.starts:
+                start = data.find(b'{', pos)
+                if start < 0:
+                    break
+                # Fast path: most objects are flat, so try up to the first closing brace.
+                # If that parses it is exactly the balanced object (no '}' can end it sooner).
+                end = data.find(b'}', start)
+                if end > 0:
+                    try:
+                        value = _loads(data[start:end + 1])
+                    except ValueError:
+                        value = None
+                    if isinstance(value, dict):
+                        found.append(value)
+                        self.objects += 1
+                        pos = end + 1
+                        continue
+                self.buffer.clear()
+                self.starts.append(0)
+                base = start
+                pos = start + 1
+                continue
+
+            if self.in_string:
+                match = _STRING.search(data, pos)
+                if match is None:
+                    break
+                if match.group() == b'\\':
+                    pos = match.end() + 1
+                    if pos > size:
+                        self.escape = True
+                else:
+                    self.in_string = False
+                    pos = match.end()
+                continue
+
+            match = _STRUCTURE.search(data, pos)
+            if match is None:
+                break
+            char = match.group()
+            pos = match.end()
+            if char[0] == 0x22:  # '"'
+                if not match.group(1):
+                    self.in_string = True  # Continues in the next chunk
+            elif char == b'{':
+                self.starts.append(len(self.buffer) + match.start() - base)
+            else:
+                self.starts.pop()
+                if not self.starts:
+                    self.buffer += data[base:pos]
+                    found.extend(self._decode(bytes(self.buffer)))
+                    self.buffer.clear()
+
+        if self.starts:
+            self.buffer += data[base:]
+            self._bound()
+        return found
+
+    def _bound(self):
+        """Keep an oversized open object from growing: descend into its newest child"""
+        while len(self.buffer) > self.max_object_size:
+            if len(self.starts) < 2:
+                self.reset()
+                return
+            cut = self.starts[1]
+            del self.buffer[:cut]
+            self.starts = [start - cut for start in self.starts[1:]]
+
+    def _decode(self, blob):
+        try:
+            value = _loads(blob)
+        except ValueError:
+            # Braces that are not JSON (code, templates): look for objects inside
+            inner = JsonScanner(self.max_object_size)
+            return inner.feed(blob[1:-1])
+        self.objects += 1
+        return [value] if isinstance(value, dict) else []
+
+
+def extract_json_objects(data):
+    """All outermost JSON objects in a complete text or bytes payload"""
+    if isinstance(data, str):
+        data = data.encode('utf-8', errors='ignore')
+    return JsonScanner().feed(data)
+
+
+def shape_of(value):
+    """Structural signature of a JSON value: types, keys and nesting, not contents"""
+    if isinstance(value, dict):
+        return '{' + ','.join(f'{key}:{shape_of(item)}' for key, item in sorted(value.items())) + '}'
+    if isinstance(value, list):
+        shapes = list(dict.fromkeys(shape_of(item) for item in value))
+        return '[' + '|'.join(shapes) + ']'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, float)):
+        return 'num'
+    if value is None:
+        return 'null'
+    return 'str'
+
+
+class MethodShapeCache:
+    """Remembers every parameter shape seen per command method"""
+
+    def __init__(self):
+        self.shapes = {}    # method -> {shape: count}
+
+    def observe(self, method, params):
+        """Record a call; returns (shape, is_new) where is_new means the shape was unseen"""
+        shape = shape_of(params)
+        counts = self.shapes.setdefault(method, {})
+        is_new = shape not in counts
+        counts[shape] = counts.get(shape, 0) + 1
+        return shape, is_new
+
+
+def benchmark(path, chunk_size=1460, rounds=5):
+    """Objects/s and MB/s over a JSON corpus streamed in packet-sized chunks, against the old regex"""
+    with open(path, 'rb') as f:
+        corpus = f.read()
+    data = json.loads(corpus)
+    entries = data.get('traffic', []) if isinstance(data, dict) else data
+    # The corpus entries, each embedded in packet-like text the way captures present them
+    stream = b''.join(b'IP 192.168.68.53 > 192.168.68.68: ' + json.dumps(entry).encode() + b'\r\n'
+                      for entry in entries)
+    chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        scanner = JsonScanner()
+        streamed = sum(len(scanner.feed(chunk)) for chunk in chunks)
+    scanner_time = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        regex_found = 0
+        for chunk in chunks:
+            for match in re.findall(r'\{[^}]*\}', chunk.decode('utf-8', errors='ignore')):
+                try:
+                    json.loads(match)
+                    regex_found += 1
+                except ValueError:
+                    continue
+    regex_time = (time.perf_counter() - start) / rounds
+
+    megabytes = len(stream) / 1e6
+    return {
+        'entries': len(entries),
+        'stream_bytes': len(stream),
+        'scanner_objects': streamed,
+        'scanner_mb_per_s': round(megabytes / scanner_time, 1),
+        'scanner_objects_per_s': round(streamed / scanner_time),
+        'regex_objects': regex_found,
+        'regex_mb_per_s': round(megabytes / regex_time, 1),
+        'decoder': _loads.__module__,
+    }
+
+
+def main():
+    """Benchmark on a corpus: xiaomi_jsonscan.py xiaomi_network_traffic.json"""
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} corpus.json")
+        sys.exit(1)
+    for key, value in benchmark(sys.argv[1]).items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
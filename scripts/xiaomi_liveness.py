@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Device Liveness Monitor
+Probes every watched device from one long-lived ICMP socket instead of forking ping
+Falls back to UDP-connect probes when ICMP sockets are not permitted
+Tracks RTT histograms per device and reports online/offline transitions to listeners
+"""
+
+import bisect
+import itertools
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+
+# Defaults
+DEFAULT_INTERVAL = 10.0      # seconds between probe rounds
+DEFAULT_TIMEOUT = 1.0        # seconds to wait for replies in a round
+DEFAULT_OFFLINE_AFTER = 2    # consecutive misses before a device is reported offline
+DEFAULT_UDP_PORT = 9         # discard port; a live host answers with port unreachable
+
+# RTT histogram bucket upper bounds in milliseconds (last bucket is open-ended)
+RTT_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+_icmp_header = struct.Struct('!BBHHH')
+
+
+def _checksum(data):
+    """RFC 1071 internet checksum"""
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def open_icmp_socket():
+    """Return (method, socket): raw ICMP as root, ping socket if allowed, else (None, None)"""
+    for kind, method in ((socket.SOCK_RAW, 'icmp'), (socket.SOCK_DGRAM, 'icmp-dgram')):
+        try:
+            sock = socket.socket(socket.AF_INET, kind, socket.IPPROTO_ICMP)
+        except OSError:
+            continue
+        sock.setblocking(False)
+        return method, sock
+    return None, None
+
+
+class RttHistogram:
+    """Fixed-bucket RTT histogram with running min/max/mean"""
+
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(RTT_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, rtt_ms):
+        """Record one round-trip time"""
+        self.counts[bisect.bisect_left(RTT_BUCKETS_MS, rtt_ms)] += 1
+        self.count += 1
+        self.total += rtt_ms
+        self.min = rtt_ms if self.min is None else min(self.min, rtt_ms)
+        self.max = rtt_ms if self.max is None else max(self.max, rtt_ms)
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the pct-th percentile"""
+        if not self.count:
+            return None
+        rank = self.count * pct / 100.0
+        seen = 0
+        for bound, count in zip(RTT_BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        """JSON-friendly view of the histogram"""
+        return {
+            'count': self.count,
+            'min_ms': self.min,
+            'max_ms': self.max,
+            'mean_ms': round(self.total / self.count, 3) if self.count else None,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'buckets': dict(zip([f'<={b}' for b in RTT_BUCKETS_MS] + ['>1000'], self.counts)),
+        }
+
+
+class DeviceState:
+    """Liveness bookkeeping for one watched address"""
+
+    __slots__ = ('ip', 'online', 'rtt_ms', 'misses', 'sent', 'received',
+                 'last_seen', 'last_change', 'histogram')
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.online = None
+        self.rtt_ms = None
+        self.misses = 0
+        self.sent = 0
+        self.received = 0
+        self.last_seen = None
+        self.last_change = None
+        self.histogram = RttHistogram()
+
+    def to_dict(self):
+        """JSON-friendly snapshot"""
+        return {
+            'online': bool(self.online),
+            'rtt_ms': self.rtt_ms,
+            'loss': round(1 - self.received / self.sent, 3) if self.sent else None,
+            'last_seen': self.last_seen,
+            'last_change': self.last_change,
+            'rtt': self.histogram.summary(),
+        }
+
+
+class LivenessMonitor:
+    """Long-lived multi-device reachability probe with transition events"""
+
+    def __init__(self, targets=(), interval=DEFAULT_INTERVAL, timeout=DEFAULT_TIMEOUT,
+                 offline_after=DEFAULT_OFFLINE_AFTER, udp_port=DEFAULT_UDP_PORT,
+                 state_file=None, use_icmp=True):
+        self.interval = interval
+        self.timeout = timeout
+        self.offline_after = offline_after
+        self.udp_port = udp_port
+        self.state_file = state_file
+        self.devices = {}
+        self.listeners = []
+
+        self.method, self._icmp = open_icmp_socket() if use_icmp else (None, None)
+        if self.method is None:
+            self.method = 'udp'
+        self._ident = os.getpid() & 0xffff
+        self._seq = itertools.count()
+        self._udp = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        for ip in targets:
+            self.add_target(ip)
+
+    def add_target(self, ip):
+        """Start watching ip"""
+        with self._lock:
+            if ip not in self.devices:
+                self.devices[ip] = DeviceState(ip)
+
+    def remove_target(self, ip):
+        """Stop watching ip"""
+        with self._lock:
+            self.devices.pop(ip, None)
+            sock = self._udp.pop(ip, None)
+            if sock is not None:
+                sock.close()
+
+    def add_listener(self, callback):
+        """Register callback(ip, online, rtt_ms) for online/offline transitions"""
+        self.listeners.append(callback)
+
+    def is_online(self, ip):
+        """Last known state of ip (False until the first reply)"""
+        state = self.devices.get(ip)
+        return bool(state and state.online)
+
+    def rtt(self, ip):
+        """Last RTT in milliseconds, or None"""
+        state = self.devices.get(ip)
+        return state.rtt_ms if state else None
+
+    def _probe_icmp(self, targets):
+        """Send one echo request per target and collect replies; returns {ip: rtt_ms}"""
+        sock = self._icmp
+        self._drain(sock)
+        pending = {}
+        for ip in targets:
+            seq = next(self._seq) & 0xffff
+            header = _icmp_header.pack(ICMP_ECHO_REQUEST, 0, 0, self._ident, seq)
+            packet = _icmp_header.pack(ICMP_ECHO_REQUEST, 0, _checksum(header), self._ident, seq)
+            try:
+                sock.sendto(packet, (ip, 0))
+            except OSError:
+                continue
+            pending[seq] = (ip, time.monotonic())
+
+        results = {}
+        deadline = time.monotonic() + self.timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                break
+            try:
+                data, addr = sock.recvfrom(2048)
+            except OSError:
+                continue
+            now = time.monotonic()
+            # Raw sockets deliver the IP header, ping sockets do not
+            offset = (data[0] & 0x0f) * 4 if self.method == 'icmp' else 0
+            if len(data) < offset + _icmp_header.size:
+                continue
+            kind, _, _, ident, seq = _icmp_header.unpack_from(data, offset)
+            if kind != ICMP_ECHO_REPLY or (self.method == 'icmp' and ident != self._ident):
+                continue
+            entry = pending.get(seq)
+            if entry and entry[0] == addr[0]:
+                del pending[seq]
+                results[entry[0]] = (now - entry[1]) * 1000.0
+        return results
+
+    def _udp_socket(self, ip):
+        """Connected UDP socket kept open per target"""
+        sock = self._udp.get(ip)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.connect((ip, self.udp_port))
+            self._udp[ip] = sock
+        return sock
+
+    def _probe_udp(self, targets):
+        """Unprivileged fallback: a refused datagram proves the host is up"""
+        pending = {}
+        for ip in targets:
+            try:
+                sock = self._udp_socket(ip)
+                self._drain(sock)
+                sock.send(b'\x00')
+            except OSError:
+                continue
+            pending[sock] = (ip, time.monotonic())
+
+        results = {}
+        deadline = time.monotonic() + self.timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            readable = select.select(list(pending), [], [], remaining)[0]
+            if not readable:
+                break
+            now = time.monotonic()
+            for sock in readable:
+                ip, sent_at = pending.pop(sock)
+                try:
+                    sock.recv(512)
+                except ConnectionRefusedError:
+                    pass
+                except OSError:
+                    # Host or network unreachable
+                    continue
+                results[ip] = (now - sent_at) * 1000.0
+        return results
+
+    @staticmethod
+    def _drain(sock):
+        """Discard late replies and stale errors from the previous round"""
+        while True:
+            try:
+                sock.recv(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+
+    def probe_once(self):
+        """Run one probe round over all targets; returns {ip: rtt_ms or None}"""
+        with self._lock:
+            targets = list(self.devices)
+            if not targets:
+                return {}
+            if self._icmp is not None:
+                results = self._probe_icmp(targets)
+            else:
+                results = self._probe_udp(targets)
+
+            transitions = []
+            now = datetime.now().isoformat()
+            for ip in targets:
+                state = self.devices[ip]
+                state.sent += 1
+                rtt = results.get(ip)
+                if rtt is not None:
+                    rtt = results[ip] = round(rtt, 3)
+                    state.received += 1
+                    state.misses = 0
+                    state.rtt_ms = rtt
+                    state.last_seen = now
+                    state.histogram.add(rtt)
+                    online = True
+                else:
+                    state.misses += 1
+                    state.rtt_ms = None
+                    online = state.online if state.misses < self.offline_after else False
+                if online is not None and online != state.online:
+                    state.online = online
+                    state.last_change = now
+                    transitions.append((ip, online, rtt))
+
+        for ip, online, rtt in transitions:
+            for callback in self.listeners:
+                callback(ip, online, rtt)
+        if self.state_file:
+            self.write_state()
+        return {ip: results.get(ip) for ip in targets}
+
+    def snapshot(self):
+        """State of all devices as a JSON-friendly dict"""
+        return {
+            'updated': datetime.now().isoformat(),
+            'method': self.method,
+            'devices': {ip: state.to_dict() for ip, state in self.devices.items()},
+        }
+
+    def write_state(self):
+        """Atomically replace the state file with the current snapshot"""
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_file, self.state_file)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.probe_once()
+            except Exception as e:
+                print(f"Liveness probe error: {e}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """Probe in a background thread every interval seconds"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.timeout + 1)
+            self._thread = None
+
+    def close(self):
+        """Stop probing and close all sockets"""
+        self.stop()
+        if self._icmp is not None:
+            self._icmp.close()
+            self._icmp = None
+        for sock in self._udp.values():
+            sock.close()
+        self._udp.clear()
+
+
+def probe(ip, timeout=DEFAULT_TIMEOUT):
+    """One-shot reachability check; returns RTT in milliseconds or None"""
+    monitor = LivenessMonitor([ip], timeout=timeout, offline_after=1)
+    try:
+        return monitor.probe_once()[ip]
+    finally:
+        monitor.close()
+
+
+def main():
+    """Watch devices: xiaomi_liveness.py ip [ip ...]"""
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} ip [ip ...]")
+        sys.exit(1)
+
+    monitor = LivenessMonitor(sys.argv[1:])
+    monitor.add_listener(lambda ip, online, rtt: print(
+        f"{'✅' if online else '❌'} {ip} is now {'ONLINE' if online else 'OFFLINE'}"
+        + (f" ({rtt} ms)" if rtt is not None else "")))
+    print(f"🚀 Watching {len(monitor.devices)} devices via {monitor.method}")
+    monitor.start()
+    try:
+        while True:
+            time.sleep(monitor.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.close()
+        print(json.dumps(monitor.snapshot()['devices'], indent=2))
+
+
+if __name__ == "__main__":
+    main()
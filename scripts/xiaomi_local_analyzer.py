@@ -8,167 +8,152 @@ Provides deep analysis and learning capabilities
 import subprocess
 import json
 import time
-import re
 import socket
-import threading
-import signal
 import sys
 from datetime import datetime
 from collections import defaultdict, deque
 import os
 
+from xiaomi_jsonscan import JsonScanner, shape_of
+from xiaomi_logsink import close_sink, get_sink
+from xiaomi_metrics import MonitorMetrics
+from xiaomi_miio import HELLO_PACKET, MIIO_PORT, MiioCodec, is_miio_packet
+from xiaomi_pcap import IPPROTO_TCP
+from xiaomi_portscan import COMMON_PORTS, PortScanner
+from xiaomi_prober import IR_COMMANDS, ProbeScheduler
+from xiaomi_reassembly import TcpReassembler
+from xiaomi_replay import Replay, busiest_hosts, format_stats, replay_args, replay_device, replay_packets
+from xiaomi_runtime import AnalyzerRuntime, instance_path
+from xiaomi_sequences import SequenceMiner
+from xiaomi_signatures import FROM_DEVICE, NEW_SIGNATURE, CommandIndex, flow_direction, http_method
+from xiaomi_store import LearningStore, write_json_atomic
+
 # Configuration
 XIAOMI_IP = "192.168.68.68"
 XIAOMI_PORT = 54321
+XIAOMI_TOKEN = ""  # 32 hex chars from Mi Home, leave empty if unknown
 LOG_FILE = "xiaomi_local_analysis.log"
 LEARNING_FILE = "xiaomi_learning.json"
 PATTERNS_FILE = "xiaomi_patterns.json"
 COMMANDS_FILE = "xiaomi_discovered_commands.json"
 PROTOCOL_FILE = "xiaomi_protocol_analysis.json"
+METRICS_PORT = 9477  # localhost metrics endpoint, None disables
 
 class XiaomiLocalAnalyzer:
-    def __init__(self):
-        self.xiaomi_ip = XIAOMI_IP
-        self.xiaomi_port = XIAOMI_PORT
-        self.log_file = LOG_FILE
-        self.learning_file = LEARNING_FILE
-        self.patterns_file = PATTERNS_FILE
-        self.commands_file = COMMANDS_FILE
-        self.protocol_file = PROTOCOL_FILE
+    STAGES = ('liveness', 'capture', 'portscan', 'discovery', 'protocol', 'persist')
+
+    def __init__(self, device=None, registry=None):
+        device = device or {}
+        self.xiaomi_ip = device.get('ip', XIAOMI_IP)
+        self.xiaomi_port = device.get('port', XIAOMI_PORT)
+        self.xiaomi_token = device.get('token', XIAOMI_TOKEN)
+        self.log_file = instance_path(LOG_FILE, device)
+        self.log_sink = get_sink(self.log_file)
+        self.learning_file = instance_path(LEARNING_FILE, device)
+        self.patterns_file = instance_path(PATTERNS_FILE, device)
+        self.commands_file = instance_path(COMMANDS_FILE, device)
+        self.protocol_file = instance_path(PROTOCOL_FILE, device)
         
         # Learning data structures
-        self.learned_commands = {}
+        self.commands_store = LearningStore(self.commands_file)
+        self.learned_commands = self.commands_store.open_dict('commands')
+        self.command_index = CommandIndex(self.learned_commands,
+                                          self.commands_store.open_dict('content_hashes'))
         self.communication_patterns = defaultdict(list)
         self.protocol_analysis = {}
+        self.codec = MiioCodec()
+        self.metrics = MonitorMetrics('local_analyzer', registry, instance=device.get('name'))
+        self.port_scanner = PortScanner()
+        self.prober = ProbeScheduler(port=self.xiaomi_port, metrics=self.metrics)
+        self.reassembler = TcpReassembler()
+        self.json_scanners = {}  # flow -> scanner holding a JSON object still open
         self.device_responses = deque(maxlen=1000)
-        self.command_sequences = deque(maxlen=100)
+        self.sequence_miner = SequenceMiner()
+        self.metrics.watch_queue('tcp_flows', lambda: len(self.reassembler.flows))
+        self.metrics.watch_queue('json_partial', lambda: len(self.json_scanners))
+        self.metrics.watch_queue('commands_unsaved', lambda: len(self.learned_commands.dirty))
+        self.metrics.watch_stats('xiaomi_reassembly', lambda: self.reassembler.stats, 'TCP reassembly counters')
+        self.metrics.watch_stats('xiaomi_sequences', self.sequence_miner.stats, 'Sequence miner counters')
         
         # Analysis state
-        self.running = False
-        self.analysis_threads = []
         self.last_activity = None
         self.device_online = False
-        
-        # Setup signal handlers for graceful shutdown
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGTERM, self.signal_handler)
-    
-    def signal_handler(self, signum, frame):
-        """Handle shutdown signals gracefully"""
-        self.log_message(f"Received signal {signum}, shutting down...")
-        self.running = False
-        self.save_learning_data()
-        sys.exit(0)
+        self.capture_runtime = None   # while its capture is open, it sees our probes and the replies too
     
     def log_message(self, message):
-        """Log message with timestamp"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        print(log_entry)
-        
-        with open(self.log_file, 'a') as f:
-            f.write(log_entry + '\n')
+        """Log message with timestamp; queued and written in batches by the shared log sink"""
+        self.log_sink.log(message)
     
-    def check_device_connectivity(self):
-        """Check if Xiaomi device is reachable"""
-        try:
-            result = subprocess.run(['ping', '-c', '1', '-W', '1000', self.xiaomi_ip], 
-                                  capture_output=True, text=True)
-            is_online = "1 received" in result.stdout
-            
-            if is_online != self.device_online:
-                self.device_online = is_online
-                if is_online:
-                    self.log_message(f"✅ Xiaomi device at {self.xiaomi_ip} is now ONLINE")
-                    self.on_device_online()
-                else:
-                    self.log_message(f"❌ Xiaomi device at {self.xiaomi_ip} is now OFFLINE")
-                    self.on_device_offline()
-            
-            return is_online
-        except Exception as e:
-            self.log_message(f"Error checking connectivity: {e}")
-            return False
+    def close(self):
+        """Write out and release the log sink"""
+        close_sink(self.log_file)
+    
+    def attach_liveness(self, runtime):
+        """Follow the device's online/offline transitions"""
+        runtime.watch_liveness(self.xiaomi_ip, self.on_liveness_change)
+    
+    def attach_capture(self, runtime):
+        """Analyze every captured packet to or from the device as it arrives"""
+        self.capture_runtime = runtime
+        runtime.watch_packets(self.xiaomi_ip, lambda packet: self.metrics.process(self.analyze_packet, packet, packet.ts))
+    
+    def attach_portscan(self, runtime):
+        runtime.every(30, self.port_scan_round, 'port scanning', retry=60, when=lambda: self.device_online)
+    
+    def attach_discovery(self, runtime):
+        runtime.every(60, self.discover_commands, 'command discovery', retry=120, when=lambda: self.device_online)
+    
+    def attach_protocol(self, runtime):
+        runtime.every(30, self.analyze_protocol_patterns, 'protocol analysis', retry=60,
+                      when=lambda: self.device_online)
+    
+    def attach_persist(self, runtime):
+        runtime.on_save(self.save_learning_data, 300, 'learning data save')
+    
+    def on_attached(self, runtime, stages):
+        """Without the liveness stage nothing reports the device online, so assume it is"""
+        if 'liveness' not in stages:
+            self.device_online = True
+    
+    def on_liveness_change(self, ip, online, rtt):
+        """Handle an online/offline transition from the liveness monitor"""
+        if online == self.device_online:
+            return
+        self.device_online = online
+        if online:
+            self.log_message(f"✅ Xiaomi device at {ip} is now ONLINE ({rtt} ms)")
+            self.on_device_online()
+        else:
+            self.log_message(f"❌ Xiaomi device at {ip} is now OFFLINE")
+            self.on_device_offline()
     
     def on_device_online(self):
         """Handle device coming online"""
         self.last_activity = datetime.now()
-        self.start_analysis_threads()
         self.log_message("Starting comprehensive device analysis...")
     
     def on_device_offline(self):
         """Handle device going offline"""
         self.log_message("Device offline, continuing to monitor...")
     
-    def start_analysis_threads(self):
-        """Start all analysis threads"""
-        if not self.analysis_threads:
-            # Port scanner thread
-            port_thread = threading.Thread(target=self.continuous_port_scan, daemon=True)
-            port_thread.start()
-            self.analysis_threads.append(port_thread)
-            
-            # Traffic analyzer thread
-            traffic_thread = threading.Thread(target=self.continuous_traffic_analysis, daemon=True)
-            traffic_thread.start()
-            self.analysis_threads.append(traffic_thread)
-            
-            # Command discoverer thread
-            command_thread = threading.Thread(target=self.continuous_command_discovery, daemon=True)
-            command_thread.start()
-            self.analysis_threads.append(command_thread)
-            
-            # Protocol analyzer thread
-            protocol_thread = threading.Thread(target=self.continuous_protocol_analysis, daemon=True)
-            protocol_thread.start()
-            self.analysis_threads.append(protocol_thread)
-    
-    def continuous_port_scan(self):
-        """Continuously scan ports for changes"""
-        known_ports = set()
+    def port_scan_round(self):
+        """One concurrent pass over the common ports, diffed against the previous scan"""
+        current_ports, new_ports, closed_ports = self.port_scanner.scan_changes(self.xiaomi_ip, COMMON_PORTS)
         
-        while self.running:
-            try:
-                if self.device_online:
-                    current_ports = self.scan_ports()
-                    
-                    # Check for new ports
-                    new_ports = current_ports - known_ports
-                    if new_ports:
-                        self.log_message(f"🔍 New ports discovered: {new_ports}")
-                        self.analyze_new_ports(new_ports)
-                    
-                    # Check for closed ports
-                    closed_ports = known_ports - current_ports
-                    if closed_ports:
-                        self.log_message(f"🔒 Ports closed: {closed_ports}")
-                    
-                    known_ports = current_ports
-                    self.protocol_analysis['open_ports'] = list(current_ports)
-                
-                time.sleep(30)  # Scan every 30 seconds
-            except Exception as e:
-                self.log_message(f"Error in port scanning: {e}")
-                time.sleep(60)
+        # Check for new ports
+        if new_ports:
+            self.log_message(f"🔍 New ports discovered: {new_ports}")
+            self.analyze_new_ports(new_ports)
+        
+        # Check for closed ports
+        if closed_ports:
+            self.log_message(f"🔒 Ports closed: {closed_ports}")
+        
+        self.protocol_analysis['open_ports'] = list(current_ports)
     
     def scan_ports(self):
         """Scan common Xiaomi ports"""
-        common_ports = [54321, 8080, 80, 443, 22, 23, 554, 8554, 9999, 8888]
-        open_ports = set()
-        
-        for port in common_ports:
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(1)
-                result = sock.connect_ex((self.xiaomi_ip, port))
-                sock.close()
-                
-                if result == 0:
-                    open_ports.add(port)
-            except Exception:
-                continue
-        
-        return open_ports
+        return self.port_scanner.scan_host(self.xiaomi_ip, COMMON_PORTS)
     
     def analyze_new_ports(self, ports):
         """Analyze newly discovered ports"""
@@ -206,7 +191,7 @@ class XiaomiLocalAnalyzer:
             
             # Common Xiaomi UDP discovery packets
             discovery_packets = [
-                b'\x21\x31\x00\x20\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff',
+                HELLO_PACKET,
                 b'{"id":1,"method":"miIO.info","params":[]}',
                 b'{"method":"get_prop","params":["power","mode","temp"]}',
                 b'{"method":"get_status","params":[]}'
@@ -218,11 +203,13 @@ class XiaomiLocalAnalyzer:
                 
                 try:
                     response, addr = sock.recvfrom(1024)
-                    self.log_message(f"📡 UDP response on port {port}: {response.hex()}")
+                    decoded = self.decode_udp_response(response)
+                    self.log_message(f"📡 UDP response on port {port}: {decoded}")
                     self.learned_commands[f'udp_port_{port}'] = {
                         'protocol': 'UDP',
                         'port': port,
                         'response': response.hex(),
+                        'decoded': decoded,
                         'timestamp': datetime.now().isoformat()
                     }
                 except socket.timeout:
@@ -267,166 +254,184 @@ class XiaomiLocalAnalyzer:
         except Exception as e:
             pass
     
-    def continuous_traffic_analysis(self):
-        """Continuously analyze network traffic"""
-        while self.running:
-            try:
-                if self.device_online:
-                    self.analyze_traffic_patterns()
-                time.sleep(10)  # Analyze every 10 seconds
-            except Exception as e:
-                self.log_message(f"Error in traffic analysis: {e}")
-                time.sleep(30)
+    def analyze_capture_file(self, path, speed=0.0):
+        """Analyze a saved pcap/pcapng capture or traffic history through the live pipeline"""
+        packets = (packet for packet in replay_packets(path)
+                   if self.xiaomi_ip in (packet.src_ip, packet.dst_ip))
+        stats = Replay(speed).run(packets, self.analyze_packet)
+        for message in self.reassembler.flush():
+            self.analyze_stream_message(message)
+        self.json_scanners.clear()
+        self.log_message(f"📂 Replayed {path}: {format_stats(stats)}")
+        return stats
     
-    def analyze_traffic_patterns(self):
-        """Analyze network traffic for patterns"""
+    def run_replay(self, path, speed=0.0):
+        """Offline analysis of a recording, without the device or tcpdump"""
+        self.log_message(f"📂 Replaying {path} for {self.xiaomi_ip}")
         try:
-            # Use tcpdump to capture traffic (if available)
-            cmd = [
-                'tcpdump', '-i', 'any', '-n', '-c', '20',
-                f'host {self.xiaomi_ip}', '-A', '-x'
-            ]
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=15)
-            
-            if result.returncode == 0:
-                self.process_traffic_output(result.stdout)
-        except Exception as e:
-            # tcpdump might not be available on macOS, continue without it
-            pass
+            stats = self.analyze_capture_file(path, speed)
+            if not stats['packets']:
+                hosts = ', '.join(f"{ip} ({count})" for ip, count in busiest_hosts(path))
+                self.log_message(f"⚠️ No packets to or from {self.xiaomi_ip}; busiest hosts: {hosts} (use --device IP)")
+            return stats
+        finally:
+            self.analyze_protocol_patterns()
+            self.save_learning_data(force=True)
     
-    def process_traffic_output(self, output):
-        """Process tcpdump output for patterns"""
-        lines = output.split('\n')
-        current_packet = []
+    def analyze_packet(self, packet):
+        """Analyze individual packet payload for command patterns"""
+        # TCP is reassembled per flow so commands split across segments are seen whole
+        if packet.proto == IPPROTO_TCP:
+            for message in self.reassembler.feed(packet):
+                self.analyze_stream_message(message)
+            return
         
-        for line in lines:
-            if 'IP' in line and self.xiaomi_ip in line:
-                if current_packet:
-                    self.analyze_packet(current_packet)
-                current_packet = [line]
-            elif current_packet:
-                current_packet.append(line)
+        if not packet.payload:
+            return
         
-        if current_packet:
-            self.analyze_packet(current_packet)
-    
-    def analyze_packet(self, packet_lines):
-        """Analyze individual packet for command patterns"""
-        packet_text = '\n'.join(packet_lines)
+        # miIO frames are binary, decode them instead of scanning for text
+        if MIIO_PORT in (packet.src_port, packet.dst_port) and is_miio_packet(packet.payload):
+            self.analyze_miio_frame(packet)
+            return
         
-        # Look for JSON commands
-        json_matches = re.findall(r'\{[^}]*\}', packet_text)
-        for json_cmd in json_matches:
-            try:
-                cmd_data = json.loads(json_cmd)
-                self.learn_command_from_json(cmd_data)
-            except json.JSONDecodeError:
-                continue
+        flow = (packet.proto, packet.src_ip, packet.src_port, packet.dst_ip, packet.dst_port)
+        self.analyze_payload_text(packet.payload.decode('utf-8', errors='ignore'), flow, ts=packet.ts)
+    
+    def analyze_stream_message(self, message):
+        """Analyze a reassembled HTTP message or line; lines may continue a JSON object"""
+        if message.kind == 'line':
+            self.analyze_payload_text(message.text() + '\n', message.flow, ts=message.ts)
+        else:
+            self.analyze_payload_text(message.text(), message.flow, resumable=False, ts=message.ts)
+    
+    def extract_json(self, packet_text, flow=None):
+        """JSON objects in the text, continuing any object left open earlier on the same flow (if given)"""
+        scanner = self.json_scanners.pop(flow, None) or JsonScanner()
+        objects = scanner.feed(packet_text.encode('utf-8'))
+        if flow is not None and scanner.depth:
+            self.json_scanners[flow] = scanner
+        return objects
+    
+    def analyze_payload_text(self, packet_text, flow=None, resumable=True, ts=None):
+        """Analyze a datagram or reassembled stream message for command patterns"""
+        # Look for JSON commands, including nested ones and ones split across packets
+        for cmd_data in self.extract_json(packet_text, flow if resumable else None):
+            self.learn_command_from_json(cmd_data, flow, ts)
         
         # Look for HTTP commands
         if 'POST' in packet_text or 'GET' in packet_text:
-            self.learn_http_command(packet_text)
+            self.learn_http_command(packet_text, flow, ts)
         
         # Look for IR command patterns
-        if 'ir' in packet_text.lower() or 'remote' in packet_text.lower():
-            self.learn_ir_command(packet_text)
+        lowered = packet_text.lower()
+        if 'ir' in lowered or 'remote' in lowered:
+            self.learn_ir_command(packet_text, flow)
+    
+    def analyze_miio_frame(self, packet):
+        """Decode a captured miIO frame and learn from its payload"""
+        try:
+            decoded = self.codec.decode(packet.payload, ip=packet.src_ip)
+        except Exception as e:
+            self.metrics.classified('miio', 'undecodable')
+            self.log_message(f"Error decoding miIO frame: {e}")
+            return
+        self.metrics.classified('miio', 'decoded')
+        
+        if decoded.get('hello') and packet.src_ip == self.xiaomi_ip and self.xiaomi_token:
+            self.codec.register_token(int(decoded['device_id'], 16), self.xiaomi_token)
+        
+        payload = decoded.get('payload')
+        if isinstance(payload, dict):
+            flow = (packet.proto, packet.src_ip, packet.src_port, packet.dst_ip, packet.dst_port)
+            self.learn_command_from_json(payload, flow, packet.ts)
     
-    def learn_command_from_json(self, cmd_data):
-        """Learn from JSON command structure"""
-        if 'method' in cmd_data:
+    def learn_command_from_json(self, cmd_data, flow=None, ts=None):
+        """Learn from JSON command structure, indexed by method, param shape, port and direction"""
+        port, direction = flow_direction(flow, self.xiaomi_ip)
+        if isinstance(cmd_data.get('method'), str):
             method = cmd_data['method']
             params = cmd_data.get('params', [])
             
-            self.learned_commands[f'json_{method}'] = {
-                'type': 'JSON',
-                'method': method,
-                'params': params,
-                'timestamp': datetime.now().isoformat()
-            }
-            
-            self.log_message(f"📝 Learned JSON command: {method} with params {params}")
+            signature, _, outcome = self.command_index.observe(
+                'json', method, cmd_data, params=params, port=port, direction=direction)
+            self.metrics.classified('json', outcome)
+            if outcome == NEW_SIGNATURE:
+                self.log_message(f"📝 Learned JSON command: {signature} with params {params}")
+        
+        symbol = self.event_symbol(cmd_data, direction)
+        if symbol:
+            self.sequence_miner.add(symbol, ts)
+    
+    def event_symbol(self, cmd_data, direction):
+        """Sequence-mining symbol for a JSON command or reply"""
+        prefix = 'rsp' if direction == FROM_DEVICE else 'cmd'
+        if isinstance(cmd_data.get('method'), str):
+            return f"{prefix} {cmd_data['method']}"
+        if 'result' in cmd_data:
+            return f"{prefix} result {shape_of(cmd_data['result'])}"
+        if 'error' in cmd_data:
+            return f"{prefix} error"
+        return None
     
-    def learn_http_command(self, packet_text):
+    def learn_http_command(self, packet_text, flow=None, ts=None):
         """Learn from HTTP command"""
-        if 'POST' in packet_text:
-            self.learned_commands['http_post'] = {
-                'type': 'HTTP_POST',
-                'content': packet_text[:200],
-                'timestamp': datetime.now().isoformat()
-            }
-            self.log_message("📝 Learned HTTP POST command")
-        elif 'GET' in packet_text:
-            self.learned_commands['http_get'] = {
-                'type': 'HTTP_GET',
-                'content': packet_text[:200],
-                'timestamp': datetime.now().isoformat()
-            }
-            self.log_message("📝 Learned HTTP GET command")
-    
-    def learn_ir_command(self, packet_text):
-        """Learn from IR command"""
-        self.learned_commands['ir_command'] = {
-            'type': 'IR',
-            'content': packet_text[:200],
-            'timestamp': datetime.now().isoformat()
-        }
-        self.log_message("📝 Learned IR command pattern")
+        for verb, type_name in (('POST', 'HTTP_POST'), ('GET', 'HTTP_GET')):
+            start = packet_text.find(verb)
+            if start < 0:
+                continue
+            port, direction = flow_direction(flow, self.xiaomi_ip)
+            method = http_method(packet_text[start:start + 512])
+            signature, _, outcome = self.command_index.observe(
+                'http', method, packet_text, port=port, direction=direction, type_name=type_name)
+            self.metrics.classified('http', outcome)
+            self.sequence_miner.add(f"{'rsp' if direction == FROM_DEVICE else 'cmd'} {method}", ts)
+            if outcome == NEW_SIGNATURE:
+                self.log_message(f"📝 Learned HTTP {verb} command: {signature}")
+            return
     
-    def continuous_command_discovery(self):
-        """Continuously discover new commands"""
-        while self.running:
-            try:
-                if self.device_online:
-                    self.discover_commands()
-                time.sleep(60)  # Discover every minute
-            except Exception as e:
-                self.log_message(f"Error in command discovery: {e}")
-                time.sleep(120)
+    def learn_ir_command(self, packet_text, flow=None):
+        """Learn from IR command"""
+        port, direction = flow_direction(flow, self.xiaomi_ip)
+        signature, _, outcome = self.command_index.observe(
+            'ir', 'ir', packet_text, port=port, direction=direction, type_name='IR')
+        self.metrics.classified('ir', outcome)
+        if outcome == NEW_SIGNATURE:
+            self.log_message(f"📝 Learned IR command pattern: {signature}")
     
     def discover_commands(self):
-        """Discover new commands by testing common patterns"""
-        # Test common Xiaomi IR commands
-        ir_commands = [
-            'power', 'volume_up', 'volume_down', 'channel_up', 'channel_down',
-            'mute', 'menu', 'ok', 'back', 'up', 'down', 'left', 'right'
-        ]
-        
-        for cmd in ir_commands:
-            self.test_ir_command(cmd)
-            time.sleep(1)  # Wait between commands
+        """Discover new commands by probing common IR command names in each format"""
+        # Probes are paced per device and kept in flight together; candidates that
+        # timed out are skipped until their backoff expires
+        replies = self.prober.discover(self.xiaomi_ip, IR_COMMANDS, encode=self.encode_udp_command,
+                                       on_response=self.handle_udp_response)
+        if replies:
+            self.log_message(f"🔍 Discovery round: {len(replies)} probes answered")
     
-    def test_ir_command(self, command):
-        """Test sending IR command"""
-        try:
-            # Try different command formats
-            formats = [
-                f'{{"method":"send_ir","params":["{command}"]}}',
-                f'{{"method":"ir_{command}","params":[]}}',
-                f'{{"method":"{command}","params":[]}}'
-            ]
-            
-            for cmd_format in formats:
-                self.send_udp_command(cmd_format.encode())
-                time.sleep(0.5)
-        except Exception as e:
-            pass
+    def decode_udp_response(self, response):
+        """Decode a reply from the device, registering our token on hello replies"""
+        decoded = self.codec.decode_response(response, ip=self.xiaomi_ip)
+        if decoded.get('hello') and self.xiaomi_token:
+            self.codec.register_token(int(decoded['device_id'], 16), self.xiaomi_token)
+        return decoded
+    
+    def encode_udp_command(self, command):
+        """Encrypt a JSON command once the device ID and token are known"""
+        device = self.codec.tracker.get(self.xiaomi_ip)
+        if device is None or self.codec.context_for_device(device['device_id']) is None:
+            return command
+        stamp = self.codec.tracker.next_stamp(self.xiaomi_ip)
+        return self.codec.encode(device['device_id'], stamp, command)
     
     def send_udp_command(self, command):
         """Send UDP command to device"""
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             sock.settimeout(2)
-            sock.sendto(command, (self.xiaomi_ip, self.xiaomi_port))
+            sock.sendto(self.encode_udp_command(command), (self.xiaomi_ip, self.xiaomi_port))
             
             try:
                 response, addr = sock.recvfrom(1024)
-                self.log_message(f"📡 Command response: {response.hex()}")
-                self.device_responses.append({
-                    'command': command.decode() if isinstance(command, bytes) else command,
-                    'response': response.hex(),
-                    'timestamp': datetime.now().isoformat()
-                })
+                self.handle_udp_response(command, response)
             except socket.timeout:
                 pass
             
@@ -434,77 +439,79 @@ class XiaomiLocalAnalyzer:
         except Exception as e:
             pass
     
-    def continuous_protocol_analysis(self):
-        """Continuously analyze protocol patterns"""
-        while self.running:
-            try:
-                if self.device_online:
-                    self.analyze_protocol_patterns()
-                time.sleep(30)  # Analyze every 30 seconds
-            except Exception as e:
-                self.log_message(f"Error in protocol analysis: {e}")
-                time.sleep(60)
-    
-    def analyze_protocol_patterns(self):
-        """Analyze protocol patterns from learned data"""
-        # Analyze response patterns
-        if len(self.device_responses) > 0:
-            self.analyze_response_patterns()
-        
-        # Analyze command sequences
-        if len(self.command_sequences) > 0:
-            self.analyze_command_sequences()
+    def handle_udp_response(self, command, response):
+        """Decode and record the device's reply to a command"""
+        decoded = self.decode_udp_response(response)
+        self.log_message(f"📡 Command response: {decoded}")
+        self.record_exchange(command, response, decoded)
+        self.device_responses.append({
+            'command': command.decode() if isinstance(command, bytes) else command,
+            'response': response.hex(),
+            'decoded': decoded,
+            'timestamp': datetime.now().isoformat()
+        })
     
-    def analyze_response_patterns(self):
-        """Analyze patterns in device responses"""
-        responses = list(self.device_responses)
-        
-        # Group by response type
-        response_groups = defaultdict(list)
-        for resp in responses:
-            response_groups[resp['response'][:10]].append(resp)
+    def record_exchange(self, command, response, decoded):
+        """Feed a probe and the device's reply to the sequence miner"""
+        if self.capture_runtime is not None and self.capture_runtime.capturing:
+            return  # Already mined from the captured datagrams; counting them here too would double supports
+        try:
+            sent = json.loads(command)
+        except ValueError:
+            sent = None
+        symbol = self.event_symbol(sent, None) if isinstance(sent, dict) else None
+        self.sequence_miner.add(symbol or 'cmd raw')
         
-        for pattern, group in response_groups.items():
-            if len(group) > 1:
-                self.log_message(f"🔄 Found response pattern: {pattern} ({len(group)} occurrences)")
+        payload = decoded.get('payload') if isinstance(decoded, dict) else None
+        if isinstance(payload, dict):
+            symbol = self.event_symbol(payload, FROM_DEVICE)
+        else:
+            symbol = None
+        # Undecodable replies are grouped by their leading bytes
+        self.sequence_miner.add(symbol or f"rsp {response.hex()[:10]}")
     
-    def analyze_command_sequences(self):
-        """Analyze command sequences for patterns"""
-        sequences = list(self.command_sequences)
-        
-        # Look for common command sequences
-        if len(sequences) > 2:
-            self.log_message(f"📊 Analyzing {len(sequences)} command sequences...")
+    def analyze_protocol_patterns(self):
+        """Report command/response sequences that became frequent since the last tick"""
+        # The miner counts sequences as events arrive; nothing is regrouped here
+        for report in self.sequence_miner.take_reports():
+            gap = report.get('gap_mean')
+            self.log_message(f"🔄 Found sequence pattern: {' → '.join(report['sequence'])} "
+                             f"({report['count']} occurrences, typical gap {gap}s)")
     
-    def save_learning_data(self):
-        """Save all learning data to files"""
-        try:
-            # Save learned commands
-            with open(self.commands_file, 'w') as f:
-                json.dump(self.learned_commands, f, indent=2)
-            
-            # Save protocol analysis
-            with open(self.protocol_file, 'w') as f:
-                json.dump(self.protocol_analysis, f, indent=2)
-            
-            # Save learning summary
-            learning_summary = {
-                'total_commands_learned': len(self.learned_commands),
-                'total_responses': len(self.device_responses),
-                'device_online': self.device_online,
-                'last_activity': self.last_activity.isoformat() if self.last_activity else None,
-                'analysis_duration': str(datetime.now() - (self.last_activity or datetime.now())),
-                'learned_commands': self.learned_commands,
-                'protocol_analysis': self.protocol_analysis
-            }
-            
-            with open(self.learning_file, 'w') as f:
-                json.dump(learning_summary, f, indent=2)
-            
-            self.log_message("💾 Learning data saved successfully")
+    def save_learning_data(self, force=False):
+        """Journal new commands; snapshot and summary files are rewritten only when compacting"""
+        with self.metrics.save_seconds.time():
+            try:
+                commands_header = {
+                    'status': 'analyzing',
+                    'device_online': self.device_online,
+                    'total_commands_discovered': len(self.learned_commands),
+                    'last_update': datetime.now().isoformat()
+                }
+                if not self.commands_store.save(commands_header, force=force):
+                    return
+                
+                # Save protocol analysis
+                write_json_atomic(self.protocol_file, self.protocol_analysis, indent=2)
+                
+                # Save learning summary
+                learning_summary = {
+                    'total_commands_learned': len(self.learned_commands),
+                    'total_responses': len(self.device_responses),
+                    'device_online': self.device_online,
+                    'last_activity': self.last_activity.isoformat() if self.last_activity else None,
+                    'analysis_duration': str(datetime.now() - (self.last_activity or datetime.now())),
+                    'learned_commands': self.learned_commands,
+                    'frequent_sequences': self.sequence_miner.top(),
+                    'sequence_stats': self.sequence_miner.stats(),
+                    'protocol_analysis': self.protocol_analysis
+                }
+                write_json_atomic(self.learning_file, learning_summary, indent=2)
+                
+                self.log_message("💾 Learning data saved successfully")
             
-        except Exception as e:
-            self.log_message(f"Error saving learning data: {e}")
+            except Exception as e:
+                self.log_message(f"Error saving learning data: {e}")
     
     def run_continuous_analysis(self):
         """Run continuous analysis until stopped"""
@@ -513,31 +520,27 @@ class XiaomiLocalAnalyzer:
         self.log_message("📊 Analysis will run continuously until stopped")
         self.log_message("🛑 Press Ctrl+C to stop")
         
-        self.running = True
-        
+        # Several devices or analyzers in one process: xiaomi_runtime.py with a pipeline file
+        runtime = AnalyzerRuntime('local_analyzer', METRICS_PORT, log=self.log_message, registry=self.metrics.registry)
+        runtime.add(self)
         try:
-            while self.running:
-                # Check device connectivity
-                self.check_device_connectivity()
-                
-                # Save learning data every 5 minutes
-                if self.last_activity and (datetime.now() - self.last_activity).seconds > 300:
-                    self.save_learning_data()
-                    self.last_activity = datetime.now()
-                
-                time.sleep(10)  # Check every 10 seconds
-                
-        except KeyboardInterrupt:
-            self.log_message("🛑 Analysis stopped by user")
+            runtime.run()
         except Exception as e:
             self.log_message(f"❌ Analysis error: {e}")
-        finally:
-            self.running = False
-            self.save_learning_data()
-            self.log_message("✅ Analysis completed and data saved")
+        self.log_message("✅ Analysis completed and data saved")
 
 def main():
     """Main function"""
+    replay = replay_args(sys.argv[1:])
+    if replay:
+        # Replayed data never mixes with what the live analyzer has learned
+        analyzer = XiaomiLocalAnalyzer(replay_device(replay))
+        try:
+            analyzer.run_replay(replay['path'], replay['speed'])
+            analyzer.log_message(f"📁 Replay results in {replay['output']}")
+        finally:
+            analyzer.close()
+        return
     analyzer = XiaomiLocalAnalyzer()
     analyzer.run_continuous_analysis()
 
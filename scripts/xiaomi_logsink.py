@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Log Sink
+Shared logging backend: log() only queues the record, a background thread formats and writes batches with writev
+Log files rotate by size and age; old segments are gzip-compressed and only the newest few are kept
+Lines keep the '[YYYY-mm-dd HH:MM:SS] message' format; XIAOMI_LOG_FORMAT=json writes JSON lines instead
+"""
+
+import atexit
+import glob
+import gzip
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import deque
+
+# Defaults
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024   # rotate when the file reaches this size
+DEFAULT_MAX_AGE = 24 * 3600.0          # or when the segment is this many seconds old
+DEFAULT_BACKUPS = 5                    # rotated segments kept
+DEFAULT_FLUSH_INTERVAL = 0.5           # seconds a record may wait before being written
+DEFAULT_BATCH = 256                    # records that wake the writer early
+DEFAULT_QUEUE_SIZE = 100000            # records held before the oldest are dropped
+TEXT = 'text'
+JSON = 'json'
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')   # buffers per writev call
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+class LogSink:
+    """Asynchronous, rotating writer for one log file
+
+    log() appends a tuple to a deque and returns; the writer thread wakes every
+    flush_interval (or after batch records), formats the lines and writes them
+    with a single writev. When the queue is full the oldest records are dropped
+    and counted rather than blocking the caller.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE,
+                 backups=DEFAULT_BACKUPS, compress=True, echo=True, fmt=None,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, batch=DEFAULT_BATCH, queue_size=DEFAULT_QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.compress = compress
+        self.echo = echo
+        self.fmt = fmt or os.environ.get('XIAOMI_LOG_FORMAT', TEXT)
+        self.flush_interval = flush_interval
+        self.batch = batch
+        self.queue_size = queue_size
+        self.stats = {'records': 0, 'written': 0, 'batches': 0, 'bytes': 0,
+                      'dropped': 0, 'rotations': 0, 'errors': 0}
+        self._queue = deque()
+        self._handled = 0        # records written (or failed) by the writer thread
+        self._wakeup = threading.Event()
+        self._idle = threading.Condition()
+        self._closed = False
+        self._fd = None
+        self._size = 0
+        self._opened = 0.0
+        self._second = None      # cached formatted timestamp for the current second
+        self._stamp = ''
+        self._thread = threading.Thread(target=self._run, name=f"logsink:{os.path.basename(path)}", daemon=True)
+        self._thread.start()
+
+    def log(self, message, level=None, ts=None, **fields):
+        """Queue one record; ts defaults to now, level is printed as 'LEVEL: message' when given"""
+        queue = self._queue
+        if len(queue) >= self.queue_size:
+            try:
+                queue.popleft()
+                self.stats['dropped'] += 1
+            except IndexError:
+                pass
+        queue.append((ts or time.time(), level, message, fields))
+        self.stats['records'] += 1
+        if len(queue) >= self.batch:
+            self._wakeup.set()
+
+    def flush(self, timeout=5.0):
+        """Block until everything queued so far is written"""
+        deadline = time.monotonic() + timeout
+        target = self.stats['records']
+        with self._idle:
+            while self._handled + self.stats['dropped'] < target and self._thread.is_alive():
+                self._wakeup.set()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(min(remaining, 0.1))
+        return True
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=5.0)
+
+    def _timestamp(self, ts):
+        second = int(ts)
+        if second != self._second:
+            self._second = second
+            self._stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        return self._stamp
+
+    def format(self, record):
+        ts, level, message, fields = record
+        if self.fmt == JSON:
+            entry = {'ts': round(ts, 6), 'time': self._timestamp(ts), 'msg': message}
+            if level:
+                entry['level'] = level
+            entry.update(fields)
+            return json.dumps(entry, default=str, ensure_ascii=False)
+        line = f"[{self._timestamp(ts)}] {level}: {message}" if level else f"[{self._timestamp(ts)}] {message}"
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._size = os.fstat(self._fd).st_size
+        self._opened = time.time()
+
+    def _rotation_due(self):
+        return (self._size >= self.max_bytes or
+                (self.max_age and self._size and time.time() - self._opened >= self.max_age))
+
+    def _rotate(self):
+        """Move the current file aside, compress it in the background and prune old segments"""
+        os.close(self._fd)
+        self._fd = None
+        segment = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}"
+        if os.path.exists(segment) or os.path.exists(segment + '.gz'):
+            segment += f".{int(time.time() * 1000) % 1000:03d}"
+        os.replace(self.path, segment)
+        self.stats['rotations'] += 1
+        self._open()
+        if self.compress:
+            threading.Thread(target=self._compress, args=(segment,), daemon=True).start()
+        else:
+            self._prune()
+
+    def _compress(self, segment):
+        try:
+            with open(segment, 'rb') as source, gzip.open(segment + '.gz', 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.remove(segment)
+        except OSError:
+            self.stats['errors'] += 1
+        self._prune()
+
+    def _prune(self):
+        segments = sorted(glob.glob(glob.escape(self.path) + '.*'), key=os.path.getmtime)
+        for old in segments[:-self.backups] if self.backups else segments:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def _write(self, records):
+        lines = [self.format(record) for record in records]
+        if self.echo:
+            try:
+                sys.stdout.write('\n'.join(lines) + '\n')
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                pass
+        buffers = [(line + '\n').encode('utf-8', errors='replace') for line in lines]
+        try:
+            if self._fd is None:
+                self._open()
+            elif self._rotation_due():
+                self._rotate()
+            for start in range(0, len(buffers), IOV_MAX):
+                chunk = buffers[start:start + IOV_MAX]
+                expected = sum(len(buffer) for buffer in chunk)
+                written = os.writev(self._fd, chunk)
+                if written < expected:
+                    # Short write (rare on regular files): finish it the slow way
+                    os.write(self._fd, b''.join(chunk)[written:])
+                self._size += expected
+                self.stats['bytes'] += expected
+            self.stats['written'] += len(records)
+            self.stats['batches'] += 1
+        except OSError:
+            self.stats['errors'] += 1
+
+    def _drain(self):
+        queue = self._queue
+        records = []
+        while queue:
+            try:
+                records.append(queue.popleft())
+            except IndexError:
+                break
+        if records:
+            self._write(records)
+        with self._idle:
+            self._handled += len(records)
+            self._idle.notify_all()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._drain()
+        self._drain()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def get_sink(path, **kwargs):
+    """The process-wide sink for a log file, created on first use"""
+    key = os.path.abspath(path)
+    with _sinks_lock:
+        sink = _sinks.get(key)
+        if sink is None:
+            sink = _sinks[key] = LogSink(path, **kwargs)
+        return sink
+
+
+def close_sink(path):
+    """Write out and forget the sink for a log file; a later get_sink opens a fresh one"""
+    with _sinks_lock:
+        sink = _sinks.pop(os.path.abspath(path), None)
+    if sink is not None:
+        sink.close()
+
+
+@atexit.register
+def close_all():
+    """Write out every queued record; runs at interpreter exit"""
+    with _sinks_lock:
+        sinks = list(_sinks.values())
+    for sink in sinks:
+        sink.close()
+
+
+def main():
+    """Measure log() cost and writer throughput: xiaomi_logsink.py [path] [records]"""
+    path = sys.argv[1] if len(sys.argv) > 1 else "xiaomi_logsink_benchmark.log"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    sink = LogSink(path, echo=False)
+    started = time.perf_counter()
+    for index in range(count):
+        sink.log(f"📡 Captured packet: IP 192.168.68.65.{index % 65535} > 192.168.68.68.54321: UDP 48")
+    queued = time.perf_counter() - started
+    sink.close()
+    total = time.perf_counter() - started
+    print(f"📊 {count} records: {queued / count * 1e6:.2f} us per log() call, "
+          f"{count / total:.0f} records/s written, {sink.stats}")
+
+
+if __name__ == "__main__":
+    main()
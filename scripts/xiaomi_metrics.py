@@ -0,0 +1,583 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Monitor Metrics
+Counters, gauges and latency histograms for the long-running monitors, cheap enough for the packet path
+Served on localhost as Prometheus text (/metrics) or JSON (/metrics.json)
+A sampling profiler can be started and stopped at runtime (/profile/start, /profile/stop or SIGUSR2)
+"""
+
+import bisect
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter as Tally
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import urlopen
+
+# Defaults
+DEFAULT_HOST = "127.0.0.1"       # never exposed beyond the machine
+DEFAULT_PORT = 9477
+DEFAULT_PROFILE_INTERVAL = 0.01  # seconds between profiler samples
+DEFAULT_PROFILE_DEPTH = 32       # frames kept per sampled stack
+
+# Latency buckets in seconds, 50us to 10s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Value:
+    """One labelled series of a counter or gauge"""
+
+    __slots__ = ('value', 'function', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from function() at scrape time, e.g. a queue length"""
+        self.function = function
+
+    def get(self):
+        if self.function is None:
+            return self.value
+        try:
+            return self.function()
+        except Exception:
+            return float('nan')
+
+
+class _Buckets:
+    """One labelled series of a histogram"""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def cumulative(self):
+        total = 0
+        result = []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+    def quantile(self, q):
+        """Upper bucket bound holding the q-quantile (None when empty)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in zip(self.bounds, self.cumulative()):
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class Metric:
+    """A named metric with zero or more label dimensions
+
+    Unlabelled metrics are used directly (counter.inc()); labelled ones through
+    labels(...), whose result can be kept to skip the lookup on hot paths.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help_text='', labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new(self):
+        return _Value()
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        series = self.series.get(key)
+        if series is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}, got {key}")
+            with self._lock:
+                series = self.series.setdefault(key, self._new())
+        return series
+
+    def label_dict(self, key):
+        return dict(zip(self.labelnames, key))
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text='', labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+
+    def _new(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        """Context manager observing the duration of its block"""
+        return self._default.time()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return '{' + pairs + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsRegistry:
+    """Every metric of one process, plus collectors evaluated at scrape time"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []   # callables returning [(name, kind, help, labels dict, value)]
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.gauge('process_uptime_seconds', 'Seconds since the monitor started').set_function(
+            lambda: round(time.time() - self.started, 3))
+        self.gauge('process_threads', 'Live Python threads').set_function(threading.active_count)
+
+    def _register(self, cls, name, help_text, labelnames, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help_text, labelnames, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is already a {metric.kind}")
+            return metric
+
+    def counter(self, name, help_text='', labelnames=()):
+        return self._register(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text='', labelnames=()):
+        return self._register(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name, help_text='', labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def _collected(self):
+        for collector in self.collectors:
+            try:
+                yield from collector()
+            except Exception:
+                continue
+
+    def render_prometheus(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for key, series in list(metric.series.items()):
+                labels = metric.label_dict(key)
+                if isinstance(metric, Histogram):
+                    bounds = metric.buckets + (float('inf'),)
+                    for bound, total in zip(bounds, series.cumulative()):
+                        bucket_labels = _format_labels(dict(labels, le=_format_number(bound)))
+                        lines.append(f"{metric.name}_bucket{bucket_labels} {total}")
+                    lines.append(f"{metric.name}_sum{_format_labels(labels)} {_format_number(series.sum)}")
+                    lines.append(f"{metric.name}_count{_format_labels(labels)} {series.count}")
+                else:
+                    lines.append(f"{metric.name}{_format_labels(labels)} {_format_number(series.get())}")
+        collected = {}   # samples of one metric must be adjacent
+        for name, kind, help_text, labels, value in self._collected():
+            if name not in collected:
+                collected[name] = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            collected[name].append(f"{name}{_format_labels(labels)} {_format_number(value)}")
+        for samples in collected.values():
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """JSON-able view; histograms carry count, sum, mean and bucket-bound p50/p90/p99"""
+        result = {}
+        for metric in list(self.metrics.values()):
+            values = []
+            for key, series in list(metric.series.items()):
+                entry = {'labels': metric.label_dict(key)}
+                if isinstance(metric, Histogram):
+                    entry.update({
+                        'count': series.count,
+                        'sum': round(series.sum, 6),
+                        'mean': round(series.sum / series.count, 6) if series.count else None,
+                        'p50': series.quantile(0.5),
+                        'p90': series.quantile(0.9),
+                        'p99': series.quantile(0.99)
+                    })
+                else:
+                    entry['value'] = series.get()
+                values.append(entry)
+            result[metric.name] = {'type': metric.kind, 'help': metric.help, 'values': values}
+        for name, kind, help_text, labels, value in self._collected():
+            result.setdefault(name, {'type': kind, 'help': help_text, 'values': []})
+            result[name]['values'].append({'labels': labels, 'value': value})
+        return result
+
+
+class _Bound:
+    """A metric with its leading labels fixed; used like a metric without them"""
+
+    __slots__ = ('metric', 'values', '_series')
+
+    def __init__(self, metric, *values):
+        self.metric = metric
+        self.values = values
+        self._series = metric.labels(*values) if len(values) == len(metric.labelnames) else None
+
+    def labels(self, *values):
+        return self.metric.labels(*self.values, *values)
+
+    def __getattr__(self, name):
+        # inc/set/observe/time/... of the fully labelled series
+        return getattr(self._series, name)
+
+
+class MonitorMetrics:
+    """The standard instruments of a packet or connection monitor, on one registry
+
+    Every series carries a monitor label (the monitor name, plus ':instance' for a
+    device name), so monitors sharing a registry in one runtime keep their own
+    counters, latencies, queue gauges and stats apart.
+    """
+
+    def __init__(self, monitor, registry=None, instance=None):
+        self.monitor = monitor if instance is None else f"{monitor}:{instance}"
+        self.instance = instance
+        self.registry = registry if registry is not None else MetricsRegistry()
+        self.registry.gauge('xiaomi_monitor_info', 'Constant 1, labelled with the monitor name',
+                            ('monitor',)).labels(self.monitor).set(1)
+        self.packets_seen = self._bound(self.registry.counter(
+            'xiaomi_packets_seen_total', 'Packets or connection events handed to the monitor', ('monitor',)))
+        self.packets_classified = self._bound(self.registry.counter(
+            'xiaomi_packets_classified_total', 'Observations learned from traffic', ('monitor', 'kind', 'outcome')))
+        self.packet_seconds = self._bound(self.registry.histogram(
+            'xiaomi_packet_seconds', 'Time spent processing one packet or event', ('monitor',)))
+        self.capture_lag = self._bound(self.registry.gauge(
+            'xiaomi_capture_lag_seconds', 'Wall clock minus the capture time of the last packet processed',
+            ('monitor',)))
+        self.queue_depth = self._bound(self.registry.gauge(
+            'xiaomi_queue_depth', 'Items waiting in an internal buffer', ('monitor', 'queue')))
+        self.save_seconds = self._bound(self.registry.histogram(
+            'xiaomi_save_seconds', 'Duration of a data save', ('monitor',)))
+        self.probes = self._bound(self.registry.counter(
+            'xiaomi_probes_total', 'Discovery probes sent, by result', ('monitor', 'result')))
+        self.probe_rtt = self._bound(self.registry.histogram(
+            'xiaomi_probe_rtt_seconds', 'Round trip time of answered discovery probes', ('monitor',)))
+        self.errors = self._bound(self.registry.counter(
+            'xiaomi_errors_total', 'Exceptions raised while processing, by stage', ('monitor', 'stage')))
+        # Series used on every packet, looked up once
+        self._seen = self.packets_seen.labels()
+        self._seconds = self.packet_seconds.labels()
+        self._lag = self.capture_lag.labels()
+        self._process_errors = self.errors.labels('process')
+        self._rtt = self.probe_rtt.labels()
+        self._replied = self.probes.labels('reply')
+        self._timed_out = self.probes.labels('timeout')
+
+    def _bound(self, metric):
+        return _Bound(metric, self.monitor)
+
+    def process(self, handler, item, ts=None):
+        """handler(item), timed and counted; ts (epoch capture time) updates the lag gauge"""
+        started = time.perf_counter()
+        try:
+            return handler(item)
+        except Exception:
+            self._process_errors.inc()
+            raise
+        finally:
+            self._seconds.observe(time.perf_counter() - started)
+            self._seen.inc()
+            if ts:
+                self._lag.set(round(time.time() - ts, 6))
+
+    def classified(self, kind, outcome='seen'):
+        self.packets_classified.labels(kind, outcome).inc()
+
+    def watch_queue(self, name, length):
+        """Report length() as the depth of a named queue"""
+        self.queue_depth.labels(name).set_function(length)
+
+    def watch_stats(self, name, stats, help_text=''):
+        """Export a component's numeric stats() dict at scrape time, one series per key"""
+        monitor = self.monitor
+
+        def collect():
+            for key, value in stats().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    yield name, 'untyped', help_text, {'monitor': monitor, 'stat': key}, value
+        self.registry.add_collector(collect)
+
+    def probe(self, rtt):
+        """Record one probe; rtt is None when it timed out"""
+        if rtt is None:
+            self._timed_out.inc()
+        else:
+            self._replied.inc()
+            self._rtt.observe(rtt)
+
+
+class SamplingProfiler:
+    """Statistical profiler: samples every thread's stack at a fixed interval
+
+    Stacks are kept in collapsed form ('file:function;file:function'), ready for
+    flamegraph tools. Costs nothing while stopped.
+    """
+
+    def __init__(self, interval=DEFAULT_PROFILE_INTERVAL, max_depth=DEFAULT_PROFILE_DEPTH):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Tally()
+        self.samples = 0
+        self.started = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if not self.running:
+            self._stop.clear()
+            self.started = time.time()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+        return self.running
+
+    def reset(self):
+        self.stacks = Tally()
+        self.samples = 0
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """One 'stack count' line per distinct stack"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def report(self, limit=25):
+        """Functions by samples spent in them (self) and under them (total)"""
+        own = Tally()
+        total = Tally()
+        for stack, count in list(self.stacks.items()):
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        return {
+            'running': self.running,
+            'interval': self.interval,
+            'samples': self.samples,
+            'started': self.started,
+            'self': own.most_common(limit),
+            'total': total.most_common(limit)
+        }
+
+
+def install_profiler_toggle(profiler, signum=getattr(signal, 'SIGUSR2', None)):
+    """Toggle the profiler with a signal (SIGUSR2 by default); main thread only"""
+    if signum is None or threading.current_thread() is not threading.main_thread():
+        return False
+    signal.signal(signum, lambda number, frame: profiler.toggle())
+    return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'XiaomiMetrics/1.0'
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?', 1)[0].rstrip('/') or '/'
+        if path in ('/', '/metrics'):
+            self._send(server.registry.render_prometheus(), 'text/plain; version=0.0.4')
+        elif path == '/metrics.json':
+            self._send(json.dumps(server.registry.snapshot(), indent=2, default=str), 'application/json')
+        elif path == '/profile':
+            self._send(json.dumps(server.profiler.report(), indent=2), 'application/json')
+        elif path == '/profile/collapsed':
+            self._send(server.profiler.collapsed(), 'text/plain')
+        elif path in ('/profile/start', '/profile/stop', '/profile/reset'):
+            action = path.rsplit('/', 1)[1]
+            getattr(server.profiler, action)()
+            self._send(json.dumps({'running': server.profiler.running}), 'application/json')
+        else:
+            self.send_error(404)
+
+    do_POST = do_GET
+
+    def _send(self, body, content_type):
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes must not flood the monitor's log
+
+
+class MetricsServer:
+    """HTTP endpoint for a registry and profiler, on a daemon thread"""
+
+    def __init__(self, registry, port=DEFAULT_PORT, host=DEFAULT_HOST, profiler=None):
+        self.registry = registry
+        self.profiler = profiler if profiler is not None else SamplingProfiler()
+        self.host = host
+        self.port = port
+        self._httpd = None
+
+    def start(self):
+        """Start serving; returns the bound port (useful with port 0)"""
+        if self._httpd is None:
+            self._httpd = ThreadingHTTPServer((self.host, self.port), _Handler)
+            self._httpd.daemon_threads = True
+            self._httpd.registry = self.registry
+            self._httpd.profiler = self.profiler
+            self.port = self._httpd.server_address[1]
+            threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self.port
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+        self.profiler.stop()
+
+
+def serve_metrics(metrics, port, log=print):
+    """Start the endpoint for a monitor's MonitorMetrics; None when disabled (port None) or busy"""
+    if port is None:
+        return None
+    server = MetricsServer(metrics.registry, port)
+    try:
+        server.start()
+    except OSError as e:
+        log(f"⚠️ Metrics endpoint unavailable on port {port}: {e}")
+        return None
+    install_profiler_toggle(server.profiler)
+    log(f"📈 Metrics on http://{server.host}:{server.port}/metrics (profiler: /profile/start)")
+    return server
+
+
+def main():
+    """Print a running monitor's metrics: xiaomi_metrics.py [port] [metrics|metrics.json|profile|profile/start|profile/stop]"""
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    path = sys.argv[2] if len(sys.argv) > 2 else 'metrics'
+    try:
+        with urlopen(f"http://{DEFAULT_HOST}:{port}/{path}", timeout=5) as response:
+            print(response.read().decode())
+    except OSError as e:
+        print(f"❌ No monitor answering on port {port}: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
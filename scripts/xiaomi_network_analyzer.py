@@ -6,98 +6,115 @@ Monitors network traffic and learns commands from phone usage
 """
 
 import subprocess
-import json
-import time
 import re
-import socket
-import threading
-import signal
 import sys
-import os
 from datetime import datetime
 from collections import defaultdict, deque
 
+from xiaomi_conntrack import CLOSED, HostFilter, format_connection
+from xiaomi_discovery import miio_hello, sweep_subnet
+from xiaomi_inventory import load_inventory
+from xiaomi_liveness import probe
+from xiaomi_logsink import close_sink, get_sink
+from xiaomi_metrics import MonitorMetrics
+from xiaomi_portscan import PortScanner
+from xiaomi_replay import Replay, format_stats, replay_args, replay_device, replay_connections
+from xiaomi_runtime import AnalyzerRuntime, instance_path
+from xiaomi_store import LearningStore, write_json_atomic
+
 # Configuration
 XIAOMI_IP = "192.168.68.68"
+XIAOMI_PORTS = [54321, 8080, 80, 443, 9999, 8888]
+XIAOMI_NETWORK = "192.168.68.0/24"
 LOG_FILE = "xiaomi_network_analysis.log"
 LEARNING_FILE = "xiaomi_network_learning.json"
 COMMANDS_FILE = "xiaomi_network_commands.json"
 TRAFFIC_FILE = "xiaomi_network_traffic.json"
+METRICS_PORT = 9480  # localhost metrics endpoint, None disables
 
 class XiaomiNetworkAnalyzer:
-    def __init__(self):
-        self.xiaomi_ip = XIAOMI_IP
-        self.log_file = LOG_FILE
-        self.learning_file = LEARNING_FILE
-        self.commands_file = COMMANDS_FILE
-        self.traffic_file = TRAFFIC_FILE
+    STAGES = ('scan', 'connections', 'persist')
+
+    def __init__(self, device=None, registry=None):
+        device = device or {}
+        self.xiaomi_ip = device.get('ip', XIAOMI_IP)
+        self.network = device.get('network', XIAOMI_NETWORK)
+        self.log_file = instance_path(LOG_FILE, device)
+        self.log_sink = get_sink(self.log_file)
+        self.learning_file = instance_path(LEARNING_FILE, device)
+        self.commands_file = instance_path(COMMANDS_FILE, device)
+        self.traffic_file = instance_path(TRAFFIC_FILE, device)
         
         # Learning data structures
+        self.commands_store = LearningStore(self.commands_file)
+        self.traffic_store = LearningStore(self.traffic_file)
         self.learned_commands = {}
         self.network_traffic = deque(maxlen=1000)
         self.command_patterns = defaultdict(int)
         self.device_responses = deque(maxlen=500)
+        self.port_scanner = PortScanner()
+        self.inventory = load_inventory()
+        self.host_filter = HostFilter([self.network])
+        self.metrics = MonitorMetrics('network_analyzer', registry, instance=device.get('name'))
         
         # Analysis state
-        self.running = False
-        self.analysis_threads = []
         self.start_time = datetime.now()
         self.traffic_monitoring = False
+        self.device_reachable = None  # unknown until the first scan
         
         # Load existing data
         self.load_existing_data()
-        
-        # Setup signal handlers
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGTERM, self.signal_handler)
+        self.metrics.watch_queue('traffic_unsaved', lambda: len(self.network_traffic.pending))
     
     def load_existing_data(self):
         """Load existing learned data from files"""
         try:
             # Load existing commands
-            if os.path.exists(self.commands_file):
-                with open(self.commands_file, 'r') as f:
-                    data = json.load(f)
-                    if 'commands' in data:
-                        self.learned_commands = data['commands']
-                    self.log_message(f"📚 Loaded {len(self.learned_commands)} existing commands")
+            self.learned_commands = self.commands_store.open_dict('commands')
+            self.log_message(f"📚 Loaded {len(self.learned_commands)} existing commands")
             
             # Load existing traffic data
-            if os.path.exists(self.traffic_file):
-                with open(self.traffic_file, 'r') as f:
-                    traffic_data = json.load(f)
-                    if 'traffic' in traffic_data:
-                        for entry in traffic_data['traffic']:
-                            self.network_traffic.append(entry)
-                    self.log_message(f"📊 Loaded {len(self.network_traffic)} traffic entries")
+            self.network_traffic = self.traffic_store.open_deque('traffic', maxlen=1000)
+            self.log_message(f"📊 Loaded {len(self.network_traffic)} traffic entries")
             
             self.log_message("✅ Existing data loaded successfully")
         except Exception as e:
             self.log_message(f"⚠️ Could not load existing data: {e}")
     
-    def signal_handler(self, signum, frame):
-        """Handle shutdown signals gracefully"""
-        self.log_message(f"Received signal {signum}, shutting down...")
-        self.running = False
-        self.save_all_data()
-        sys.exit(0)
-    
     def log_message(self, message):
-        """Log message with timestamp"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        print(log_entry)
-        
-        with open(self.log_file, 'a') as f:
-            f.write(log_entry + '\n')
+        """Log message with timestamp; queued and written in batches by the shared log sink"""
+        self.log_sink.log(message)
+    
+    def close(self):
+        """Write out and release the log sink"""
+        close_sink(self.log_file)
+    
+    def attach_scan(self, runtime):
+        """Scan for the device now, then every minute while it stays unreachable"""
+        runtime.every(60, self.scan_round, 'network scan', when=lambda: not self.device_reachable)
+    
+    def attach_connections(self, runtime):
+        runtime.watch_connections(
+            [self.network], lambda event: self.metrics.process(self.on_connection_event, event, event.ts))
+        self.traffic_monitoring = True
+        self.log_message(f"🌐 Tracking connections in {self.network}")
+    
+    def attach_persist(self, runtime):
+        """Save every 30 seconds to preserve learned commands"""
+        runtime.on_save(self.save_all_data, 30, 'data save')
+    
+    def scan_round(self):
+        """Check connectivity and scan the network for Xiaomi devices"""
+        if self.device_reachable is not None:
+            self.log_message("🔍 Scanning for Xiaomi devices...")
+        self.scan_network_for_xiaomi_devices()
+        self.device_reachable = self.check_network_connectivity()
     
     def check_network_connectivity(self):
         """Check network connectivity and find Xiaomi device"""
         try:
             # Check if we can reach the device
-            result = subprocess.run(['ping', '-c', '1', '-W', '1000', self.xiaomi_ip], 
-                                  capture_output=True, text=True)
-            is_reachable = "1 received" in result.stdout
+            is_reachable = probe(self.xiaomi_ip) is not None
             
             if is_reachable:
                 self.log_message(f"✅ Xiaomi device at {self.xiaomi_ip} is reachable")
@@ -127,34 +144,59 @@ class XiaomiNetworkAnalyzer:
                 network_base = '.'.join(current_ip.split('.')[:-1])
                 self.log_message(f"📡 Scanning network {network_base}.0/24")
                 
-                # Scan for devices
-                for i in range(1, 255):
-                    test_ip = f"{network_base}.{i}"
-                    if test_ip != current_ip:
-                        try:
-                            result = subprocess.run(['ping', '-c', '1', '-W', '500', test_ip], 
-                                                  capture_output=True, text=True)
-                            if "1 received" in result.stdout:
-                                self.log_message(f"📱 Found device at {test_ip}")
-                                # Test if it's a Xiaomi device
-                                self.test_xiaomi_device(test_ip)
-                        except:
-                            continue
+                # Probe the whole subnet concurrently
+                devices = sweep_subnet(network_base, exclude={current_ip})
+                candidates = []
+                for test_ip, info in devices.items():
+                    self.log_message(f"📱 Found device at {test_ip} ({info['method']})")
+                    if 'miio_device_id' in info:
+                        # Answered the miIO hello, no need to probe ports
+                        self.log_message(f"🎯 Found Xiaomi device at {test_ip}:54321")
+                        self.learned_commands[f'xiaomi_device_{test_ip}'] = {
+                            'ip': test_ip,
+                            'port': 54321,
+                            'device_id': info['miio_device_id'],
+                            'discovered': True,
+                            'timestamp': datetime.now().isoformat()
+                        }
+                    else:
+                        candidates.append(test_ip)
+                
+                # Probe every candidate's Xiaomi ports in one concurrent pass
+                self.port_scanner.scan(candidates, XIAOMI_PORTS)
+                for test_ip in candidates:
+                    self.test_xiaomi_device(test_ip)
         except Exception as e:
             self.log_message(f"Error scanning network: {e}")
     
     def test_xiaomi_device(self, ip):
         """Test if device is a Xiaomi device"""
         try:
-            # Test common Xiaomi ports
-            xiaomi_ports = [54321, 8080, 80, 443, 9999, 8888]
-            for port in xiaomi_ports:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(1)
-                result = sock.connect_ex((ip, port))
-                sock.close()
-                
-                if result == 0:
+            # Devices that announced miIO over mDNS need no probe; a Xiaomi OUI alone also
+            # matches phones and TVs, so those have to answer a miIO hello first
+            device = self.inventory.refresh().get(ip)
+            if device is not None:
+                announced = '_miio._udp' in device.services
+                device_id = None
+                if not announced and 'xiaomi' in (device.vendor or '').lower():
+                    device_id = miio_hello(ip)
+                if announced or device_id:
+                    how = 'hello' if device_id else f"passive: {', '.join(sorted(device.sources))}"
+                    self.log_message(f"🎯 Found Xiaomi device at {ip}:54321 ({how})")
+                    self.learned_commands[f'xiaomi_device_{ip}'] = {
+                        'ip': ip,
+                        'port': 54321,
+                        'hostname': device.hostname,
+                        'device_id': device_id,
+                        'discovered': True,
+                        'timestamp': datetime.now().isoformat()
+                    }
+                    return True
+            
+            # Test common Xiaomi ports (served from the scanner cache after a sweep)
+            open_ports = self.port_scanner.scan_host(ip, XIAOMI_PORTS)
+            for port in XIAOMI_PORTS:
+                if port in open_ports:
                     self.log_message(f"🎯 Found Xiaomi device at {ip}:{port}")
                     self.learned_commands[f'xiaomi_device_{ip}'] = {
                         'ip': ip,
@@ -167,97 +209,39 @@ class XiaomiNetworkAnalyzer:
             pass
         return False
     
-    def start_network_monitoring(self):
-        """Start monitoring network traffic"""
-        try:
-            self.log_message("🌐 Starting network traffic monitoring...")
-            
-            # Get network interfaces
-            result = subprocess.run(['ifconfig'], capture_output=True, text=True)
-            interfaces = []
-            for line in result.stdout.split('\n'):
-                if line.startswith('en') and 'inet' in line:
-                    interface = line.split(':')[0]
-                    interfaces.append(interface)
-            
-            if not interfaces:
-                interfaces = ['en0', 'en1']  # Default interfaces
-            
-            self.log_message(f"📡 Monitoring interfaces: {interfaces}")
-            
-            # Start traffic monitoring for each interface
-            for interface in interfaces:
-                thread = threading.Thread(target=self.monitor_interface_traffic, 
-                                        args=(interface,), daemon=True)
-                thread.start()
-                self.analysis_threads.append(thread)
-            
-            self.traffic_monitoring = True
-            self.log_message("✅ Network monitoring started")
-            
-        except Exception as e:
-            self.log_message(f"Error starting network monitoring: {e}")
-    
-    def monitor_interface_traffic(self, interface):
-        """Monitor traffic on specific interface"""
-        try:
-            self.log_message(f"📊 Monitoring traffic on {interface}")
-            
-            # Use netstat to monitor connections
-            while self.running:
-                try:
-                    result = subprocess.run(['netstat', '-an'], capture_output=True, text=True)
-                    connections = result.stdout
-                    
-                    # Look for connections to Xiaomi IP or similar patterns
-                    xiaomi_connections = []
-                    for line in connections.split('\n'):
-                        if self.xiaomi_ip in line or '192.168.68' in line:
-                            xiaomi_connections.append(line)
-                    
-                    if xiaomi_connections:
-                        self.log_message(f"🔍 Found {len(xiaomi_connections)} Xiaomi-related connections")
-                        for conn in xiaomi_connections:
-                            self.analyze_connection(conn)
-                    
-                    time.sleep(5)  # Check every 5 seconds
-                    
-                except Exception as e:
-                    self.log_message(f"Error monitoring {interface}: {e}")
-                    time.sleep(10)
-                    
-        except Exception as e:
-            self.log_message(f"Error in interface monitoring: {e}")
+    def on_connection_event(self, event):
+        """Analyze connections as they open or change state"""
+        if event.kind != CLOSED:
+            self.analyze_connection(event.connection)
     
-    def analyze_connection(self, connection):
+    def analyze_connection(self, conn):
         """Analyze network connection for Xiaomi commands"""
         try:
-            # Extract connection info
-            parts = connection.split()
-            if len(parts) >= 4:
-                local_addr = parts[3]
-                remote_addr = parts[4]
-                state = parts[5] if len(parts) > 5 else 'unknown'
+            local_addr = f"{conn.local_ip}:{conn.local_port}"
+            remote_addr = f"{conn.remote_ip}:{conn.remote_port}"
+            state = conn.state or 'unknown'
+            
+            # Check if it's related to Xiaomi
+            if conn.remote_ip == self.xiaomi_ip or self.host_filter.match_ip(conn.remote_ip):
+                self.log_message(f"📡 Xiaomi connection: {local_addr} -> {remote_addr} ({state})")
                 
-                # Check if it's related to Xiaomi
-                if self.xiaomi_ip in remote_addr or '192.168.68' in remote_addr:
-                    self.log_message(f"📡 Xiaomi connection: {local_addr} -> {remote_addr} ({state})")
-                    
-                    # Record the connection
-                    traffic_entry = {
-                        'timestamp': datetime.now().isoformat(),
-                        'local_addr': local_addr,
-                        'remote_addr': remote_addr,
-                        'state': state,
-                        'type': 'xiaomi_connection'
-                    }
-                    
-                    self.network_traffic.append(traffic_entry)
-                    
-                    # Learn from the connection pattern
-                    self.learn_command_pattern(connection)
+                # Record the connection
+                traffic_entry = {
+                    'timestamp': datetime.now().isoformat(),
+                    'local_addr': local_addr,
+                    'remote_addr': remote_addr,
+                    'state': state,
+                    'type': 'xiaomi_connection'
+                }
+                
+                self.network_traffic.append(traffic_entry)
+                self.metrics.classified('connection', 'xiaomi')
+                
+                # Learn from the connection pattern
+                self.learn_command_pattern(format_connection(conn))
                     
         except Exception as e:
+            self.metrics.errors.labels('analyze_connection').inc()
             self.log_message(f"Error analyzing connection: {e}")
     
     def learn_command_pattern(self, connection):
@@ -292,65 +276,62 @@ class XiaomiNetworkAnalyzer:
         except Exception as e:
             self.log_message(f"Error learning pattern: {e}")
     
-    def continuous_data_saving(self):
-        """Continuously save data to preserve learned commands"""
-        while self.running:
+    def save_all_data(self, force=False):
+        """Journal new commands and traffic; snapshots are rewritten only when compacting"""
+        with self.metrics.save_seconds.time():
             try:
-                self.save_all_data()
-                time.sleep(30)  # Save every 30 seconds
+                # Save learned commands
+                commands_header = {
+                    'status': 'analyzing',
+                    'total_commands_discovered': len(self.learned_commands),
+                    'last_update': datetime.now().isoformat(),
+                    'command_patterns': dict(self.command_patterns)
+                }
+                compacted = self.commands_store.save(commands_header, force=force)
+                
+                # Save network traffic
+                traffic_header = {
+                    'status': 'monitoring',
+                    'total_traffic_entries': len(self.network_traffic),
+                    'last_update': datetime.now().isoformat()
+                }
+                compacted = self.traffic_store.save(traffic_header, force=force) or compacted
+                if not compacted:
+                    return
+                
+                # Save learning summary
+                learning_summary = {
+                    'status': 'analyzing',
+                    'total_commands_learned': len(self.learned_commands),
+                    'total_traffic_entries': len(self.network_traffic),
+                    'analysis_duration': str(datetime.now() - self.start_time),
+                    'start_time': self.start_time.isoformat(),
+                    'learned_commands': self.learned_commands,
+                    'command_patterns': dict(self.command_patterns),
+                    'traffic_summary': {
+                        'total_connections': len(self.network_traffic),
+                        'unique_ports': len(set(entry.get('port', '') for entry in self.network_traffic)),
+                        'last_activity': self.network_traffic[-1]['timestamp'] if self.network_traffic else None
+                    }
+                }
+                write_json_atomic(self.learning_file, learning_summary, indent=2)
+                
+                self.log_message(f"💾 Data saved: {len(self.learned_commands)} commands, {len(self.network_traffic)} traffic entries")
+                
             except Exception as e:
                 self.log_message(f"Error saving data: {e}")
-                time.sleep(60)
     
-    def save_all_data(self):
-        """Save all learning data to files"""
+    def run_replay(self, path, speed=0.0):
+        """Feed recorded connections (traffic history or capture flows) through analyze_connection"""
+        self.log_message(f"📂 Replaying {path} for {self.xiaomi_ip}")
         try:
-            # Save learned commands
-            commands_data = {
-                'status': 'analyzing',
-                'total_commands_discovered': len(self.learned_commands),
-                'last_update': datetime.now().isoformat(),
-                'commands': self.learned_commands,
-                'command_patterns': dict(self.command_patterns)
-            }
-            
-            with open(self.commands_file, 'w') as f:
-                json.dump(commands_data, f, indent=2)
-            
-            # Save network traffic
-            traffic_data = {
-                'status': 'monitoring',
-                'total_traffic_entries': len(self.network_traffic),
-                'last_update': datetime.now().isoformat(),
-                'traffic': list(self.network_traffic)
-            }
-            
-            with open(self.traffic_file, 'w') as f:
-                json.dump(traffic_data, f, indent=2)
-            
-            # Save learning summary
-            learning_summary = {
-                'status': 'analyzing',
-                'total_commands_learned': len(self.learned_commands),
-                'total_traffic_entries': len(self.network_traffic),
-                'analysis_duration': str(datetime.now() - self.start_time),
-                'start_time': self.start_time.isoformat(),
-                'learned_commands': self.learned_commands,
-                'command_patterns': dict(self.command_patterns),
-                'traffic_summary': {
-                    'total_connections': len(self.network_traffic),
-                    'unique_ports': len(set(entry.get('port', '') for entry in self.network_traffic)),
-                    'last_activity': self.network_traffic[-1]['timestamp'] if self.network_traffic else None
-                }
-            }
-            
-            with open(self.learning_file, 'w') as f:
-                json.dump(learning_summary, f, indent=2)
-            
-            self.log_message(f"💾 Data saved: {len(self.learned_commands)} commands, {len(self.network_traffic)} traffic entries")
-            
-        except Exception as e:
-            self.log_message(f"Error saving data: {e}")
+            stats = Replay(speed).run(replay_connections(path, self.host_filter),
+                                      lambda item: self.analyze_connection(item[1]),
+                                      timestamp=lambda item: item[0])
+            self.log_message(f"📂 Replayed {path}: {format_stats(stats)}")
+            return stats
+        finally:
+            self.save_all_data(force=True)
     
     def run_continuous_analysis(self):
         """Run continuous analysis until stopped"""
@@ -360,43 +341,27 @@ class XiaomiNetworkAnalyzer:
         self.log_message("📊 Analysis will monitor network traffic and learn commands")
         self.log_message("🛑 Press Ctrl+C to stop")
         
-        self.running = True
-        
-        # Check connectivity
-        device_reachable = self.check_network_connectivity()
-        
-        # Scan for Xiaomi devices
-        self.scan_network_for_xiaomi_devices()
-        
-        # Start network monitoring
-        self.start_network_monitoring()
-        
-        # Start data saving thread
-        saver_thread = threading.Thread(target=self.continuous_data_saving, daemon=True)
-        saver_thread.start()
-        self.analysis_threads.append(saver_thread)
-        
+        # Several devices or analyzers in one process: xiaomi_runtime.py with a pipeline file
+        runtime = AnalyzerRuntime('network_analyzer', METRICS_PORT, log=self.log_message, registry=self.metrics.registry)
+        runtime.add(self)
         try:
-            while self.running:
-                # Periodic network scan
-                if not device_reachable:
-                    self.log_message("🔍 Scanning for Xiaomi devices...")
-                    self.scan_network_for_xiaomi_devices()
-                    device_reachable = self.check_network_connectivity()
-                
-                time.sleep(60)  # Check every minute
-                
-        except KeyboardInterrupt:
-            self.log_message("🛑 Analysis stopped by user")
+            runtime.run()
         except Exception as e:
             self.log_message(f"❌ Analysis error: {e}")
-        finally:
-            self.running = False
-            self.save_all_data()
-            self.log_message("✅ Analysis completed and data saved")
+        self.log_message("✅ Analysis completed and data saved")
 
 def main():
     """Main function"""
+    replay = replay_args(sys.argv[1:])
+    if replay:
+        # Replayed data never mixes with what the live analyzer has learned
+        analyzer = XiaomiNetworkAnalyzer(replay_device(replay))
+        try:
+            analyzer.run_replay(replay['path'], replay['speed'])
+            analyzer.log_message(f"📁 Replay results in {replay['output']}")
+        finally:
+            analyzer.close()
+        return
     analyzer = XiaomiNetworkAnalyzer()
     analyzer.run_continuous_analysis()
 
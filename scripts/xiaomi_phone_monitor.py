@@ -6,88 +6,75 @@ Uses tcpdump to capture packets between specific IPs
 """
 
 import subprocess
-import json
-import time
-import re
-import threading
-import signal
 import sys
-import os
 from datetime import datetime
 from collections import defaultdict, deque
 
+from xiaomi_flowstore import FLOW_DIR, get_store
+from xiaomi_logsink import close_sink, get_sink
+from xiaomi_metrics import MonitorMetrics
+from xiaomi_pcap import IPPROTO_TCP, IPPROTO_UDP
+from xiaomi_replay import Replay, busiest_hosts, format_stats, replay_args, replay_device, replay_packets
+from xiaomi_runtime import AnalyzerRuntime, instance_path
+from xiaomi_store import LearningStore
+
 # Configuration
 PHONE_IP = "192.168.68.65"
 XIAOMI_IP = "192.168.68.68"
 LOG_FILE = "xiaomi_phone_monitor.log"
 COMMANDS_FILE = "xiaomi_phone_commands.json"
 TRAFFIC_FILE = "xiaomi_phone_traffic.json"
+METRICS_PORT = 9478  # localhost metrics endpoint, None disables
 
 class XiaomiPhoneMonitor:
-    def __init__(self):
-        self.phone_ip = PHONE_IP
-        self.xiaomi_ip = XIAOMI_IP
-        self.log_file = LOG_FILE
-        self.commands_file = COMMANDS_FILE
-        self.traffic_file = TRAFFIC_FILE
+    STAGES = ('capture', 'persist', 'status')
+
+    def __init__(self, device=None, registry=None):
+        device = device or {}
+        self.phone_ip = device.get('phone_ip', PHONE_IP)
+        self.xiaomi_ip = device.get('ip', XIAOMI_IP)
+        self.log_file = instance_path(LOG_FILE, device)
+        self.log_sink = get_sink(self.log_file)
+        self.commands_file = instance_path(COMMANDS_FILE, device)
+        self.traffic_file = instance_path(TRAFFIC_FILE, device)
         
         # Data structures
+        self.commands_store = LearningStore(self.commands_file)
+        self.traffic_store = LearningStore(self.traffic_file)
+        self.flow_store = get_store(instance_path(FLOW_DIR, device))
         self.captured_commands = {}
         self.network_traffic = deque(maxlen=1000)
         self.command_patterns = defaultdict(int)
-        self.tcpdump_process = None
+        self.metrics = MonitorMetrics('phone_monitor', registry, instance=device.get('name'))
         
         # State
-        self.running = False
-        self.monitor_threads = []
         self.start_time = datetime.now()
         
         # Load existing data
         self.load_existing_data()
-        
-        # Setup signal handlers
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGTERM, self.signal_handler)
+        self.metrics.watch_queue('commands_unsaved', lambda: len(self.captured_commands.dirty))
+        self.metrics.watch_queue('traffic_unsaved', lambda: len(self.network_traffic.pending))
     
     def load_existing_data(self):
         """Load existing captured data"""
         try:
-            if os.path.exists(self.commands_file):
-                with open(self.commands_file, 'r') as f:
-                    data = json.load(f)
-                    if 'commands' in data:
-                        self.captured_commands = data['commands']
-                    self.log_message(f"📚 Loaded {len(self.captured_commands)} existing commands")
+            self.captured_commands = self.commands_store.open_dict('commands')
+            self.log_message(f"📚 Loaded {len(self.captured_commands)} existing commands")
             
-            if os.path.exists(self.traffic_file):
-                with open(self.traffic_file, 'r') as f:
-                    data = json.load(f)
-                    if 'traffic' in data:
-                        for entry in data['traffic']:
-                            self.network_traffic.append(entry)
-                    self.log_message(f"📊 Loaded {len(self.network_traffic)} traffic entries")
+            self.network_traffic = self.traffic_store.open_deque('traffic', maxlen=1000)
+            self.log_message(f"📊 Loaded {len(self.network_traffic)} traffic entries")
             
             self.log_message("✅ Existing data loaded successfully")
         except Exception as e:
             self.log_message(f"⚠️ Could not load existing data: {e}")
     
-    def signal_handler(self, signum, frame):
-        """Handle shutdown signals gracefully"""
-        self.log_message(f"Received signal {signum}, shutting down...")
-        self.running = False
-        if self.tcpdump_process:
-            self.tcpdump_process.terminate()
-        self.save_all_data()
-        sys.exit(0)
-    
     def log_message(self, message):
-        """Log message with timestamp"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        print(log_entry)
-        
-        with open(self.log_file, 'a') as f:
-            f.write(log_entry + '\n')
+        """Log message with timestamp; queued and written in batches by the shared log sink"""
+        self.log_sink.log(message)
+    
+    def close(self):
+        """Write out and release the log sink"""
+        close_sink(self.log_file)
     
     def get_network_interface(self):
         """Get the network interface for monitoring"""
@@ -116,111 +103,47 @@ class XiaomiPhoneMonitor:
             self.log_message(f"Error getting interface: {e}")
             return 'en0'
     
-    def start_tcpdump_monitoring(self):
-        """Start tcpdump to monitor traffic between phone and Xiaomi"""
-        try:
-            interface = self.get_network_interface()
-            self.log_message(f"🌐 Starting tcpdump monitoring on {interface}")
-            
-            # Create tcpdump filter for traffic between phone and Xiaomi
-            filter_expr = f"host {self.phone_ip} and host {self.xiaomi_ip}"
-            
-            # Start tcpdump process
-            cmd = [
-                'sudo', 'tcpdump', 
-                '-i', interface,
-                '-n',  # Don't resolve hostnames
-                '-l',  # Line buffered
-                '-A',  # Print ASCII
-                '-s', '0',  # Capture full packets
-                filter_expr
-            ]
-            
-            self.log_message(f"🔍 Running: {' '.join(cmd)}")
-            self.log_message(f"📡 Filter: {filter_expr}")
-            
-            self.tcpdump_process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1,
-                universal_newlines=True
-            )
-            
-            # Start thread to read tcpdump output
-            monitor_thread = threading.Thread(target=self.read_tcpdump_output, daemon=True)
-            monitor_thread.start()
-            self.monitor_threads.append(monitor_thread)
-            
-            self.log_message("✅ tcpdump monitoring started")
-            
-        except Exception as e:
-            self.log_message(f"Error starting tcpdump: {e}")
-            self.log_message("💡 Make sure tcpdump is installed: brew install tcpdump")
+    def attach_capture(self, runtime):
+        """Process every captured packet exchanged between phone and Xiaomi"""
+        runtime.watch_packets(self.xiaomi_ip, lambda packet: self.metrics.process(self.process_packet, packet, packet.ts),
+                              peer=self.phone_ip)
+        self.log_message(f"📡 Capturing host {self.phone_ip} and host {self.xiaomi_ip}")
     
-    def read_tcpdump_output(self):
-        """Read and process tcpdump output"""
-        try:
-            self.log_message("📊 Reading tcpdump output...")
-            
-            while self.running and self.tcpdump_process:
-                try:
-                    line = self.tcpdump_process.stdout.readline()
-                    if line:
-                        self.process_tcpdump_line(line)
-                    else:
-                        break
-                except Exception as e:
-                    self.log_message(f"Error reading tcpdump: {e}")
-                    break
-                    
-        except Exception as e:
-            self.log_message(f"Error in tcpdump reader: {e}")
+    def attach_persist(self, runtime):
+        """Save every 10 seconds for immediate updates"""
+        runtime.on_save(self.save_all_data, 10, 'data save')
     
-    def process_tcpdump_line(self, line):
-        """Process a line from tcpdump output"""
-        try:
-            # Parse tcpdump output
-            if 'IP' in line and (self.phone_ip in line or self.xiaomi_ip in line):
-                self.log_message(f"📡 Captured packet: {line.strip()}")
-                
-                # Extract packet information
-                packet_info = self.parse_tcpdump_line(line)
-                if packet_info:
-                    self.network_traffic.append(packet_info)
-                    self.analyze_packet(packet_info)
-                    
-        except Exception as e:
-            self.log_message(f"Error processing tcpdump line: {e}")
+    def attach_status(self, runtime):
+        runtime.every(30, self.log_status, 'status')
     
-    def parse_tcpdump_line(self, line):
-        """Parse tcpdump line to extract packet information"""
+    def log_status(self):
+        self.log_message(f"📊 Status: {len(self.captured_commands)} commands captured, {len(self.network_traffic)} traffic entries")
+    
+    def process_packet(self, packet):
+        """Record a captured packet and analyze it"""
         try:
-            # Extract timestamp
-            timestamp_match = re.search(r'(\d{2}:\d{2}:\d{2}\.\d+)', line)
-            timestamp = timestamp_match.group(1) if timestamp_match else datetime.now().strftime("%H:%M:%S.%f")[:-3]
-            
-            # Extract source and destination
-            ip_match = re.search(r'(\d+\.\d+\.\d+\.\d+)\.(\d+) > (\d+\.\d+\.\d+\.\d+)\.(\d+)', line)
-            if ip_match:
-                src_ip, src_port, dst_ip, dst_port = ip_match.groups()
-                
-                return {
-                    'timestamp': datetime.now().isoformat(),
-                    'src_ip': src_ip,
-                    'src_port': src_port,
-                    'dst_ip': dst_ip,
-                    'dst_port': dst_port,
-                    'raw_line': line.strip(),
-                    'type': 'tcpdump_packet'
-                }
-            
-            return None
+            proto = {IPPROTO_TCP: 'TCP', IPPROTO_UDP: 'UDP'}.get(packet.proto, str(packet.proto))
+            summary = (f"IP {packet.src_ip}.{packet.src_port} > {packet.dst_ip}.{packet.dst_port}: "
+                       f"{proto} {len(packet.payload)}")
+            self.log_message(f"📡 Captured packet: {summary}")
             
+            packet_info = {
+                'timestamp': datetime.fromtimestamp(packet.ts).isoformat(),
+                'src_ip': packet.src_ip,
+                'src_port': str(packet.src_port),
+                'dst_ip': packet.dst_ip,
+                'dst_port': str(packet.dst_port),
+                'raw_line': summary,
+                'type': 'tcpdump_packet'
+            }
+            self.network_traffic.append(packet_info)
+            self.flow_store.add(packet.ts, packet.src_ip, packet.src_port,
+                                packet.dst_ip, packet.dst_port, kind='tcpdump_packet')
+            self.analyze_packet(packet_info)
+                    
         except Exception as e:
-            self.log_message(f"Error parsing tcpdump line: {e}")
-            return None
+            self.metrics.errors.labels('process_packet').inc()
+            self.log_message(f"Error processing packet: {e}")
     
     def analyze_packet(self, packet_info):
         """Analyze packet for Xiaomi commands"""
@@ -247,9 +170,10 @@ class XiaomiPhoneMonitor:
                 }
                 
                 self.command_patterns[f'port_{dst_port}'] += 1
+                self.metrics.classified('phone_to_xiaomi')
                 self.log_message(f"📝 Learned command: {command_key}")
-                # Save immediately when new command is learned
-                self.save_all_data()
+                # Journal the new command immediately
+                self.commands_store.flush()
             
             # Check if it's from Xiaomi to phone
             elif src_ip == self.xiaomi_ip and dst_ip == self.phone_ip:
@@ -268,55 +192,62 @@ class XiaomiPhoneMonitor:
                 }
                 
                 self.command_patterns[f'response_port_{src_port}'] += 1
+                self.metrics.classified('xiaomi_to_phone')
                 self.log_message(f"📝 Learned response: {command_key}")
-                # Save immediately when new response is learned
-                self.save_all_data()
+                # Journal the new response immediately
+                self.commands_store.flush()
                 
         except Exception as e:
+            self.metrics.errors.labels('analyze_packet').inc()
             self.log_message(f"Error analyzing packet: {e}")
     
-    def continuous_data_saving(self):
-        """Continuously save data"""
-        while self.running:
+    def save_all_data(self, force=False):
+        """Journal new captured data; snapshots are rewritten only when compacting"""
+        with self.metrics.save_seconds.time():
             try:
-                self.save_all_data()
-                time.sleep(10)  # Save every 10 seconds for immediate updates
+                # Save captured commands
+                commands_header = {
+                    'status': 'monitoring',
+                    'phone_ip': self.phone_ip,
+                    'xiaomi_ip': self.xiaomi_ip,
+                    'total_commands_captured': len(self.captured_commands),
+                    'last_update': datetime.now().isoformat(),
+                    'command_patterns': dict(self.command_patterns)
+                }
+                compacted = self.commands_store.save(commands_header, force=force)
+                
+                # Save network traffic
+                traffic_header = {
+                    'status': 'monitoring',
+                    'total_traffic_entries': len(self.network_traffic),
+                    'last_update': datetime.now().isoformat()
+                }
+                compacted = self.traffic_store.save(traffic_header, force=force) or compacted
+                self.flow_store.flush()
+                
+                if compacted:
+                    self.log_message(f"💾 Data saved: {len(self.captured_commands)} commands, {len(self.network_traffic)} traffic entries")
+                
             except Exception as e:
                 self.log_message(f"Error saving data: {e}")
-                time.sleep(30)
     
-    def save_all_data(self):
-        """Save all captured data"""
+    def run_replay(self, path, speed=0.0):
+        """Feed a recorded capture or traffic history through process_packet, without tcpdump
+
+        Only packets exchanged between phone and Xiaomi are fed, as attach_capture routes them live.
+        """
+        self.log_message(f"📂 Replaying {path} for {self.phone_ip} <-> {self.xiaomi_ip}")
+        hosts = {self.phone_ip, self.xiaomi_ip}
+        packets = (packet for packet in replay_packets(path) if {packet.src_ip, packet.dst_ip} == hosts)
         try:
-            # Save captured commands
-            commands_data = {
-                'status': 'monitoring',
-                'phone_ip': self.phone_ip,
-                'xiaomi_ip': self.xiaomi_ip,
-                'total_commands_captured': len(self.captured_commands),
-                'last_update': datetime.now().isoformat(),
-                'commands': self.captured_commands,
-                'command_patterns': dict(self.command_patterns)
-            }
-            
-            with open(self.commands_file, 'w') as f:
-                json.dump(commands_data, f, indent=2)
-            
-            # Save network traffic
-            traffic_data = {
-                'status': 'monitoring',
-                'total_traffic_entries': len(self.network_traffic),
-                'last_update': datetime.now().isoformat(),
-                'traffic': list(self.network_traffic)
-            }
-            
-            with open(self.traffic_file, 'w') as f:
-                json.dump(traffic_data, f, indent=2)
-            
-            self.log_message(f"💾 Data saved: {len(self.captured_commands)} commands, {len(self.network_traffic)} traffic entries")
-            
-        except Exception as e:
-            self.log_message(f"Error saving data: {e}")
+            stats = Replay(speed).run(packets, self.process_packet)
+            self.log_message(f"📂 Replayed {path}: {format_stats(stats)}")
+            if not stats['packets']:
+                busiest = ', '.join(f"{ip} ({count})" for ip, count in busiest_hosts(path))
+                self.log_message(f"⚠️ No packets between {self.phone_ip} and {self.xiaomi_ip}; busiest hosts: {busiest} (use --device IP)")
+            return stats
+        finally:
+            self.save_all_data(force=True)
     
     def run_continuous_monitoring(self):
         """Run continuous phone-to-Xiaomi monitoring"""
@@ -327,36 +258,29 @@ class XiaomiPhoneMonitor:
         self.log_message("📊 Will capture ONLY traffic between phone and Xiaomi device")
         self.log_message("🛑 Press Ctrl+C to stop")
         
-        self.running = True
-        
-        # Start tcpdump monitoring
-        self.start_tcpdump_monitoring()
-        
-        # Start data saving thread
-        saver_thread = threading.Thread(target=self.continuous_data_saving, daemon=True)
-        saver_thread.start()
-        self.monitor_threads.append(saver_thread)
-        
+        # Several devices or analyzers in one process: xiaomi_runtime.py with a pipeline file
+        interface = self.get_network_interface()
+        runtime = AnalyzerRuntime('phone_monitor', METRICS_PORT, interface=interface, sudo=True,
+                                  log=self.log_message, registry=self.metrics.registry)
+        runtime.add(self)
         try:
-            while self.running:
-                # Show status every 30 seconds and save immediately
-                self.log_message(f"📊 Status: {len(self.captured_commands)} commands captured, {len(self.network_traffic)} traffic entries")
-                self.save_all_data()  # Save immediately on each status update
-                time.sleep(30)  # Check every 30 seconds
-                
-        except KeyboardInterrupt:
-            self.log_message("🛑 Monitoring stopped by user")
+            runtime.run()
         except Exception as e:
             self.log_message(f"❌ Monitoring error: {e}")
-        finally:
-            self.running = False
-            if self.tcpdump_process:
-                self.tcpdump_process.terminate()
-            self.save_all_data()
-            self.log_message("✅ Monitoring completed and data saved")
+        self.log_message("✅ Monitoring completed and data saved")
 
 def main():
     """Main function"""
+    replay = replay_args(sys.argv[1:])
+    if replay:
+        # Replayed data never mixes with what the live monitor has learned
+        monitor = XiaomiPhoneMonitor(replay_device(replay))
+        try:
+            monitor.run_replay(replay['path'], replay['speed'])
+            monitor.log_message(f"📁 Replay results in {replay['output']}")
+        finally:
+            monitor.close()
+        return
     monitor = XiaomiPhoneMonitor()
     monitor.run_continuous_monitoring()
 
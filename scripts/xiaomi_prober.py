@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Probe Scheduler
+Sends command-discovery probes over UDP with many in flight, paced by a token bucket per device
+Candidates that time out back off exponentially; formats that got replies are tried first
+"""
+
+import asyncio
+import sys
+import time
+
+# Defaults
+DEFAULT_PORT = 54321
+DEFAULT_RATE = 4.0           # probes per second per device
+DEFAULT_BURST = 4            # probes a device may receive back to back
+DEFAULT_IN_FLIGHT = 8        # probes awaiting a reply at once
+DEFAULT_TIMEOUT = 2.0
+DEFAULT_BACKOFF = 60.0       # first retry delay after a timeout, doubled per further timeout
+DEFAULT_MAX_BACKOFF = 3600.0
+
+IR_COMMANDS = [
+    'power', 'volume_up', 'volume_down', 'channel_up', 'channel_down',
+    'mute', 'menu', 'ok', 'back', 'up', 'down', 'left', 'right'
+]
+
+# Command formats probed for each IR command name
+PROBE_FORMATS = [
+    '{{"method":"send_ir","params":["{command}"]}}',
+    '{{"method":"ir_{command}","params":[]}}',
+    '{{"method":"{command}","params":[]}}'
+]
+
+
+class TokenBucket:
+    """Async token bucket: rate tokens per second, holding at most burst
+
+    Waiters reserve a token up front (the balance may go negative), so they are
+    served in order without a lock and the bucket works across event loops.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Take a token, waiting until it has accrued"""
+        self._refill()
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class _ReplyProtocol(asyncio.DatagramProtocol):
+    """Resolves a future with the first datagram received"""
+
+    def __init__(self, future):
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        if not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class ProbeScheduler:
+    """Adaptive, rate-limited discovery probing of one or more devices
+
+    Each (host, command, format) candidate remembers its timeouts; after n
+    consecutive timeouts it is skipped for backoff * 2**(n-1) seconds. Formats
+    are ordered by their reply rate so productive ones spend the tokens first.
+    """
+
+    def __init__(self, port=DEFAULT_PORT, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 in_flight=DEFAULT_IN_FLIGHT, timeout=DEFAULT_TIMEOUT,
+                 backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF, formats=PROBE_FORMATS,
+                 metrics=None):
+        self.port = port
+        self.rate = rate
+        self.burst = burst
+        self.in_flight = in_flight
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.formats = list(formats)
+        self.buckets = {}       # host -> TokenBucket
+        self.failures = {}      # (host, command, format index) -> consecutive timeouts
+        self.retry_at = {}      # (host, command, format index) -> monotonic time
+        self.format_stats = {index: [0, 0] for index in range(len(self.formats))}  # [replies, probes]
+        self.callback_errors = 0
+        self.metrics = metrics  # anything with probe(rtt), rtt None on timeout
+
+    def bucket(self, host):
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return self.buckets[host]
+
+    def format_score(self, index):
+        """Smoothed reply rate of a format"""
+        replies, probes = self.format_stats[index]
+        return (replies + 1) / (probes + 2)
+
+    def candidates(self, host, commands, now=None):
+        """Due (command, format index) pairs, most promising format first"""
+        now = time.monotonic() if now is None else now
+        order = sorted(range(len(self.formats)), key=self.format_score, reverse=True)
+        due = []
+        for index in order:
+            for command in commands:
+                if self.retry_at.get((host, command, index), 0) <= now:
+                    due.append((command, index))
+        return due
+
+    def payload(self, command, index):
+        return self.formats[index].format(command=command).encode()
+
+    async def _send(self, host, data):
+        """Send one datagram on its own socket and wait for the reply, or None on timeout"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        transport = None
+        try:
+            # Unreachable networks fail here; that counts against this target only
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: _ReplyProtocol(future), remote_addr=(host, self.port))
+            transport.sendto(data)
+            return await asyncio.wait_for(future, self.timeout)
+        except (asyncio.TimeoutError, OSError):
+            return None
+        finally:
+            if transport is not None:
+                transport.close()
+
+    def _record(self, host, command, index, response):
+        key = (host, command, index)
+        stats = self.format_stats[index]
+        stats[1] += 1
+        if response is not None:
+            stats[0] += 1
+            self.failures.pop(key, None)
+            self.retry_at.pop(key, None)
+            return
+        failures = self.failures.get(key, 0) + 1
+        self.failures[key] = failures
+        delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+        self.retry_at[key] = time.monotonic() + delay
+
+    async def _probe(self, host, command, index, semaphore, encode, on_response):
+        async with semaphore:
+            await self.bucket(host).acquire()
+            payload = self.payload(command, index)
+            data = encode(payload) if encode else payload
+            sent = time.monotonic()
+            response = await self._send(host, data)
+        self._record(host, command, index, response)
+        if self.metrics is not None:
+            self.metrics.probe(time.monotonic() - sent if response is not None else None)
+        if response is not None and on_response:
+            try:
+                on_response(payload, response)
+            except Exception:
+                self.callback_errors += 1  # A bad reply must not abort the round
+        return command, payload, response
+
+    async def probe_round(self, targets, encode=None, on_response=None):
+        """Probe every due candidate of every {host: commands}; returns (command, payload, response) triples"""
+        semaphore = asyncio.Semaphore(self.in_flight)
+        tasks = [self._probe(host, command, index, semaphore, encode, on_response)
+                 for host, commands in targets.items()
+                 for command, index in self.candidates(host, commands)]
+        return await asyncio.gather(*tasks)
+
+    def discover(self, host, commands=IR_COMMANDS, encode=None, on_response=None):
+        """Blocking probe round against one device; returns the probes that got a reply"""
+        results = asyncio.run(self.probe_round({host: commands}, encode, on_response))
+        return [result for result in results if result[2] is not None]
+
+    def stats(self):
+        return {
+            'formats': {self.formats[index]: {'replies': replies, 'probes': probes}
+                        for index, (replies, probes) in self.format_stats.items()},
+            'backing_off': sum(1 for at in self.retry_at.values() if at > time.monotonic()),
+            'callback_errors': self.callback_errors
+        }
+
+
+def main():
+    """One discovery round: xiaomi_prober.py host"""
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} host")
+        sys.exit(1)
+    scheduler = ProbeScheduler()
+    start = time.monotonic()
+    replies = scheduler.discover(sys.argv[1])
+    for command, payload, response in replies:
+        print(f"📡 {payload.decode()} -> {response.hex()}")
+    print(f"📊 {len(replies)} replies in {time.monotonic() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Offline Replay
+Feeds recorded pcaps or the NDJSON/JSON traffic history through an analyzer's pipeline without a network
+Replays as fast as possible, or paced by the recorded timestamps at a configurable time scale
+Reports packets per second processed
+Learned data goes to a scratch directory (or --output DIR), never to the live monitors' files
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from xiaomi_conntrack import Connection
+from xiaomi_flowstore import parse_endpoint
+from xiaomi_pcap import IPPROTO_TCP, IPPROTO_UDP, Packet, read_pcap
+
+# Defaults
+DEFAULT_SPEED = 0.0   # 0 replays as fast as possible; 1.0 is real time, 10.0 ten times faster
+PCAP_EXTENSIONS = ('.pcap', '.pcapng', '.cap')
+
+
+def is_capture_file(path):
+    return path.lower().endswith(PCAP_EXTENSIONS)
+
+
+def entry_timestamp(entry):
+    """Epoch seconds of a traffic history entry"""
+    value = entry.get('timestamp')
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def read_traffic_history(path):
+    """Traffic entries from a JSON snapshot ({'traffic': [...]}) or an NDJSON file
+
+    NDJSON lines may be LearningStore journal records ({'s': 'traffic', 'a': entry})
+    or bare entries; other journal sections are skipped.
+    """
+    if path.endswith('.ndjson'):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 's' in record:
+                    if record['s'] == 'traffic' and 'a' in record:
+                        yield record['a']
+                elif isinstance(record, dict):
+                    yield record
+        return
+
+    with open(path, 'r') as f:
+        data = json.load(f)
+    entries = data.get('traffic', []) if isinstance(data, dict) else data
+    for entry in entries:
+        if isinstance(entry, dict):
+            yield entry
+    # A snapshot's journal holds the entries appended since it was written
+    journal = os.path.splitext(path)[0] + '.ndjson'
+    if os.path.exists(journal):
+        yield from read_traffic_history(journal)
+
+
+def entry_connection(entry):
+    """Connection for a traffic history entry (netstat 'ip.port' or 'ip:port' addresses)"""
+    local_ip, local_port = parse_endpoint(entry.get('local_addr', ''))
+    remote_ip, remote_port = parse_endpoint(entry.get('remote_addr', ''))
+    proto = 'udp' if 'udp' in str(entry.get('protocol', '')).lower() else 'tcp'
+    return Connection(proto, local_ip, local_port, remote_ip, remote_port,
+                      entry.get('state', ''), None, None, None, entry.get('process'))
+
+
+def entry_packet(entry):
+    """Payload-less Packet standing in for a traffic history entry"""
+    conn = entry_connection(entry)
+    proto = IPPROTO_UDP if conn.proto == 'udp' else IPPROTO_TCP
+    return Packet(entry_timestamp(entry), conn.local_ip, conn.remote_ip, proto,
+                  conn.local_port, conn.remote_port, 0, b'', 0)
+
+
+def packet_connection(packet):
+    """Connection as seen from the packet's sender"""
+    proto = 'udp' if packet.proto == IPPROTO_UDP else 'tcp'
+    return Connection(proto, packet.src_ip, packet.src_port, packet.dst_ip, packet.dst_port,
+                      'ESTABLISHED', None, None, None, None)
+
+
+def replay_packets(path):
+    """Packets from a capture file, or stand-ins from a traffic history"""
+    if is_capture_file(path):
+        return read_pcap(path)
+    return (entry_packet(entry) for entry in read_traffic_history(path))
+
+
+def replay_connections(path, host_filter=None):
+    """(ts, Connection) for every history entry, or for the first packet of each capture flow
+
+    host_filter (a conntrack HostFilter) keeps only what the live tracker would report.
+    """
+    if is_capture_file(path):
+        seen = set()
+        recorded = ((packet.ts, packet_connection(packet)) for packet in read_pcap(path))
+    else:
+        seen = None
+        recorded = ((entry_timestamp(entry), entry_connection(entry)) for entry in read_traffic_history(path))
+    for ts, conn in recorded:
+        if host_filter is not None and not host_filter.match(conn.local_ip, conn.remote_ip):
+            continue
+        if seen is not None:
+            if conn[:5] in seen:
+                continue
+            seen.add(conn[:5])
+        yield ts, conn
+
+
+class Replay:
+    """Drives a handler with recorded items, as fast as possible or scaled to their timestamps"""
+
+    def __init__(self, speed=DEFAULT_SPEED):
+        self.speed = speed
+        self.items = 0
+        self.elapsed = 0.0
+        self.recorded = 0.0   # seconds of recorded time covered
+
+    def run(self, items, handler, timestamp=lambda item: item.ts):
+        """Call handler(item) for each item; returns stats"""
+        start = time.monotonic()
+        first_ts = None
+        last_ts = None
+        for item in items:
+            ts = timestamp(item)
+            if first_ts is None:
+                first_ts = ts
+            last_ts = ts
+            if self.speed > 0:
+                delay = (ts - first_ts) / self.speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            handler(item)
+            self.items += 1
+        self.elapsed += time.monotonic() - start
+        if first_ts is not None:
+            self.recorded += last_ts - first_ts
+        return self.stats()
+
+    def stats(self):
+        return {
+            'packets': self.items,
+            'elapsed': round(self.elapsed, 3),
+            'recorded_seconds': round(self.recorded, 3),
+            'packets_per_second': round(self.items / self.elapsed) if self.elapsed else 0
+        }
+
+
+def format_stats(stats):
+    return (f"{stats['packets']} packets in {stats['elapsed']:.2f}s "
+            f"({stats['packets_per_second']} packets/s, {stats['recorded_seconds']:.0f}s recorded)")
+
+
+def replay_args(argv):
+    """Parse '--replay PATH [--speed X] [--device IP] [--output DIR]' from argv; None when not replaying"""
+    if '--replay' not in argv:
+        return None
+    options = {'path': None, 'speed': DEFAULT_SPEED, 'device': None, 'output': None}
+    args = iter(argv)
+    for arg in args:
+        if arg == '--replay':
+            options['path'] = next(args, None)
+        elif arg == '--speed':
+            options['speed'] = float(next(args, DEFAULT_SPEED))
+        elif arg == '--device':
+            options['device'] = next(args, None)
+        elif arg == '--output':
+            options['output'] = next(args, None)
+    if not options['path']:
+        print(f"Usage: {os.path.basename(sys.argv[0])} --replay capture.pcap|traffic.json "
+              f"[--speed X] [--device IP] [--output DIR]")
+        sys.exit(1)
+    if not options['output']:
+        options['output'] = tempfile.mkdtemp(prefix='xiaomi_replay_')
+    return options
+
+
+def replay_device(options):
+    """Device entry for an analyzer replaying with these options: --device IP, files under --output"""
+    device = {'data_dir': options['output']}
+    if options['device']:
+        device['ip'] = options['device']
+    return device
+
+
+def busiest_hosts(path, limit=3):
+    """The addresses that appear in the most packets of a recording, as [(ip, packets)]"""
+    counts = {}
+    for packet in replay_packets(path):
+        for ip in (packet.src_ip, packet.dst_ip):
+            counts[ip] = counts.get(ip, 0) + 1
+    return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+def main():
+    """Replay throughput of a source with a no-op handler: xiaomi_replay.py capture.pcap|traffic.json"""
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} capture.pcap|traffic.json [speed]")
+        sys.exit(1)
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_SPEED
+    stats = Replay(speed).run(replay_packets(sys.argv[1]), lambda packet: None)
+    print(f"📂 {format_stats(stats)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Analyzer Runtime
+Runs any number of analyzers for any number of devices in one process
+One scheduler and worker pool replace the per-analyzer polling threads; one capture, one connection tracker
+and one liveness monitor are shared by every component, with packets and events routed by device address
+Analyzers plug in as components whose stages (capture, liveness, portscan, persist, ...) are attach_<stage>() methods
+Which components run for which devices, with which stages, comes from a pipeline config file
+"""
+
+import heapq
+import importlib
+import itertools
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from xiaomi_capture import open_packet_stream
+from xiaomi_conntrack import ConnectionTracker, HostFilter
+from xiaomi_liveness import LivenessMonitor
+from xiaomi_logsink import get_sink
+from xiaomi_metrics import MonitorMetrics, serve_metrics
+
+# Defaults
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xiaomi_pipeline.json")
+DEFAULT_LOG_FILE = "xiaomi_runtime.log"
+DEFAULT_WORKERS = 4           # threads running scheduled tasks (scans, probes, saves)
+METRICS_PORT = 9482           # localhost metrics endpoint, None disables
+LIVENESS_INTERVAL = 10.0      # seconds between probe rounds over every watched device
+RECAPTURE_DELAY = 10.0        # seconds before reopening a capture that ended
+STATUS_INTERVAL = 60.0        # seconds between runtime status lines
+
+
+def instance_path(path, device=None):
+    """path with the device's 'files' tag before the extension, so two devices never share a file
+
+    A 'data_dir' entry moves the file into that directory (replay uses a scratch one).
+    """
+    device = device or {}
+    tag = device.get('files')
+    if tag:
+        root, ext = os.path.splitext(path)
+        path = f"{root}_{tag}{ext}"
+    data_dir = device.get('data_dir')
+    if data_dir:
+        os.makedirs(data_dir, exist_ok=True)
+        path = os.path.join(data_dir, os.path.basename(path))
+    return path
+
+
+class Task:
+    """A job run every interval seconds on the worker pool, never overlapping itself"""
+
+    __slots__ = ('label', 'function', 'interval', 'retry', 'when', 'runs', 'errors', 'cancelled')
+
+    def __init__(self, label, function, interval, retry=None, when=None):
+        self.label = label
+        self.function = function
+        self.interval = interval
+        self.retry = retry or interval
+        self.when = when
+        self.runs = 0
+        self.errors = 0
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class AnalyzerRuntime:
+    """Shared scheduler, sources, saves, signals and metrics for analyzer components
+
+    Components register their work through every(), on_save(), watch_packets(),
+    watch_connections() and watch_liveness() from their attach_<stage>() methods;
+    sources are opened by start(), so everything is registered before it runs.
+    """
+
+    def __init__(self, name='xiaomi_runtime', metrics_port=METRICS_PORT, workers=DEFAULT_WORKERS,
+                 interface='any', sudo=False, log=None, registry=None):
+        self.name = name
+        self.metrics_port = metrics_port
+        self.workers = workers
+        self.interface = interface
+        self.sudo = sudo
+        self.log = log or get_sink(DEFAULT_LOG_FILE).log
+        self.metrics = MonitorMetrics(name, registry)
+        self.registry = self.metrics.registry
+        self.metrics_server = None
+        self.components = []
+        self.tasks = []
+        self.tracker = None
+        self.liveness = None
+        self.running = False
+        self.capturing = False             # a packet stream is open right now
+        self.stats = {'packets': 0, 'routed': 0, 'handler_errors': 0, 'connection_events': 0,
+                      'tasks_run': 0, 'task_errors': 0, 'captures_opened': 0}
+
+        self._timers = []                  # heap of (due, sequence, task)
+        self._sequence = itertools.count()
+        self._wakeup = threading.Condition()
+        self._stopped = threading.Event()
+        self._executor = None
+        self._savers = []
+        self._files = {}                   # data file -> component writing it
+        self._routes = {}                  # ip -> [(peer, handler)]
+        self._stream = None
+        self._connection_hosts = []
+        self._connection_handlers = []     # [(HostFilter, handler)]
+        self._resolve_processes = False
+        self._liveness_listeners = {}      # ip -> [callback]
+
+        self.metrics.watch_queue('runtime_timers', lambda: len(self._timers))
+        self.metrics.watch_stats('xiaomi_runtime', lambda: self.stats, 'Analyzer runtime counters')
+        self.metrics.watch_stats('xiaomi_conntrack', lambda: self.tracker.stats if self.tracker else {},
+                                 'Connection tracker counters')
+
+    # Components
+
+    def add(self, component, stages=None):
+        """Attach the given stages of component (default: all of component.STAGES); returns it
+
+        Components keep their data file paths in *_file attributes; two components
+        writing the same file would corrupt it, so that is refused (log files may be shared).
+        """
+        stages = list(component.STAGES if stages is None else stages)
+        name = type(component).__name__
+        missing = [stage for stage in stages if not hasattr(component, f'attach_{stage}')]
+        if missing:
+            raise ValueError(f"{name} has no stage {', '.join(missing)}; available: {', '.join(component.STAGES)}")
+        files = {os.path.abspath(value) for key, value in vars(component).items()
+                 if key.endswith('_file') and key != 'log_file' and isinstance(value, str)}
+        clash = sorted(files & self._files.keys())
+        if clash:
+            raise ValueError(f"{name} and {self._files[clash[0]]} both write {clash[0]}; "
+                             f"give one of them a distinct 'files' tag")
+        self._files.update(dict.fromkeys(files, name))
+        for stage in stages:
+            getattr(component, f'attach_{stage}')(self)
+        attached = getattr(component, 'on_attached', None)
+        if attached is not None:
+            attached(self, stages)
+        self.components.append(component)
+        return component
+
+    # Scheduling
+
+    def every(self, interval, function, label, retry=None, when=None, delay=0.0):
+        """Run function() now (after delay) and then every interval seconds
+
+        An exception is logged and the next run waits retry seconds instead;
+        when() is checked at each due time and skips that run while it is false.
+        """
+        task = Task(label, function, interval, retry, when)
+        self.tasks.append(task)
+        self._schedule(task, delay)
+        return task
+
+    def on_save(self, save, interval, label='save'):
+        """Call save() every interval seconds and save(force=True) once when the runtime stops"""
+        self._savers.append((label, save))
+        return self.every(interval, save, label, delay=interval)
+
+    def _schedule(self, task, delay):
+        with self._wakeup:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._sequence), task))
+            self._wakeup.notify()
+
+    def _run_timers(self):
+        while True:
+            with self._wakeup:
+                while self.running:
+                    if self._timers:
+                        remaining = self._timers[0][0] - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._wakeup.wait(remaining)
+                    else:
+                        self._wakeup.wait()
+                if not self.running:
+                    return
+                _, _, task = heapq.heappop(self._timers)
+            if task.cancelled:
+                continue
+            if task.when is not None and not task.when():
+                self._schedule(task, task.interval)
+                continue
+            self._executor.submit(self._execute, task)
+
+    def _execute(self, task):
+        delay = task.interval
+        try:
+            task.function()
+        except Exception as e:
+            task.errors += 1
+            self.stats['task_errors'] += 1
+            self.metrics.errors.labels(task.label).inc()
+            self.log(f"Error in {task.label}: {e}")
+            delay = task.retry
+        task.runs += 1
+        self.stats['tasks_run'] += 1
+        if self.running and not task.cancelled:
+            self._schedule(task, delay)
+
+    # Shared sources
+
+    def watch_packets(self, ip, handler, peer=None):
+        """handler(packet) for every captured packet to or from ip (exchanged with peer, when given)"""
+        self._routes.setdefault(ip, []).append((peer, handler))
+
+    def watch_connections(self, hosts, handler, resolve_processes=False):
+        """handler(event) for every ConnectionEvent touching one of hosts (addresses or networks)"""
+        self._connection_hosts.extend(hosts)
+        self._connection_handlers.append((HostFilter(hosts), handler))
+        self._resolve_processes = self._resolve_processes or resolve_processes
+
+    def watch_liveness(self, ip, callback):
+        """callback(ip, online, rtt_ms) on online/offline transitions of ip"""
+        self._liveness_listeners.setdefault(ip, []).append(callback)
+
+    def capture_filter(self):
+        """One filter covering every watched device"""
+        return ' or '.join(f'host {ip}' for ip in sorted(self._routes))
+
+    def route_packet(self, packet):
+        """Hand packet to the handlers of its source and destination"""
+        self.stats['packets'] += 1
+        for ip, other in ((packet.src_ip, packet.dst_ip), (packet.dst_ip, packet.src_ip)):
+            for peer, handler in self._routes.get(ip, ()):
+                if peer is not None and peer != other:
+                    continue
+                self.stats['routed'] += 1
+                try:
+                    handler(packet)
+                except Exception as e:
+                    self.stats['handler_errors'] += 1
+                    self.log(f"Error handling packet {packet.src_ip} > {packet.dst_ip}: {e}")
+
+    def _capture_loop(self):
+        bpf_filter = self.capture_filter()
+        failure = None
+        while self.running:
+            try:
+                # Shared capture daemon if running, otherwise a private tcpdump pcap pipe
+                self._stream = open_packet_stream(bpf_filter, self.name, self.interface, self.sudo)
+            except Exception as e:
+                if str(e) != failure:
+                    self.log(f"⚠️ Capture unavailable ({bpf_filter}): {e}")
+                    failure = str(e)
+            else:
+                failure = None
+                self.stats['captures_opened'] += 1
+                self.capturing = True
+                try:
+                    for packet in self._stream:
+                        if not self.running:
+                            break
+                        self.route_packet(packet)
+                except Exception as e:
+                    self.log(f"Error in capture: {e}")
+                finally:
+                    self.capturing = False
+                    self._stream.close()
+            self._stopped.wait(RECAPTURE_DELAY)
+
+    def _on_connection(self, event):
+        self.stats['connection_events'] += 1
+        conn = event.connection
+        for host_filter, handler in self._connection_handlers:
+            if host_filter.match(conn.local_ip, conn.remote_ip):
+                handler(event)
+
+    def _on_liveness(self, ip, online, rtt):
+        for callback in self._liveness_listeners.get(ip, ()):
+            callback(ip, online, rtt)
+
+    # Lifecycle
+
+    def start(self):
+        """Open the shared sources and start the scheduler"""
+        if self.running:
+            return
+        self.running = True
+        self._stopped.clear()
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix=self.name)
+        if self._liveness_listeners:
+            self.liveness = LivenessMonitor(list(self._liveness_listeners))
+            self.liveness.add_listener(self._on_liveness)
+            self.every(LIVENESS_INTERVAL, self.liveness.probe_once, 'liveness')
+        if self._connection_handlers:
+            self.tracker = ConnectionTracker(self._connection_hosts, resolve_processes=self._resolve_processes)
+            self.tracker.add_listener(self._on_connection)
+            self.tracker.start()
+        if self._routes:
+            threading.Thread(target=self._capture_loop, name=f"{self.name}-capture", daemon=True).start()
+        threading.Thread(target=self._run_timers, name=f"{self.name}-scheduler", daemon=True).start()
+        self.metrics_server = serve_metrics(self.metrics, self.metrics_port, self.log)
+        self.log(f"⚙️ {len(self.components)} components, {len(self.tasks)} tasks, "
+                 f"{len(self._routes)} captured devices, {self.workers} workers")
+
+    def stop(self):
+        """Stop sources and scheduler, wait for running tasks, then force every save"""
+        if not self.running:
+            return
+        self.running = False
+        self._stopped.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        if self._stream is not None:
+            self._stream.close()
+        if self.tracker is not None:
+            self.tracker.stop()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        for label, save in self._savers:
+            try:
+                save(force=True)
+            except Exception as e:
+                self.log(f"Error in final {label}: {e}")
+        if self.liveness is not None:
+            self.liveness.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    def _on_signal(self, signum, frame):
+        self.log(f"Received signal {signum}, shutting down...")
+        self._stopped.set()
+
+    def run(self, status=None, status_interval=STATUS_INTERVAL):
+        """start(), call status() every status_interval seconds until SIGINT/SIGTERM, then stop()"""
+        handlers = {signum: signal.signal(signum, self._on_signal) for signum in (signal.SIGINT, signal.SIGTERM)}
+        self.start()
+        try:
+            while not self._stopped.wait(status_interval):
+                if status is not None:
+                    status()
+        except KeyboardInterrupt:
+            self.log("🛑 Stopped by user")
+        finally:
+            self.stop()
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def log_status(self):
+        failing = sum(1 for task in self.tasks if task.errors)
+        self.log(f"📊 Runtime: {self.stats['packets']} packets, {self.stats['connection_events']} connection events, "
+                 f"{self.stats['tasks_run']} task runs ({self.stats['task_errors']} errors, {failing} tasks failing)")
+
+
+def create_component(spec, device=None, registry=None):
+    """Instantiate 'module:Class' for a device"""
+    module_name, _, class_name = spec.partition(':')
+    if not class_name:
+        raise ValueError(f"Component '{spec}' must be 'module:Class'")
+    component_class = getattr(importlib.import_module(module_name), class_name)
+    return component_class(device=device, registry=registry)
+
+
+def load_pipeline(path=DEFAULT_CONFIG):
+    """Build a runtime and its components from a pipeline config file
+
+    {"devices": {name: {"ip", "port", "token", "phone_ip", "network", "files"}},
+     "pipelines": [{"component": "module:Class", "device": name, "stages": [...], "files"}],
+     "metrics_port", "workers", "interface", "sudo", "log_file"}
+
+    Each device's files are tagged with its name unless the device or the
+    pipeline sets "files" itself ("" keeps the analyzers' default file names).
+    """
+    with open(path) as f:
+        config = json.load(f)
+    runtime = AnalyzerRuntime(config.get('name', 'xiaomi_runtime'),
+                              config.get('metrics_port', METRICS_PORT),
+                              workers=config.get('workers', DEFAULT_WORKERS),
+                              interface=config.get('interface', 'any'),
+                              sudo=config.get('sudo', False),
+                              log=get_sink(config.get('log_file', DEFAULT_LOG_FILE)).log)
+    devices = config.get('devices', {})
+    for entry in config.get('pipelines', []):
+        spec = entry['component']
+        name = entry.get('device')
+        if name is not None and name not in devices:
+            raise ValueError(f"Pipeline {spec} names unknown device '{name}'")
+        device = dict(devices[name], name=name) if name is not None else {}
+        device['files'] = entry.get('files', device.get('files', name))
+        runtime.add(create_component(spec, device, runtime.registry), entry.get('stages'))
+    return runtime
+
+
+def main():
+    """Run every pipeline of a config file: xiaomi_runtime.py [config]"""
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CONFIG
+    if not os.path.exists(path):
+        print(f"Usage: xiaomi_runtime.py [config]  ({path} not found)")
+        sys.exit(1)
+    runtime = load_pipeline(path)
+    runtime.log(f"🚀 Starting {len(runtime.components)} analyzers from {path}")
+    runtime.log("🛑 Press Ctrl+C to stop")
+    runtime.run(status=runtime.log_status)
+    runtime.log("✅ Runtime stopped and data saved")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Sequence Miner
+Incremental n-gram counts of command/response event sequences in a prefix tree
+Each event updates at most max_order nodes, so mining stays O(1) per event
+Sequences whose count reaches a power of two are queued for reporting
+"""
+
+import heapq
+import json
+import sys
+import threading
+import time
+
+# Defaults
+DEFAULT_MAX_ORDER = 4        # longest sequence counted
+DEFAULT_MAX_GAP = 30.0       # seconds of silence that end a sequence
+DEFAULT_MAX_NODES = 50000    # prefix tree size that triggers pruning of rare sequences
+DEFAULT_MIN_SUPPORT = 2      # occurrences before a sequence is reported
+
+
+class SequenceNode:
+    """Prefix tree node: one event sequence and how often it occurred"""
+
+    __slots__ = ('symbol', 'parent', 'depth', 'count', 'children', 'gap_total', 'gap_min', 'gap_max')
+
+    def __init__(self, symbol=None, parent=None):
+        self.symbol = symbol
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.count = 0
+        self.children = {}
+        self.gap_total = 0.0    # gaps before this node's last event, summed over occurrences
+        self.gap_min = None
+        self.gap_max = 0.0
+
+    def sequence(self):
+        symbols = []
+        node = self
+        while node.parent is not None:
+            symbols.append(node.symbol)
+            node = node.parent
+        return tuple(reversed(symbols))
+
+    def summary(self):
+        """Sequence, count and the gap before its last event"""
+        result = {'sequence': list(self.sequence()), 'count': self.count}
+        if self.depth > 1:
+            result['gap_mean'] = round(self.gap_total / self.count, 3)
+            result['gap_min'] = round(self.gap_min, 3)
+            result['gap_max'] = round(self.gap_max, 3)
+        return result
+
+
+class SequenceMiner:
+    """Counts every event sequence of up to max_order events as the events arrive
+
+    The active list holds the nodes of the sequences ending at the latest event
+    (one per length); the next event only extends those, instead of re-walking
+    the history. A silence longer than max_gap starts a new session.
+    """
+
+    def __init__(self, max_order=DEFAULT_MAX_ORDER, max_gap=DEFAULT_MAX_GAP,
+                 max_nodes=DEFAULT_MAX_NODES, min_support=DEFAULT_MIN_SUPPORT):
+        self.max_order = max_order
+        self.max_gap = max_gap
+        self.max_nodes = max_nodes
+        self.min_support = min_support
+        self.root = SequenceNode()
+        self.nodes = 0
+        self.events = 0
+        self.sessions = 0
+        self.pruned = 0
+        self.last_ts = None
+        self._active = []
+        self._pending = {}   # node -> None, reported once per take_reports
+        self._lock = threading.Lock()
+
+    def add(self, symbol, ts=None):
+        """Record an event; returns the nodes of every sequence ending with it"""
+        ts = time.time() if ts is None else ts
+        with self._lock:
+            return self._add(symbol, ts)
+
+    def _add(self, symbol, ts):
+        gap = None
+        if self.last_ts is not None and 0 <= ts - self.last_ts <= self.max_gap:
+            gap = ts - self.last_ts
+        else:
+            self._active = []
+            self.sessions += 1
+        self.last_ts = ts
+        self.events += 1
+
+        active = [self._step(self.root, symbol, None)]
+        for node in self._active:
+            if node.depth < self.max_order:
+                active.append(self._step(node, symbol, gap))
+        self._active = active
+
+        if self.nodes > self.max_nodes:
+            self.prune()
+        return active
+
+    def _step(self, node, symbol, gap):
+        child = node.children.get(symbol)
+        if child is None:
+            child = SequenceNode(symbol, node)
+            node.children[symbol] = child
+            self.nodes += 1
+        child.count += 1
+        if gap is not None:
+            child.gap_total += gap
+            child.gap_min = gap if child.gap_min is None else min(child.gap_min, gap)
+            child.gap_max = max(child.gap_max, gap)
+        count = child.count
+        if count >= self.min_support and count & (count - 1) == 0 and child.depth > 1:
+            self._pending[child] = None
+        return child
+
+    def prune(self):
+        """Drop the rarest sequences until the tree is at half its limit; amortized over the inserts"""
+        threshold = 1
+        while self.nodes > self.max_nodes // 2:
+            removed = self._prune_below(self.root, threshold)
+            self.nodes -= removed
+            self.pruned += removed
+            threshold *= 2
+        self._active = []   # Active nodes may have been removed
+
+    def _prune_below(self, node, threshold):
+        removed = 0
+        for symbol, child in list(node.children.items()):
+            if child.count <= threshold:
+                removed += self._size(child)
+                del node.children[symbol]
+            else:
+                removed += self._prune_below(child, threshold)
+        return removed
+
+    def _size(self, node):
+        return 1 + sum(self._size(child) for child in node.children.values())
+
+    def take_reports(self):
+        """Sequences that reached a new power-of-two count since the last call"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            return [node.summary() for node in pending]
+
+    def _walk(self, min_length):
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            if node.depth >= min_length:
+                yield node
+            stack.extend(node.children.values())
+
+    def top(self, limit=20, min_length=2):
+        """Most frequent sequences of at least min_length events"""
+        with self._lock:
+            nodes = heapq.nlargest(limit, self._walk(min_length), key=lambda node: (node.count, node.depth))
+            return [node.summary() for node in nodes]
+
+    def count(self, sequence):
+        """Occurrences of an exact sequence"""
+        node = self.root
+        for symbol in sequence:
+            node = node.children.get(symbol)
+            if node is None:
+                return 0
+        return node.count
+
+    def successors(self, sequence, limit=5):
+        """Events most often seen right after a sequence, with their probability"""
+        node = self.root
+        for symbol in sequence:
+            node = node.children.get(symbol)
+            if node is None:
+                return []
+        total = sum(child.count for child in node.children.values())
+        children = heapq.nlargest(limit, node.children.values(), key=lambda child: child.count)
+        return [(child.symbol, round(child.count / total, 3)) for child in children]
+
+    def stats(self):
+        return {
+            'events': self.events,
+            'sessions': self.sessions,
+            'nodes': self.nodes,
+            'pruned': self.pruned
+        }
+
+
+def main():
+    """Mine an event log of JSON lines with 'symbol' and 'ts': xiaomi_sequences.py events.ndjson"""
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} events.ndjson")
+        sys.exit(1)
+    miner = SequenceMiner()
+    with open(sys.argv[1], 'r') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            miner.add(event['symbol'], event.get('ts'))
+    print(f"📊 {miner.stats()}")
+    for entry in miner.top():
+        print(f"{entry['count']:>7}  {' → '.join(entry['sequence'])}  (gap {entry.get('gap_mean')}s)")
+
+
+if __name__ == "__main__":
+    main()
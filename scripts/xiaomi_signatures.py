@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Command Signature Index
+Learned commands keyed by a normalized signature (kind, method, param shape, port, direction)
+Each signature keeps occurrence counts and first/last-seen times; a hash of the command
+content (method and params, or the body of a text command) answers "seen this exact
+command before?" in O(1), and only the newest MAX_HASHES are kept
+"""
+
+import hashlib
+import json
+import sys
+from datetime import datetime
+from itertools import islice
+
+from xiaomi_jsonscan import shape_of
+
+# Defaults
+HASH_SIZE = 16            # bytes of blake2b digest per observation
+SAMPLE_LIMIT = 200        # characters of text content kept as a sample
+MAX_HASHES = 20000        # content hashes kept; the oldest tenth goes when the cap is reached
+
+# Observation outcomes
+NEW_SIGNATURE = 'new_signature'   # first command with this signature
+NEW_CONTENT = 'new_content'       # known signature, content not seen before
+DUPLICATE = 'duplicate'           # exact repeat of an earlier observation
+MALFORMED = 'malformed'           # method is not a string (e.g. a list in a garbled payload)
+
+# Directions, relative to the device
+TO_DEVICE = 'to_device'
+FROM_DEVICE = 'from_device'
+UNKNOWN = 'unknown'
+
+
+def flow_direction(flow, device_ip):
+    """(device-side port, direction) for a (proto, src_ip, src_port, dst_ip, dst_port) flow"""
+    if flow is None:
+        return None, UNKNOWN
+    _, src_ip, src_port, dst_ip, dst_port = flow
+    if dst_ip == device_ip:
+        return dst_port, TO_DEVICE
+    if src_ip == device_ip:
+        return src_port, FROM_DEVICE
+    return dst_port, UNKNOWN
+
+
+def make_signature(kind, method, params_shape='', port=None, direction=UNKNOWN):
+    """Signature key, a string so it can key a JSON section"""
+    return f"{kind}|{method}|{params_shape}|{port if port is not None else '*'}|{direction}"
+
+
+def command_content(method, content, params=None):
+    """What identifies a command: method and params, or method and the body of a text command
+
+    Request ids, HTTP headers and whitespace change between otherwise identical
+    commands, so they are left out.
+    """
+    if params is not None:
+        return {'method': method, 'params': params}
+    if isinstance(content, dict):
+        return {key: value for key, value in content.items() if key != 'id'}
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', errors='ignore')
+    text = str(content)
+    for separator in ('\r\n\r\n', '\n\n'):
+        _, found, body = text.partition(separator)
+        if found:
+            text = body
+            break
+    return f"{method}\n{' '.join(text.split())}"
+
+
+def content_hash(content):
+    """Digest of a command's content; dicts are hashed canonically, without the request id"""
+    if isinstance(content, dict):
+        content = {key: value for key, value in content.items() if key != 'id'}
+        content = json.dumps(content, sort_keys=True, separators=(',', ':'), default=str)
+    if isinstance(content, str):
+        content = content.encode('utf-8', errors='ignore')
+    return hashlib.blake2b(content, digest_size=HASH_SIZE).hexdigest()
+
+
+def http_method(text):
+    """Normalized 'VERB /path' of an HTTP request, query string dropped"""
+    parts = text.split(None, 2)
+    if len(parts) < 2:
+        return text[:16]
+    return f"{parts[0]} {parts[1].split('?', 1)[0]}"
+
+
+class CommandIndex:
+    """Learned commands deduplicated by signature and content hash
+
+    entries maps signature -> entry dict and hashes maps content hash -> signature;
+    both may be persistent (e.g. LearningStore sections). Entries are reassigned,
+    never mutated in place, so journaled dicts record every change. hashes is
+    capped at max_hashes, dropping the oldest first.
+    """
+
+    def __init__(self, entries=None, hashes=None, max_hashes=MAX_HASHES):
+        self.entries = entries if entries is not None else {}
+        self.hashes = hashes if hashes is not None else {}
+        self.max_hashes = max_hashes
+        self.by_method = {}   # method -> set of signatures
+        for signature, entry in self.entries.items():
+            if isinstance(entry, dict) and 'signature' in entry and isinstance(entry.get('method'), str):
+                self.by_method.setdefault(entry['method'], set()).add(signature)
+        self._trim_hashes()
+
+    def __len__(self):
+        return sum(len(signatures) for signatures in self.by_method.values())
+
+    def __contains__(self, signature):
+        return signature in self.entries
+
+    def get(self, signature):
+        return self.entries.get(signature)
+
+    def seen(self, method, content, params=None):
+        """True if this exact command was observed before"""
+        return content_hash(command_content(method, content, params)) in self.hashes
+
+    def signatures_for(self, method):
+        """Every signature learned for a method"""
+        return sorted(self.by_method.get(method, ()))
+
+    def observe(self, kind, method, content, params=None, port=None, direction=UNKNOWN,
+                type_name=None, ts=None):
+        """Record one observation; returns (signature, entry, outcome)"""
+        if not isinstance(method, str):
+            return None, None, MALFORMED
+        params_shape = shape_of(params) if params is not None else ''
+        signature = make_signature(kind, method, params_shape, port, direction)
+        digest = content_hash(command_content(method, content, params))
+        timestamp = ts or datetime.now().isoformat()
+
+        entry = self.entries.get(signature)
+        if entry is None:
+            outcome = NEW_SIGNATURE
+            entry = {
+                'type': type_name or kind.upper(),
+                'signature': signature,
+                'method': method,
+                'params_shape': params_shape,
+                'port': port,
+                'direction': direction,
+                'count': 0,
+                'unique_count': 0,
+                'first_seen': timestamp
+            }
+            self.by_method.setdefault(method, set()).add(signature)
+        else:
+            entry = dict(entry)
+            outcome = DUPLICATE if digest in self.hashes else NEW_CONTENT
+
+        entry['count'] += 1
+        entry['last_seen'] = timestamp
+        if outcome != DUPLICATE:
+            entry['unique_count'] += 1
+            entry['sample'] = params if params is not None else str(content)[:SAMPLE_LIMIT]
+            self.hashes[digest] = signature
+            self._trim_hashes()
+        self.entries[signature] = entry
+        return signature, entry, outcome
+
+    def _trim_hashes(self):
+        """Drop the oldest tenth of the hashes once there are more than max_hashes"""
+        if self.max_hashes and len(self.hashes) > self.max_hashes:
+            excess = len(self.hashes) - self.max_hashes + self.max_hashes // 10
+            for digest in list(islice(self.hashes, excess)):
+                del self.hashes[digest]
+
+
+def main():
+    """Summarize a learned commands file: xiaomi_signatures.py xiaomi_discovered_commands.json"""
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} commands.json")
+        sys.exit(1)
+    with open(sys.argv[1], 'r') as f:
+        data = json.load(f)
+    index = CommandIndex(data.get('commands', {}), data.get('content_hashes', {}))
+    print(f"📊 {len(index)} signatures, {len(index.hashes)} distinct observations")
+    entries = sorted((entry for entry in index.entries.values() if 'signature' in entry),
+                     key=lambda entry: entry['count'], reverse=True)
+    for entry in entries:
+        print(f"{entry['count']:>7} {entry['unique_count']:>6}  {entry['signature']}")
+
+
+if __name__ == "__main__":
+    main()
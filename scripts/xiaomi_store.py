@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Xiaomi Learning Store
+Persists learned commands and traffic as an NDJSON journal of changes next to a JSON snapshot
+Saving appends only what changed since the last flush; the snapshot is rewritten
+(atomically, via rename) only when the journal is compacted
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+# Defaults
+DEFAULT_COMPACT_INTERVAL = 300.0   # seconds between snapshot rewrites while changes are pending
+DEFAULT_COMPACT_RECORDS = 5000     # journal records that force an early compaction
+JOURNAL_SEQ_KEY = 'journal_seq'
+
+
+def write_json_atomic(path, data, indent=None):
+    """Write JSON to a temp file, fsync it and rename it over path"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=indent, default=str)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class JournaledDict(dict):
+    """dict that remembers which keys changed since the last flush
+
+    Only item assignment is tracked; call touch(key) after mutating a value in place.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = set()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.dirty.add(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.dirty.add(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            self.dirty.add(key)
+        return super().pop(key, *default)
+
+    def clear(self):
+        self.dirty.update(self.keys())
+        super().clear()
+
+    def touch(self, key):
+        """Mark key as changed after an in-place mutation of its value"""
+        self.dirty.add(key)
+
+    def take_changes(self, section):
+        """Journal records for every changed key, resetting the dirty set"""
+        dirty, self.dirty = self.dirty, set()
+        records = []
+        for key in dirty:
+            if key in self:
+                records.append({'s': section, 'k': key, 'v': self[key]})
+            else:
+                records.append({'s': section, 'd': key})
+        return records
+
+
+class JournaledDeque(deque):
+    """Bounded deque that remembers entries appended since the last flush"""
+
+    def __init__(self, iterable=(), maxlen=None):
+        super().__init__(iterable, maxlen)
+        self.pending = []
+
+    def append(self, entry):
+        super().append(entry)
+        self.pending.append(entry)
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def take_changes(self, section):
+        """Journal records for every new entry (at most maxlen), resetting the backlog"""
+        pending = self.pending
+        if self.maxlen is not None and len(pending) > self.maxlen:
+            pending = pending[-self.maxlen:]
+        self.pending = []
+        return [{'s': section, 'a': entry} for entry in pending]
+
+
+class LearningStore:
+    """JSON snapshot plus an NDJSON journal of the changes made since it was written"""
+
+    def __init__(self, path, compact_interval=DEFAULT_COMPACT_INTERVAL,
+                 compact_records=DEFAULT_COMPACT_RECORDS):
+        self.path = path
+        self.journal_path = os.path.splitext(path)[0] + '.ndjson'
+        self.compact_interval = compact_interval
+        self.compact_records = compact_records
+        self.sections = {}
+        self.seq = 0
+        self.journal_records = 0
+        self.last_compact = time.monotonic()
+        self._snapshot = None
+        self._lock = threading.RLock()
+
+    def _load_snapshot(self):
+        if self._snapshot is None:
+            self._snapshot = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r') as f:
+                        data = json.load(f)
+                except ValueError:
+                    # Unreadable snapshot; the journal and the next compaction replace it
+                    data = None
+                if isinstance(data, dict):
+                    self._snapshot = data
+            self.seq = self._snapshot.get(JOURNAL_SEQ_KEY, 0)
+        return self._snapshot
+
+    def _journal(self):
+        """Journal records newer than the snapshot; a torn last line is ignored"""
+        base = self._load_snapshot().get(JOURNAL_SEQ_KEY, 0)
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('n', 0) > base:
+                    yield record
+
+    def _open(self, section, container):
+        replayed = 0
+        for record in self._journal():
+            self.seq = max(self.seq, record['n'])
+            if record.get('s') != section:
+                continue
+            replayed += 1
+            # Bypass change tracking; these records are already on disk
+            if 'a' in record:
+                deque.append(container, record['a'])
+            elif 'k' in record:
+                dict.__setitem__(container, record['k'], record['v'])
+            elif 'd' in record:
+                dict.pop(container, record['d'], None)
+        self.journal_records += replayed
+        self.sections[section] = container
+        return container
+
+    def open_dict(self, section):
+        """Keyed section (e.g. learned commands) loaded from snapshot and journal"""
+        with self._lock:
+            data = self._load_snapshot().get(section)
+            return self._open(section, JournaledDict(data if isinstance(data, dict) else {}))
+
+    def open_deque(self, section, maxlen=None):
+        """Append-only section (e.g. traffic) keeping the newest maxlen entries"""
+        with self._lock:
+            data = self._load_snapshot().get(section)
+            return self._open(section, JournaledDeque(data if isinstance(data, list) else (), maxlen))
+
+    def flush(self):
+        """Group-commit all pending changes as one append and fsync; returns the record count"""
+        with self._lock:
+            records = []
+            for section, container in self.sections.items():
+                records.extend(container.take_changes(section))
+            if not records:
+                return 0
+            lines = []
+            for record in records:
+                self.seq += 1
+                record['n'] = self.seq
+                lines.append(json.dumps(record, separators=(',', ':'), default=str))
+            with open(self.journal_path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal_records += len(records)
+            return len(records)
+
+    def compaction_due(self):
+        """True when the journal is large or has held changes for a full interval"""
+        if self.journal_records >= self.compact_records:
+            return True
+        return bool(self.journal_records) and time.monotonic() - self.last_compact >= self.compact_interval
+
+    def compact(self, header=None):
+        """Rewrite the snapshot from memory and truncate the journal
+
+        The snapshot records the last journal sequence number it contains, so a
+        crash between the rename and the truncate cannot replay records twice.
+        """
+        with self._lock:
+            for container in self.sections.values():
+                container.take_changes(None)
+            snapshot = dict(header or {})
+            for section, container in self.sections.items():
+                snapshot[section] = list(container) if isinstance(container, deque) else dict(container)
+            snapshot[JOURNAL_SEQ_KEY] = self.seq
+            write_json_atomic(self.path, snapshot)
+            self._snapshot = snapshot
+            with open(self.journal_path, 'w'):
+                pass
+            self.journal_records = 0
+            self.last_compact = time.monotonic()
+
+    def save(self, header=None, force=False):
+        """Flush the journal and compact when due (or when forced); returns True if compacted"""
+        with self._lock:
+            self.flush()
+            if force or self.compaction_due():
+                self.compact(header)
+                return True
+            return False
+
+
+def main():
+    """Compact a store: xiaomi_store.py snapshot.json"""
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} snapshot.json")
+        sys.exit(1)
+    store = LearningStore(sys.argv[1])
+    snapshot = store._load_snapshot()
+    header = {key: value for key, value in snapshot.items()
+              if not isinstance(value, (dict, list)) and key != JOURNAL_SEQ_KEY}
+    for section, value in list(snapshot.items()):
+        if isinstance(value, dict):
+            store.open_dict(section)
+        elif isinstance(value, list):
+            store.open_deque(section)
+    pending = store.journal_records
+    store.compact(header)
+    print(f"💾 Compacted {pending} journal records into {store.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,285 +5,168 @@ Monitors network traffic to capture commands sent to Xiaomi device
 Works by monitoring network traffic regardless of device status
 """
 
-import subprocess
-import json
-import time
-import re
-import threading
-import signal
 import sys
-import os
 from datetime import datetime
 from collections import defaultdict, deque
 
+from xiaomi_conntrack import CLOSED, NEW, HostFilter, format_connection
+from xiaomi_flowstore import FLOW_DIR, get_store
+from xiaomi_logsink import close_sink, get_sink
+from xiaomi_metrics import MonitorMetrics
+from xiaomi_replay import Replay, format_stats, replay_args, replay_device, replay_connections
+from xiaomi_runtime import AnalyzerRuntime, instance_path
+from xiaomi_store import LearningStore
+
 # Configuration
 XIAOMI_IP = "192.168.68.68"
+XIAOMI_NETWORK = "192.168.68.0/24"
 LOG_FILE = "xiaomi_traffic_monitor.log"
 COMMANDS_FILE = "xiaomi_captured_commands.json"
 TRAFFIC_FILE = "xiaomi_network_traffic.json"
+METRICS_PORT = 9479  # localhost metrics endpoint, None disables
 
 class XiaomiTrafficMonitor:
-    def __init__(self):
-        self.xiaomi_ip = XIAOMI_IP
-        self.log_file = LOG_FILE
-        self.commands_file = COMMANDS_FILE
-        self.traffic_file = TRAFFIC_FILE
+    STAGES = ('connections', 'persist', 'status')
+
+    def __init__(self, device=None, registry=None):
+        device = device or {}
+        self.xiaomi_ip = device.get('ip', XIAOMI_IP)
+        self.network = device.get('network', XIAOMI_NETWORK)
+        self.log_file = instance_path(LOG_FILE, device)
+        self.log_sink = get_sink(self.log_file)
+        self.commands_file = instance_path(COMMANDS_FILE, device)
+        self.traffic_file = instance_path(TRAFFIC_FILE, device)
         
         # Data structures
+        self.commands_store = LearningStore(self.commands_file)
+        self.traffic_store = LearningStore(self.traffic_file)
+        self.flow_store = get_store(instance_path(FLOW_DIR, device))
+        self.host_filter = HostFilter([self.network])
+        self.metrics = MonitorMetrics('traffic_monitor', registry, instance=device.get('name'))
         self.captured_commands = {}
         self.network_traffic = deque(maxlen=2000)
         self.command_patterns = defaultdict(int)
         self.traffic_monitoring = False
         
         # State
-        self.running = False
-        self.monitor_threads = []
         self.start_time = datetime.now()
         
         # Load existing data
         self.load_existing_data()
-        
-        # Setup signal handlers
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGTERM, self.signal_handler)
+        self.metrics.watch_queue('traffic_unsaved', lambda: len(self.network_traffic.pending))
     
     def load_existing_data(self):
         """Load existing captured data"""
         try:
-            if os.path.exists(self.commands_file):
-                with open(self.commands_file, 'r') as f:
-                    data = json.load(f)
-                    if 'commands' in data:
-                        self.captured_commands = data['commands']
-                    self.log_message(f"📚 Loaded {len(self.captured_commands)} existing commands")
+            self.captured_commands = self.commands_store.open_dict('commands')
+            self.log_message(f"📚 Loaded {len(self.captured_commands)} existing commands")
             
-            if os.path.exists(self.traffic_file):
-                with open(self.traffic_file, 'r') as f:
-                    data = json.load(f)
-                    if 'traffic' in data:
-                        for entry in data['traffic']:
-                            self.network_traffic.append(entry)
-                    self.log_message(f"📊 Loaded {len(self.network_traffic)} traffic entries")
+            self.network_traffic = self.traffic_store.open_deque('traffic', maxlen=2000)
+            self.log_message(f"📊 Loaded {len(self.network_traffic)} traffic entries")
             
             self.log_message("✅ Existing data loaded successfully")
         except Exception as e:
             self.log_message(f"⚠️ Could not load existing data: {e}")
     
-    def signal_handler(self, signum, frame):
-        """Handle shutdown signals gracefully"""
-        self.log_message(f"Received signal {signum}, shutting down...")
-        self.running = False
-        self.save_all_data()
-        sys.exit(0)
-    
     def log_message(self, message):
-        """Log message with timestamp"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        print(log_entry)
-        
-        with open(self.log_file, 'a') as f:
-            f.write(log_entry + '\n')
+        """Log message with timestamp; queued and written in batches by the shared log sink"""
+        self.log_sink.log(message)
     
-    def get_network_interfaces(self):
-        """Get available network interfaces"""
-        try:
-            result = subprocess.run(['ifconfig'], capture_output=True, text=True)
-            interfaces = []
-            for line in result.stdout.split('\n'):
-                if line.startswith('en') and 'inet' in line:
-                    interface = line.split(':')[0]
-                    interfaces.append(interface)
-            
-            if not interfaces:
-                interfaces = ['en0', 'en1']  # Default interfaces
-            
-            return interfaces
-        except Exception as e:
-            self.log_message(f"Error getting interfaces: {e}")
-            return ['en0', 'en1']
+    def close(self):
+        """Write out and release the log sink"""
+        close_sink(self.log_file)
     
-    def start_traffic_monitoring(self):
-        """Start monitoring network traffic"""
+    def attach_connections(self, runtime):
+        """Track connections in the Xiaomi network, with their owning processes"""
+        runtime.watch_connections(
+            [self.network], lambda event: self.metrics.process(self.on_connection_event, event, event.ts),
+            resolve_processes=True)
+        self.traffic_monitoring = True
+        self.log_message(f"🌐 Tracking connections in {self.network}")
+    
+    def attach_persist(self, runtime):
+        runtime.on_save(self.save_all_data, 30, 'data save')
+    
+    def attach_status(self, runtime):
+        runtime.every(60, self.log_status, 'status')
+    
+    def log_status(self):
+        self.log_message(f"📊 Status: {len(self.captured_commands)} commands captured, {len(self.network_traffic)} traffic entries")
+    
+    def on_connection_event(self, event):
+        """Handle a new, changed or closed connection from the tracker"""
+        conn = event.connection
+        self.analyze_connection(conn, event.kind)
+        
+        # Connections to the device owned by a local process (what lsof used to report)
+        if event.kind == NEW and conn.process and self.xiaomi_ip in (conn.local_ip, conn.remote_ip):
+            self.analyze_process_connection(conn)
+    
+    def analyze_connection(self, conn, event_kind):
+        """Analyze network connection for Xiaomi commands"""
         try:
-            self.log_message("🌐 Starting network traffic monitoring...")
+            local_addr = f"{conn.local_ip}:{conn.local_port}"
+            remote_addr = f"{conn.remote_ip}:{conn.remote_port}"
+            state = 'CLOSED' if event_kind == CLOSED else (conn.state or 'unknown')
+            self.metrics.classified('connection', event_kind)
             
-            interfaces = self.get_network_interfaces()
-            self.log_message(f"📡 Monitoring interfaces: {interfaces}")
-            
-            # Start monitoring each interface
-            for interface in interfaces:
-                thread = threading.Thread(target=self.monitor_interface, 
-                                        args=(interface,), daemon=True)
-                thread.start()
-                self.monitor_threads.append(thread)
+            # Record the connection
+            traffic_entry = {
+                'timestamp': datetime.now().isoformat(),
+                'local_addr': local_addr,
+                'remote_addr': remote_addr,
+                'state': state,
+                'event': event_kind,
+                'type': 'netstat_connection',
+                'source': 'conntrack'
+            }
             
-            # Start netstat monitoring
-            netstat_thread = threading.Thread(target=self.monitor_netstat, daemon=True)
-            netstat_thread.start()
-            self.monitor_threads.append(netstat_thread)
+            self.network_traffic.append(traffic_entry)
+            self.flow_store.add(traffic_entry['timestamp'], conn.local_ip, conn.local_port,
+                                conn.remote_ip, conn.remote_port, state, 'netstat_connection')
             
-            # Start lsof monitoring
-            lsof_thread = threading.Thread(target=self.monitor_lsof, daemon=True)
-            lsof_thread.start()
-            self.monitor_threads.append(lsof_thread)
+            if event_kind == CLOSED:
+                self.log_message(f"🔌 Connection closed: {local_addr} -> {remote_addr}")
+                return
             
-            self.traffic_monitoring = True
-            self.log_message("✅ Traffic monitoring started")
+            # Learn from the connection
+            self.learn_from_connection(format_connection(conn), traffic_entry)
             
+            self.log_message(f"📡 Captured connection: {local_addr} -> {remote_addr} ({state})")
+                
         except Exception as e:
-            self.log_message(f"Error starting traffic monitoring: {e}")
+            self.metrics.errors.labels('analyze_connection').inc()
+            self.log_message(f"Error analyzing connection: {e}")
     
-    def monitor_interface(self, interface):
-        """Monitor traffic on specific interface"""
+    def analyze_process_connection(self, conn):
+        """Analyze a process-owned connection for Xiaomi commands"""
         try:
-            self.log_message(f"📊 Monitoring traffic on {interface}")
+            name = f"{conn.local_ip}:{conn.local_port}->{conn.remote_ip}:{conn.remote_port}"
             
-            while self.running:
-                try:
-                    # Use netstat to monitor connections
-                    result = subprocess.run(['netstat', '-an'], capture_output=True, text=True)
-                    connections = result.stdout
-                    
-                    # Look for connections to Xiaomi IP
-                    xiaomi_connections = []
-                    for line in connections.split('\n'):
-                        if self.xiaomi_ip in line:
-                            xiaomi_connections.append(line)
-                            self.analyze_connection(line)
-                    
-                    if xiaomi_connections:
-                        self.log_message(f"🔍 Found {len(xiaomi_connections)} connections to {self.xiaomi_ip}")
-                    
-                    time.sleep(2)  # Check every 2 seconds
-                    
-                except Exception as e:
-                    self.log_message(f"Error monitoring {interface}: {e}")
-                    time.sleep(5)
-                    
-        except Exception as e:
-            self.log_message(f"Error in interface monitoring: {e}")
-    
-    def monitor_netstat(self):
-        """Monitor netstat for Xiaomi connections"""
-        try:
-            self.log_message("📊 Starting netstat monitoring...")
+            # Record the connection
+            traffic_entry = {
+                'timestamp': datetime.now().isoformat(),
+                'process': conn.process,
+                'pid': str(conn.pid),
+                'user': str(conn.uid),
+                'type': conn.proto,
+                'node': str(conn.inode),
+                'name': name,
+                'state': conn.state,
+                'source': 'conntrack'
+            }
             
-            while self.running:
-                try:
-                    # Get all connections
-                    result = subprocess.run(['netstat', '-an'], capture_output=True, text=True)
-                    connections = result.stdout
-                    
-                    # Look for Xiaomi-related connections
-                    for line in connections.split('\n'):
-                        if self.xiaomi_ip in line or '192.168.68' in line:
-                            self.analyze_connection(line)
-                    
-                    time.sleep(3)  # Check every 3 seconds
-                    
-                except Exception as e:
-                    self.log_message(f"Error in netstat monitoring: {e}")
-                    time.sleep(10)
-                    
-        except Exception as e:
-            self.log_message(f"Error in netstat monitoring: {e}")
-    
-    def monitor_lsof(self):
-        """Monitor lsof for network connections"""
-        try:
-            self.log_message("📊 Starting lsof monitoring...")
+            self.network_traffic.append(traffic_entry)
+            self.flow_store.add(traffic_entry['timestamp'], conn.local_ip, conn.local_port,
+                                conn.remote_ip, conn.remote_port, conn.state, 'lsof_connection')
             
-            while self.running:
-                try:
-                    # Get network connections
-                    result = subprocess.run(['lsof', '-i'], capture_output=True, text=True)
-                    connections = result.stdout
-                    
-                    # Look for Xiaomi connections
-                    for line in connections.split('\n'):
-                        if self.xiaomi_ip in line:
-                            self.analyze_lsof_connection(line)
-                    
-                    time.sleep(5)  # Check every 5 seconds
-                    
-                except Exception as e:
-                    self.log_message(f"Error in lsof monitoring: {e}")
-                    time.sleep(10)
-                    
-        except Exception as e:
-            self.log_message(f"Error in lsof monitoring: {e}")
-    
-    def analyze_connection(self, connection):
-        """Analyze network connection for Xiaomi commands"""
-        try:
-            # Extract connection info
-            parts = connection.split()
-            if len(parts) >= 4:
-                local_addr = parts[3]
-                remote_addr = parts[4]
-                state = parts[5] if len(parts) > 5 else 'unknown'
-                
-                # Record the connection
-                traffic_entry = {
-                    'timestamp': datetime.now().isoformat(),
-                    'local_addr': local_addr,
-                    'remote_addr': remote_addr,
-                    'state': state,
-                    'type': 'netstat_connection',
-                    'source': 'netstat'
-                }
-                
-                self.network_traffic.append(traffic_entry)
-                
-                # Learn from the connection
-                self.learn_from_connection(connection, traffic_entry)
-                
-                self.log_message(f"📡 Captured connection: {local_addr} -> {remote_addr} ({state})")
-                
-        except Exception as e:
-            self.log_message(f"Error analyzing connection: {e}")
-    
-    def analyze_lsof_connection(self, connection):
-        """Analyze lsof connection for Xiaomi commands"""
-        try:
-            # Extract connection info from lsof
-            parts = connection.split()
-            if len(parts) >= 9:
-                process = parts[0]
-                pid = parts[1]
-                user = parts[2]
-                fd = parts[3]
-                type_info = parts[4]
-                device = parts[5]
-                size = parts[6]
-                node = parts[7]
-                name = parts[8]
-                
-                # Record the connection
-                traffic_entry = {
-                    'timestamp': datetime.now().isoformat(),
-                    'process': process,
-                    'pid': pid,
-                    'user': user,
-                    'fd': fd,
-                    'type': type_info,
-                    'device': device,
-                    'size': size,
-                    'node': node,
-                    'name': name,
-                    'source': 'lsof'
-                }
-                
-                self.network_traffic.append(traffic_entry)
-                
-                # Learn from the connection
-                self.learn_from_lsof_connection(connection, traffic_entry)
-                
-                self.log_message(f"📱 Captured process connection: {process} ({pid}) -> {name}")
+            # Learn from the connection
+            self.learn_from_lsof_connection(format_connection(conn), traffic_entry)
+            
+            self.log_message(f"📱 Captured process connection: {conn.process} ({conn.pid}) -> {name}")
                 
         except Exception as e:
-            self.log_message(f"Error analyzing lsof connection: {e}")
+            self.log_message(f"Error analyzing process connection: {e}")
     
     def learn_from_connection(self, connection, traffic_entry):
         """Learn from network connection"""
@@ -347,46 +230,45 @@ class XiaomiTrafficMonitor:
         except Exception as e:
             self.log_message(f"Error learning from lsof connection: {e}")
     
-    def continuous_data_saving(self):
-        """Continuously save data"""
-        while self.running:
+    def save_all_data(self, force=False):
+        """Journal new captured data; snapshots are rewritten only when compacting"""
+        with self.metrics.save_seconds.time():
             try:
-                self.save_all_data()
-                time.sleep(30)  # Save every 30 seconds
+                # Save captured commands
+                commands_header = {
+                    'status': 'monitoring',
+                    'total_commands_captured': len(self.captured_commands),
+                    'last_update': datetime.now().isoformat(),
+                    'command_patterns': dict(self.command_patterns)
+                }
+                compacted = self.commands_store.save(commands_header, force=force)
+                
+                # Save network traffic
+                traffic_header = {
+                    'status': 'monitoring',
+                    'total_traffic_entries': len(self.network_traffic),
+                    'last_update': datetime.now().isoformat()
+                }
+                compacted = self.traffic_store.save(traffic_header, force=force) or compacted
+                self.flow_store.flush()
+                
+                if compacted:
+                    self.log_message(f"💾 Data saved: {len(self.captured_commands)} commands, {len(self.network_traffic)} traffic entries")
+                
             except Exception as e:
                 self.log_message(f"Error saving data: {e}")
-                time.sleep(60)
     
-    def save_all_data(self):
-        """Save all captured data"""
+    def run_replay(self, path, speed=0.0):
+        """Feed recorded connections (traffic history or capture flows) through the tracker handler"""
+        self.log_message(f"📂 Replaying {path} for {self.xiaomi_ip}")
         try:
-            # Save captured commands
-            commands_data = {
-                'status': 'monitoring',
-                'total_commands_captured': len(self.captured_commands),
-                'last_update': datetime.now().isoformat(),
-                'commands': self.captured_commands,
-                'command_patterns': dict(self.command_patterns)
-            }
-            
-            with open(self.commands_file, 'w') as f:
-                json.dump(commands_data, f, indent=2)
-            
-            # Save network traffic
-            traffic_data = {
-                'status': 'monitoring',
-                'total_traffic_entries': len(self.network_traffic),
-                'last_update': datetime.now().isoformat(),
-                'traffic': list(self.network_traffic)
-            }
-            
-            with open(self.traffic_file, 'w') as f:
-                json.dump(traffic_data, f, indent=2)
-            
-            self.log_message(f"💾 Data saved: {len(self.captured_commands)} commands, {len(self.network_traffic)} traffic entries")
-            
-        except Exception as e:
-            self.log_message(f"Error saving data: {e}")
+            stats = Replay(speed).run(replay_connections(path, self.host_filter),
+                                      lambda item: self.analyze_connection(item[1], NEW),
+                                      timestamp=lambda item: item[0])
+            self.log_message(f"📂 Replayed {path}: {format_stats(stats)}")
+            return stats
+        finally:
+            self.save_all_data(force=True)
     
     def run_continuous_monitoring(self):
         """Run continuous traffic monitoring"""
@@ -396,33 +278,27 @@ class XiaomiTrafficMonitor:
         self.log_message("📊 Will capture all network traffic to Xiaomi device")
         self.log_message("🛑 Press Ctrl+C to stop")
         
-        self.running = True
-        
-        # Start traffic monitoring
-        self.start_traffic_monitoring()
-        
-        # Start data saving thread
-        saver_thread = threading.Thread(target=self.continuous_data_saving, daemon=True)
-        saver_thread.start()
-        self.monitor_threads.append(saver_thread)
-        
+        # Several devices or analyzers in one process: xiaomi_runtime.py with a pipeline file
+        runtime = AnalyzerRuntime('traffic_monitor', METRICS_PORT, log=self.log_message, registry=self.metrics.registry)
+        runtime.add(self)
         try:
-            while self.running:
-                # Show status every minute
-                self.log_message(f"📊 Status: {len(self.captured_commands)} commands captured, {len(self.network_traffic)} traffic entries")
-                time.sleep(60)
-                
-        except KeyboardInterrupt:
-            self.log_message("🛑 Monitoring stopped by user")
+            runtime.run()
         except Exception as e:
             self.log_message(f"❌ Monitoring error: {e}")
-        finally:
-            self.running = False
-            self.save_all_data()
-            self.log_message("✅ Monitoring completed and data saved")
+        self.log_message("✅ Monitoring completed and data saved")
 
 def main():
     """Main function"""
+    replay = replay_args(sys.argv[1:])
+    if replay:
+        # Replayed data never mixes with what the live monitor has learned
+        monitor = XiaomiTrafficMonitor(replay_device(replay))
+        try:
+            monitor.run_replay(replay['path'], replay['speed'])
+            monitor.log_message(f"📁 Replay results in {replay['output']}")
+        finally:
+            monitor.close()
+        return
     monitor = XiaomiTrafficMonitor()
     monitor.run_continuous_monitoring()
 
@@ -9,8 +9,18 @@ import requests
 import time
 import json
 import socket
+import sys
+import os
 from datetime import datetime
 
+# Shared LAN discovery engine lives with the Xiaomi scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from xiaomi_discovery import sweep_subnet
+from xiaomi_inventory import load_inventory
+
+# Passive inventory kept by xiaomi_inventory.py (mDNS/SSDP/DHCP); empty when it isn't running
+inventory = load_inventory()
+
 def log(message):
     """Log with timestamp"""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -42,27 +52,39 @@ def scan_for_camera(network):
     
     found_cameras = []
     
-    for i in range(1, 255):
-        ip = f"{network}{i}"
-        try:
-            # Quick ping test
-            result = subprocess.run(['ping', '-c', '1', '-W', '1000', ip], 
-                                  capture_output=True, text=True, timeout=2)
-            if result.returncode == 0:
-                log(f"📱 Found device at {ip}")
-                
-                # Try to identify as DCS-8000LH
-                if is_dcs_camera(ip):
-                    found_cameras.append(ip)
-                    log(f"✅ DCS-8000LH camera found at {ip}")
-                    
-        except Exception:
-            continue
+    # Cameras already identified from their DHCP/mDNS traffic need no probing at all
+    for device in inventory.refresh().find():
+        if is_dcs_device(device):
+            found_cameras.append(device.ip)
+            log(f"✅ DCS-8000LH camera found at {device.ip} (passive: {', '.join(sorted(device.sources))})")
+    if found_cameras:
+        return found_cameras
+    
+    # Probe the whole subnet concurrently (RTSP port included in the TCP fallback)
+    devices = sweep_subnet(network, tcp_ports=(80, 554, 443, 8080))
+    for ip in devices:
+        log(f"📱 Found device at {ip}")
+        
+        # Try to identify as DCS-8000LH
+        if is_dcs_camera(ip):
+            found_cameras.append(ip)
+            log(f"✅ DCS-8000LH camera found at {ip}")
     
     return found_cameras
 
+def is_dcs_device(device):
+    """Whether an inventory entry looks like a DCS camera: D-Link OUI, DCS hostname or an RTSP service"""
+    hostname = (device.hostname or '').lower()
+    return ('d-link' in (device.vendor or '').lower() or hostname.startswith('dcs') or
+            '_rtsp._tcp' in device.services)
+
 def is_dcs_camera(ip):
     """Check if device is DCS-8000LH camera"""
+    # Answer from the passive inventory when it knows the device's vendor
+    device = inventory.refresh().get(ip)
+    if device is not None and (is_dcs_device(device) or device.vendor):
+        return is_dcs_device(device)
+    
     try:
         # Try HTTP connection
         response = requests.get(f"http://{ip}", timeout=3)